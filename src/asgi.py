@@ -0,0 +1,112 @@
+# asgi.py
+"""
+Entry point ASGI, accanto all'app Flask di main.py.
+
+Le richieste /generate_quiz restano in attesa sull'event loop durante la chiamata LLM,
+quindi un singolo processo regge centinaia di richieste in volo.
+Avvio (dalla cartella src/):
+    uvicorn asgi:app --host 0.0.0.0 --port 5051
+In produzione con più worker: SAGE_SERVER=asgi gunicorn -c gunicorn.conf.py (vedi serve.py).
+"""
+
+import json
+
+from services.quiz_generator import agenerate_quiz_from_data
+from services.metrics import render_prometheus
+from services.deadline import deadline_from_header, DEADLINE_STATUS
+from services.single_flight import COALESCE_GENERATION, acoalesced_generate
+from services.health import liveness, readiness, record_memory
+from services.log import configure_logging
+
+configure_logging()
+
+
+async def _read_body(receive):
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            return body
+
+
+async def _respond(send, status, body, content_type="application/json"):
+    if isinstance(body, str):
+        body = body.encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [
+            (b"content-type", content_type.encode("latin-1")),
+            (b"content-length", str(len(body)).encode("latin-1")),
+        ],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+def _json(payload):
+    return json.dumps(payload, ensure_ascii=False)
+
+
+def _header(scope, name):
+    name = name.lower().encode("latin-1")
+    for key, value in scope.get("headers", []):
+        if key.lower() == name:
+            return value.decode("latin-1")
+    return None
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    path = scope["path"]
+    method = scope["method"]
+
+    if path == "/generate_quiz" and method == "POST":
+        # il budget parte all'arrivo della richiesta, prima della lettura del body
+        deadline = deadline_from_header(_header(scope, "X-Request-Timeout"))
+        try:
+            data = json.loads(await _read_body(receive) or b"null")
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            await _respond(send, 400, _json({"status": 4, "data": {}}))
+            return
+
+        data["llmProvider"] = data.get("llmProvider", "groq")
+        if COALESCE_GENERATION:
+            quiz = await acoalesced_generate(data, agenerate_quiz_from_data, deadline)
+        else:
+            quiz = await agenerate_quiz_from_data(data, deadline=deadline)
+        await _respond(send, 504 if quiz["status"] == DEADLINE_STATUS else 200, _json(quiz))
+        return
+
+    if path == "/healthz" and method == "GET":
+        await _respond(send, 200, _json(liveness()))
+        return
+
+    if path == "/readyz" and method == "GET":
+        ready, detail = readiness()
+        await _respond(send, 200 if ready else 503, _json(detail))
+        return
+
+    if path == "/metrics" and method == "GET":
+        record_memory()
+        await _respond(send, 200, render_prometheus(), "text/plain; version=0.0.4")
+        return
+
+    await _respond(send, 404, _json({"error": "not found"}))
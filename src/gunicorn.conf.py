@@ -0,0 +1,32 @@
+# gunicorn.conf.py
+# Configurazione di produzione (vedi serve.py). Avvio dalla cartella src/:
+#     gunicorn -c gunicorn.conf.py
+
+import os
+
+SERVER = os.getenv("SAGE_SERVER", "wsgi")
+
+bind = os.getenv("SAGE_BIND", "0.0.0.0:5050")
+# con più worker la coda dei job è su SQLite (SAGE_JOB_DB o jobs.SHARED_JOB_DB), condivisa
+workers = int(os.getenv("SAGE_WORKERS", "2"))
+# L'app (modello di embedding compreso) si carica una volta nel master e i worker la condividono
+preload_app = True
+wsgi_app = "serve:create_app()"
+
+if SERVER == "asgi":
+    worker_class = "uvicorn.workers.UvicornWorker"
+else:
+    # le richieste aspettano soprattutto l'LLM: thread per worker invece di più processi
+    worker_class = "gthread"
+    threads = int(os.getenv("SAGE_THREADS", "8"))
+
+# oltre il budget di una richiesta (SAGE_REQUEST_TIMEOUT) con margine
+timeout = int(float(os.getenv("SAGE_REQUEST_TIMEOUT", "30"))) + 30
+graceful_timeout = 30
+keepalive = 5
+
+
+def post_fork(server, worker):
+    from serve import post_fork as init_worker
+    # numero effettivo di worker: comprende l'override da riga di comando (-w/--workers)
+    init_worker(server.cfg.workers)
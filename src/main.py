@@ -1,9 +1,38 @@
-from flask import Flask, request, jsonify, render_template
-from services.quiz_generator import generate_quiz_from_data
+from flask import Flask, Response, request, jsonify, render_template, stream_with_context
+from services.quiz_generator import generate_quiz_from_data, generate_quiz_batch
+from services.quiz_bank import QUIZ_BANK_ENABLED, get_or_generate
+from services.metrics import render_prometheus
+from services.deadline import deadline_from_header, DEADLINE_STATUS
+from services.single_flight import COALESCE_GENERATION, coalesced_generate
+from services.jobs import get_job_queue, public_view, QueueFull
+from services.batch import parse_batch, run_batch, BatchError
+from services.health import liveness, readiness, record_memory
+from services.log import configure_logging
 import json
 
+configure_logging()
 app = Flask(__name__)
 
+def _deadline():
+    # Budget di tempo della richiesta: header X-Request-Timeout (secondi) o SAGE_REQUEST_TIMEOUT
+    return deadline_from_header(request.headers.get("X-Request-Timeout"))
+
+def _http_status(result):
+    # deadline scaduto → 504, così proxy e client distinguono il timeout dagli altri esiti
+    return 504 if result["status"] == DEADLINE_STATUS else 200
+
+def _live(payload, deadline=None):
+    # Con SAGE_COALESCE=generation le richieste identiche concorrenti condividono la generazione
+    if COALESCE_GENERATION:
+        return coalesced_generate(payload, generate_quiz_from_data, deadline)
+    return generate_quiz_from_data(payload, deadline=deadline)
+
+def _generate(payload, deadline):
+    # Con SAGE_QUIZ_BANK=1 si serve dallo stock pre-generato, la generazione live è il fallback
+    if QUIZ_BANK_ENABLED:
+        return get_or_generate(payload, _live, deadline=deadline)
+    return _live(payload, deadline)
+
 @app.route("/generate_quiz", methods=["GET", "POST"])
 def quiz_form():
     if request.method == "POST":
@@ -11,8 +40,8 @@ def quiz_form():
             # Richiesta JSON (es. Postman)
             data = request.get_json()
             data["llmProvider"] = data.get("llmProvider", "groq")
-            quiz = generate_quiz_from_data(data)
-            return jsonify(quiz)
+            quiz = _generate(data, _deadline())
+            return jsonify(quiz), _http_status(quiz)
 
         try:
             # Richiesta da browser (form)
@@ -28,7 +57,7 @@ def quiz_form():
             error_json = json.dumps({"status": 4, "data": {}}, indent=4, ensure_ascii=False)
             return render_template("form.html", result=error_json)
 
-        quiz = generate_quiz_from_data(payload)
+        quiz = _generate(payload, _deadline())
         # Qui lo trasformo in stringa JSON formattata
         quiz_json = json.dumps(quiz, indent=4, ensure_ascii=False)
         return render_template("form.html", result=quiz_json)
@@ -36,5 +65,81 @@ def quiz_form():
     # GET → pagina vuota
     return render_template("form.html", result=None)
 
+@app.route("/generate_quiz_set", methods=["POST"])
+def quiz_set():
+    # N quiz sullo stesso argomento: un solo retrieval e un solo contesto inviato al modello
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": 4, "data": [], "errors": []}), 400
+    data["llmProvider"] = data.get("llmProvider", "groq")
+    result = generate_quiz_batch(data, deadline=_deadline())
+    return jsonify(result), _http_status(result)
+
+@app.route("/generate_quiz/batch", methods=["POST"])
+def quiz_batch():
+    # Array di richieste: un risultato NDJSON per elemento, appena pronto (ordine di completamento)
+    try:
+        valid, invalid = parse_batch(request.get_json(silent=True))
+    except BatchError as e:
+        return jsonify({"error": str(e)}), 400
+    timeout = request.headers.get("X-Request-Timeout")
+    results = run_batch(valid, invalid, _generate, lambda: deadline_from_header(timeout))
+    lines = (json.dumps(result, ensure_ascii=False) + "\n" for result in results)
+    return Response(stream_with_context(lines), mimetype="application/x-ndjson")
+
+@app.route("/jobs", methods=["POST"])
+def submit_job():
+    # Job asincrono: risposta immediata con l'id, risultato via polling o SSE
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({"status": 4, "data": {}}), 400
+    data["llmProvider"] = data.get("llmProvider", "groq")
+    try:
+        job = get_job_queue(_generate).submit(data)
+    except QueueFull as e:
+        # coda piena: rifiuto immediato invece di rallentare tutti
+        return jsonify({"error": "queue full"}), 429, {"Retry-After": str(e.retry_after)}
+    return jsonify(public_view(job)), 202, {"Location": f"/jobs/{job['id']}"}
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def job_status(job_id):
+    job = get_job_queue(_generate).get(job_id)
+    if job is None:
+        return jsonify({"error": "not found"}), 404
+    return jsonify(public_view(job))
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    jobs = get_job_queue(_generate)
+    if jobs.get(job_id) is None:
+        return jsonify({"error": "not found"}), 404
+
+    def events():
+        # un evento per cambio di stato (queued → running → done/failed), commento come keep-alive
+        for job in jobs.watch(job_id):
+            if job is None:
+                yield ": keep-alive\n\n"
+                continue
+            yield f"event: {job['status']}\ndata: {json.dumps(public_view(job), ensure_ascii=False)}\n\n"
+
+    return Response(stream_with_context(events()), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    # liveness: il processo risponde
+    return jsonify(liveness())
+
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    # readiness: modello, indice e schemi caricati
+    ready, detail = readiness()
+    return jsonify(detail), 200 if ready else 503
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    # Formato testo Prometheus (latenze per fase, status 1/2/3/4, memoria del worker)
+    record_memory()
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
 if __name__ == "__main__":
     app.run(host='0.0.0.0', port=5050, debug=False)
@@ -0,0 +1,306 @@
+# src/rag_tools/chunk_store.py
+"""
+Chunk store colonnare: sostituisce i file JSONL per fonte in data/chunks/.
+
+Layout (una cartella, pochi file letti in memory-map; `path` è un link alla versione
+corrente in {path}.versions/, sostituito atomicamente a ogni scrittura):
+    manifest.json     numero di chunk e dizionari dei metadati (valori distinti per colonna)
+    text.bin          testi UTF-8 concatenati
+    text_offsets.npy  int64, n+1 offset in byte: il testo i è text.bin[off[i]:off[i+1]]
+    ids.bin / ids_offsets.npy   id dei chunk, stesso schema
+    meta.npy          int32 (n, colonne): codice nel dizionario di ogni metadato
+I metadati ripetuti in ogni record JSONL (fonte, titolo, materia, ...) diventano un intero
+per colonna; leggere un batch è uno slice degli array, senza json.loads per riga.
+
+Il chunker e la pipeline scrivono con update() (sostituisce i chunk delle fonti indicate,
+nuova versione + swap del link, lock per più processi); embed e pool leggono con ChunkStore.
+Export/import JSONL per debug e per migrare i vecchi data/chunks/:
+    python -m rag_tools.chunk_store export ../data/chunk_store ../data/chunks_jsonl
+    python -m rag_tools.chunk_store import ../data/chunks ../data/chunk_store
+"""
+
+import os
+import sys
+import json
+import mmap
+import fcntl
+import shutil
+import argparse
+import contextlib
+from pathlib import Path
+from typing import Any, Callable, Dict, Iterable, Iterator, List
+
+import numpy as np
+
+FORMAT_VERSION = 1
+MANIFEST = "manifest.json"
+META_COLUMNS = ("source_id", "title", "subject", "classe", "anno", "created_at")
+
+
+def is_store(path) -> bool:
+    return (Path(path) / MANIFEST).is_file()
+
+
+class _Writer:
+    """
+    Scrive le colonne di uno store nuovo in `directory`: record (da codificare) o righe di
+    uno store esistente, copiate come byte e codici senza decodificare testi e metadati.
+    """
+
+    def __init__(self, directory: Path):
+        self.directory = directory
+        self.dictionaries = {col: [] for col in META_COLUMNS}
+        self._lookup = {col: {} for col in META_COLUMNS}
+        self._files = {name: open(directory / f"{name}.bin", "wb") for name in ("text", "ids")}
+        self._lengths = {name: [] for name in ("text", "ids")}
+        self._codes = []
+
+    def _code(self, col: str, value) -> int:
+        # chiave con il tipo: anno=3 e anno="3" restano valori distinti
+        key = (type(value).__name__, value)
+        code = self._lookup[col].get(key)
+        if code is None:
+            code = self._lookup[col][key] = len(self.dictionaries[col])
+            self.dictionaries[col].append(value)
+        return code
+
+    def _write_strings(self, name: str, values: List[str]):
+        encoded = [v.encode("utf-8") for v in values]
+        self._files[name].write(b"".join(encoded))
+        self._lengths[name].append(np.array([len(b) for b in encoded], dtype=np.int64))
+
+    def add_records(self, records: List[Dict[str, Any]]):
+        self._write_strings("text", [r["text"] for r in records])
+        self._write_strings("ids", [r.get("chunk_id") or r.get("id") for r in records])
+        codes = [[self._code(col, r.get("metadata", {}).get(col, "")) for col in META_COLUMNS] for r in records]
+        self._codes.append(np.array(codes, dtype=np.int32).reshape(len(records), len(META_COLUMNS)))
+
+    def copy_rows(self, store: "ChunkStore", rows: np.ndarray):
+        if not len(rows):
+            return
+        codes = np.array(store.codes[rows], dtype=np.int32)
+        for j, col in enumerate(META_COLUMNS):
+            # nel dizionario nuovo entrano solo i valori ancora usati
+            used = np.unique(codes[:, j])
+            remap = np.zeros(len(store.dictionaries[col]), dtype=np.int32)
+            remap[used] = [self._code(col, store.dictionaries[col][u]) for u in used]
+            codes[:, j] = remap[codes[:, j]]
+        self._codes.append(codes)
+        for name, column in (("text", store.texts), ("ids", store.ids)):
+            self._lengths[name].append(column.copy_rows(rows, self._files[name]))
+
+    def finish(self):
+        for name, f in self._files.items():
+            f.close()
+            lengths = np.concatenate(self._lengths[name]) if self._lengths[name] else np.zeros(0, dtype=np.int64)
+            offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+            np.cumsum(lengths, out=offsets[1:])
+            np.save(self.directory / f"{name}_offsets.npy", offsets)
+        codes = np.concatenate(self._codes) if self._codes else np.zeros((0, len(META_COLUMNS)), dtype=np.int32)
+        np.save(self.directory / "meta.npy", codes)
+        with open(self.directory / MANIFEST, "w", encoding="utf-8") as f:
+            json.dump({"format": FORMAT_VERSION, "count": len(codes), "columns": self.dictionaries}, f, ensure_ascii=False)
+
+
+def _versions_dir(path: Path) -> Path:
+    return path.with_name(f"{path.name}.versions")
+
+
+def _write(path: Path, fill: Callable[[_Writer], None]):
+    """
+    Scrive lo store in una versione nuova e ci sposta sopra il link `path` con os.replace
+    (atomico): in ogni istante `path` punta a uno store completo, anche per gli altri processi.
+    """
+    versions = _versions_dir(path)
+    versions.mkdir(parents=True, exist_ok=True)
+    existing = sorted(int(p.name) for p in versions.iterdir() if p.name.isdigit())
+    previous = str(existing[-1]) if existing else None
+    name = str(existing[-1] + 1) if existing else "1"
+    directory = versions / name
+    shutil.rmtree(directory, ignore_errors=True)
+    directory.mkdir()
+    try:
+        writer = _Writer(directory)
+        fill(writer)
+        writer.finish()
+    except BaseException:
+        shutil.rmtree(directory, ignore_errors=True)
+        raise
+
+    if path.exists() and not path.is_symlink():
+        # cartella del formato precedente: migrazione una tantum (unico momento senza store)
+        os.replace(path, versions / "0")
+    link = path.with_name(f"{path.name}.link-{os.getpid()}")
+    with contextlib.suppress(FileNotFoundError):
+        os.unlink(link)
+    os.symlink(os.path.join(versions.name, name), link)
+    os.replace(link, path)
+
+    # resta anche la versione precedente: un lettore può aver risolto il link senza aver ancora
+    # aperto i file; chi li ha già in memory-map continua a leggerli anche dopo la rimozione
+    for old in versions.iterdir():
+        if old.name not in (name, previous):
+            shutil.rmtree(old, ignore_errors=True)
+
+
+@contextlib.contextmanager
+def _locked(path: Path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path.with_name(f"{path.name}.lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def write_store(path, records: Iterable[Dict[str, Any]]):
+    """Scrive da zero uno store con `records` (formato dei vecchi JSONL: id, text, metadata)."""
+    path = Path(path)
+    with _locked(path):
+        _write(path, lambda writer: writer.add_records(list(records)))
+
+
+def update(path, by_source: Dict[str, List[Dict[str, Any]]]):
+    """
+    Sostituisce i chunk delle fonti in `by_source` (lista vuota = fonte rimossa), tiene le altre.
+    Le righe tenute si copiano a blocchi dai file dello store attuale, senza decodificarle.
+    """
+    path = Path(path)
+
+    def fill(writer: _Writer):
+        if is_store(path):
+            with ChunkStore(path) as store:
+                sources = store.codes[:, META_COLUMNS.index("source_id")]
+                replaced = [code for code, s in enumerate(store.dictionaries["source_id"]) if s in by_source]
+                writer.copy_rows(store, np.flatnonzero(~np.isin(sources, replaced)))
+        for records in by_source.values():
+            writer.add_records(records)
+
+    with _locked(path):
+        _write(path, fill)
+
+
+class _StringColumn:
+    def __init__(self, directory: Path, name: str):
+        self.offsets = np.load(directory / f"{name}_offsets.npy", mmap_mode="r")
+        self._file = open(directory / f"{name}.bin", "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        # mmap di un file vuoto non è permesso
+        self.blob = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __getitem__(self, i: int) -> str:
+        return self.blob[self.offsets[i]:self.offsets[i + 1]].decode("utf-8")
+
+    def copy_rows(self, rows: np.ndarray, out) -> np.ndarray:
+        """Scrive in `out` i byte delle righe `rows`, un blocco per tratto contiguo; ritorna le lunghezze."""
+        starts, ends = self.offsets[rows], self.offsets[rows + 1]
+        breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+        for a, b in zip(np.r_[0, breaks], np.r_[breaks, len(rows)]):
+            out.write(self.blob[starts[a]:ends[b - 1]])
+        return np.asarray(ends - starts, dtype=np.int64)
+
+    def close(self):
+        if isinstance(self.blob, mmap.mmap):
+            self.blob.close()
+        self._file.close()
+
+
+class ChunkStore:
+    """Lettura in memory-map: solo gli offset e i codici dei chunk usati finiscono in memoria."""
+
+    def __init__(self, path):
+        # si risolve il link una volta: tutte le colonne vengono dalla stessa versione
+        self.path = Path(path).resolve()
+        with open(self.path / MANIFEST, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("format") != FORMAT_VERSION:
+            raise ValueError(f"Formato del chunk store non supportato: {manifest.get('format')}")
+        self.count = manifest["count"]
+        self.dictionaries = manifest["columns"]
+        self.texts = _StringColumn(self.path, "text")
+        self.ids = _StringColumn(self.path, "ids")
+        self.codes = np.load(self.path / "meta.npy", mmap_mode="r")
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.texts.close()
+        self.ids.close()
+
+    def metadata(self, i: int) -> Dict[str, Any]:
+        row = self.codes[i]
+        return {col: self.dictionaries[col][row[j]] for j, col in enumerate(META_COLUMNS)}
+
+    def record(self, i: int) -> Dict[str, Any]:
+        return {"id": self.ids[i], "text": self.texts[i], "metadata": self.metadata(i)}
+
+    def records(self, rows: Iterable[int] = None) -> Iterator[Dict[str, Any]]:
+        for i in range(self.count) if rows is None else rows:
+            yield self.record(int(i))
+
+    def batches(self, size: int) -> Iterator[List[Dict[str, Any]]]:
+        for start in range(0, self.count, size):
+            yield list(self.records(range(start, min(start + size, self.count))))
+
+    def sources(self) -> List[str]:
+        return list(self.dictionaries["source_id"])
+
+    def rows_of(self, source_id: str) -> np.ndarray:
+        """Indici dei chunk di una fonte (confronto sui codici, senza decodificare i testi)."""
+        try:
+            code = self.dictionaries["source_id"].index(source_id)
+        except ValueError:
+            return np.zeros(0, dtype=np.int64)
+        return np.flatnonzero(self.codes[:, META_COLUMNS.index("source_id")] == code)
+
+
+# ---------------- export/import JSONL ----------------
+
+def export_jsonl(store_path, out_dir) -> int:
+    """Un file {source_id}.jsonl per fonte, come il vecchio data/chunks/. Ritorna i chunk scritti."""
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with ChunkStore(store_path) as store:
+        for source_id in store.sources():
+            with open(out_dir / f"{source_id}.jsonl", "w", encoding="utf-8") as f:
+                for record in store.records(store.rows_of(source_id)):
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        return len(store)
+
+
+def import_jsonl(chunks_dir, store_path) -> int:
+    records = []
+    for path in sorted(Path(chunks_dir).glob("*.jsonl")):
+        with open(path, "r", encoding="utf-8") as f:
+            records += [json.loads(line) for line in f if line.strip()]
+    write_store(store_path, records)
+    return len(records)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export/import JSONL del chunk store")
+    sub = parser.add_subparsers(dest="command", required=True)
+    exp = sub.add_parser("export", help="store → un JSONL per fonte (debug)")
+    exp.add_argument("store")
+    exp.add_argument("out_dir")
+    imp = sub.add_parser("import", help="cartella di JSONL → store")
+    imp.add_argument("chunks_dir")
+    imp.add_argument("store")
+    args = parser.parse_args(argv)
+
+    if args.command == "export":
+        print(f"Chunk esportati: {export_jsonl(args.store, args.out_dir)}")
+    else:
+        print(f"Chunk importati: {import_jsonl(args.chunks_dir, args.store)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,20 @@
 import os
+import sys
 import json
 import re
 from pathlib import Path
 from datetime import datetime
 from typing import List, Dict
 
-SOURCE_INDEX_PATH = "../../data/fonte_index.json"
-CLEANED_DIR       = Path("../../data/cleaned")
-CHUNK_DIR         = Path("../../data/chunks")
+# src/ nel path anche lanciando lo script da src/rag_tools
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from rag_tools import chunk_store
+
+# data/ nella radice del repository, da qualunque cartella si lanci lo script
+DATA_DIR          = Path(__file__).resolve().parent.parent.parent / "data"
+SOURCE_INDEX_PATH = str(DATA_DIR / "fonte_index.json")
+CLEANED_DIR       = DATA_DIR / "cleaned"
+CHUNK_DIR         = DATA_DIR / "chunk_store"
 
 CHUNK_SIZE_WORDS = 500
 OVERLAP_WORDS    = 50
@@ -36,7 +43,7 @@ def split_text_into_chunks(text: str, size: int = CHUNK_SIZE_WORDS, overlap: int
 
 def chunk_all_sources():
     index = load_source_index()
-    CHUNK_DIR.mkdir(parents=True, exist_ok=True)
+    by_source = {}
 
     for txt_file in CLEANED_DIR.glob("*.txt"):
         source_id = txt_file.stem
@@ -48,25 +55,29 @@ def chunk_all_sources():
             raw_text = fp.read()
 
         chunks = split_text_into_chunks(raw_text)
+        # un timestamp per fonte: nel chunk store è un solo valore nel dizionario
+        created_at = datetime.now().isoformat()
 
-        out_path = CHUNK_DIR / f"{source_id}.jsonl"
-        with open(out_path, "w", encoding="utf-8") as fp:
-            for i, chunk in enumerate(chunks):
-                record = {
-                    "id": f"{source_id}_{i}",
-                    "text": chunk,
-                    "metadata": {
-                        "source_id": source_id,
-                        "title": meta["titolo"],
-                        "subject": meta["materia"],
-                        "classe": meta["classe"],
-                        "anno": meta["anno"],
-                        "created_at": datetime.now().isoformat()
-                    }
+        by_source[source_id] = [
+            {
+                "id": f"{source_id}_{i}",
+                "text": chunk,
+                "metadata": {
+                    "source_id": source_id,
+                    "title": meta["titolo"],
+                    "subject": meta["materia"],
+                    "classe": meta["classe"],
+                    "anno": meta["anno"],
+                    "created_at": created_at
                 }
-                fp.write(json.dumps(record, ensure_ascii=False) + "\n")
+            }
+            for i, chunk in enumerate(chunks)
+        ]
+        print(f"   ➜ {len(chunks)} chunks")
 
-        print(f"   ➜ {len(chunks)} chunks → {out_path}")
+    # una sola scrittura dello store per tutte le fonti
+    chunk_store.update(CHUNK_DIR, by_source)
+    print(f"Chunk store aggiornato: {CHUNK_DIR}")
 
 if __name__ == "__main__":
     chunk_all_sources()
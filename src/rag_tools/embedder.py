@@ -1,17 +1,35 @@
-# src/RAG-Tools/embedder.py
-import os
+# src/rag_tools/embedder.py
+"""
+Embedding dei chunk nell'indice Chroma (dal chunk store, vedi chunk_store).
+
+  - embed_all: indicizza tutti i chunk; con fresh=True in una versione nuova, pubblicata
+    solo dopo la validazione (services/index_versions);
+  - sync_all: sync incrementale, riscrive solo i chunk con hash cambiato (HASH_KEY);
+  - precompute_pools: pool di candidati precalcolati per il servizio (services/candidate_pools).
+I percorsi di default sono quelli di chunker.py e pipeline.py (data/ nella radice del
+repository), da qualunque cartella si lanci lo script.
+"""
+
 import json
+import hashlib
 import argparse
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
+from typing import List, Dict, Any, Iterator, Tuple
 
 from chromadb import PersistentClient
 from sentence_transformers import SentenceTransformer
 
-CHROMA_DIR = "../data/chroma_db"
-CHUNKS_DIR = "../data/chunks"
+from rag_tools.chunk_store import ChunkStore, is_store
+
+DATA_DIR = Path(__file__).resolve().parent.parent.parent / "data"
+CHROMA_DIR = str(DATA_DIR / "chroma_db")
+# Chunk store colonnare (vedi chunk_store); una cartella di JSONL per fonte è ancora accettata
+CHUNKS_DIR = str(DATA_DIR / "chunk_store")
 COLLECTION_NAME = "educational_chunks"
 BATCH_SIZE = 100
+POOLS_PATH = str(DATA_DIR / "candidate_pools.json")
+# Hash di testo + metadati salvato in ogni chunk: il sync riscrive solo i chunk cambiati
+HASH_KEY = "content_hash"
 
 
 def get_model() -> SentenceTransformer:
@@ -24,6 +42,9 @@ def get_collection(chroma_dir: str = CHROMA_DIR, name: str = COLLECTION_NAME):
 
 
 def load_chunks(chunks_dir: str = CHUNKS_DIR) -> List[Dict[str, Any]]:
+    if is_store(chunks_dir):
+        with ChunkStore(chunks_dir) as store:
+            return list(store.records())
     all_chunks: List[Dict[str, Any]] = []
     for path in Path(chunks_dir).glob("*.jsonl"):
         with open(path, "r", encoding="utf-8") as f:
@@ -32,6 +53,32 @@ def load_chunks(chunks_dir: str = CHUNKS_DIR) -> List[Dict[str, Any]]:
     return all_chunks
 
 
+def iter_chunk_batches(chunks_dir: str = CHUNKS_DIR, batch_size: int = BATCH_SIZE) -> Iterator[List[Dict[str, Any]]]:
+    """Chunk a batch: dallo store si decodifica un batch alla volta dal memory-map."""
+    if is_store(chunks_dir):
+        with ChunkStore(chunks_dir) as store:
+            yield from store.batches(batch_size)
+    else:
+        yield from batch_iter(load_chunks(chunks_dir), batch_size)
+
+
+def load_source_chunks(source_id: str, chunks_dir: str = CHUNKS_DIR) -> List[Dict[str, Any]]:
+    """
+    Chunk di una fonte; [] se la fonte non c'è più. Uno store mancante è un errore, non
+    "nessun chunk": il sync cancellerebbe dall'indice la fonte.
+    """
+    if is_store(chunks_dir):
+        with ChunkStore(chunks_dir) as store:
+            return list(store.records(store.rows_of(source_id)))
+    if not Path(chunks_dir).is_dir():
+        raise FileNotFoundError(f"Chunk store non trovato: {chunks_dir}")
+    path = Path(chunks_dir) / f"{source_id}.jsonl"
+    if not path.exists():
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
 def clean_metadata(meta: Dict[str, Any]) -> Dict[str, Any]:
     return {
         "source_id": meta.get("source_id", ""),
@@ -48,6 +95,20 @@ def batch_iter(lst: List[Any], size: int) -> List[List[Any]]:
         yield lst[i:i + size]
 
 
+def chunk_hash(text: str, metadata: Dict[str, Any]) -> str:
+    # created_at cambia a ogni chunking anche se il contenuto è identico: non conta
+    stable = {k: v for k, v in metadata.items() if k not in ("created_at", HASH_KEY)}
+    payload = json.dumps([text, stable], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+def chunk_record(chunk: Dict[str, Any]) -> Tuple[str, str, Dict[str, Any]]:
+    """(id, testo, metadati puliti con l'hash del contenuto) di un chunk letto dal JSONL."""
+    meta = clean_metadata(chunk.get("metadata", {}))
+    meta[HASH_KEY] = chunk_hash(chunk["text"], meta)
+    return chunk.get("chunk_id") or chunk.get("id"), chunk["text"], meta
+
+
 def embed_all(
     fresh: bool = False,
     chroma_dir: str = CHROMA_DIR,
@@ -57,40 +118,173 @@ def embed_all(
 ) -> Tuple[int, int]:
     """
     Ritorna (num_chunks_totali, num_documenti_in_collection_dopo).
+    Con fresh=True l'indice si ricostruisce in una versione nuova (shadow, vedi
+    services/index_versions): il servizio continua a leggere la versione attiva finché
+    la nuova non è validata e pubblicata con lo swap atomico dell'alias.
     """
-    # init
-    if fresh and os.path.exists(chroma_dir):
-        # reset directory
-        import shutil
-        shutil.rmtree(chroma_dir)
+    from services import index_versions
+    from services.candidate_pools import write_index_version
 
-    model = get_model()
-    collection = get_collection(chroma_dir, collection_name)
+    if fresh:
+        version, target_dir = index_versions.new_version(chroma_dir)
+    else:
+        version, target_dir = None, index_versions.index_dir(chroma_dir)
 
-    chunks = load_chunks(chunks_dir)
-    total = len(chunks)
+    try:
+        model = get_model()
+        collection = get_collection(target_dir, collection_name)
 
-    for batch in batch_iter(chunks, batch_size):
-        texts = [c["text"] for c in batch]
-        ids = [c.get("chunk_id") or c.get("id") for c in batch]
-        metadatas = [clean_metadata(c.get("metadata", {})) for c in batch]
-        embeddings = model.encode(texts, convert_to_numpy=True).tolist()
-        collection.add(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+        total = 0
+        samples = []
 
-    try:
-        count = collection.count()
-    except Exception:
-        count = -1
+        for batch in iter_chunk_batches(chunks_dir, batch_size):
+            total += len(batch)
+            ids, texts, metadatas = (list(col) for col in zip(*map(chunk_record, batch)))
+            embeddings = model.encode(texts, convert_to_numpy=True).tolist()
+            collection.add(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+            # un chunk per batch come query di prova della versione nuova
+            samples.append((ids[0], embeddings[0]))
+
+        if version is not None:
+            step = max(1, len(samples) // index_versions.VALIDATION_SAMPLES)
+            index_versions.validate_index(collection, total, samples[::step][:index_versions.VALIDATION_SAMPLES])
+            count = total
+        else:
+            try:
+                count = collection.count()
+            except Exception:
+                count = -1
+
+        # Nuova versione dell'indice: invalida i pool precalcolati
+        write_index_version(target_dir)
+    except BaseException:
+        if version is not None:
+            index_versions.discard(chroma_dir, version)
+        raise
+
+    if version is not None:
+        index_versions.publish(chroma_dir, version)
+        index_versions.collect_garbage(chroma_dir)
     return total, count
 
 
+def stored_hashes(collection, source_id: str) -> Dict[str, Any]:
+    """{id: hash del contenuto} dei chunk di una fonte già nello store."""
+    got = collection.get(where={"source_id": source_id}, include=["metadatas"])
+    return {
+        chunk_id: (meta or {}).get(HASH_KEY)
+        for chunk_id, meta in zip(got.get("ids") or [], got.get("metadatas") or [])
+    }
+
+
+def sync_source(collection, model, source_id: str, chunks: List[Dict[str, Any]], batch_size: int = BATCH_SIZE) -> Dict[str, int]:
+    """
+    Allinea lo store ai chunk attuali di una fonte: cancella gli id spariti (es. fonte più corta
+    dopo il re-chunking), fa upsert solo dei chunk nuovi o con contenuto cambiato.
+    Si calcolano gli embedding solo per questi, quindi il costo è proporzionale al delta.
+    Con chunks vuoto la fonte viene tolta dallo store.
+    """
+    stored = stored_hashes(collection, source_id)
+    records = [chunk_record(c) for c in chunks]
+    current_ids = {chunk_id for chunk_id, _, _ in records}
+
+    changed = [r for r in records if stored.get(r[0]) != r[2][HASH_KEY]]
+    stale = [chunk_id for chunk_id in stored if chunk_id not in current_ids]
+
+    for batch in batch_iter(stale, batch_size):
+        collection.delete(ids=batch)
+    for batch in batch_iter(changed, batch_size):
+        ids, texts, metadatas = (list(col) for col in zip(*batch))
+        embeddings = model.encode(texts, convert_to_numpy=True).tolist()
+        collection.upsert(ids=ids, embeddings=embeddings, documents=texts, metadatas=metadatas)
+
+    updated = sum(1 for chunk_id, _, _ in changed if chunk_id in stored)
+    return {
+        "added": len(changed) - updated,
+        "updated": updated,
+        "deleted": len(stale),
+        "unchanged": len(records) - len(changed),
+    }
+
+
+def sync_all(
+    sources: List[str] = None,
+    chroma_dir: str = CHROMA_DIR,
+    chunks_dir: str = CHUNKS_DIR,
+    collection_name: str = COLLECTION_NAME,
+    batch_size: int = BATCH_SIZE,
+) -> Dict[str, int]:
+    """
+    Sync incrementale delle fonti in `sources` (tutte quelle in chunks_dir se None) nella
+    versione attiva dell'indice. Ritorna i conteggi totali (added/updated/deleted/unchanged).
+    """
+    from services.index_versions import index_dir
+    from services.candidate_pools import write_index_version
+
+    if sources is None:
+        by_source: Dict[str, List[Dict[str, Any]]] = {}
+        for chunk in load_chunks(chunks_dir):
+            by_source.setdefault(chunk.get("metadata", {}).get("source_id", ""), []).append(chunk)
+    else:
+        # si leggono solo i file delle fonti indicate
+        by_source = {source_id: load_source_chunks(source_id, chunks_dir) for source_id in sources}
+
+    target_dir = index_dir(chroma_dir)
+    model = get_model()
+    collection = get_collection(target_dir, collection_name)
+
+    totals = {"added": 0, "updated": 0, "deleted": 0, "unchanged": 0}
+    for source_id, chunks in by_source.items():
+        report = sync_source(collection, model, source_id, chunks, batch_size)
+        for key, value in report.items():
+            totals[key] += value
+
+    # i pool precalcolati vanno invalidati solo se lo store è cambiato
+    if totals["added"] or totals["updated"] or totals["deleted"]:
+        write_index_version(target_dir)
+    return totals
+
+
+def precompute_pools(
+    chroma_dir: str = CHROMA_DIR,
+    collection_name: str = COLLECTION_NAME,
+    pools_path: str = POOLS_PATH,
+) -> int:
+    """
+    Materializza i pool di candidati per tutte le combinazioni (tipo/difficoltà, filtri).
+    Da eseguire dopo embed_all. Ritorna il numero di pool scritti.
+    """
+    from services.candidate_pools import build_pools, save_pools, read_index_version, write_index_version
+
+    from services.index_versions import index_dir
+
+    data_dir = index_dir(chroma_dir)
+    model = get_model()
+    collection = get_collection(data_dir, collection_name)
+    version = read_index_version(data_dir) or write_index_version(data_dir)
+
+    data = build_pools(collection, model, version)
+    save_pools(data, pools_path)
+    return len(data["pools"])
+
+
 def main():
     parser = argparse.ArgumentParser()
-    parser.add_argument("--fresh", action="store_true", help="Reset ChromaDB before embedding")
+    parser.add_argument("--fresh", action="store_true", help="Ricostruisce l'indice in una versione nuova e la pubblica a fine embed")
+    parser.add_argument("--sync", action="store_true", help="Sync incrementale: riscrive solo i chunk cambiati")
+    parser.add_argument("--source", action="append", help="Con --sync: limita alle fonti indicate (ripetibile)")
+    parser.add_argument("--precompute-pools", action="store_true", help="Precalcola i pool di candidati dopo l'embed")
     args = parser.parse_args()
-    total, count = embed_all(fresh=args.fresh)
-    print(f"Total chunks to embed: {total}")
-    print(f"Documenti nella collection: {count}")
+    if args.sync:
+        report = sync_all(sources=args.source)
+        print("Sync: {added} aggiunti, {updated} aggiornati, {deleted} rimossi, {unchanged} invariati".format(**report))
+    else:
+        total, count = embed_all(fresh=args.fresh)
+        print(f"Total chunks to embed: {total}")
+        print(f"Documenti nella collection: {count}")
+    if args.precompute_pools:
+        n_pools = precompute_pools()
+        print(f"Pool precalcolati: {n_pools}")
 
 
 if __name__ == "__main__":
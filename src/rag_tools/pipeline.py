@@ -5,7 +5,7 @@ One-shot pipeline to automate:
 CSV (classe/anno/keyword) -> download Wikipedia HTML -> clean text -> chunk -> embed in ChromaDB
 
 Requirements (pip):
-  beautifulsoup4 requests tqdm sentence-transformers chromadb
+  beautifulsoup4 requests sentence-transformers chromadb
 Optional but recommended:
   unidecode (to help with URL slugs if you use non-ASCII titles)
 
@@ -15,11 +15,14 @@ Usage examples:
   python pipeline.py --csv sources_csv/topics_storia_primaria.csv
   python pipeline.py --csv-dir sources_csv --limit 50 --skip-embed
   python pipeline.py --csv-dir sources_csv --fresh-db
+  python pipeline.py --workers 4           # -> 4 processi sulla stessa coda (data/ingest_queue.sqlite)
+  python pipeline.py --restart             # -> riprocessa anche gli argomenti già completati
 
-Directory layout creato sotto ./data :
+Directory layout creato sotto data/ nella radice del repository (da qualunque cartella si lanci):
   data/raw/       (downloaded HTML)
   data/cleaned/   (plain text extracted)
-  data/chunks/    (jsonl chunks)
+  data/chunk_segments/ (chunk per fonte scritti dai worker, uniti nello store a fine coda)
+  data/chunk_store/ (chunk store colonnare; export JSONL: python -m rag_tools.chunk_store export)
   data/chroma_db/ (Chroma persistence)
   data/fonte_index.json (metadata registry)
 
@@ -32,24 +35,38 @@ CSV columns expected:
 - keyword_wikipedia: page title su it.wikipedia.org
 
 Idempotente: se l'HTML grezzo esiste, salta il download (a meno di --force).
-Batch embed eseguito UNA volta alla fine di tutti i CSV (a meno di --skip-embed).
+Ripresa: ogni argomento è un task della coda su SQLite (rag_tools/work_queue.py) con
+checkpoint dopo download e pulizia; se il processo muore, il rerun riprende i task non finiti
+(quelli di un worker morto tornano liberi allo scadere del lease) e salta quelli completati.
+Altri pipeline.py sulla stessa coda (--queue) si dividono i task; ogni task scrive i suoi chunk in un
+segmento (un file per fonte) e chi finisce per ultimo li unisce nello store con una sola riscrittura,
+poi fa l'embed.
+Batch embed eseguito UNA volta alla fine di tutti i CSV (a meno di --skip-embed): sync incrementale
+delle fonti processate (solo i chunk cambiati), o ricostruzione completa dell'indice con --fresh-db.
 """
 
-import os, re, csv, json, sys, time, shutil, argparse
+import os, re, csv, json, sys, time, fcntl, socket, argparse, multiprocessing
 from pathlib import Path
 from datetime import datetime
 from urllib.parse import quote
 import requests
 from bs4 import BeautifulSoup
-from tqdm import tqdm
+
+# services/ e rag_tools/ importabili anche lanciando lo script da src/rag_tools
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from rag_tools import chunk_store
+from rag_tools.work_queue import WorkQueue, run_worker, LEASE_SECONDS, PENDING, LEASED
 
 # ----------------- Config -----------------
-DATA_DIR      = Path("../../data")
+# data/ nella radice del repository (come chunker.py ed embedder.py), da qualunque cartella
+DATA_DIR      = Path(__file__).resolve().parent.parent.parent / "data"
 RAW_DIR       = DATA_DIR / "raw"
 CLEANED_DIR   = DATA_DIR / "cleaned"
-CHUNKS_DIR    = DATA_DIR / "chunks"
+CHUNKS_DIR    = DATA_DIR / "chunk_store"   # chunk store colonnare (rag_tools/chunk_store.py)
+SEGMENTS_DIR  = DATA_DIR / "chunk_segments"  # chunk per fonte in attesa di merge_segments()
 CHROMA_DIR    = DATA_DIR / "chroma_db"
 SOURCE_INDEX  = DATA_DIR / "fonte_index.json"
+QUEUE_PATH    = DATA_DIR / "ingest_queue.sqlite"
 
 DEFAULT_CSV_DIR = Path("sources_csv")
 
@@ -72,7 +89,7 @@ def clean_filename_from_url(url: str) -> str:
     return path.replace("/", "_") or "index"
 
 def ensure_dirs():
-    for d in [DATA_DIR, RAW_DIR, CLEANED_DIR, CHUNKS_DIR, CHROMA_DIR]:
+    for d in [DATA_DIR, RAW_DIR, CLEANED_DIR, SEGMENTS_DIR, CHROMA_DIR]:
         d.mkdir(parents=True, exist_ok=True)
 
 def load_fonte_index():
@@ -87,10 +104,14 @@ def save_fonte_index(idx):
         json.dump(idx, f, indent=2, ensure_ascii=False)
 
 def upsert_source_metadata(source):
-    idx = load_fonte_index()
-    kept = [s for s in idx if s.get("id") != source["id"]]
-    kept.append(source)
-    save_fonte_index(kept)
+    # più worker aggiornano lo stesso indice: lettura-modifica-scrittura sotto lock
+    SOURCE_INDEX.parent.mkdir(parents=True, exist_ok=True)
+    with open(SOURCE_INDEX.with_suffix(".lock"), "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        idx = load_fonte_index()
+        kept = [s for s in idx if s.get("id") != source["id"]]
+        kept.append(source)
+        save_fonte_index(kept)
 
 def download_html(url: str, force: bool=False, user_agent: str="Mozilla/5.0"):
     ensure_dirs()
@@ -132,133 +153,194 @@ def split_into_chunks(text: str, size: int=CHUNK_SIZE, overlap: int=OVERLAP):
         start = max(0, end - overlap)
     return chunks
 
-def chunk_and_write(source_id: str, title: str, subject: str, classe: str, anno: int, cleaned_path: Path):
+def chunk_source(source_id: str, title: str, subject: str, classe: str, anno: int, cleaned_path: Path):
+    """Record dei chunk di una fonte; si scrivono in un segmento (write_chunks)."""
     raw_text = cleaned_path.read_text(encoding="utf-8")
-    chunks = split_into_chunks(raw_text)
-    out_path = CHUNKS_DIR / f"{source_id}.jsonl"
-    with out_path.open("w", encoding="utf-8") as fp:
-        for i, ch in enumerate(chunks):
-            record = {
-                "id": f"{source_id}_{i}",
-                "text": ch,
-                "metadata": {
-                    "source_id": source_id,
-                    "title": title,
-                    "subject": subject,
-                    "classe": classe,
-                    "anno": int(anno),
-                    "created_at": datetime.now().isoformat()
-                }
+    # un timestamp per fonte: nel chunk store è un solo valore nel dizionario
+    created_at = datetime.now().isoformat()
+    return [
+        {
+            "id": f"{source_id}_{i}",
+            "text": ch,
+            "metadata": {
+                "source_id": source_id,
+                "title": title,
+                "subject": subject,
+                "classe": classe,
+                "anno": int(anno),
+                "created_at": created_at
             }
-            fp.write(json.dumps(record, ensure_ascii=False) + "\n")
-    return out_path, len(chunks)
+        }
+        for i, ch in enumerate(split_into_chunks(raw_text))
+    ]
+
+def write_chunks(by_source):
+    """
+    Un segmento per fonte (scrittura atomica, nessun lock): lo store non viene riscritto
+    a ogni argomento, ci pensa merge_segments() una volta a fine coda.
+    """
+    SEGMENTS_DIR.mkdir(parents=True, exist_ok=True)
+    for source_id, chunks in by_source.items():
+        path = SEGMENTS_DIR / f"{source_id}.json"
+        tmp = path.with_name(f"{path.name}.tmp-{os.getpid()}")
+        tmp.write_text(json.dumps(chunks, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+def merge_segments():
+    """Unisce i segmenti nello store con un solo chunk_store.update; ritorna le fonti unite."""
+    SEGMENTS_DIR.mkdir(parents=True, exist_ok=True)
+    # più worker possono arrivare qui insieme: il merge lo fa uno alla volta
+    with open(SEGMENTS_DIR / ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        paths = sorted(SEGMENTS_DIR.glob("*.json"))
+        by_source = {p.stem: json.loads(p.read_text(encoding="utf-8")) for p in paths}
+        if by_source:
+            chunk_store.update(CHUNKS_DIR, by_source)
+        # dopo un crash qui il rerun riunisce gli stessi segmenti: nessun effetto in più
+        for p in paths:
+            p.unlink()
+    return list(by_source)
 
 # ----------------- Embedding -----------------
-def embed_all(chroma_dir: Path = CHROMA_DIR, batch_size: int = BATCH_SIZE):
-    from chromadb import PersistentClient
-    from sentence_transformers import SentenceTransformer
-    client = PersistentClient(path=str(chroma_dir))
-    col = client.get_or_create_collection(name="educational_chunks")
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-
-    files = list(CHUNKS_DIR.glob("*.jsonl"))
-    total = 0
-    for fp in files:
-        with fp.open("r", encoding="utf-8") as f:
-            for _ in f:
-                total += 1
-
-    print(f"\nEmbedding ~{total} chunks da {len(files)} file ...")
-    docs, ids, metas = [], [], []
-    k = 0
-
-    def flush():
-        nonlocal docs, ids, metas, k
-        if not docs:
-            return
-        embeds = model.encode(docs, convert_to_numpy=True).tolist()
-        col.add(ids=ids, documents=docs, metadatas=metas, embeddings=embeds)
-        k += len(docs)
-        print(f"  -> aggiunti {len(docs)} (totale {k})")
-        docs.clear(); ids.clear(); metas.clear()
-
-    for fp in files:
-        with fp.open("r", encoding="utf-8") as f:
-            for line in f:
-                obj = json.loads(line)
-                docs.append(obj["text"])
-                ids.append(obj.get("id"))
-                metas.append({
-                    "source_id": obj["metadata"]["source_id"],
-                    "title": obj["metadata"]["title"],
-                    "subject": obj["metadata"]["subject"],
-                    "classe": obj["metadata"]["classe"],
-                    "anno": int(obj["metadata"]["anno"]),
-                    "created_at": obj["metadata"]["created_at"]
-                })
-                if len(docs) >= batch_size:
-                    flush()
-    flush()
-    print("Done. (Il count esatto della collection richiede una query separata.)")
+def sync_sources(source_ids, chroma_dir: Path = CHROMA_DIR, batch_size: int = BATCH_SIZE):
+    """Sync incrementale delle sole fonti ri-processate: upsert dei chunk cambiati, delete di quelli spariti."""
+    from rag_tools.embedder import sync_all
+    report = sync_all(sources=list(source_ids), chroma_dir=str(chroma_dir), chunks_dir=str(CHUNKS_DIR), batch_size=batch_size)
+    print("\nSync di {n} fonti: {added} aggiunti, {updated} aggiornati, {deleted} rimossi, {unchanged} invariati".format(
+        n=len(source_ids), **report))
+    return report
+
+def embed_pending(queue: WorkQueue, merged, fresh: bool = False):
+    """
+    Porta nell'indice le fonti appena unite nello store e quelle dei task completati dopo
+    l'ultimo embed riuscito (es. run interrotto prima dell'embed): il sync resta
+    proporzionale a ciò che è cambiato, non a tutto ciò che è mai passato dalla coda.
+    """
+    pending = queue.unsynced()
+    if fresh:
+        rebuild_index()
+    else:
+        sync_sources(dict.fromkeys([*merged, *(r["source_id"] for r in pending.values())]))
+    # dopo un crash nell'embed i task restano da sincronizzare e il rerun li riprende
+    queue.mark_synced(pending)
+
+def rebuild_index(chroma_dir: Path = CHROMA_DIR, batch_size: int = BATCH_SIZE):
+    """
+    Ricostruzione completa (--fresh-db) con rag_tools.embedder.embed_all: versione shadow,
+    validazione, publish atomico dell'alias e pulizia (src/services/index_versions.py).
+    """
+    from rag_tools.embedder import embed_all
+    if not chunk_store.is_store(CHUNKS_DIR):
+        # un indice vuoto validerebbe e sostituirebbe quello attivo
+        print(f"\nNessun chunk da indicizzare in {CHUNKS_DIR}")
+        return None
+    total, count = embed_all(fresh=True, chroma_dir=str(chroma_dir), chunks_dir=str(CHUNKS_DIR), batch_size=batch_size)
+    print(f"\nIndice ricostruito e pubblicato: {total} chunk, {count} documenti")
+    return total, count
 
 # ----------------- Core -----------------
-def process_csv_file(csv_path: Path, limit: int = 0, force: bool = False):
-    """Processa un singolo CSV end-to-end (download -> clean -> chunk)."""
-    print(f"\n>>> Processing CSV: {csv_path.name}")
+def topic_id(materia: str, classe: str, anno: int, kw: str) -> str:
+    # stabile tra un run e l'altro: lo stesso argomento non viene riaccodato
+    return f"{materia}/{classe}/{anno}/{kw}"
+
+def read_topics(csv_path: Path, limit: int = 0):
+    """Task della coda (uno per riga valida del CSV)."""
+    print(f"\n>>> Reading CSV: {csv_path.name}")
     try:
         with open(csv_path, "r", encoding="utf-8") as f:
             reader = csv.DictReader(f)
             rows = list(reader)
     except Exception as e:
         print(f"[SKIP FILE] {csv_path}: {e}")
-        return
+        return []
 
     if limit and limit > 0:
         rows = rows[:limit]
 
-    for r in tqdm(rows, desc=f"Topics ({csv_path.name})"):
+    tasks = []
+    for r in rows:
         try:
-            materia = r["materia"].strip()
-            classe  = r["classe"].strip()
-            anno    = int(r["anno"])
-            titolo  = r["titolo"].strip()
-            kw      = r["keyword_wikipedia"].strip()
+            topic = {
+                "materia": r["materia"].strip(),
+                "classe": r["classe"].strip(),
+                "anno": int(r["anno"]),
+                "titolo": r["titolo"].strip(),
+                "keyword": r["keyword_wikipedia"].strip(),
+            }
         except KeyError as e:
             print(f"[SKIP ROW] Colonna mancante {e} in {csv_path.name}")
             continue
         except Exception as e:
             print(f"[SKIP ROW] Errore parsing riga in {csv_path.name}: {e}")
             continue
-
+        tasks.append({"id": topic_id(topic["materia"], topic["classe"], topic["anno"], topic["keyword"]), "payload": topic})
+    return tasks
+
+def process_topic(task, save_checkpoint, force: bool = False):
+    """
+    Un argomento end-to-end (download -> clean -> chunk), con checkpoint dopo ogni passo:
+    un task ripreso dopo un crash riparte dall'ultimo passo completato.
+    """
+    t = task["payload"]
+    state = task["checkpoint"] or {}
+    kw = t["keyword"]
+
+    if "raw_path" not in state:
         url = page_url_from_keyword(kw)
-        try:
-            filename, raw_path = download_html(url, force=force)
-        except Exception as e:
-            print(f"[SKIP] {kw} -> {e}")
-            continue
+        filename, raw_path = download_html(url, force=force)
+        state = {"url": url, "source_id": filename.replace(".html", ""), "raw_path": str(raw_path)}
+        save_checkpoint(state)
 
-        source_id = filename.replace(".html", "")
+    source_id = state["source_id"]
+    if "cleaned_path" not in state:
         upsert_source_metadata({
             "id": source_id,
-            "titolo": titolo,
-            "materia": materia,
-            "classe": classe,
-            "anno": anno,
-            "fonte": url,
+            "titolo": t["titolo"],
+            "materia": t["materia"],
+            "classe": t["classe"],
+            "anno": t["anno"],
+            "fonte": state["url"],
             "formato": "html",
             "salvato_il": datetime.now().isoformat()
         })
-
-        cleaned_path = extract_text_from_html(raw_path)
-        _, n_chunks = chunk_and_write(
-            source_id=source_id,
-            title=titolo,
-            subject=materia,
-            classe=classe,
-            anno=anno,
-            cleaned_path=cleaned_path
-        )
-        print(f"  -> {kw}: {n_chunks} chunks")
+        cleaned_path = extract_text_from_html(Path(state["raw_path"]))
+        state = dict(state, cleaned_path=str(cleaned_path))
+        save_checkpoint(state)
+
+    chunks = chunk_source(
+        source_id=source_id,
+        title=t["titolo"],
+        subject=t["materia"],
+        classe=t["classe"],
+        anno=t["anno"],
+        cleaned_path=Path(state["cleaned_path"])
+    )
+    write_chunks({source_id: chunks})
+    print(f"  -> {kw}: {len(chunks)} chunks")
+    return {"source_id": source_id, "chunks": len(chunks)}
+
+def _worker_main(queue_path: str, force: bool, lease_seconds: float):
+    queue = WorkQueue(queue_path, lease_seconds=lease_seconds)
+    owner = f"{socket.gethostname()}:{os.getpid()}"
+    try:
+        stats = run_worker(queue, lambda task, save: process_topic(task, save, force=force), owner)
+    finally:
+        queue.close()
+    print(f"[worker {owner}] completati {stats['done']}, falliti {stats['failed']}, persi {stats['lost']}")
+
+def run_workers(queue_path: Path, workers: int = 1, force: bool = False, lease_seconds: float = LEASE_SECONDS):
+    """Esegue i task della coda con `workers` processi (1 = nel processo corrente)."""
+    if workers <= 1:
+        _worker_main(str(queue_path), force, lease_seconds)
+        return
+    procs = [
+        multiprocessing.Process(target=_worker_main, args=(str(queue_path), force, lease_seconds))
+        for _ in range(workers)
+    ]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
 
 # ----------------- Main -----------------
 def main():
@@ -266,17 +348,17 @@ def main():
     ap.add_argument("--csv", help="Singolo CSV (materia,classe,anno,titolo,keyword_wikipedia)")
     ap.add_argument("--csv-dir", default=str(DEFAULT_CSV_DIR), help="Cartella con più CSV (default: sources_csv)")
     ap.add_argument("--limit", type=int, default=0, help="Processa al massimo N righe per CSV (0 = tutte)")
-    ap.add_argument("--force", action="store_true", help="Forza redownload HTML anche se esiste")
-    ap.add_argument("--fresh-db", action="store_true", help="Resetta la cartella ChromaDB prima dell'embed finale")
+    ap.add_argument("--force", action="store_true", help="Forza redownload HTML anche se esiste (riprocessa anche i task finiti)")
+    ap.add_argument("--fresh-db", action="store_true", help="Ricostruisce l'indice in una versione nuova e la pubblica a fine embed")
     ap.add_argument("--skip-embed", action="store_true", help="Esegue tutto tranne l'embed finale")
+    ap.add_argument("--queue", default=str(QUEUE_PATH), help="Coda dei task su SQLite, condivisa tra i worker")
+    ap.add_argument("--workers", type=int, default=1, help="Processi worker su questa macchina")
+    ap.add_argument("--restart", action="store_true", help="Riprocessa anche i task già completati o falliti")
+    ap.add_argument("--lease", type=float, default=LEASE_SECONDS, help="Secondi di lease di un task senza heartbeat")
     args = ap.parse_args()
 
     ensure_dirs()
 
-    if args.fresh_db and CHROMA_DIR.exists():
-        print("Resetting ChromaDB directory ...")
-        shutil.rmtree(CHROMA_DIR, ignore_errors=True)
-
     csv_paths = []
 
     # 1) Se è passato --csv, usalo
@@ -305,11 +387,26 @@ def main():
         sys.exit(1)
 
     print(f"Trovati {len(csv_paths)} file CSV da processare.")
-    for csv_file in csv_paths:
-        process_csv_file(csv_file, limit=args.limit, force=args.force)
-
+    queue = WorkQueue(args.queue, lease_seconds=args.lease)
+    if args.restart or args.force:
+        print(f"Task rimessi in coda: {queue.requeue()}")
+    added = queue.enqueue(task for csv_file in csv_paths for task in read_topics(csv_file, limit=args.limit))
+    print(f"Nuovi task: {added}; stato della coda: {queue.counts()}")
+
+    run_workers(Path(args.queue), workers=args.workers, force=args.force, lease_seconds=args.lease)
+
+    counts = queue.counts()
+    print(f"Stato della coda: {counts}")
+    if counts[PENDING] or counts[LEASED]:
+        # altri processi lavorano ancora sulla stessa coda: merge ed embed li farà l'ultimo
+        print("Task ancora in corso in altri worker: merge dei chunk ed embed rimandati.")
+        queue.close()
+        return
+    merged = merge_segments()
+    print(f"Chunk store aggiornato con {len(merged)} fonti")
     if not args.skip_embed:
-        embed_all()
+        embed_pending(queue, merged, fresh=args.fresh_db)
+    queue.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,243 @@
+# src/rag_tools/work_queue.py
+"""
+Coda di lavoro persistente (SQLite) per l'ingestion: un task per argomento del CSV.
+
+Più processi pipeline.py sullo stesso file si dividono i task:
+  - claim(): prende un task libero con un lease di LEASE_SECONDS (transazione IMMEDIATE,
+    un solo processo alla volta può assegnare);
+  - heartbeat()/checkpoint(): il worker rinnova il lease mentre lavora e salva lo stato
+    dell'ultimo passo completato;
+  - un worker morto smette di rinnovare: alla scadenza il task torna assegnabile e chi lo
+    riprende riparte dal checkpoint;
+  - dopo MAX_ATTEMPTS tentativi il task resta "failed" (non blocca gli altri).
+I task già "done" restano tali: rilanciare la pipeline continua da dove si era fermata.
+I task "done" non ancora passati all'indice (unsynced) vengono segnati con mark_synced dopo
+l'embed: il run successivo sincronizza solo quelli completati nel frattempo.
+SQLite va bene tra processi della stessa macchina; su filesystem di rete i lock non sono affidabili.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+from typing import Any, Callable, Dict, Iterable, Optional
+
+LEASE_SECONDS = 120.0
+MAX_ATTEMPTS = 3
+
+PENDING, LEASED, DONE, FAILED = "pending", "leased", "done", "failed"
+
+
+class LeaseLost(RuntimeError):
+    """Il lease è scaduto ed è passato a un altro worker: il risultato va scartato."""
+
+
+class WorkQueue:
+    def __init__(self, path, lease_seconds=LEASE_SECONDS, max_attempts=MAX_ATTEMPTS, clock=time.time):
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.clock = clock
+        # autocommit: le transazioni sono esplicite (BEGIN IMMEDIATE in claim)
+        self._db = sqlite3.connect(str(path), timeout=30, isolation_level=None, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS tasks ("
+                " id TEXT PRIMARY KEY, kind TEXT, payload TEXT, status TEXT, owner TEXT,"
+                " lease_until REAL, attempts INTEGER DEFAULT 0, checkpoint TEXT, result TEXT,"
+                " error TEXT, updated_at REAL)"
+            )
+            # file di una versione precedente: colonna aggiunta sul posto (i task già fatti
+            # risultano da sincronizzare una volta)
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(tasks)")}
+            if "synced" not in columns:
+                self._db.execute("ALTER TABLE tasks ADD COLUMN synced INTEGER DEFAULT 0")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def enqueue(self, tasks: Iterable[Dict[str, Any]], kind="topic") -> int:
+        """Aggiunge task {"id", "payload"}; gli id già presenti (anche finiti) vengono ignorati."""
+        now = self.clock()
+        rows = [(t["id"], kind, json.dumps(t["payload"], ensure_ascii=False), PENDING, now) for t in tasks]
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO tasks (id, kind, payload, status, updated_at) VALUES (?, ?, ?, ?, ?)", rows
+            )
+            return self._db.total_changes - before
+
+    def claim(self, owner: str) -> Optional[Dict[str, Any]]:
+        """Il prossimo task libero (o con lease scaduto), assegnato a `owner`; None se non ce ne sono."""
+        now = self.clock()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self._db.execute(
+                    "SELECT id, kind, payload, attempts, checkpoint FROM tasks"
+                    " WHERE (status = ? OR (status = ? AND lease_until < ?)) AND attempts < ?"
+                    " ORDER BY rowid LIMIT 1",
+                    (PENDING, LEASED, now, self.max_attempts),
+                ).fetchone()
+                if row is None:
+                    # lease scaduti all'ultimo tentativo: il task non verrà più ripreso
+                    self._db.execute(
+                        "UPDATE tasks SET status = ?, error = 'lease scaduto', updated_at = ?"
+                        " WHERE status = ? AND lease_until < ? AND attempts >= ?",
+                        (FAILED, now, LEASED, now, self.max_attempts),
+                    )
+                    self._db.execute("COMMIT")
+                    return None
+                self._db.execute(
+                    "UPDATE tasks SET status = ?, owner = ?, lease_until = ?, attempts = attempts + 1, updated_at = ?"
+                    " WHERE id = ?",
+                    (LEASED, owner, now + self.lease_seconds, now, row[0]),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        task_id, kind, payload, attempts, checkpoint = row
+        return {
+            "id": task_id,
+            "kind": kind,
+            "payload": json.loads(payload),
+            "attempt": attempts + 1,
+            "checkpoint": json.loads(checkpoint) if checkpoint else None,
+        }
+
+    def _update_owned(self, task_id, owner, sql, params):
+        # solo il proprietario del lease ancora valido può aggiornare il task
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE tasks SET {sql}, updated_at = ? WHERE id = ? AND owner = ? AND status = ?",
+                (*params, self.clock(), task_id, owner, LEASED),
+            )
+        if cursor.rowcount == 0:
+            raise LeaseLost(f"Task {task_id}: lease non più di {owner}")
+
+    def heartbeat(self, task_id: str, owner: str):
+        self._update_owned(task_id, owner, "lease_until = ?", (self.clock() + self.lease_seconds,))
+
+    def checkpoint(self, task_id: str, owner: str, state: Dict[str, Any]):
+        """Salva lo stato dell'ultimo passo completato (e rinnova il lease)."""
+        self._update_owned(
+            task_id, owner, "checkpoint = ?, lease_until = ?",
+            (json.dumps(state, ensure_ascii=False), self.clock() + self.lease_seconds),
+        )
+
+    def complete(self, task_id: str, owner: str, result: Any = None):
+        self._update_owned(
+            task_id, owner, "status = ?, result = ?, lease_until = NULL, synced = 0",
+            (DONE, json.dumps(result, ensure_ascii=False)),
+        )
+
+    def fail(self, task_id: str, owner: str, error: str):
+        """Errore del task: torna in coda (il checkpoint resta) finché ci sono tentativi."""
+        self._update_owned(
+            task_id, owner, "status = CASE WHEN attempts >= ? THEN ? ELSE ? END, error = ?, lease_until = NULL",
+            (self.max_attempts, FAILED, PENDING, error),
+        )
+
+    def counts(self) -> Dict[str, int]:
+        with self._lock:
+            rows = self._db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status").fetchall()
+        counts = {PENDING: 0, LEASED: 0, DONE: 0, FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def results(self, kind="topic"):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT result FROM tasks WHERE kind = ? AND status = ? ORDER BY rowid", (kind, DONE)
+            ).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def unsynced(self, kind="topic") -> Dict[str, Any]:
+        """{id: risultato} dei task completati dopo l'ultimo mark_synced."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, result FROM tasks WHERE kind = ? AND status = ? AND NOT synced ORDER BY rowid", (kind, DONE)
+            ).fetchall()
+        return {task_id: json.loads(result) for task_id, result in rows}
+
+    def mark_synced(self, task_ids: Iterable[str]):
+        """I risultati di questi task sono nell'indice (embed/sync riuscito)."""
+        with self._lock:
+            self._db.executemany("UPDATE tasks SET synced = 1 WHERE id = ?", [(i,) for i in task_ids])
+
+    def requeue(self, statuses=(DONE, FAILED)) -> int:
+        """Rimette in coda i task negli stati indicati (es. --force, o dopo aver corretto un errore)."""
+        marks = ",".join("?" * len(statuses))
+        with self._lock:
+            cursor = self._db.execute(
+                f"UPDATE tasks SET status = ?, attempts = 0, checkpoint = NULL, error = NULL, owner = NULL,"
+                f" lease_until = NULL WHERE status IN ({marks})",
+                (PENDING, *statuses),
+            )
+        return cursor.rowcount
+
+
+class _Heartbeat:
+    """Rinnova il lease in background mentre il task è in esecuzione."""
+
+    def __init__(self, queue: WorkQueue, task_id: str, owner: str, interval: float):
+        self.queue, self.task_id, self.owner, self.interval = queue, task_id, owner, interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"heartbeat-{task_id}", daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.queue.heartbeat(self.task_id, self.owner)
+            except LeaseLost:
+                self.lost = True
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+
+def run_worker(
+    queue: WorkQueue,
+    handler: Callable[[Dict[str, Any], Callable[[Dict[str, Any]], None]], Any],
+    owner: str,
+    heartbeat_interval: float = None,
+) -> Dict[str, int]:
+    """
+    Esegue task finché la coda ne ha di assegnabili.
+    handler(task, save_checkpoint) → risultato; task["checkpoint"] è lo stato salvato da un
+    tentativo precedente (None al primo). Ritorna {"done": n, "failed": n, "lost": n}.
+    """
+    interval = heartbeat_interval or queue.lease_seconds / 4
+    stats = {"done": 0, "failed": 0, "lost": 0}
+    while True:
+        task = queue.claim(owner)
+        if task is None:
+            return stats
+
+        def save_checkpoint(state, task_id=task["id"]):
+            queue.checkpoint(task_id, owner, state)
+
+        try:
+            with _Heartbeat(queue, task["id"], owner, interval):
+                result = handler(task, save_checkpoint)
+            queue.complete(task["id"], owner, result)
+            stats["done"] += 1
+        except LeaseLost:
+            # il task è già di un altro worker: niente da segnare
+            stats["lost"] += 1
+        except Exception as e:
+            try:
+                queue.fail(task["id"], owner, f"{type(e).__name__}: {e}")
+                stats["failed"] += 1
+            except LeaseLost:
+                stats["lost"] += 1
@@ -0,0 +1,147 @@
+# serve.py
+"""
+Entry point di produzione: gunicorn con preload dell'app nel master.
+
+Avvio (dalla cartella src/):
+    gunicorn -c gunicorn.conf.py                    # Flask (main.py), worker gthread
+    SAGE_SERVER=asgi gunicorn -c gunicorn.conf.py   # ASGI (asgi.py), worker uvicorn
+
+create_app() gira una volta nel master: carica modello di embedding, pool di candidati
+e schemi, poi gc.freeze() sposta tutti gli oggetti caricati nella generazione permanente.
+I worker nascono con fork e condividono quelle pagine copy-on-write: il GC dei worker
+non le visita (niente scritture sugli header degli oggetti) e i pesi del modello stanno
+in buffer che nessuno modifica. Ogni worker riapre solo le risorse che non sopravvivono
+al fork (client Chroma, thread di torch), vedi post_fork().
+
+Misura della memoria per worker:
+    python serve.py --measure 4
+"""
+
+import gc
+import os
+import sys
+import json
+import argparse
+
+SERVER = os.getenv("SAGE_SERVER", "wsgi")
+# Thread di torch per worker (0 = core disponibili divisi tra i worker)
+WORKER_TORCH_THREADS = int(os.getenv("SAGE_WORKER_TORCH_THREADS", "0"))
+
+_preloaded = False
+
+
+def preload():
+    """Carica nel processo corrente tutto ciò che è pesante e in sola lettura, poi congela il GC."""
+    global _preloaded
+    if _preloaded:
+        return
+    # niente raccolte durante il caricamento: gli oggetti restano compatti nelle stesse pagine
+    gc.disable()
+    try:
+        from services import retriever_chain  # noqa: F401 (embedder, pool di candidati, indice)
+        from validators.validator_schemas import get_registry
+        from services import quiz_generator  # noqa: F401 (template dei prompt, client, metriche)
+        get_registry()
+        gc.collect()
+        gc.freeze()
+    finally:
+        gc.enable()
+    _preloaded = True
+
+
+def create_app(kind=None):
+    """App WSGI (Flask) o ASGI, con il preload già fatto."""
+    preload()
+    if (kind or SERVER) == "asgi":
+        from asgi import app
+    else:
+        from main import app
+    return app
+
+
+def post_fork(workers=1):
+    """Da chiamare in ogni worker subito dopo il fork."""
+    from services import retriever_chain, jobs, rate_limiter
+    retriever_chain.reopen_index()
+    # con più processi la coda dei job deve essere condivisa (SQLite)
+    jobs.configure(workers)
+    # i limiti rpm/tpm dei provider si dividono tra i worker
+    rate_limiter.configure(workers)
+
+    threads = WORKER_TORCH_THREADS or max(1, (os.cpu_count() or 1) // max(workers, 1))
+    try:
+        import torch
+    except ImportError:
+        return
+    # senza limite ogni worker userebbe tutti i core: N worker × N thread in competizione
+    torch.set_num_threads(threads)
+
+
+def _warmup():
+    from services import retriever_chain
+    retriever_chain.embedder.encode("warmup")
+
+
+def measure_workers(workers=2, warmup=_warmup):
+    """
+    Forka `workers` processi come gunicorn dopo il preload; ognuno esegue post_fork() e warmup(),
+    poi tutti misurano la memoria insieme (la PSS dipende da quanti processi condividono le pagine).
+    Ritorna {"master": memory_usage(), "workers": [memory_usage(), ...]}.
+    """
+    from services.health import memory_usage
+
+    children = []
+    go_read, go_write = os.pipe()
+    for _ in range(workers):
+        ready_read, ready_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                os.close(ready_read)
+                os.close(go_write)
+                post_fork(workers)
+                warmup()
+                os.write(ready_write, b"1")
+                os.read(go_read, 1)  # EOF quando tutti i worker sono pronti
+                os.write(ready_write, json.dumps(memory_usage()).encode("ascii"))
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        os.close(ready_write)
+        children.append((pid, ready_read))
+
+    os.close(go_read)
+    for _, ready_read in children:
+        os.read(ready_read, 1)
+    os.close(go_write)
+
+    results = []
+    for pid, ready_read in children:
+        with os.fdopen(ready_read, "rb") as f:
+            data = f.read()
+        os.waitpid(pid, 0)
+        results.append(json.loads(data) if data else {})
+    return {"master": memory_usage(), "workers": results}
+
+
+def _mb(value):
+    return f"{value / 2**20:8.1f}" if value is not None else "       ?"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Memoria per worker dopo il preload")
+    parser.add_argument("--measure", type=int, default=2, metavar="WORKERS")
+    args = parser.parse_args(argv)
+
+    preload()
+    report = measure_workers(args.measure)
+    print(f"{'processo':<10} {'RSS MB':>8} {'PSS MB':>8} {'USS MB':>8}")
+    rows = [("master", report["master"])] + [(f"worker {i}", w) for i, w in enumerate(report["workers"])]
+    for name, usage in rows:
+        print(f"{name:<10} {_mb(usage.get('rss'))} {_mb(usage.get('pss'))} {_mb(usage.get('uss'))}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
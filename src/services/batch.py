@@ -0,0 +1,111 @@
+# services/batch.py
+"""
+Molti quiz in una sola richiesta HTTP (POST /generate_quiz/batch).
+
+L'integrazione con il registro elettronico manda centinaia di richieste piccole:
+qui arrivano come un array JSON. Gli elementi sono validati tutti subito (quelli
+non validi escono per primi con status 4), i candidati del retrieval sono calcolati
+una volta per query distinta (una encode + una query Chroma per filtro) e la
+generazione gira su un numero limitato di thread. I risultati escono uno per riga
+(NDJSON) appena pronti: gli elementi veloci non aspettano quelli lenti.
+"""
+
+import os
+import contextlib
+import concurrent.futures
+
+from services.metrics import counter, histogram
+from services.quiz_generator import retrieval_query, validate_request
+from services.retriever_chain import preloaded_candidates
+from services.log import get_logger
+
+logger = get_logger("batch")
+
+# Generazioni contemporanee per richiesta batch
+BATCH_PARALLELISM = int(os.getenv("SAGE_BATCH_PARALLELISM", "8"))
+MAX_BATCH_ITEMS = int(os.getenv("SAGE_BATCH_MAX_ITEMS", "200"))
+
+# Provider quando l'elemento non lo indica: lo stesso default della route singola JSON
+DEFAULT_PROVIDER = "groq"
+
+BATCH_ITEMS = counter(
+    "sage_batch_items_total",
+    "Elementi delle richieste batch per esito: invalid (scartati in validazione) o status 1-5",
+    labelnames=("outcome",),
+)
+BATCH_SIZE = histogram(
+    "sage_batch_size", "Elementi per richiesta batch", buckets=(1, 5, 10, 25, 50, 100, 200, 500)
+)
+
+
+class BatchError(ValueError):
+    pass
+
+
+def parse_batch(payloads):
+    """
+    Ritorna (validi, non validi): [(indice, payload)] e [(indice, errore)].
+    Solleva BatchError se il corpo non è un array utilizzabile.
+    """
+    if not isinstance(payloads, list) or not payloads:
+        raise BatchError("Expected a non-empty JSON array of quiz requests")
+    if len(payloads) > MAX_BATCH_ITEMS:
+        raise BatchError(f"Too many items: {len(payloads)} (max {MAX_BATCH_ITEMS})")
+
+    valid, invalid = [], []
+    for i, item in enumerate(payloads):
+        if isinstance(item, dict) and "llmProvider" not in item:
+            item = dict(item, llmProvider=DEFAULT_PROVIDER)
+        # stesso validatore di generate_quiz_from_data: ciò che passa qui non torna 4 dopo
+        error = validate_request(item)
+        if error is not None:
+            invalid.append((i, error))
+        else:
+            valid.append((i, item))
+    BATCH_SIZE.observe(len(payloads))
+    return valid, invalid
+
+
+def _preload(valid):
+    # richieste con la stessa query (tipo, categoria, classe, anno, difficoltà) condividono i candidati
+    try:
+        return preloaded_candidates([retrieval_query(payload) for _, payload in valid])
+    except Exception as e:
+        logger.warning("Retrieval batch fallito, ogni elemento userà il proprio: %s", e)
+        return contextlib.nullcontext()
+
+
+def run_batch(valid, invalid, generate, deadline_factory, parallelism=BATCH_PARALLELISM):
+    """
+    Generatore di risultati {"index", "status", "data"[, "error"]} nell'ordine in cui sono pronti.
+    generate(payload, deadline=...) come la route singola; il deadline di ogni elemento
+    (deadline_factory()) parte quando l'elemento inizia, non quando arriva il batch.
+    """
+    for i, error in invalid:
+        BATCH_ITEMS.inc(outcome="invalid")
+        yield {"index": i, "status": 4, "data": {}, "error": error}
+    if not valid:
+        return
+
+    def run(payload):
+        return generate(payload, deadline=deadline_factory())
+
+    with _preload(valid):
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, min(parallelism, len(valid))), thread_name_prefix="batch"
+        )
+        try:
+            futures = {executor.submit(run, payload): i for i, payload in valid}
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    # un elemento in errore non interrompe lo stream degli altri
+                    logger.warning("Batch: elemento %d fallito: %s", i, e)
+                    result = {"status": 4, "data": {}, "error": str(e)}
+                BATCH_ITEMS.inc(outcome=str(result["status"]))
+                yield {"index": i, **result}
+        finally:
+            # client disconnesso: gli elementi non ancora partiti non vengono generati
+            executor.shutdown(wait=False, cancel_futures=True)
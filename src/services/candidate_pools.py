@@ -0,0 +1,199 @@
+# services/candidate_pools.py
+"""
+Pool di candidati precalcolati per il retriever.
+
+La query di retrieval è il testo templato di build_prompt(tipo, categoria, difficoltà)
+e i filtri sono un insieme chiuso (subject × classe × anno): tra due build dell'indice
+il pool deduplicato di candidati per ogni combinazione è quindi fisso.
+Dopo embed_all si può materializzare tutto in un file di lookup compatto
+(testi e metadati salvati una volta sola, i pool sono liste di indici).
+"""
+
+import os
+import json
+import uuid
+import hashlib
+
+from services.prompt_builder import build_prompt
+from services.index_versions import IndexAlias
+
+POOLS_PATH = "../data/candidate_pools.json"
+INDEX_VERSION_FILE = "index_version"
+
+QUIZ_TYPES = ["quiz", "matching", "memory", "sorting"]
+DIFFICULTIES = list(range(1, 11))
+
+
+def write_index_version(chroma_dir: str) -> str:
+    """Scrive un nuovo token di versione dell'indice (da chiamare dopo ogni embed)."""
+    version = uuid.uuid4().hex
+    os.makedirs(chroma_dir, exist_ok=True)
+    with open(os.path.join(chroma_dir, INDEX_VERSION_FILE), "w", encoding="utf-8") as f:
+        f.write(version)
+    return version
+
+
+def read_index_version(chroma_dir: str):
+    path = os.path.join(chroma_dir, INDEX_VERSION_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip() or None
+
+
+def pool_key(query: str, subject=None, classe=None, anno=None) -> str:
+    # I tipi contano: anno=3 e anno="3" danno filtri Chroma diversi
+    filters = json.dumps([subject or None, classe or None, anno], ensure_ascii=False)
+    return hashlib.md5(f"{query}\x00{filters}".encode("utf-8")).hexdigest()
+
+
+def _hash_doc(text: str) -> str:
+    return hashlib.md5(text.strip().encode("utf-8")).hexdigest()
+
+
+def build_where(subject=None, classe=None, anno=None):
+    """Filtro Chroma per (subject, classe, anno); None se non c'è nessun filtro."""
+    filters = {}
+    if subject:
+        filters["subject"] = subject
+    if classe:
+        filters["classe"] = classe
+    if anno is not None:
+        filters["anno"] = anno
+
+    if len(filters) == 1:
+        return next(iter([{k: v} for k, v in filters.items()]))
+    elif len(filters) > 1:
+        return {"$and": [{k: v} for k, v in filters.items()]}
+    return None
+
+
+def list_filter_combos(collection):
+    """Combinazioni distinte (subject, classe, anno) presenti nella collection."""
+    result = collection.get(include=["metadatas"])
+    combos = set()
+    for meta in result.get("metadatas") or []:
+        combos.add((meta.get("subject"), meta.get("classe"), meta.get("anno")))
+    return sorted(combos, key=repr)
+
+
+def build_pools(collection, model, index_version, candidate_limit: int = 30, combos=None):
+    """
+    Calcola il pool deduplicato per ogni (tipo, difficoltà) × (subject, classe, anno).
+    Per ogni combinazione di filtri fa una sola encode e una sola query multi-embedding.
+    """
+    if combos is None:
+        combos = list_filter_combos(collection)
+
+    docs, metas, doc_index = [], [], {}
+    pools = {}
+
+    for subject, classe, anno in combos:
+        questions = [build_prompt(t, subject, d) for t in QUIZ_TYPES for d in DIFFICULTIES]
+        embeddings = model.encode(questions, convert_to_numpy=True).tolist()
+        query_args = {
+            "query_embeddings": embeddings,
+            "n_results": candidate_limit,
+            "include": ["documents", "metadatas"],
+        }
+        where = build_where(subject, classe, anno)
+        if where is not None:
+            query_args["where"] = where
+        results = collection.query(**query_args)
+        all_docs = results.get("documents") or []
+        all_metas = results.get("metadatas") or []
+
+        for pos, question in enumerate(questions):
+            cand_docs = all_docs[pos] if pos < len(all_docs) else []
+            cand_metas = all_metas[pos] if pos < len(all_metas) else []
+            seen = set()
+            indexes = []
+            for doc, meta in zip(cand_docs, cand_metas):
+                h = _hash_doc(doc)
+                if h in seen:
+                    continue
+                seen.add(h)
+                if h not in doc_index:
+                    doc_index[h] = len(docs)
+                    docs.append(doc)
+                    metas.append(meta)
+                indexes.append(doc_index[h])
+            pools[pool_key(question, subject, classe, anno)] = indexes
+
+    return {"index_version": index_version, "docs": docs, "metas": metas, "pools": pools}
+
+
+def save_pools(data, path: str = POOLS_PATH):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp_path, path)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class IndexVersionWatcher:
+    """
+    Versione corrente dell'indice; il file viene riletto solo quando cambia l'mtime.
+    Con le versioni (services/index_versions) si legge quello della versione attiva.
+    """
+
+    def __init__(self, chroma_dir: str):
+        self.chroma_dir = chroma_dir
+        self._alias = IndexAlias(chroma_dir)
+        self._key = None
+        self._version = None
+
+    def current(self):
+        data_dir = self._alias.path()
+        key = (data_dir, _mtime(os.path.join(data_dir, INDEX_VERSION_FILE)))
+        if key != self._key:
+            self._key = key
+            self._version = read_index_version(data_dir)
+        return self._version
+
+
+class CandidatePools:
+    """
+    Lookup in tempo costante dei pool precalcolati.
+
+    Il file viene ricaricato quando cambia su disco; se la versione dell'indice
+    in chroma_dir non coincide con quella del file, get() ritorna None
+    e il chiamante ripiega sulla ricerca live.
+    """
+
+    def __init__(self, path: str = POOLS_PATH, chroma_dir: str = None):
+        self.path = path
+        self.chroma_dir = chroma_dir
+        self._data = None
+        self._pools_mtime = None
+        self._version = IndexVersionWatcher(chroma_dir) if chroma_dir is not None else None
+
+    def _refresh(self):
+        mtime = _mtime(self.path)
+        if mtime != self._pools_mtime:
+            self._pools_mtime = mtime
+            self._data = None
+            if mtime is not None:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    self._data = json.load(f)
+
+    def get(self, query: str, subject=None, classe=None, anno=None):
+        """Ritorna (docs, metas) deduplicati oppure None se non disponibile."""
+        self._refresh()
+        data = self._data
+        if data is None:
+            return None
+        if self._version is not None and data.get("index_version") != self._version.current():
+            return None
+
+        indexes = data["pools"].get(pool_key(query, subject, classe, anno))
+        if indexes is None:
+            return None
+        return [data["docs"][i] for i in indexes], [data["metas"][i] for i in indexes]
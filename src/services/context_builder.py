@@ -0,0 +1,130 @@
+# services/context_builder.py
+"""
+Contesto con budget di token e compressione estrattiva.
+
+Invece di concatenare per intero i chunk selezionati (6 × ~500 parole), si spezzano
+in frasi, si ordinano per similarità con la query usando lo stesso modello di embedding
+del retriever, si scartano le frasi ridondanti e si riempie il budget con le migliori.
+Le frasi scelte restano nell'ordine originale, raggruppate per fonte.
+
+La compressione è opt-in (SAGE_CONTEXT_COMPRESSION=1 o SAGE_CONTEXT_BUDGET=<token>):
+costa una encode di tutte le frasi dei chunk a ogni richiesta, sulla CPU del worker,
+e conviene solo dove il prompt più corto fa risparmiare più latenza LLM di quanta ne aggiunga.
+"""
+
+import os
+import re
+
+import numpy as np
+
+from services.metrics import counter
+
+CONTEXT_COMPRESSION = os.getenv("SAGE_CONTEXT_COMPRESSION", "0") == "1"
+# Budget di token del contesto per provider, con la compressione attiva
+# (SAGE_CONTEXT_BUDGET: budget unico per tutti, 0 = disattivato)
+CONTEXT_BUDGETS = {
+    "groq": 1500,    # llama3-8b-8192: finestra piccola, latenza sensibile all'input
+    "claude": 2500,  # claude-3-5-haiku
+}
+DEFAULT_BUDGET = 2000
+# Oltre questa similarità una frase è considerata un doppione di una già scelta
+REDUNDANCY_THRESHOLD = 0.9
+# Frasi troppo corte (titoli, elenchi spezzati) non valgono un posto nel budget
+MIN_SENTENCE_CHARS = 20
+
+CONTEXT_TOKENS = counter(
+    "sage_context_tokens_total",
+    "Token stimati del contesto: full (senza compressione), used (inviati), saved",
+    labelnames=("kind",),
+)
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?;])\s+|\n+")
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 caratteri per token: stima sufficiente per il budget, senza tokenizer del provider
+    return (len(text) + 3) // 4
+
+
+def context_budget_for(provider):
+    env = os.getenv("SAGE_CONTEXT_BUDGET")
+    if env is not None:
+        budget = int(env)
+        return budget if budget > 0 else None
+    if not CONTEXT_COMPRESSION:
+        return None
+    return CONTEXT_BUDGETS.get(provider, DEFAULT_BUDGET)
+
+
+def split_sentences(text: str):
+    return [s.strip() for s in _SENTENCE_SPLIT.split(text) if len(s.strip()) >= MIN_SENTENCE_CHARS]
+
+
+def source_header(meta) -> str:
+    source = meta.get("title", "Sconosciuto")
+    classe = meta.get("classe", "?")
+    anno = meta.get("anno", "?")
+    subject = meta.get("subject", "?")
+    return f"[Fonte: {source} | Classe: {classe} {anno} | Materia: {subject}]"
+
+
+def _normalize(matrix):
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def build_budgeted_context(query, docs, metas, budget, encode, full_context=None):
+    """
+    Ritorna (context, stats) con stats = {"tokens_full", "tokens_used", "tokens_saved"}.
+    `encode` è la encode del SentenceTransformer (lista di testi → matrice).
+    """
+    if full_context is None:
+        full_context = "\n\n".join(f"{source_header(m)}\n{d}" for d, m in zip(docs, metas))
+    tokens_full = estimate_tokens(full_context)
+
+    sentences = []  # (doc_idx, pos, testo)
+    for doc_idx, doc in enumerate(docs):
+        for pos, sentence in enumerate(split_sentences(doc)):
+            sentences.append((doc_idx, pos, sentence))
+
+    if tokens_full <= budget or not sentences:
+        context = full_context
+    else:
+        vectors = _normalize(encode([query] + [s for _, _, s in sentences]))
+        query_vec, sent_vecs = vectors[0], vectors[1:]
+        scores = sent_vecs @ query_vec
+
+        selected = []
+        used_docs = set()
+        used = 0
+        for i in np.argsort(-scores):
+            doc_idx, _, sentence = sentences[i]
+            cost = estimate_tokens(sentence) + 1
+            if doc_idx not in used_docs:
+                cost += estimate_tokens(source_header(metas[doc_idx])) + 1
+            if used + cost > budget:
+                continue
+            if selected and float(np.max(sent_vecs[selected] @ sent_vecs[i])) >= REDUNDANCY_THRESHOLD:
+                continue
+            selected.append(i)
+            used_docs.add(doc_idx)
+            used += cost
+
+        parts = []
+        for doc_idx in sorted(used_docs):
+            kept = sorted((sentences[i][1], sentences[i][2]) for i in selected if sentences[i][0] == doc_idx)
+            parts.append(f"{source_header(metas[doc_idx])}\n" + " ".join(s for _, s in kept))
+        context = "\n\n".join(parts)
+
+    tokens_used = estimate_tokens(context)
+    stats = {
+        "tokens_full": tokens_full,
+        "tokens_used": tokens_used,
+        "tokens_saved": max(tokens_full - tokens_used, 0),
+    }
+    CONTEXT_TOKENS.inc(stats["tokens_full"], kind="full")
+    CONTEXT_TOKENS.inc(stats["tokens_used"], kind="used")
+    CONTEXT_TOKENS.inc(stats["tokens_saved"], kind="saved")
+    return context, stats
@@ -0,0 +1,77 @@
+# services/deadline.py
+"""
+Deadline per richiesta, propagata dalla route fino alla chiamata LLM.
+
+La route crea un Deadline; retrieval, costruzione del contesto e chiamata LLM
+lo ricevono con l'input della chain. Prima di ogni fase costosa si controlla il
+tempo rimasto: se non basta per arrivare in fondo la richiesta viene scartata subito
+(shed) invece di occupare un worker per una risposta che arriverebbe tardi.
+Il tempo rimasto diventa il timeout passato al provider LLM.
+"""
+
+import os
+import time
+
+from services.metrics import counter
+
+# Budget di default per richiesta (secondi) e massimo accettato dall'header X-Request-Timeout
+REQUEST_TIMEOUT = float(os.getenv("SAGE_REQUEST_TIMEOUT", "30"))
+# Tempo minimo perché abbia senso iniziare retrieval + chiamata LLM
+MIN_LLM_SECONDS = float(os.getenv("SAGE_MIN_LLM_SECONDS", "1.0"))
+
+# Status del risultato quando il budget della richiesta è esaurito
+DEADLINE_STATUS = 5
+
+DEADLINE_EVENTS = counter(
+    "sage_deadline_total",
+    "Richieste interrotte per deadline: shed (scartate prima della fase) o expired (scadute durante)",
+    labelnames=("stage", "outcome"),
+)
+
+
+class DeadlineExceeded(Exception):
+    def __init__(self, stage, shed=False):
+        self.stage = stage
+        self.shed = shed
+        what = "scartata prima di" if shed else "scaduta durante"
+        super().__init__(f"Deadline {what} {stage}")
+
+
+class Deadline:
+    def __init__(self, seconds=REQUEST_TIMEOUT, clock=time.monotonic):
+        self.clock = clock
+        self.expires_at = clock() + seconds
+
+    def remaining(self):
+        return max(self.expires_at - self.clock(), 0.0)
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, stage, reserve=0.0):
+        """
+        Da chiamare prima di una fase: solleva DeadlineExceeded (shed) se restano
+        meno di `reserve` secondi, cioè la richiesta non può più finire in tempo.
+        """
+        if self.remaining() <= reserve:
+            DEADLINE_EVENTS.inc(stage=stage, outcome="shed")
+            raise DeadlineExceeded(stage, shed=True)
+
+    def exceeded(self, stage):
+        """Eccezione da sollevare quando una fase è stata interrotta dal timeout."""
+        DEADLINE_EVENTS.inc(stage=stage, outcome="expired")
+        return DeadlineExceeded(stage)
+
+
+def deadline_from_header(value, default=REQUEST_TIMEOUT):
+    """
+    Deadline dall'header X-Request-Timeout (secondi), limitato al default di configurazione.
+    Valori mancanti o non numerici → default.
+    """
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        seconds = default
+    if seconds != seconds or seconds < 0:  # NaN o negativo
+        seconds = default
+    return Deadline(min(seconds, default))
@@ -0,0 +1,209 @@
+# services/embed_batcher.py
+"""
+Micro-batching degli embedding delle query (SAGE_EMBED_BATCHING=1).
+
+Ogni richiesta codifica una sola domanda: sotto carico la CPU esegue tanti forward pass
+piccoli invece di pochi grandi. Qui le richieste accodano il testo e ricevono un future;
+un thread raccoglie fino a EMBED_BATCH_SIZE testi (sotto carico aspetta al massimo
+EMBED_BATCH_WAIT_MS dal primo), esegue un solo encode e risolve i future.
+Testi uguali nello stesso batch sono codificati una volta.
+
+Benchmark (throughput e p99 a vari livelli di concorrenza, diretto vs micro-batch):
+    python -m services.embed_batcher            # modello vero (retriever_chain.embedder)
+    python -m services.embed_batcher --synthetic
+"""
+
+import os
+import time
+import queue
+import argparse
+import threading
+import concurrent.futures
+
+import numpy as np
+
+from services.metrics import histogram
+from services.log import get_logger
+
+logger = get_logger("embed_batcher")
+
+EMBED_BATCHING = os.getenv("SAGE_EMBED_BATCHING", "0") == "1"
+EMBED_BATCH_SIZE = int(os.getenv("SAGE_EMBED_BATCH_SIZE", "32"))
+EMBED_BATCH_WAIT_MS = float(os.getenv("SAGE_EMBED_BATCH_WAIT_MS", "2"))
+
+BENCHMARK_CONCURRENCY = (1, 4, 16, 64)
+BENCHMARK_REQUESTS = 512
+
+EMBED_BATCH = histogram(
+    "sage_embed_batch_size", "Testi per encode del micro-batcher", buckets=(1, 2, 4, 8, 16, 32, 64, 128)
+)
+EMBED_QUEUE_WAIT = histogram(
+    "sage_embed_queue_wait_seconds",
+    "Attesa di un testo nel micro-batcher prima dell'encode",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.025, 0.05, 0.1),
+)
+
+
+class MicroBatcher:
+    """
+    encode_batch(lista di testi) → array (una riga per testo), es. SentenceTransformer.encode.
+    Il thread parte al primo utilizzo e riparte in un processo figlio dopo un fork
+    (i thread non sopravvivono al fork: vedi serve.py).
+    """
+
+    def __init__(self, encode_batch, max_batch=EMBED_BATCH_SIZE, max_wait=EMBED_BATCH_WAIT_MS / 1000):
+        self.encode_batch = encode_batch
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self._queue = None
+        self._pid = None
+        self._last_batch = 0
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return self._queue
+        with self._lock:
+            if self._pid != os.getpid():
+                self._queue = queue.SimpleQueue()
+                threading.Thread(target=self._run, args=(self._queue,), name="embed-batcher", daemon=True).start()
+                self._pid = os.getpid()
+            return self._queue
+
+    def submit(self, text):
+        future = concurrent.futures.Future()
+        self._ensure_worker().put((text, future, time.perf_counter()))
+        return future
+
+    def encode(self, text, timeout=None):
+        """Embedding di un testo (stessa riga che ritornerebbe encode_batch([text])[0])."""
+        return self.submit(text).result(timeout)
+
+    def _collect(self, q):
+        batch = [q.get()]
+        # si aspetta altri testi solo sotto carico (ultimo batch con più testi):
+        # una richiesta isolata non paga l'attesa
+        until = time.perf_counter() + (self.max_wait if self._last_batch > 1 else 0.0)
+        while len(batch) < self.max_batch:
+            remaining = until - time.perf_counter()
+            try:
+                # oltre l'attesa massima si prende solo ciò che è già in coda
+                batch.append(q.get(timeout=remaining) if remaining > 0 else q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, q):
+        while True:
+            batch = self._collect(q)
+            self._last_batch = len(batch)
+            started = time.perf_counter()
+            live = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not live:
+                continue
+            texts = list(dict.fromkeys(text for text, _, _ in live))
+            EMBED_BATCH.observe(len(texts))
+            for _, _, queued_at in live:
+                EMBED_QUEUE_WAIT.observe(started - queued_at)
+            try:
+                vectors = self.encode_batch(texts)
+            except Exception as e:
+                for _, future, _ in live:
+                    future.set_exception(e)
+                continue
+            rows = dict(zip(texts, vectors))
+            for text, future, _ in live:
+                future.set_result(rows[text])
+
+
+# ---------------- benchmark ----------------
+
+class SyntheticEncoder:
+    """
+    Encoder CPU-bound con la stessa forma di costo di un transformer piccolo:
+    costo fisso per chiamata (overhead Python/NumPy) + costo per testo (due matmul su 16 "token").
+    Serve solo per il benchmark quando il modello vero non è disponibile.
+    """
+
+    def __init__(self, dim=384, hidden=1536, seed=0):
+        rng = np.random.default_rng(seed)
+        self.w1 = rng.standard_normal((dim, hidden)).astype(np.float32)
+        self.w2 = rng.standard_normal((hidden, dim)).astype(np.float32)
+        self.dim = dim
+
+    def _features(self, text):
+        x = np.zeros(self.dim, dtype=np.float32)
+        for token in text.split():
+            x[hash(token) % self.dim] += 1.0
+        return x
+
+    def encode(self, texts):
+        single = isinstance(texts, str)
+        x = np.stack([self._features(t) for t in ([texts] if single else texts)])
+        # padding a 16 "token" per testo: come la sequenza di un transformer
+        h = np.maximum(np.repeat(x, 16, axis=0) @ self.w1, 0) @ self.w2
+        out = h.reshape(len(x), 16, self.dim).mean(axis=1)
+        return out[0] if single else out
+
+
+def _run_level(encode_one, concurrency, requests):
+    latencies = []
+    lock = threading.Lock()
+    per_thread = max(1, requests // concurrency)
+
+    def client(worker):
+        local = []
+        for i in range(per_thread):
+            start = time.perf_counter()
+            encode_one(f"domanda {worker} numero {i} sulla storia romana")
+            local.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(w,)) for w in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[min(len(latencies) - 1, int(0.99 * len(latencies)))] * 1000,
+    }
+
+
+def benchmark(encode_batch, levels=BENCHMARK_CONCURRENCY, requests=BENCHMARK_REQUESTS):
+    """{concorrenza: {"direct": {...}, "batched": {...}}} con throughput (encode/s), p50 e p99 (ms)."""
+    batcher = MicroBatcher(encode_batch)
+    report = {}
+    for level in levels:
+        report[level] = {
+            "direct": _run_level(lambda text: encode_batch([text])[0], level, requests),
+            "batched": _run_level(batcher.encode, level, requests),
+        }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark del micro-batching degli embedding")
+    parser.add_argument("--synthetic", action="store_true", help="encoder sintetico invece del modello")
+    parser.add_argument("--requests", type=int, default=BENCHMARK_REQUESTS)
+    args = parser.parse_args(argv)
+
+    if args.synthetic:
+        encode_batch = SyntheticEncoder().encode
+    else:
+        from services.retriever_chain import embedder
+        encode_batch = embedder.encode
+
+    print(f"{'conc.':>5} {'modo':<8} {'enc/s':>8} {'p50 ms':>8} {'p99 ms':>8}")
+    for level, modes in benchmark(encode_batch, requests=args.requests).items():
+        for mode, row in modes.items():
+            print(f"{level:>5} {mode:<8} {row['throughput']:>8.1f} {row['p50_ms']:>8.2f} {row['p99_ms']:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+# services/health.py
+"""
+Liveness, readiness e memoria del processo, per /healthz, /readyz e /metrics.
+
+  - /healthz: il processo risponde (nessun controllo sulle dipendenze);
+  - /readyz: embedder, indice Chroma e schemi sono caricati, il worker può ricevere traffico.
+La memoria viene letta da /proc/self/smaps_rollup (Linux): con i worker forkati dal
+master l'RSS conta anche le pagine condivise (modello, indice), USS e PSS no.
+"""
+
+import os
+
+from services.metrics import gauge
+
+MEMORY_KINDS = ("rss", "pss", "uss", "shared")
+
+PROCESS_MEMORY = gauge(
+    "sage_process_memory_bytes",
+    "Memoria del processo: rss (totale residente), pss (condivisa ripartita), uss (privata), shared",
+    labelnames=("kind",),
+)
+
+
+def memory_usage(pid="self"):
+    """Byte di memoria del processo per tipo (MEMORY_KINDS); {} se /proc non è disponibile."""
+    fields = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r", encoding="ascii") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    fields[parts[0].rstrip(":")] = int(parts[1]) * 1024
+    except OSError:
+        return {}
+    return {
+        "rss": fields.get("Rss", 0),
+        "pss": fields.get("Pss", 0),
+        "uss": fields.get("Private_Clean", 0) + fields.get("Private_Dirty", 0),
+        "shared": fields.get("Shared_Clean", 0) + fields.get("Shared_Dirty", 0),
+    }
+
+
+def record_memory():
+    """Aggiorna i gauge della memoria (da chiamare prima di esporre /metrics)."""
+    for kind, value in memory_usage().items():
+        PROCESS_MEMORY.set(value, kind=kind)
+
+
+def liveness():
+    return {"status": "ok", "pid": os.getpid()}
+
+
+def readiness():
+    """(pronto?, dettaglio dei controlli)."""
+    # import locali: /healthz non deve dipendere dal caricamento del modello
+    from services import retriever_chain
+    from validators.validator_schemas import get_registry
+
+    checks = {
+        "embedder": retriever_chain.embedder is not None,
+        "index": retriever_chain.collection is not None,
+    }
+    try:
+        checks["schemas"] = bool(get_registry().types())
+    except Exception:
+        checks["schemas"] = False
+    ready = all(checks.values())
+    return ready, {"status": "ready" if ready else "not ready", "pid": os.getpid(), "checks": checks}
@@ -0,0 +1,394 @@
+# services/hedging.py
+"""
+Richieste "hedged" e failover tra provider (Groq / Claude).
+
+Si invia la richiesta al provider scelto; se non risponde entro un ritardo basato
+sul p95 delle sue latenze recenti, si manda la stessa richiesta all'altro provider.
+Vince la prima risposta valida, l'altra viene cancellata. Ogni provider ha un
+circuit breaker: dopo troppi errori consecutivi viene escluso per un po'.
+"""
+
+import os
+import time
+import asyncio
+import threading
+import concurrent.futures
+from collections import deque
+
+from services.metrics import counter, gauge
+from services.log import get_logger
+from services.json_repair import repair_json, JsonRepairError
+from services.json_stream import JsonObjectScanner, JsonStreamError, _chunk_text
+from services.rate_limiter import RateLimited
+
+logger = get_logger("hedging")
+
+HEDGING_ENABLED = os.getenv("SAGE_HEDGING", "0") == "1"
+# Ritardo di hedge usato finché non ci sono abbastanza campioni per il p95
+DEFAULT_HEDGE_DELAY = float(os.getenv("SAGE_HEDGE_DELAY", "3.0"))
+MIN_HEDGE_DELAY = 0.2
+MIN_SAMPLES = 20
+LATENCY_WINDOW = 200
+
+BREAKER_FAILURES = int(os.getenv("SAGE_BREAKER_FAILURES", "5"))
+BREAKER_RESET_SECONDS = float(os.getenv("SAGE_BREAKER_RESET", "30"))
+
+HEDGE_EVENTS = counter(
+    "sage_hedge_events_total",
+    "Eventi di hedging: hedged (seconda richiesta inviata), winner (provider vincente), failure",
+    labelnames=("event", "provider"),
+)
+BREAKER_STATE = gauge(
+    "sage_circuit_breaker_open",
+    "1 se il circuit breaker del provider è aperto",
+    labelnames=("provider",),
+)
+
+
+class CircuitBreaker:
+    """closed → (N errori consecutivi) → open → (dopo reset_timeout) → half-open → closed/open."""
+
+    def __init__(self, name, failure_threshold=BREAKER_FAILURES, reset_timeout=BREAKER_RESET_SECONDS, clock=time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._failures = 0
+        self._opened_at = None
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state()
+
+    def _state(self):
+        if self._opened_at is None:
+            return "closed"
+        if self.clock() - self._opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        with self._lock:
+            state = self._state()
+            if state == "closed":
+                return True
+            if state == "half_open" and not self._probe_in_flight:
+                # una sola richiesta di prova alla volta
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe_in_flight = False
+        BREAKER_STATE.set(0, provider=self.name)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probe_in_flight = False
+            if self._opened_at is not None or self._failures >= self.failure_threshold:
+                self._opened_at = self.clock()
+                opened = True
+            else:
+                opened = False
+        if opened:
+            BREAKER_STATE.set(1, provider=self.name)
+
+    def release(self):
+        """La richiesta è stata cancellata senza esito: libera lo slot di prova."""
+        with self._lock:
+            self._probe_in_flight = False
+
+
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def hedge_delay(self, default=DEFAULT_HEDGE_DELAY):
+        with self._lock:
+            samples = sorted(self._samples)
+        if len(samples) < MIN_SAMPLES:
+            return default
+        p95 = samples[min(len(samples) - 1, int(0.95 * len(samples)))]
+        return max(p95, MIN_HEDGE_DELAY)
+
+
+def looks_like_quiz_json(content):
+    """Risposta valida = contiene un oggetto JSON decodificabile (anche dopo la riparazione locale)."""
+    try:
+        repair_json(content)
+    except JsonRepairError:
+        return False
+    return True
+
+
+def _complete_object(text):
+    """Il testo contiene già un oggetto JSON chiuso (non solo riparabile)."""
+    try:
+        return JsonObjectScanner().feed(text) is not None
+    except JsonStreamError:
+        return False
+
+
+class NoProviderAvailable(RuntimeError):
+    pass
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _background_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="hedging-loop", daemon=True).start()
+        return _loop
+
+
+def background_loop_if_started():
+    """Il loop di background se è già stato avviato, senza crearlo."""
+    with _loop_lock:
+        return _loop
+
+
+class HedgedLLM:
+    """
+    Stessa interfaccia minima dei client LangChain (invoke/ainvoke) usata da build_rag_chain.
+    `providers` è una lista ordinata [(nome, llm)]: il primo è il provider richiesto.
+    `provider_kwargs` ({nome: kwargs}) si aggiunge agli argomenti di ogni chiamata a quel provider
+    (es. max_tokens / JSON mode, che non sono uguali per tutti).
+    `messages` può essere anche una funzione nome → messaggi: il prompt si costruisce per il
+    provider chiamato (es. il cache_control di Claude non va inviato a Groq).
+    """
+
+    per_provider_messages = True
+
+    def __init__(self, providers, breakers=None, trackers=None, is_valid=looks_like_quiz_json, provider_kwargs=None):
+        self.providers = providers
+        self.provider_kwargs = provider_kwargs or {}
+        self.breakers = breakers if breakers is not None else {}
+        self.trackers = trackers if trackers is not None else {}
+        self.is_valid = is_valid
+        for name, _ in providers:
+            self.breakers.setdefault(name, CircuitBreaker(name))
+            self.trackers.setdefault(name, LatencyTracker())
+
+    def invoke(self, messages, **kwargs):
+        # loop di background persistente: i client ottenuti fuori da un event loop
+        # (registry.get senza loop attivo) usano il pool async sempre e solo qui
+        future = asyncio.run_coroutine_threadsafe(self.ainvoke(messages, **kwargs), _background_loop())
+        try:
+            return future.result(timeout=kwargs.get("timeout"))
+        except concurrent.futures.TimeoutError:
+            # cancella le richieste ancora in volo sul loop di background
+            future.cancel()
+            raise
+
+    def stream(self, messages, **kwargs):
+        """
+        Lo streaming non viene duplicato: si usa il primo provider disponibile.
+        Il provider si sceglie alla prima lettura e l'esito va sul suo breaker come in _call.
+        """
+        name, llm = self._first_allowed()
+        chunks = self._open_stream(name, lambda: llm.stream(self._messages(name, messages), **self._kwargs(name, kwargs)))
+        text = []
+        try:
+            for chunk in chunks:
+                text.append(_chunk_text(chunk))
+                yield chunk
+        except GeneratorExit:
+            self._stream_outcome(name, "".join(text), finished=False)
+            raise
+        except RateLimited:
+            self.breakers[name].release()
+            raise
+        except Exception:
+            self._record_failure(name)
+            raise
+        finally:
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+        self._stream_outcome(name, "".join(text), finished=True)
+
+    async def astream(self, messages, **kwargs):
+        name, llm = self._first_allowed()
+        chunks = self._open_stream(name, lambda: llm.astream(self._messages(name, messages), **self._kwargs(name, kwargs)))
+        text = []
+        try:
+            async for chunk in chunks:
+                text.append(_chunk_text(chunk))
+                yield chunk
+        except (GeneratorExit, asyncio.CancelledError):
+            self._stream_outcome(name, "".join(text), finished=False)
+            raise
+        except RateLimited:
+            self.breakers[name].release()
+            raise
+        except Exception:
+            self._record_failure(name)
+            raise
+        finally:
+            aclose = getattr(chunks, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        self._stream_outcome(name, "".join(text), finished=True)
+
+    def _open_stream(self, name, open_stream):
+        try:
+            return open_stream()
+        except RateLimited:
+            self.breakers[name].release()
+            raise
+        except Exception:
+            self._record_failure(name)
+            raise
+
+    def _record_failure(self, name):
+        self.breakers[name].record_failure()
+        HEDGE_EVENTS.inc(event="failure", provider=name)
+
+    def _stream_outcome(self, name, text, finished):
+        # lo stream viene chiuso appena il primo oggetto JSON è completo (consume_stream):
+        # conta come successo; chiuso prima (deadline, abort) non ha un esito
+        if finished:
+            if self.is_valid(text):
+                self.breakers[name].record_success()
+            else:
+                self._record_failure(name)
+        elif _complete_object(text):
+            self.breakers[name].record_success()
+        else:
+            self.breakers[name].release()
+
+    @staticmethod
+    def _messages(name, messages):
+        return messages(name) if callable(messages) else messages
+
+    def _kwargs(self, name, kwargs):
+        return {**self.provider_kwargs.get(name, {}), **kwargs}
+
+    def _first_allowed(self):
+        for name, llm in self.providers:
+            if self.breakers[name].allow():
+                return name, llm
+        raise NoProviderAvailable("Tutti i provider LLM hanno il circuit breaker aperto")
+
+    async def _call(self, name, llm, messages, kwargs):
+        start = time.perf_counter()
+        try:
+            response = await llm.ainvoke(self._messages(name, messages), **self._kwargs(name, kwargs))
+        except (asyncio.CancelledError, RateLimited):
+            # nessuna risposta dal provider (cancellata o trattenuta dal limiter locale)
+            self.breakers[name].release()
+            raise
+        except Exception:
+            self._record_failure(name)
+            raise
+        self.trackers[name].observe(time.perf_counter() - start)
+        if self.is_valid(getattr(response, "content", "")):
+            self.breakers[name].record_success()
+        else:
+            self._record_failure(name)
+        return response
+
+    async def ainvoke(self, messages, **kwargs):
+        pending = {}
+        waiting = list(self.providers)
+        last_response, last_error = None, None
+
+        def launch():
+            # il breaker si consulta solo al momento dell'invio (lo slot half-open è uno solo)
+            while waiting:
+                name, llm = waiting.pop(0)
+                if self.breakers[name].allow():
+                    task = asyncio.ensure_future(self._call(name, llm, messages, kwargs))
+                    pending[task] = name
+                    return name
+            return None
+
+        primary = launch()
+        if primary is None:
+            raise NoProviderAvailable("Tutti i provider LLM hanno il circuit breaker aperto")
+        delay = self.trackers[primary].hedge_delay()
+
+        try:
+            while pending:
+                timeout = delay if waiting else None
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # primo provider lento: hedge verso il successivo
+                    hedged = launch()
+                    if hedged is None:
+                        continue
+                    HEDGE_EVENTS.inc(event="hedged", provider=hedged)
+                    logger.info("Hedge: %s oltre %.2fs, invio anche a %s", primary, delay, hedged)
+                    continue
+
+                for task in done:
+                    name = pending.pop(task)
+                    try:
+                        response = task.result()
+                    except Exception as e:
+                        last_error = e
+                        continue
+                    if self.is_valid(getattr(response, "content", "")):
+                        HEDGE_EVENTS.inc(event="winner", provider=name)
+                        return response
+                    last_response = response
+
+                # risposta non valida o errore: si passa subito al provider successivo
+                if waiting and not pending:
+                    launch()
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+        if last_response is not None:
+            return last_response
+        raise last_error
+
+
+# Stato condiviso per provider: breaker e latenze sopravvivono tra richieste
+_breakers = {}
+_trackers = {}
+
+
+def configured_providers():
+    """Provider con chiave API configurata, nell'ordine di preferenza."""
+    keys = {"groq": "GROQ_API_KEY", "claude": "ANTHROPIC_API_KEY"}
+    return [name for name, env in keys.items() if os.getenv(env)]
+
+
+def get_hedged_llm(provider, get_llm, call_kwargs=None):
+    """
+    HedgedLLM con `provider` come primario e gli altri provider configurati come riserva.
+    `call_kwargs(nome)` (opzionale) ritorna gli argomenti di chiamata specifici del provider.
+    """
+    names = [provider] + [p for p in configured_providers() if p != provider]
+    providers = []
+    for name in names:
+        try:
+            providers.append((name, get_llm(name)))
+        except Exception:
+            if name == provider:
+                raise
+            logger.warning("Provider di riserva %s non inizializzabile", name)
+    provider_kwargs = {name: call_kwargs(name) for name, _ in providers} if call_kwargs else None
+    return HedgedLLM(providers, breakers=_breakers, trackers=_trackers, provider_kwargs=provider_kwargs)
@@ -0,0 +1,199 @@
+# services/index_versions.py
+"""
+Versioni dell'indice Chroma e alias della versione attiva (reindex senza downtime).
+
+Layout sotto la cartella dell'indice (CHROMA_DIR):
+    CURRENT               nome della versione attiva (alias)
+    versions/<versione>/  un indice Chroma completo per versione
+Un reindex completo scrive in una versione nuova ("shadow"), la valida e poi sostituisce
+CURRENT con os.replace (atomico): il servizio vede il nuovo alias alla query successiva
+e riapre i handle senza riavvio. Le versioni vecchie oltre le ultime KEEP_VERSIONS
+vengono cancellate.
+Senza CURRENT (indici creati prima delle versioni) l'indice è la cartella stessa. Dopo il
+primo publish i worker la leggono ancora finché non vedono l'alias (e Chroma apre i file
+dei segmenti solo quando servono): collect_garbage la segna come ritirata (LEGACY_MARKER)
+e ne cancella i file solo in un run successivo, passati LEGACY_GRACE_SECONDS.
+"""
+
+import os
+import time
+import uuid
+import shutil
+import contextlib
+
+from services.log import get_logger
+
+logger = get_logger("index_versions")
+
+ALIAS_FILE = "CURRENT"
+VERSIONS_DIR = "versions"
+# Versioni tenute su disco (attiva compresa): la precedente serve alle query ancora in volo
+KEEP_VERSIONS = int(os.getenv("SAGE_INDEX_KEEP_VERSIONS", "2"))
+# Query di prova sulla versione shadow prima dello swap
+VALIDATION_SAMPLES = 5
+# File dell'indice senza versioni nella radice (oltre alle cartelle dei segmenti, con nome uuid)
+LEGACY_FILES = ("chroma.sqlite3", "chroma.sqlite3-wal", "chroma.sqlite3-shm", "chroma.sqlite3-journal", "index_version")
+# Segna quando l'indice senza versioni è stato ritirato (mtime); i file restano per il periodo di grazia
+LEGACY_MARKER = "LEGACY_RETIRED"
+LEGACY_GRACE_SECONDS = float(os.getenv("SAGE_INDEX_LEGACY_GRACE", "3600"))
+
+
+class IndexValidationError(RuntimeError):
+    pass
+
+
+def version_dir(root, version):
+    return os.path.join(root, VERSIONS_DIR, version)
+
+
+def current_version(root):
+    try:
+        with open(os.path.join(root, ALIAS_FILE), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def index_dir(root):
+    """Cartella della versione attiva (root stessa se non ci sono versioni)."""
+    version = current_version(root)
+    return version_dir(root, version) if version else root
+
+
+def new_version(root):
+    """Crea la cartella di una nuova versione (shadow); ritorna (versione, cartella)."""
+    # il prefisso temporale ordina le versioni per data di creazione
+    version = time.strftime("%Y%m%d-%H%M%S") + "-" + uuid.uuid4().hex[:8]
+    path = version_dir(root, version)
+    os.makedirs(path)
+    return version, path
+
+
+def publish(root, version):
+    """Rende attiva `version` sostituendo l'alias in modo atomico."""
+    if not os.path.isdir(version_dir(root, version)):
+        raise FileNotFoundError(f"Versione dell'indice inesistente: {version}")
+    tmp_path = os.path.join(root, f"{ALIAS_FILE}.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, ALIAS_FILE))
+    logger.info("Indice: versione attiva %s", version)
+
+
+def discard(root, version):
+    """Cancella una versione shadow non pubblicata (es. validazione fallita)."""
+    if version != current_version(root):
+        shutil.rmtree(version_dir(root, version), ignore_errors=True)
+
+
+def collect_garbage(root, keep=KEEP_VERSIONS, legacy_grace=LEGACY_GRACE_SECONDS, clock=time.time):
+    """
+    Cancella le versioni più vecchie oltre le ultime `keep`; l'attiva non viene mai toccata.
+    L'indice senza versioni nella radice viene cancellato solo `legacy_grace` secondi dopo
+    il primo run che lo ha trovato ritirato.
+    """
+    try:
+        versions = sorted(os.listdir(os.path.join(root, VERSIONS_DIR)), reverse=True)
+    except FileNotFoundError:
+        return []
+    active = current_version(root)
+    removed = []
+    for version in versions[max(keep, 1):]:
+        if version == active:
+            continue
+        shutil.rmtree(version_dir(root, version), ignore_errors=True)
+        removed.append(version)
+    if removed:
+        logger.info("Indice: rimosse %d versioni vecchie", len(removed))
+    if active is not None:
+        _collect_legacy_index(root, legacy_grace, clock)
+    return removed
+
+
+def _is_segment_dir(path):
+    try:
+        uuid.UUID(os.path.basename(path))
+    except ValueError:
+        return False
+    return os.path.isdir(path)
+
+
+def _collect_legacy_index(root, grace, clock):
+    legacy = [
+        path for path in (os.path.join(root, name) for name in os.listdir(root))
+        if os.path.basename(path) in LEGACY_FILES or _is_segment_dir(path)
+    ]
+    marker = os.path.join(root, LEGACY_MARKER)
+    if not legacy:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(marker)
+        return
+    try:
+        retired_at = os.stat(marker).st_mtime
+    except FileNotFoundError:
+        # primo run dopo il publish: i worker possono ancora avere l'indice aperto
+        now = clock()
+        open(marker, "w").close()
+        os.utime(marker, (now, now))
+        logger.info("Indice: indice senza versioni ritirato, cancellazione tra %.0fs", grace)
+        return
+    if clock() - retired_at < grace:
+        return
+    for path in legacy:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(path)
+    os.unlink(marker)
+    logger.info("Indice: rimosso l'indice senza versioni nella radice (%d voci)", len(legacy))
+
+
+def validate_index(collection, expected_count, samples=()):
+    """
+    Controlli sulla versione shadow prima dello swap: numero di documenti e query di prova.
+    `samples` è una lista di (id, embedding) di chunk indicizzati: ognuno deve ritrovare se stesso
+    (o un chunk con lo stesso vettore, es. testi duplicati).
+    """
+    count = collection.count()
+    if count != expected_count:
+        raise IndexValidationError(f"Documenti nell'indice: {count}, attesi {expected_count}")
+    for chunk_id, embedding in samples:
+        result = collection.query(query_embeddings=[embedding], n_results=3, include=["distances"])
+        ids = result["ids"][0] if result.get("ids") else []
+        distances = result["distances"][0] if result.get("distances") else []
+        if chunk_id not in ids and not (distances and distances[0] <= 1e-6):
+            raise IndexValidationError(f"Query di prova: il chunk {chunk_id} non ritrova se stesso")
+
+
+def _stamp(path):
+    # os.replace crea sempre un inode nuovo: cambia anche se l'mtime ha risoluzione grossolana
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_mtime_ns
+
+
+class IndexAlias:
+    """Versione attiva dell'indice in `root`; l'alias viene riletto solo quando cambia il file."""
+
+    _UNREAD = object()
+
+    def __init__(self, root):
+        self.root = root
+        self._stamp = self._UNREAD
+        self._version = None
+
+    def version(self):
+        stamp = _stamp(os.path.join(self.root, ALIAS_FILE))
+        if stamp != self._stamp:
+            self._stamp = stamp
+            self._version = current_version(self.root)
+        return self._version
+
+    def path(self):
+        version = self.version()
+        return version_dir(self.root, version) if version else self.root
@@ -0,0 +1,405 @@
+# services/jobs.py
+"""
+API a job: la richiesta di quiz viene accodata e il client riceve subito un id.
+
+Un pool limitato di worker esegue i job; i risultati si leggono con polling
+(GET /jobs/<id>) o come Server-Sent Events (GET /jobs/<id>/events).
+La coda ha una profondità massima: oltre il limite la richiesta viene rifiutata
+subito (429 + Retry-After) invece di rallentare tutti.
+
+Senza SAGE_JOB_DB i job stanno nella memoria del processo: va bene con un solo processo.
+Con SAGE_JOB_DB=<file> la coda è su SQLite, condivisa dai processi della macchina (worker
+gunicorn): GET /jobs/<id> risponde da qualunque worker e i thread prendono i job con claim(),
+che assegna un lease di JOB_LEASE_SECONDS (più lungo del deadline di un job). Un lease scaduto
+vuol dire processo morto: il job torna assegnabile, anche dopo un riavvio, senza toccare
+quelli in corso negli altri processi. Con più worker gunicorn e SAGE_JOB_DB vuoto si usa
+SHARED_JOB_DB (vedi configure()). La profondità massima vale per tutta la coda condivisa.
+"""
+
+import os
+import json
+import math
+import time
+import uuid
+import socket
+import sqlite3
+import threading
+from collections import deque
+
+from services.deadline import Deadline, REQUEST_TIMEOUT
+from services.metrics import counter, gauge, histogram
+from services.log import get_logger
+
+logger = get_logger("jobs")
+
+JOB_WORKERS = int(os.getenv("SAGE_JOB_WORKERS", "4"))
+JOB_QUEUE_DEPTH = int(os.getenv("SAGE_JOB_QUEUE_DEPTH", "100"))
+JOB_DB = os.getenv("SAGE_JOB_DB", "")
+# Coda condivisa usata con più processi se SAGE_JOB_DB non è impostato
+SHARED_JOB_DB = "../data/jobs.sqlite"
+# Lease di un job in esecuzione: oltre il suo deadline, con margine
+JOB_LEASE_SECONDS = float(os.getenv("SAGE_JOB_LEASE", str(REQUEST_TIMEOUT + 30)))
+# Ogni quanto si ricontrolla la coda condivisa (job accodati o finiti in altri processi)
+JOB_POLL_SECONDS = 0.5
+# Per quanto restano leggibili i job finiti (secondi)
+JOB_TTL = float(os.getenv("SAGE_JOB_TTL", "3600"))
+# Durata di un job stimata finché non ce ne sono di misurati (per Retry-After)
+DEFAULT_JOB_SECONDS = 5.0
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+FINISHED = (DONE, FAILED)
+
+JOB_EVENTS = counter(
+    "sage_jobs_total",
+    "Job: submitted, rejected (coda piena), done, failed, requeued (ripresi dopo un lease scaduto)",
+    labelnames=("event",),
+)
+JOB_QUEUE_DEPTH_GAUGE = gauge("sage_job_queue_depth", "Job in coda in attesa di un worker")
+JOB_QUEUE_WAIT = histogram("sage_job_queue_wait_seconds", "Attesa in coda prima dell'esecuzione")
+JOB_RUN_TIME = histogram("sage_job_run_seconds", "Durata di esecuzione dei job")
+
+
+class QueueFull(Exception):
+    def __init__(self, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f"Coda job piena, riprovare tra {retry_after}s")
+
+
+def public_view(job):
+    """Campi del job esposti al client (senza il payload)."""
+    view = {k: job.get(k) for k in ("id", "status", "created_at", "started_at", "finished_at")}
+    if job["status"] == DONE:
+        view["result"] = job.get("result")
+    elif job["status"] == FAILED:
+        view["error"] = job.get("error")
+    return view
+
+
+class StoreClosed(RuntimeError):
+    """Lo store è stato chiuso (shutdown): i worker della coda si fermano."""
+
+
+class JobStore:
+    """Job in memoria (un solo processo), con notifica dei cambi di stato (per SSE)."""
+
+    def __init__(self, ttl=JOB_TTL, clock=time.time):
+        self.ttl = ttl
+        self.clock = clock
+        self._jobs = {}
+        self._queued = deque()
+        self._changed = threading.Condition()
+
+    def put(self, job):
+        with self._changed:
+            self._evict_finished()
+            self._jobs[job["id"]] = dict(job)
+            if job["status"] == QUEUED:
+                self._queued.append(job["id"])
+            self._changed.notify_all()
+
+    def update(self, job_id, **fields):
+        with self._changed:
+            self._jobs[job_id].update(fields)
+            self._changed.notify_all()
+
+    def get(self, job_id):
+        with self._changed:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def claim(self, owner, timeout):
+        """Il prossimo job in coda, già segnato running; None se non arriva entro `timeout`."""
+        with self._changed:
+            if not self._changed.wait_for(lambda: self._queued, timeout):
+                return None
+            job = self._jobs[self._queued.popleft()]
+            job.update(status=RUNNING, started_at=self.clock())
+            self._changed.notify_all()
+            return dict(job)
+
+    def depth(self):
+        """Job in attesa di un worker."""
+        with self._changed:
+            return len(self._queued)
+
+    def unfinished(self):
+        with self._changed:
+            return sum(1 for j in self._jobs.values() if j["status"] not in FINISHED)
+
+    def wait_for_change(self, job_id, status, timeout):
+        """Attende che lo stato del job sia diverso da `status` (o il timeout); ritorna il job."""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                job = self._jobs.get(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job["status"] != status or remaining <= 0:
+                    return dict(job) if job is not None else None
+                self._changed.wait(remaining)
+
+    def _evict_finished(self):
+        limit = self.clock() - self.ttl
+        expired = [i for i, j in self._jobs.items() if j["status"] in FINISHED and j["finished_at"] < limit]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+class SQLiteJobStore(JobStore):
+    """
+    Coda su SQLite condivisa tra processi: lo stato sta solo nel file, letto a ogni accesso.
+    I cambi fatti da altri processi si vedono con polling (JOB_POLL_SECONDS); quelli del
+    processo corrente svegliano subito i thread in attesa.
+    """
+
+    def __init__(self, path, ttl=JOB_TTL, clock=time.time, lease_seconds=JOB_LEASE_SECONDS, poll_seconds=JOB_POLL_SECONDS):
+        super().__init__(ttl=ttl, clock=clock)
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        # autocommit: le transazioni sono esplicite (BEGIN IMMEDIATE in claim/update)
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        self._closed = False
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, finished_at REAL, doc TEXT)")
+            # file di una versione precedente: colonne della coda aggiunte sul posto
+            columns = {row[1] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            for name, kind in (("created_at", "REAL"), ("owner", "TEXT"), ("lease_until", "REAL")):
+                if name not in columns:
+                    self._db.execute(f"ALTER TABLE jobs ADD COLUMN {name} {kind}")
+            self._db.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (clock() - ttl,))
+
+    def _transaction(self, work):
+        with self._db_lock:
+            if self._closed:
+                raise StoreClosed("Job store chiuso")
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                result = work()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        with self._changed:
+            self._changed.notify_all()
+        return result
+
+    def put(self, job):
+        def work():
+            self._db.execute("DELETE FROM jobs WHERE finished_at IS NOT NULL AND finished_at < ?", (self.clock() - self.ttl,))
+            self._db.execute(
+                "INSERT OR REPLACE INTO jobs (id, status, created_at, finished_at, doc) VALUES (?, ?, ?, ?, ?)",
+                (job["id"], job["status"], job.get("created_at"), job.get("finished_at"), json.dumps(job, ensure_ascii=False)),
+            )
+        self._transaction(work)
+
+    def update(self, job_id, **fields):
+        def work():
+            row = self._db.execute("SELECT doc FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            job = json.loads(row[0])
+            job.update(fields)
+            self._db.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, doc = ? WHERE id = ?",
+                (job["status"], job.get("finished_at"), json.dumps(job, ensure_ascii=False), job_id),
+            )
+        self._transaction(work)
+
+    def get(self, job_id):
+        with self._db_lock:
+            row = self._db.execute("SELECT doc FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def claim(self, owner, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self._transaction(lambda: self._claim(owner))
+            remaining = deadline - time.monotonic()
+            if job is not None or remaining <= 0:
+                return job
+            with self._changed:
+                self._changed.wait(min(remaining, self.poll_seconds))
+
+    def _claim(self, owner):
+        now = self.clock()
+        # running con lease scaduto (o senza lease, file di una versione precedente):
+        # il processo che lo eseguiva è morto
+        row = self._db.execute(
+            "SELECT doc FROM jobs WHERE status = ? OR (status = ? AND (lease_until IS NULL OR lease_until < ?))"
+            " ORDER BY created_at LIMIT 1",
+            (QUEUED, RUNNING, now),
+        ).fetchone()
+        if row is None:
+            return None
+        job = json.loads(row[0])
+        if job["status"] == RUNNING:
+            JOB_EVENTS.inc(event="requeued")
+        job.update(status=RUNNING, started_at=now)
+        self._db.execute(
+            "UPDATE jobs SET status = ?, owner = ?, lease_until = ?, doc = ? WHERE id = ?",
+            (RUNNING, owner, now + self.lease_seconds, json.dumps(job, ensure_ascii=False), job["id"]),
+        )
+        return job
+
+    def depth(self):
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (QUEUED,)).fetchone()[0]
+
+    def unfinished(self):
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", (QUEUED, RUNNING)).fetchone()[0]
+
+    def wait_for_change(self, job_id, status, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job["status"] != status or remaining <= 0:
+                return job
+            with self._changed:
+                self._changed.wait(min(remaining, self.poll_seconds))
+
+    def close(self):
+        with self._db_lock:
+            self._closed = True
+            self._db.close()
+
+
+class JobQueue:
+    def __init__(self, generate, workers=JOB_WORKERS, max_depth=JOB_QUEUE_DEPTH, store=None, clock=time.time):
+        """
+        generate: funzione (payload, deadline=...) → {"status", "data"}, come generate_quiz_from_data.
+        """
+        self.generate = generate
+        self.workers = workers
+        self.max_depth = max_depth
+        self.store = store if store is not None else JobStore(clock=clock)
+        self.clock = clock
+        # proprietario dei lease: processo + coda (più code nello stesso processo nei test)
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._admit_lock = threading.Lock()
+        self._avg_run = None
+        JOB_QUEUE_DEPTH_GAUGE.set(self.store.depth())
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"job-worker-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, payload):
+        """Accoda un job e lo ritorna; solleva QueueFull se la coda è al limite."""
+        with self._admit_lock:
+            depth = self.store.depth()
+            if depth >= self.max_depth:
+                JOB_EVENTS.inc(event="rejected")
+                raise QueueFull(self.retry_after(depth))
+            job = {
+                "id": uuid.uuid4().hex,
+                "status": QUEUED,
+                "payload": payload,
+                "created_at": self.clock(),
+                "started_at": None,
+                "finished_at": None,
+            }
+            self.store.put(job)
+            JOB_QUEUE_DEPTH_GAUGE.set(depth + 1)
+        JOB_EVENTS.inc(event="submitted")
+        return job
+
+    def retry_after(self, depth=None):
+        """Secondi stimati perché la coda si svuoti abbastanza da accettare un nuovo job."""
+        depth = self.store.depth() if depth is None else depth
+        run = self._avg_run if self._avg_run is not None else DEFAULT_JOB_SECONDS
+        return max(1, math.ceil(depth * run / max(self.workers, 1)))
+
+    def get(self, job_id):
+        return self.store.get(job_id)
+
+    def watch(self, job_id, heartbeat=15.0):
+        """
+        Generatore per SSE: ritorna il job a ogni cambio di stato fino a done/failed,
+        None ogni `heartbeat` secondi senza cambi.
+        """
+        job = self.store.get(job_id)
+        if job is None:
+            return
+        yield job
+        while job["status"] not in FINISHED:
+            changed = self.store.wait_for_change(job_id, job["status"], heartbeat)
+            if changed is None:
+                return
+            if changed["status"] == job["status"]:
+                yield None
+            else:
+                job = changed
+                yield job
+
+    def join(self, poll=0.01):
+        """Attende che non ci siano più job in coda o in esecuzione (test e shutdown)."""
+        while self.store.unfinished():
+            time.sleep(poll)
+
+    def _worker(self):
+        while True:
+            try:
+                job = self.store.claim(self.owner, timeout=JOB_POLL_SECONDS)
+                if job is None:
+                    continue
+                JOB_QUEUE_DEPTH_GAUGE.set(self.store.depth())
+                self._run(job)
+            except StoreClosed:
+                return
+            except Exception:
+                logger.exception("Job worker: errore inatteso")
+                time.sleep(JOB_POLL_SECONDS)
+
+    def _run(self, job):
+        job_id = job["id"]
+        started = job["started_at"]
+        JOB_QUEUE_WAIT.observe(max(started - job["created_at"], 0.0))
+
+        try:
+            # il deadline parte quando il job viene eseguito, non quando è accodato
+            result = self.generate(job["payload"], deadline=Deadline())
+        except Exception as e:
+            logger.warning("Job %s fallito: %s", job_id, e)
+            self.store.update(job_id, status=FAILED, error=str(e), finished_at=self.clock())
+            JOB_EVENTS.inc(event="failed")
+            return
+
+        finished = self.clock()
+        self.store.update(job_id, status=DONE, result=result, finished_at=finished)
+        JOB_EVENTS.inc(event="done")
+        JOB_RUN_TIME.observe(finished - started)
+        # media mobile della durata, per la stima di Retry-After
+        run = finished - started
+        self._avg_run = run if self._avg_run is None else 0.8 * self._avg_run + 0.2 * run
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+_processes = 1
+
+
+def configure(processes):
+    """Numero di processi che servono l'API (serve.post_fork): con più di uno la coda è su SQLite."""
+    global _processes
+    _processes = processes
+
+
+def job_db():
+    return JOB_DB or (SHARED_JOB_DB if _processes > 1 else "")
+
+
+def get_job_queue(generate):
+    """Coda di processo, creata (e avviata) al primo utilizzo."""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            path = job_db()
+            if path:
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            store = SQLiteJobStore(path) if path else JobStore()
+            _job_queue = JobQueue(generate, store=store)
+        return _job_queue
@@ -0,0 +1,221 @@
+# services/json_repair.py
+"""
+Riparazione locale dell'output JSON del modello, prima di dichiararlo illeggibile (status 3).
+
+Uno status 3 costa al client un nuovo giro completo RAG + LLM, ma gli errori più comuni
+sono banali: testo o code fence intorno all'oggetto, virgole finali, apici singoli
+(o letterali Python True/False/None, chiavi senza virgolette), parentesi non chiuse
+perché l'output è stato troncato.
+Gli stadi sono provati in ordine di costo e sono cumulativi: ognuno lavora sul testo
+già corretto dai precedenti.
+"""
+
+import re
+import json
+
+from services.metrics import counter
+
+JSON_REPAIRS = counter(
+    "sage_json_repair_total",
+    "Output LLM passati dalla riparazione JSON: stage che li ha resi leggibili (none = irreparabile)",
+    labelnames=("stage",),
+)
+LLM_CALLS_SAVED = counter(
+    "sage_llm_calls_saved_total",
+    "Quiz validi ottenuti grazie alla riparazione JSON (chiamate LLM di retry evitate)",
+    labelnames=("stage",),
+)
+
+# Tentativi massimi di "taglio" all'ultima virgola per output troncati
+MAX_TRUNCATION_CUTS = 20
+
+_PYTHON_LITERALS = {"True": "true", "False": "false", "None": "null"}
+_decoder = json.JSONDecoder()
+
+
+class JsonRepairError(ValueError):
+    pass
+
+
+def _first_object(text):
+    """Primo oggetto JSON dalla prima '{', ignorando il testo che segue (anche altre graffe)."""
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("No JSON object found")
+    obj, _ = _decoder.raw_decode(text[start:])
+    if not isinstance(obj, dict):
+        raise ValueError("Not a dict")
+    return obj
+
+
+def _strict(text):
+    # comportamento storico: dalla prima '{' all'ultima '}'
+    match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not match:
+        raise ValueError("No JSON object found")
+    obj = json.loads(match.group())
+    if not isinstance(obj, dict):
+        raise ValueError("Not a dict")
+    return obj
+
+
+def _next_significant(text, i):
+    while i < len(text) and text[i] in " \t\r\n":
+        i += 1
+    return text[i] if i < len(text) else ""
+
+
+def _fix_tokens(text):
+    """
+    Una passata che rispetta le stringhe: rimuove le virgole prima di } e ],
+    converte le stringhe con apici singoli e i letterali Python, mette tra virgolette le chiavi nude.
+    Un apice dentro una stringa singola chiude la stringa solo se seguito da , : } ] o fine testo
+    (altrimenti è un apostrofo, es. 'l'acqua').
+    """
+    out = []
+    i = 0
+    n = len(text)
+    while i < n:
+        ch = text[i]
+        if ch == '"':
+            # stringa doppia: copiata così com'è
+            j = i + 1
+            while j < n and text[j] != '"':
+                j += 2 if text[j] == "\\" else 1
+            out.append(text[i:j + 1])
+            i = j + 1
+        elif ch == "'":
+            j = i + 1
+            buf = []
+            while j < n:
+                c = text[j]
+                if c == "\\" and j + 1 < n:
+                    buf.append("'" if text[j + 1] == "'" else text[j:j + 2])
+                    j += 2
+                    continue
+                if c == "'" and _next_significant(text, j + 1) in (",", ":", "}", "]", ""):
+                    break
+                buf.append('\\"' if c == '"' else c)
+                j += 1
+            out.append('"' + "".join(buf) + '"')
+            i = j + 1
+        elif ch == "," and _next_significant(text, i + 1) in ("}", "]"):
+            i += 1
+        elif ch.isalpha():
+            j = i
+            while j < n and (text[j].isalnum() or text[j] == "_"):
+                j += 1
+            word = text[i:j]
+            if _next_significant(text, j) == ":":
+                out.append(f'"{word}"')  # chiave senza virgolette
+            else:
+                out.append(_PYTHON_LITERALS.get(word, word))
+            i = j
+        else:
+            out.append(ch)
+            i += 1
+    return "".join(out)
+
+
+def _scan(text):
+    """(stack delle parentesi aperte, dentro una stringa?, posizioni delle virgole fuori stringa)."""
+    stack, commas = [], []
+    in_string = escape = False
+    for i, ch in enumerate(text):
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+            continue
+        if ch == '"':
+            in_string = True
+        elif ch in "{[":
+            stack.append(ch)
+        elif ch in "}]":
+            if stack:
+                stack.pop()
+        elif ch == ",":
+            commas.append(i)
+    return stack, in_string, commas
+
+
+def _close(text):
+    stack, in_string, _ = _scan(text)
+    if in_string:
+        text += '"'
+    text = text.rstrip()
+    if text.endswith(","):
+        text = text[:-1]
+    elif text.endswith(":"):
+        text += " null"
+    closing = {"{": "}", "[": "]"}
+    return text + "".join(closing[c] for c in reversed(stack))
+
+
+def _close_truncated(text):
+    """Chiude stringhe e parentesi rimaste aperte; se non basta, taglia all'ultima virgola."""
+    start = text.find("{")
+    if start < 0:
+        raise ValueError("No JSON object found")
+    text = text[start:]
+    candidates = [text] + [text[:pos] for pos in reversed(_scan(text)[2][-MAX_TRUNCATION_CUTS:])]
+    for candidate in candidates:
+        try:
+            obj = _first_object(_close(candidate))
+        except ValueError:
+            continue
+        # "{" vagante (es. un rifiuto del modello) non è un quiz troncato: serve almeno una chiave
+        if obj:
+            return obj
+    raise ValueError("Truncated JSON not recoverable")
+
+
+# (nome, trasformazione del testo, parser) in ordine di costo
+STAGES = (
+    # primo oggetto ignorando il testo intorno (code fence, spiegazioni, altri oggetti)
+    ("extract", lambda t: t, _first_object),
+    ("quotes_commas", _fix_tokens, _first_object),
+    ("truncation", lambda t: t, _close_truncated),
+)
+
+
+def repair_json(text):
+    """
+    Ritorna (oggetto, stage): stage è "strict" se l'output era già leggibile,
+    altrimenti il nome dello stadio di riparazione che ha funzionato.
+    Solleva JsonRepairError se nessuno stadio ottiene un oggetto JSON.
+    """
+    text = text or ""
+    try:
+        return _strict(text), "strict"
+    except ValueError:
+        pass
+
+    for name, transform, parse in STAGES:
+        text = transform(text)
+        try:
+            return parse(text), name
+        except ValueError:
+            continue
+    raise JsonRepairError("No JSON object found, even after repair")
+
+
+def parse_llm_json(text):
+    """repair_json con le metriche (da usare una volta per risposta LLM)."""
+    try:
+        obj, stage = repair_json(text)
+    except JsonRepairError:
+        JSON_REPAIRS.inc(stage="none")
+        raise
+    if stage != "strict":
+        JSON_REPAIRS.inc(stage=stage)
+    return obj, stage
+
+
+def record_saved_call(stage):
+    """Da chiamare quando un output riparato produce un quiz valido."""
+    if stage != "strict":
+        LLM_CALLS_SAVED.inc(stage=stage)
@@ -0,0 +1,169 @@
+# services/json_stream.py
+"""
+Estrazione incrementale del primo oggetto JSON da uno stream di token.
+
+Lo scanner tiene lo stato di parentesi/stringhe carattere per carattere: appena il primo
+oggetto top-level è chiuso si può interrompere lo stream (i modelli spesso continuano
+a scrivere dopo il JSON e quei token si pagano in tempo e costo).
+Se l'output non può più diventare JSON valido lo scanner solleva JsonStreamError.
+Con apici singoli (stile dict Python) le parentesi non si possono più seguire in modo
+affidabile: lo scanner smette di cercare la fine dell'oggetto e accumula tutto l'output,
+che viene poi riparato da json_repair come nel percorso senza stream.
+"""
+
+from services.metrics import counter
+
+# Caratteri di "chiacchiera" tollerati prima della prima '{'
+MAX_PREFIX_CHARS = 500
+
+STREAM_OUTCOMES = counter(
+    "sage_llm_stream_total",
+    "Esito degli stream LLM: complete (oggetto chiuso), aborted (JSON impossibile), exhausted (stream finito prima)",
+    labelnames=("outcome",),
+)
+
+_CLOSING = {"}": "{", "]": "["}
+
+
+class JsonStreamError(ValueError):
+    pass
+
+
+class JsonObjectScanner:
+    def __init__(self, max_prefix_chars: int = MAX_PREFIX_CHARS):
+        self.max_prefix_chars = max_prefix_chars
+        self._prefix_len = 0
+        self._stack = []
+        self._in_string = False
+        self._escape = False
+        self._last = ""
+        self._parts = []
+        self.done = False
+        # apici singoli: si accumula lo stream intero senza cercarne la fine
+        self.raw = False
+
+    @property
+    def text(self):
+        """Testo dell'oggetto accumulato finora (dalla prima '{')."""
+        return "".join(self._parts)
+
+    def feed(self, chunk: str):
+        """
+        Consuma un pezzo di output. Ritorna il testo dell'oggetto quando è completo,
+        altrimenti None. Il testo dopo la chiusura dell'oggetto viene ignorato.
+        """
+        if self.done:
+            return self.text
+        if self.raw:
+            self._parts.append(chunk)
+            return None
+
+        start = 0
+        if not self._stack:
+            # ancora prima dell'oggetto: cerca la prima '{'
+            brace = chunk.find("{")
+            if brace < 0:
+                self._prefix_len += len(chunk)
+                self._check_prefix()
+                return None
+            self._prefix_len += brace
+            self._check_prefix()
+            start = brace
+
+        try:
+            return self._scan(chunk, start)
+        except JsonStreamError:
+            # il pezzo già letto resta nel testo (serve a json_repair)
+            self._parts.append(chunk[start:])
+            raise
+
+    def _scan(self, chunk, start):
+        for i in range(start, len(chunk)):
+            ch = chunk[i]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    self._last = ch
+                elif ch < " " and ch not in "\n\r\t":
+                    raise JsonStreamError(f"Carattere di controllo {ch!r} in una stringa")
+                continue
+
+            if ch in " \n\r\t":
+                continue
+            if ch == "'":
+                self.raw = True
+                self._parts.append(chunk[start:])
+                return None
+            self._last = ch
+            if ch == '"':
+                self._in_string = True
+            elif ch in "{[":
+                self._stack.append(ch)
+            elif ch in "}]":
+                if not self._stack or self._stack[-1] != _CLOSING[ch]:
+                    raise JsonStreamError(f"Parentesi {ch!r} non bilanciata")
+                self._stack.pop()
+                if not self._stack:
+                    self._parts.append(chunk[start:i + 1])
+                    self.done = True
+                    return self.text
+
+        self._parts.append(chunk[start:])
+        return None
+
+    def _check_prefix(self):
+        if self._prefix_len > self.max_prefix_chars:
+            raise JsonStreamError("Nessun oggetto JSON all'inizio dell'output")
+
+
+def _chunk_text(chunk):
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, list):
+        # alcuni provider restituiscono blocchi [{"type": "text", "text": ...}]
+        return "".join(b.get("text", "") if isinstance(b, dict) else str(b) for b in content)
+    return content or ""
+
+
+def consume_stream(stream, scanner: JsonObjectScanner = None):
+    """
+    Legge i chunk finché il primo oggetto JSON è completo, poi chiude lo stream.
+    Ritorna il testo dell'oggetto (oppure il testo parziale se lo stream finisce o va abortito).
+    """
+    scanner = scanner or JsonObjectScanner()
+    try:
+        for chunk in stream:
+            if scanner.feed(_chunk_text(chunk)) is not None:
+                STREAM_OUTCOMES.inc(outcome="complete")
+                return scanner.text
+    except JsonStreamError:
+        STREAM_OUTCOMES.inc(outcome="aborted")
+        return scanner.text
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+    STREAM_OUTCOMES.inc(outcome="exhausted")
+    return scanner.text
+
+
+async def aconsume_stream(stream, scanner: JsonObjectScanner = None):
+    """Come consume_stream per stream async (llm.astream)."""
+    scanner = scanner or JsonObjectScanner()
+    try:
+        async for chunk in stream:
+            if scanner.feed(_chunk_text(chunk)) is not None:
+                STREAM_OUTCOMES.inc(outcome="complete")
+                return scanner.text
+    except JsonStreamError:
+        STREAM_OUTCOMES.inc(outcome="aborted")
+        return scanner.text
+    finally:
+        aclose = getattr(stream, "aclose", None)
+        if aclose is not None:
+            await aclose()
+    STREAM_OUTCOMES.inc(outcome="exhausted")
+    return scanner.text
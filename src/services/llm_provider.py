@@ -1,23 +1,204 @@
 import os
+import asyncio
+import weakref
+import threading
 
 from dotenv import load_dotenv
 load_dotenv()
 
+import httpx
+import anthropic
 from langchain_groq import ChatGroq
 from langchain_anthropic import ChatAnthropic  # nuova import
 
-def get_llm(provider):
+from services.rate_limiter import RATE_LIMIT_ENABLED, limited
+from services.log import get_logger
+
+logger = get_logger("llm_provider")
+
+# Configurazione del pool HTTP condiviso dai client LLM
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "5"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+
+# Provider supportati da get_llm
+LLM_PROVIDERS = ("groq", "claude")
+
+def get_llm(provider, **client_kwargs):
+    """
+    Crea un nuovo client per il provider. `client_kwargs` (http_client, timeout, ...)
+    viene passato così com'è al costruttore; per l'uso nelle richieste vedi get_shared_llm.
+    """
     if provider == "groq":
         return ChatGroq(
             groq_api_key=os.getenv("GROQ_API_KEY"),
             model="llama3-8b-8192",
-            temperature=0.9
+            temperature=0.9,
+            **client_kwargs
         )
     elif provider == "claude":
         return ChatAnthropic(
             anthropic_api_key=os.getenv("ANTHROPIC_API_KEY"),
-            model="claude-3-5-haiku-20241022", 
-            temperature=0.9
+            model="claude-3-5-haiku-20241022",
+            temperature=0.9,
+            **client_kwargs
         )
     else:
         raise ValueError(f"Unknown LLM provider: {provider}")
+
+
+class LLMRegistry:
+    """
+    Registry di processo: un client per provider, creato alla prima richiesta e poi riusato.
+    Ogni client usa un httpx.Client con pool keep-alive dimensionato da configurazione,
+    così le richieste successive non rifanno connessione TCP e handshake TLS.
+
+    Il pool async (httpx.AsyncClient) è legato all'event loop su cui viene usato: get()
+    chiamato dentro un loop (ASGI) ritorna un client riservato a quel loop; fuori da un loop
+    (Flask, worker) il client è condiviso e le sue chiamate async girano solo sul loop di
+    background di services/hedging.py.
+    """
+
+    def __init__(
+        self,
+        pool_size: int = LLM_POOL_SIZE,
+        timeout: float = LLM_TIMEOUT,
+        connect_timeout: float = LLM_CONNECT_TIMEOUT,
+        keepalive_expiry: float = LLM_KEEPALIVE_EXPIRY,
+        max_retries: int = LLM_MAX_RETRIES,
+    ):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.keepalive_expiry = keepalive_expiry
+        self.max_retries = max_retries
+        self._clients = {}
+        # loop → {provider: llm}: sparisce con il loop
+        self._loop_clients = weakref.WeakKeyDictionary()
+        self._http_clients = []
+        self._lock = threading.Lock()
+
+    def _limits(self):
+        return httpx.Limits(
+            max_connections=self.pool_size,
+            max_keepalive_connections=self.pool_size,
+            keepalive_expiry=self.keepalive_expiry,
+        )
+
+    def _timeout(self):
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+    def _new_http_clients(self, loop):
+        http_client = httpx.Client(limits=self._limits(), timeout=self._timeout())
+        http_async_client = httpx.AsyncClient(limits=self._limits(), timeout=self._timeout())
+        # il client async va chiuso sul loop che ne possiede le connessioni (vedi close)
+        owner = weakref.ref(loop) if loop is not None else None
+        self._http_clients += [(http_client, None), (http_async_client, owner)]
+        return http_client, http_async_client
+
+    def _build(self, provider, loop=None):
+        if provider == "groq":
+            http_client, http_async_client = self._new_http_clients(loop)
+            return get_llm(
+                provider,
+                http_client=http_client,
+                http_async_client=http_async_client,
+                timeout=self.timeout,
+                max_retries=self.max_retries,
+            )
+        elif provider == "claude":
+            llm = get_llm(provider, timeout=self.timeout, max_retries=self.max_retries)
+            # ChatAnthropic non accetta un http_client: sostituiamo i client SDK
+            # con versioni equivalenti che usano il nostro pool. Sono attributi privati
+            # di langchain-anthropic: la versione è fissata in requirements.txt e un
+            # aggiornamento che li cambia deve fallire qui, non usare client senza pool
+            if not isinstance(getattr(llm, "_client", None), anthropic.Client) or not isinstance(
+                getattr(llm, "_async_client", None), anthropic.AsyncClient
+            ):
+                raise RuntimeError("langchain-anthropic non compatibile: client SDK non trovati (vedi requirements.txt)")
+            http_client, http_async_client = self._new_http_clients(loop)
+            params = {
+                "api_key": llm.anthropic_api_key.get_secret_value(),
+                "base_url": llm.anthropic_api_url,
+                "max_retries": self.max_retries,
+                "timeout": self._timeout(),
+            }
+            object.__setattr__(llm, "_client", anthropic.Client(http_client=http_client, **params))
+            object.__setattr__(llm, "_async_client", anthropic.AsyncClient(http_client=http_async_client, **params))
+            return llm
+        return get_llm(provider)
+
+    def _clients_for(self, loop):
+        if loop is None:
+            return self._clients
+        return self._loop_clients.setdefault(loop, {})
+
+    def get(self, provider):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        llm = self._clients_for(loop).get(provider)
+        if llm is not None:
+            return llm
+        with self._lock:
+            clients = self._clients_for(loop)
+            llm = clients.get(provider)
+            if llm is None:
+                llm = self._build(provider, loop)
+                clients[provider] = llm
+            return llm
+
+    def close(self):
+        """Chiude i pool HTTP (es. allo shutdown) e svuota il registry."""
+        with self._lock:
+            http_clients, self._http_clients = self._http_clients, []
+            self._clients = {}
+            self._loop_clients = weakref.WeakKeyDictionary()
+        for client, owner in http_clients:
+            if isinstance(client, httpx.AsyncClient):
+                _aclose(client, owner() if owner is not None else _background_loop())
+            else:
+                client.close()
+
+
+def _background_loop():
+    # i client creati fuori da un loop fanno le chiamate async sul loop di hedging
+    from services import hedging
+    return hedging.background_loop_if_started()
+
+
+def _aclose(client, loop):
+    """Chiude un httpx.AsyncClient sul loop che ne possiede le connessioni."""
+    try:
+        if loop is not None and loop.is_running():
+            try:
+                current = asyncio.get_running_loop()
+            except RuntimeError:
+                current = None
+            if current is loop:
+                # close() chiamato dal loop stesso (es. shutdown ASGI): non si può attendere
+                loop.create_task(client.aclose())
+            else:
+                asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+        elif loop is not None and not loop.is_closed():
+            loop.run_until_complete(client.aclose())
+        else:
+            # loop mai avviato o già chiuso: nessuna connessione ancora legata a un loop vivo
+            asyncio.run(client.aclose())
+    except Exception:
+        logger.warning("Chiusura del pool HTTP async non riuscita", exc_info=True)
+
+
+registry = LLMRegistry()
+
+
+def get_shared_llm(provider):
+    """
+    Client LLM condiviso a livello di processo per `provider`.
+    Con SAGE_RATE_LIMIT=1 le chiamate passano dal limiter del provider (services/rate_limiter.py).
+    """
+    llm = registry.get(provider)
+    return limited(provider, llm) if RATE_LIMIT_ENABLED else llm
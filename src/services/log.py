@@ -0,0 +1,39 @@
+# services/log.py
+"""
+Logging a livelli con campionamento per i messaggi ad alto volume.
+
+Il livello si imposta con SAGE_LOG_LEVEL (default INFO), la frazione di messaggi
+campionati con SAGE_LOG_SAMPLE_RATE (default 0.1).
+"""
+
+import os
+import random
+import logging
+
+LOG_LEVEL = os.getenv("SAGE_LOG_LEVEL", "INFO").upper()
+SAMPLE_RATE = float(os.getenv("SAGE_LOG_SAMPLE_RATE", "0.1"))
+
+
+def configure_logging(level: str = LOG_LEVEL):
+    logging.basicConfig(
+        level=level,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+
+def get_logger(name: str) -> logging.Logger:
+    return logging.getLogger(f"sage.{name}")
+
+
+def log_sampled(logger: logging.Logger, level: int, msg: str, *args, rate: float = None):
+    """
+    Logga solo una frazione `rate` dei messaggi. Il controllo di livello viene prima,
+    così con il livello disattivato non si formatta né si estrae nulla.
+    """
+    if not logger.isEnabledFor(level):
+        return
+    if rate is None:
+        rate = SAMPLE_RATE
+    if rate < 1.0 and random.random() >= rate:
+        return
+    logger.log(level, msg, *args)
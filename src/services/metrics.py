@@ -0,0 +1,229 @@
+# services/metrics.py
+"""
+Metriche in-process esportate in formato testo Prometheus (senza dipendenze esterne).
+
+Uso tipico:
+    with span("llm_call"):
+        ...
+    record_status(result["status"], elapsed)
+
+main.py espone render_prometheus() su /metrics.
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+
+# Bucket di latenza in secondi (coprono da pochi ms fino alle chiamate LLM lente)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_labels(labelnames, values, extra=None):
+    pairs = list(zip(labelnames, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: label attese {self.labelnames}, ricevute {tuple(labels)}")
+        return tuple(labels[name] for name in self.labelnames)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][i] += 1
+                    break
+            state["sum"] += value
+            state["count"] += 1
+
+    def snapshot(self, **labels):
+        """Ritorna (count, sum) per una combinazione di label."""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None:
+                return 0, 0.0
+            return state["count"], state["sum"]
+
+    def quantile(self, q, **labels):
+        """Stima del quantile q dai bucket (limite superiore del bucket), None se vuoto."""
+        with self._lock:
+            state = self._values.get(self._key(labels))
+            if state is None or state["count"] == 0:
+                return None
+            target = q * state["count"]
+            cumulative = 0
+            for bound, n in zip(self.buckets, state["counts"]):
+                cumulative += n
+                if cumulative >= target:
+                    return bound
+            return float("inf")
+
+    def render(self):
+        lines = self.header()
+        with self._lock:
+            items = sorted((k, dict(v, counts=list(v["counts"]))) for k, v in self._values.items())
+        for key, state in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, state["counts"]):
+                cumulative += n
+                labels = _format_labels(self.labelnames, key, ("le", _format_value(float(bound))))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key, ("le", "+Inf"))
+            lines.append(f"{self.name}_bucket{labels} {state['count']}")
+            plain = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{plain} {_format_value(state['sum'])}")
+            lines.append(f"{self.name}_count{plain} {state['count']}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            metric.clear()
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# ----------------- Metriche della pipeline quiz -----------------
+STAGE_LATENCY = histogram(
+    "sage_stage_duration_seconds",
+    "Durata delle singole fasi di generazione (embedding, chroma, llm, ...)",
+    labelnames=("stage",),
+)
+REQUEST_LATENCY = histogram(
+    "sage_quiz_duration_seconds",
+    "Durata end-to-end di generate_quiz_from_data per status",
+    labelnames=("status",),
+)
+QUIZ_STATUS = counter(
+    "sage_quiz_status_total",
+    "Risposte di generate_quiz_from_data per status (1 ok, 2 no fonti, 3 parsing, 4 richiesta non valida)",
+    labelnames=("status",),
+)
+
+
+@contextmanager
+def span(stage):
+    """Misura la durata del blocco e la registra nell'istogramma delle fasi."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_LATENCY.observe(time.perf_counter() - start, stage=stage)
+
+
+def record_status(status, elapsed):
+    QUIZ_STATUS.inc(status=str(status))
+    REQUEST_LATENCY.observe(elapsed, status=str(status))
+
+
+def render_prometheus():
+    return REGISTRY.render()
@@ -0,0 +1,149 @@
+# services/output_budget.py
+"""
+Budget dei token di output per tipo di quiz, ricavato dagli schemi JSON in src/schemas.
+
+Ogni schema viene percorso stimando i token di chiavi, stringhe e array (numero tipico
+di elementi dove manca maxItems); con un margine di sicurezza diventa il max_tokens
+della chiamata. Un tetto sull'output evita risposte che continuano oltre il JSON
+(più latenza, più costo) e rende la lunghezza prevedibile.
+Dove il provider lo supporta si chiede anche l'output in JSON mode.
+"""
+
+import os
+import json
+import math
+
+from services.context_builder import estimate_tokens
+from services.metrics import counter, histogram
+from validators.validator_schemas import SCHEMA_DIR
+
+# Elementi attesi in un array senza maxItems (opzioni, coppie, elementi da ordinare)
+TYPICAL_ARRAY_ITEMS = 6
+STRING_TOKENS = 15
+# Campi testuali più lunghi della media
+LONG_STRING_TOKENS = {"question": 50}
+NUMBER_TOKENS = 2
+SAFETY_MARGIN = 1.5
+# Arrotondamento del budget (multipli di) e tetto assoluto
+BUDGET_STEP = 64
+MAX_OUTPUT_TOKENS = 4096
+# Involucro {"quizzes": [...]} della generazione batch
+BATCH_OVERHEAD_TOKENS = 16
+
+# Provider con JSON mode (response_format OpenAI-compatibile); Groq non lo supporta in streaming
+JSON_MODE_PROVIDERS = {"groq"}
+
+OUTPUT_TOKENS = histogram(
+    "sage_llm_output_tokens",
+    "Token di output per chiamata LLM",
+    labelnames=("type", "provider"),
+    buckets=(32, 64, 128, 256, 512, 1024, 2048, 4096),
+)
+LLM_OUTPUTS = counter(
+    "sage_llm_outputs_total",
+    "Esito dell'output LLM: ok, parse_error (status 3), schema_error; truncated = tagliato da max_tokens",
+    labelnames=("type", "provider", "outcome"),
+)
+
+
+def _literal_tokens(value):
+    return estimate_tokens(json.dumps(value, ensure_ascii=False))
+
+
+def estimate_schema_tokens(schema, key=None):
+    """Token stimati per un'istanza tipica dello schema (JSON compatto)."""
+    if "const" in schema:
+        return _literal_tokens(schema["const"])
+    if "enum" in schema:
+        return max(_literal_tokens(v) for v in schema["enum"])
+
+    kind = schema.get("type")
+    if kind == "object":
+        props = schema.get("properties", {})
+        return 2 + sum(_literal_tokens(k) + 1 + estimate_schema_tokens(p, k) for k, p in props.items())
+    if kind == "array":
+        n = max(schema.get("minItems", 0), TYPICAL_ARRAY_ITEMS)
+        n = min(n, schema.get("maxItems", n))
+        return 2 + n * (estimate_schema_tokens(schema.get("items", {}), key) + 1)
+    if kind == "string":
+        return LONG_STRING_TOKENS.get(key, STRING_TOKENS)
+    if kind in ("integer", "number"):
+        return NUMBER_TOKENS
+    return 1
+
+
+def _round_budget(tokens):
+    budget = int(math.ceil(tokens * SAFETY_MARGIN / BUDGET_STEP) * BUDGET_STEP)
+    return min(budget, MAX_OUTPUT_TOKENS)
+
+
+def load_output_budgets(schema_dir=SCHEMA_DIR):
+    """{tipo: max_tokens} per ogni <tipo>_schema.json in schema_dir."""
+    budgets = {}
+    for name in sorted(os.listdir(schema_dir)):
+        if not name.endswith("_schema.json"):
+            continue
+        with open(os.path.join(schema_dir, name), "r", encoding="utf-8") as f:
+            schema = json.load(f)
+        budgets[name[:-len("_schema.json")]] = _round_budget(estimate_schema_tokens(schema))
+    return budgets
+
+
+OUTPUT_BUDGETS = load_output_budgets()
+
+
+def max_batch_size(budgets=OUTPUT_BUDGETS, limit=MAX_OUTPUT_TOKENS):
+    """Quiz per chiamata batch tali che anche N del tipo più pesante stiano nel tetto di output."""
+    return max(1, (limit - BATCH_OVERHEAD_TOKENS) // max(budgets.values()))
+
+
+# Oltre questo numero l'output del batch verrebbe troncato da max_tokens (errori di parsing)
+MAX_BATCH_SIZE = max_batch_size()
+
+def output_budget(quiz_types):
+    """max_tokens per uno o più quiz (batch: somma dei tipi richiesti)."""
+    if len(quiz_types) == 1:
+        return OUTPUT_BUDGETS.get(quiz_types[0], MAX_OUTPUT_TOKENS)
+    total = BATCH_OVERHEAD_TOKENS + sum(OUTPUT_BUDGETS.get(t, MAX_OUTPUT_TOKENS) for t in quiz_types)
+    return min(total, MAX_OUTPUT_TOKENS)
+
+
+def generation_kwargs(provider, quiz_types, stream=False):
+    """Argomenti per la singola chiamata LLM (inoltrati dai client LangChain all'SDK)."""
+    kwargs = {"max_tokens": output_budget(quiz_types)}
+    if provider in JSON_MODE_PROVIDERS and not stream:
+        kwargs["response_format"] = {"type": "json_object"}
+    return kwargs
+
+
+def response_usage(response):
+    """
+    (token di output, troncato) da una risposta LangChain.
+    Groq riporta token_usage/finish_reason, Anthropic usage/stop_reason;
+    se mancano si stima dal testo.
+    """
+    meta = getattr(response, "response_metadata", None) or {}
+    usage = getattr(response, "usage_metadata", None) or {}
+
+    tokens = usage.get("output_tokens")
+    if tokens is None:
+        tokens = (meta.get("token_usage") or {}).get("completion_tokens")
+    if tokens is None:
+        tokens = (meta.get("usage") or {}).get("output_tokens")
+    if tokens is None:
+        tokens = estimate_tokens(getattr(response, "content", "") or "")
+
+    truncated = meta.get("finish_reason") == "length" or meta.get("stop_reason") == "max_tokens"
+    return tokens, truncated
+
+
+def record_output(quiz_type, provider, status, output_tokens=None, truncated=False):
+    """Metriche per una risposta LLM già interpretata (status 1/3/4 di generate_quiz)."""
+    outcome = {1: "ok", 3: "parse_error", 4: "schema_error"}.get(status)
+    if outcome is None:
+        return
+    LLM_OUTPUTS.inc(type=quiz_type, provider=provider, outcome=outcome)
+    if truncated:
+        LLM_OUTPUTS.inc(type=quiz_type, provider=provider, outcome="truncated")
+    if output_tokens is not None:
+        OUTPUT_TOKENS.observe(output_tokens, type=quiz_type, provider=provider)
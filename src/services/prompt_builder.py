@@ -1,8 +1,4 @@
-def build_prompt(quiz_type, category, difficulty):
-    """
-    Crea il prompt per l'LLM.
-    """
-    difficulty_instructions = """
+DIFFICULTY_INSTRUCTIONS = """
 The difficulty must clearly influence the questions and answer options:
 
 - Difficulty 1-3 → simple questions, clearly different answers, no trick options.
@@ -12,26 +8,122 @@ The difficulty must clearly influence the questions and answer options:
 Always match the complexity to the student's age and school curriculum.
 """
 
+# Schema JSON di esempio per ogni tipo, come mostrato al modello
+SCHEMA_SPECS = {
+    "quiz": "{\"type\": \"quiz\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"options\": [...], \"answer\": ...}",
+    "matching": "{\"type\": \"matching\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"pairs\": [{\"left\": ..., \"right\": ...}]}",
+    "memory": "{\"type\": \"memory\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"pairs\": [{\"front\": ..., \"back\": ...}]}",
+    "sorting": "{\"type\": \"sorting\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"items\": [...], \"solution\": [...]}",
+}
+
+
+def _schema_block(quiz_types):
+    return "".join(f"▶ For '{t}':\n{SCHEMA_SPECS[t]}\n\n" for t in quiz_types)
+
+
+def build_prompt(quiz_type, category, difficulty):
+    """
+    Crea il prompt per l'LLM.
+    """
     return (
         f"You are a quiz generator for children. Generate a single Italian quiz of type '{quiz_type}' "
         f"about the category '{category}', suitable for the given level. The difficulty value must be the number {difficulty}. "
         f"Use only the provided sources. The quiz must follow strictly one of the following JSON schemas:\n\n"
 
-        f"▶ For 'quiz':\n"
-        f"{{\"type\": \"quiz\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"options\": [...], \"answer\": ...}}\n\n"
+        f"{_schema_block(SCHEMA_SPECS)}"
 
-        f"▶ For 'matching':\n"
-        f"{{\"type\": \"matching\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"pairs\": [{{\"left\": ..., \"right\": ...}}]}}\n\n"
+        f"{DIFFICULTY_INSTRUCTIONS}\n"
+        f"Only output the raw JSON object. No extra text. Only return a single valid JSON object. "
+        f"Use double quotes around all keys and string values. Do not use single quotes. "
+        f"Always respond in **ITALIANO**.\n"
+        f"Return an empty JSON (i.e. '{{}}') if the context is insufficient."
+    )
 
-        f"▶ For 'memory':\n"
-        f"{{\"type\": \"memory\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"pairs\": [{{\"front\": ..., \"back\": ...}}]}}\n\n"
 
-        f"▶ For 'sorting':\n"
-        f"{{\"type\": \"sorting\", \"category\": ..., \"question\": ..., \"difficulty\": ..., \"items\": [...], \"solution\": [...]}}\n\n"
+def build_batch_prompt(quiz_types, category, difficulty):
+    """
+    Prompt per generare più quiz in una sola chiamata (stesso contesto per tutti).
+    `quiz_types` è la lista dei tipi richiesti, uno per quiz (anche misti).
+    """
+    n = len(quiz_types)
+    types_list = ", ".join(f"{i + 1}. '{t}'" for i, t in enumerate(quiz_types))
+    used_types = [t for t in SCHEMA_SPECS if t in quiz_types]
 
-        f"{difficulty_instructions}\n"
-        f"Only output the raw JSON object. No extra text. Only return a single valid JSON object. "
+    return (
+        f"You are a quiz generator for children. Generate {n} different Italian quizzes "
+        f"about the category '{category}', suitable for the given level. The difficulty value must be the number {difficulty}. "
+        f"The quizzes must be, in this order, of these types: {types_list}. Do not repeat the same question. "
+        f"Use only the provided sources. Each quiz must follow strictly the JSON schema of its type:\n\n"
+
+        f"{_schema_block(used_types)}"
+
+        f"{DIFFICULTY_INSTRUCTIONS}\n"
+        f"Only output one raw JSON object of the form {{\"quizzes\": [...]}} containing exactly {n} quizzes. No extra text. "
         f"Use double quotes around all keys and string values. Do not use single quotes. "
         f"Always respond in **ITALIANO**.\n"
-        f"Return an empty JSON (i.e. '{{}}') if the context is insufficient."
+        f"Return {{\"quizzes\": []}} if the context is insufficient."
     )
+
+
+class PromptTemplate:
+    """
+    Prompt precompilato per un tipo di quiz.
+
+    `prefix` contiene solo istruzioni statiche (incluso il solo schema del tipo) ed è
+    identico tra richieste: va messo prima delle fonti, così i provider che lo supportano
+    possono metterlo in cache. `render()` produce la parte variabile (categoria, difficoltà).
+    """
+
+    def __init__(self, quiz_type):
+        self.quiz_type = quiz_type
+        self.prefix = (
+            f"You are a quiz generator for children. You generate a single Italian quiz of type '{quiz_type}' "
+            f"about the requested category, suitable for the given level, with the requested difficulty value. "
+            f"Use only the provided sources. The quiz must follow strictly this JSON schema:\n\n"
+
+            f"{_schema_block([quiz_type])}"
+
+            f"{DIFFICULTY_INSTRUCTIONS}\n"
+            f"Only output the raw JSON object. No extra text. Only return a single valid JSON object. "
+            f"Use double quotes around all keys and string values. Do not use single quotes. "
+            f"Always respond in **ITALIANO**.\n"
+            f"Return an empty JSON (i.e. '{{}}') if the context is insufficient."
+        )
+        self._suffix = (
+            "Generate the '" + quiz_type + "' quiz about the category '{category}'. "
+            "The difficulty value must be the number {difficulty}."
+        )
+
+    def render(self, category, difficulty):
+        return self._suffix.format(category=category, difficulty=difficulty)
+
+
+# Compilati una volta all'import, uno per tipo
+PROMPT_TEMPLATES = {quiz_type: PromptTemplate(quiz_type) for quiz_type in SCHEMA_SPECS}
+
+
+def get_prompt_template(quiz_type):
+    return PROMPT_TEMPLATES.get(quiz_type)
+
+
+def template_token_report():
+    """
+    Token stimati (~4 caratteri/token) per template: prefisso statico, parte variabile,
+    e confronto con il prompt monolitico di build_prompt.
+    """
+    # import locale: context_builder importa numpy, non serve per costruire i prompt
+    from services.context_builder import estimate_tokens
+
+    report = {}
+    for quiz_type, template in PROMPT_TEMPLATES.items():
+        report[quiz_type] = {
+            "prefix_tokens": estimate_tokens(template.prefix),
+            "variable_tokens": estimate_tokens(template.render("matematica", 10)),
+            "monolithic_tokens": estimate_tokens(build_prompt(quiz_type, "matematica", 10)),
+        }
+    return report
+
+
+if __name__ == "__main__":
+    for quiz_type, row in template_token_report().items():
+        print(f"{quiz_type:<10} prefisso={row['prefix_tokens']:>4}  variabile={row['variable_tokens']:>3}  monolitico={row['monolithic_tokens']:>4}")
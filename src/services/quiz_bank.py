@@ -0,0 +1,294 @@
+# services/quiz_bank.py
+"""
+Banca di quiz pre-generati con rifornimento in background.
+
+Lo spazio delle richieste è piccolo e limitato (tipo × categoria × classe × anno × difficoltà):
+dei worker generano in anticipo quiz già validati per ogni chiave e mantengono
+uno stock obiettivo. Le richieste vengono servite dallo stock in pochi millisecondi,
+lo stock si riempie in modo asincrono e la generazione live resta il fallback.
+Ogni quiz è legato alla versione dell'indice con cui è stato generato:
+dopo un nuovo embed dei chunk le voci vecchie vengono scartate.
+Alla creazione la banca accoda il rifornimento di tutte le chiavi; un thread controlla
+la versione dell'indice ogni WATCH_SECONDS e a ogni versione nuova scarta le voci vecchie
+e rifornisce di nuovo tutto.
+Stock e rifornimento riguardano solo le chiavi di all_keys() (combinazioni presenti
+nell'indice × provider della banca): le altre richieste vanno in generazione live
+senza creare stato, così la memoria della banca resta limitata.
+"""
+
+import os
+import time
+import queue
+import threading
+from collections import deque
+
+from services.candidate_pools import IndexVersionWatcher, QUIZ_TYPES, DIFFICULTIES, list_filter_combos
+from services.metrics import counter, gauge
+from services.log import get_logger
+
+logger = get_logger("quiz_bank")
+
+CHROMA_DIR = "../data/chroma_db"
+
+QUIZ_BANK_ENABLED = os.getenv("SAGE_QUIZ_BANK", "0") == "1"
+TARGET_STOCK = int(os.getenv("SAGE_QUIZ_BANK_STOCK", "3"))
+BANK_WORKERS = int(os.getenv("SAGE_QUIZ_BANK_WORKERS", "2"))
+# Provider per cui la banca genera (le richieste per gli altri vanno sempre in live)
+BANK_PROVIDERS = tuple(p.strip() for p in os.getenv("SAGE_QUIZ_BANK_PROVIDERS", "groq").split(",") if p.strip())
+# Tentativi falliti consecutivi oltre i quali una chiave non viene più rifornita da sola
+MAX_FAILURES = 3
+# Ogni quanto si controlla se c'è una nuova versione dell'indice (0 = mai)
+WATCH_SECONDS = float(os.getenv("SAGE_QUIZ_BANK_WATCH", "30"))
+
+BANK_REQUESTS = counter(
+    "sage_quiz_bank_requests_total",
+    "Richieste servite dalla banca (hit) o passate alla generazione live (miss)",
+    labelnames=("result",),
+)
+BANK_STOCK = gauge("sage_quiz_bank_stock", "Quiz disponibili in banca (tutte le chiavi)")
+
+
+def bank_key(data):
+    return (
+        data.get("type"),
+        data.get("category"),
+        data.get("classe"),
+        data.get("anno"),
+        data.get("difficulty"),
+        data.get("llmProvider"),
+    )
+
+
+def all_keys(combos, providers=BANK_PROVIDERS):
+    """Tutte le chiavi per le combinazioni (subject, classe, anno) e i provider dati."""
+    return [
+        (quiz_type, subject, classe, anno, difficulty, provider)
+        for subject, classe, anno in combos
+        for quiz_type in QUIZ_TYPES
+        for difficulty in DIFFICULTIES
+        for provider in providers
+    ]
+
+
+def _index_combos():
+    # import pesante (Chroma, modello di embedding): solo se la banca è attiva
+    from services.retriever_chain import _query_collection
+    with _query_collection() as collection:
+        return list_filter_combos(collection)
+
+
+class QuizBank:
+    _UNSET = object()
+
+    def __init__(
+        self,
+        generate,
+        target_stock: int = TARGET_STOCK,
+        workers: int = BANK_WORKERS,
+        index_version=None,
+        providers=BANK_PROVIDERS,
+        combos=None,
+        watch_seconds: float = WATCH_SECONDS,
+    ):
+        """
+        generate: funzione come generate_quiz_from_data (dict → {"status", "data"}).
+        index_version: funzione senza argomenti che ritorna la versione corrente dell'indice.
+        combos: funzione senza argomenti che ritorna le combinazioni (subject, classe, anno)
+        dell'indice; viene richiamata a ogni cambio di versione.
+        watch_seconds: intervallo del controllo della versione (0 = nessun thread di controllo).
+        """
+        self.generate = generate
+        self.target_stock = target_stock
+        self.providers = tuple(providers)
+        self.index_version = index_version or IndexVersionWatcher(CHROMA_DIR).current
+        self.combos = combos or _index_combos
+        # (versione dell'indice, chiavi ammesse)
+        self._allowed = (None, None)
+        # versione dell'indice dell'ultimo warm_all (_UNSET: mai fatto)
+        self._warmed_version = self._UNSET
+        self._stock = {}
+        self._failures = {}
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"quiz-bank-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        if watch_seconds:
+            self._threads.append(
+                threading.Thread(target=self._watch, args=(watch_seconds,), name="quiz-bank-watch", daemon=True)
+            )
+        for t in self._threads:
+            t.start()
+
+    # ----------------- Lettura -----------------
+    def allowed_keys(self):
+        """Chiavi gestite dalla banca per la versione corrente dell'indice."""
+        version = self.index_version()
+        allowed_version, keys = self._allowed
+        if keys is None or allowed_version != version:
+            try:
+                keys = frozenset(all_keys(self.combos(), self.providers))
+            except Exception:
+                logger.exception("Combinazioni dell'indice non disponibili: banca vuota")
+                keys = frozenset()
+            self._allowed = (version, keys)
+        return keys
+
+    def take(self, data):
+        """Ritorna un quiz dallo stock (status 1) oppure None; per le chiavi della banca pianifica il rifornimento."""
+        key = bank_key(data)
+        try:
+            allowed = key in self.allowed_keys()
+        except TypeError:
+            # valori non hashabili (liste/oggetti JSON): mai in banca, li scarta la validazione
+            allowed = False
+        if not allowed:
+            BANK_REQUESTS.inc(result="miss")
+            return None
+        version = self.index_version()
+        result = None
+        with self._lock:
+            entries = self._stock.get(key)
+            while entries:
+                entry_version, quiz = entries.popleft()
+                if entry_version == version:
+                    result = {"status": 1, "data": quiz}
+                    break
+            self._update_stock_gauge()
+
+        BANK_REQUESTS.inc(result="hit" if result else "miss")
+        self.refill(key)
+        return result
+
+    def stock(self, key):
+        with self._lock:
+            return len(self._stock.get(key, ()))
+
+    # ----------------- Rifornimento -----------------
+    def refill(self, key):
+        if key not in self.allowed_keys():
+            return
+        with self._lock:
+            if key in self._queued or self._failures.get(key, 0) >= MAX_FAILURES:
+                return
+            self._queued.add(key)
+        self._queue.put(key)
+
+    def warm(self, keys):
+        for key in keys:
+            self.refill(key)
+
+    def warm_all(self):
+        """Accoda il rifornimento di tutte le chiavi della versione corrente dell'indice."""
+        self._warmed_version = self.index_version()
+        self.warm(self.allowed_keys())
+
+    def check_index(self):
+        """Nuova versione dell'indice rispetto all'ultimo warm_all: scarta le voci vecchie e rifornisce."""
+        if self.index_version() == self._warmed_version:
+            return False
+        logger.info("Banca: nuova versione dell'indice %s, rifornimento completo", self.index_version())
+        self.evict_stale()
+        self.warm_all()
+        return True
+
+    def evict_stale(self):
+        """Scarta tutte le voci generate con una versione dell'indice diversa da quella attuale."""
+        version = self.index_version()
+        allowed = self.allowed_keys()
+        with self._lock:
+            # le chiavi uscite dall'indice spariscono del tutto
+            self._stock = {
+                key: deque(e for e in entries if e[0] == version)
+                for key, entries in self._stock.items()
+                if key in allowed
+            }
+            self._failures.clear()
+            self._update_stock_gauge()
+
+    def join(self):
+        """Attende che la coda di rifornimento sia vuota (utile in test e warm-up)."""
+        self._queue.join()
+
+    def _payload(self, key):
+        quiz_type, category, classe, anno, difficulty, provider = key
+        return {
+            "type": quiz_type,
+            "category": category,
+            "classe": classe,
+            "anno": anno,
+            "difficulty": difficulty,
+            "llmProvider": provider,
+        }
+
+    def _watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.check_index()
+            except Exception:
+                logger.exception("Controllo della versione dell'indice fallito")
+
+    def _worker(self):
+        while True:
+            key = self._queue.get()
+            try:
+                self._fill(key)
+            except Exception:
+                logger.exception("Rifornimento fallito per %s", key)
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
+                self._queue.task_done()
+
+    def _fill(self, key):
+        while True:
+            version = self.index_version()
+            with self._lock:
+                entries = self._stock.setdefault(key, deque())
+                # scarta le voci generate su un indice precedente
+                if any(e[0] != version for e in entries):
+                    self._stock[key] = entries = deque(e for e in entries if e[0] == version)
+                if len(entries) >= self.target_stock:
+                    return
+
+            result = self.generate(self._payload(key))
+            if result.get("status") != 1:
+                with self._lock:
+                    self._failures[key] = self._failures.get(key, 0) + 1
+                logger.info("Generazione in banca non riuscita per %s (status %s)", key, result.get("status"))
+                return
+
+            with self._lock:
+                self._failures.pop(key, None)
+                self._stock.setdefault(key, deque()).append((version, result["data"]))
+                self._update_stock_gauge()
+
+    def _update_stock_gauge(self):
+        BANK_STOCK.set(sum(len(e) for e in self._stock.values()))
+
+
+_bank = None
+_bank_lock = threading.Lock()
+
+
+def get_bank(generate):
+    """Banca di processo, creata (e avviata, con il rifornimento di tutte le chiavi) al primo utilizzo."""
+    global _bank
+    with _bank_lock:
+        if _bank is None:
+            _bank = QuizBank(generate)
+            _bank.warm_all()
+        return _bank
+
+
+def get_or_generate(data, generate, deadline=None):
+    """Servi dalla banca se c'è stock, altrimenti generazione live (entro `deadline`, se dato)."""
+    quiz = get_bank(generate).take(data)
+    if quiz is not None:
+        return quiz
+    if deadline is not None:
+        return generate(data, deadline=deadline)
+    return generate(data)
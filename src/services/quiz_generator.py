@@ -1,18 +1,52 @@
 # services/quiz_generator.py
 
-import json
-import re
-from services.llm_provider import get_llm
+import os
+import time
+import logging
+from services.llm_provider import get_shared_llm, LLM_PROVIDERS
+from services.hedging import HEDGING_ENABLED, get_hedged_llm
 from services.retriever_chain import build_rag_chain
-from services.prompt_builder import build_prompt
+from services.prompt_builder import build_prompt, build_batch_prompt, get_prompt_template
+from services.candidate_pools import QUIZ_TYPES
 
 
 from validators.validator_schemas import validate_quiz_data
+from services.metrics import span, record_status
+from services.context_builder import context_budget_for
+from services.deadline import DeadlineExceeded, DEADLINE_STATUS
+from services.output_budget import generation_kwargs, record_output, MAX_BATCH_SIZE
+from services.json_repair import parse_llm_json, record_saved_call
+from services.log import get_logger, log_sampled
 
+logger = get_logger("quiz_generator")
 
-def generate_quiz_from_data(data):
+# Con SAGE_LLM_STREAMING=1 l'output LLM viene letto in streaming e interrotto
+# appena il primo oggetto JSON è completo (vedi services/json_stream.py)
+LLM_STREAMING = os.getenv("SAGE_LLM_STREAMING", "0") == "1"
+# Provider che supportano la prompt cache esplicita (cache_control sul prefisso statico)
+PROMPT_CACHE_PROVIDERS = {"claude"}
+REQUIRED_FIELDS = ("type", "category", "classe", "anno", "difficulty", "llmProvider")
+
+
+def validate_request(data):
+    """Motivo per cui la richiesta non è valida, oppure None (stesse regole per singola e batch)."""
+    if not isinstance(data, dict):
+        return "Not a JSON object"
+    # niente default: il provider lo sceglie la route
+    missing = [f for f in REQUIRED_FIELDS if data.get(f) is None or data.get(f) == ""]
+    if missing:
+        return f"Missing fields: {', '.join(missing)}"
+    if data["type"] not in QUIZ_TYPES:
+        return f"Unknown quiz type: {data['type']}"
+    if data["llmProvider"] not in LLM_PROVIDERS:
+        return f"Unknown LLM provider: {data['llmProvider']}"
+    return None
+
+
+def generate_quiz_from_data(data, deadline=None):
     """
     Genera un quiz usando RAG + LLM in base ai parametri forniti.
+    `deadline` (services.deadline.Deadline, opzionale) è il budget di tempo della richiesta.
 
     Ritorna sempre:
       - status:
@@ -20,9 +54,80 @@ def generate_quiz_from_data(data):
           2 -> fonti non disponibili (retriever non ha trovato chunk)
           3 -> errore parsing output LLM (JSON non valido)
           4 -> richiesta non valida / init LLM fallito / schema non rispettato
+          5 -> deadline della richiesta scaduto (o richiesta scartata perché non poteva finire in tempo)
       - data: contenuto del quiz o {}
     """
+    start = time.perf_counter()
+    try:
+        result = _generate_quiz(data, deadline)
+    except DeadlineExceeded as e:
+        logger.info("%s", e)
+        result = {"status": DEADLINE_STATUS, "data": {}}
+    record_status(result["status"], time.perf_counter() - start)
+    return result
+
+
+async def agenerate_quiz_from_data(data, deadline=None):
+    """
+    Versione async di generate_quiz_from_data (stessi status e stesso output).
+    Usa rag_chain.ainvoke: retrieval nel thread pool limitato, chiamata LLM via ainvoke.
+    """
+    start = time.perf_counter()
+    prepared = _prepare(data, deadline)
+    if "status" in prepared:
+        result = prepared
+    else:
+        try:
+            rag_response = await prepared["rag_chain"].ainvoke(prepared["rag_input"])
+            result = _build_result(rag_response, prepared["rag_input"]["subject"])
+            _record_output(prepared, rag_response, result)
+        except DeadlineExceeded as e:
+            logger.info("%s", e)
+            result = {"status": DEADLINE_STATUS, "data": {}}
+    record_status(result["status"], time.perf_counter() - start)
+    return result
+
+
+def _generate_quiz(data, deadline=None):
+    prepared = _prepare(data, deadline)
+    if "status" in prepared:
+        return prepared
+
+    # Query RAG con filtri
+    rag_response = prepared["rag_chain"].invoke(prepared["rag_input"])
+    result = _build_result(rag_response, prepared["rag_input"]["subject"])
+    _record_output(prepared, rag_response, result)
+    return result
+
 
+def _record_output(prepared, rag_response, result):
+    # senza fonti non c'è stata chiamata LLM
+    if rag_response.get("source_documents"):
+        record_output(
+            prepared["labels"]["type"],
+            prepared["labels"]["provider"],
+            status=result["status"],
+            output_tokens=rag_response.get("output_tokens"),
+            truncated=rag_response.get("truncated", False),
+        )
+
+
+def retrieval_query(data):
+    """Argomenti di query_chunks per la richiesta: richieste con la stessa query condividono il retrieval."""
+    return {
+        "question": build_prompt(data.get("type"), data.get("category"), data.get("difficulty")),
+        "subject": data.get("category"),
+        "classe": data.get("classe"),
+        "anno": data.get("anno"),
+    }
+
+
+def _prepare(data, deadline=None, quiz_types=None):
+    """
+    Valida la richiesta e prepara chain + input RAG.
+    Ritorna direttamente il risultato ({"status": ..., "data": ...}) se la richiesta non è valida.
+    `quiz_types` (batch) sono i tipi da generare nella stessa chiamata, per il budget di output.
+    """
     quiz_type = data.get("type")
     category = data.get("category")
     classe = data.get("classe")
@@ -31,46 +136,81 @@ def generate_quiz_from_data(data):
     llm_provider = data.get("llmProvider")
 
     # ✅ Validazione preliminare dei campi in ingresso (niente default)
-    required_fields = [quiz_type, category, classe, anno, difficulty, llm_provider]
-    if any(field is None or field == "" for field in required_fields):
+    if validate_request(data) is not None:
         return {"status": 4, "data": {}}
 
-    # Inizializza LLM + RAG
+    # max_tokens dal budget del tipo (schemi JSON) e JSON mode dove il provider lo supporta
+    quiz_types = quiz_types or [quiz_type]
+
+    def call_kwargs(provider):
+        return generation_kwargs(provider, quiz_types, stream=LLM_STREAMING)
+
+    # LLM dal registry di processo (client e connessioni riusati tra richieste) + RAG
     try:
-        llm = get_llm(llm_provider)
+        llm = get_shared_llm(llm_provider)
+        llm_kwargs = call_kwargs(llm_provider)
+        if HEDGING_ENABLED:
+            # hedge verso l'altro provider configurato se il primo è lento o in errore;
+            # gli argomenti di chiamata li applica HedgedLLM provider per provider
+            llm = get_hedged_llm(llm_provider, get_shared_llm, call_kwargs=call_kwargs)
+            llm_kwargs = {}
         rag_chain = build_rag_chain(llm)
     except Exception:
         #init fallito (es. chiave mancante, modello inesistente...)
         return {"status": 4, "data": {}}
 
-    # Prompt super-esplicito (in ENG), output in ITA, JSON puro
-    prompt = build_prompt(quiz_type, category, difficulty)
+    # Prompt super-esplicito (in ENG), output in ITA, JSON puro.
+    # È anche la query di retrieval (e la chiave dei pool precalcolati)
+    prompt = retrieval_query(data)["question"]
+
+    rag_input = {}
+    template = get_prompt_template(quiz_type)
+    if template is not None:
+        # Al modello va il template del solo tipo richiesto: prefisso statico + parte variabile
+        rag_input = {
+            "question": template.render(category, difficulty),
+            "prompt_prefix": template.prefix,
+            "cache_prefix": llm_provider in PROMPT_CACHE_PROVIDERS,
+            # con l'hedging il prompt si costruisce per ogni provider chiamato
+            "cache_providers": sorted(PROMPT_CACHE_PROVIDERS),
+        }
+
+    return {
+        "rag_chain": rag_chain,
+        "labels": {"type": quiz_type if len(quiz_types) == 1 else "batch", "provider": llm_provider},
+        "rag_input": {
+            **rag_input,
+            "query": prompt,
+            "subject": category,
+            "classe": classe,
+            "anno": anno,
+            "stream": LLM_STREAMING,
+            # budget di token del contesto per provider (None = contesto completo)
+            "context_budget": context_budget_for(llm_provider),
+            # budget di tempo: shed prima delle fasi costose e timeout della chiamata LLM
+            "deadline": deadline,
+            "llm_kwargs": llm_kwargs,
+        },
+    }
+
+
+def _invalid_status(repair_stage):
+    return 4 if repair_stage == "strict" else 3
 
-    # Query RAG con filtri
-    rag_response = rag_chain.invoke({
-        "query": prompt,
-        "subject": category,
-        "classe": classe,
-        "anno": anno
-    })
 
-    print("RAG result raw:", rag_response.get("result", ""))
+def _build_result(rag_response, category):
+    log_sampled(logger, logging.DEBUG, "RAG result raw: %s", rag_response.get("result", ""))
 
     # Nessuna fonte rilevante
     if not rag_response.get("source_documents"):
         return {"status": 2, "data": {}}
 
-    # Parsing del JSON prodotto dall'LLM
+    # Parsing del JSON prodotto dall'LLM (con riparazione locale prima di arrendersi)
     try:
-        match = re.search(r"\{.*\}", rag_response["result"], re.DOTALL)
-        if not match:
-            raise ValueError("No JSON object found")
-
-        quiz_data = json.loads(match.group())
-        if not isinstance(quiz_data, dict):
-            raise ValueError("Not a dict")
+        with span("json_extract"):
+            quiz_data, repair_stage = parse_llm_json(rag_response["result"])
     except Exception as e:
-        print("JSON PARSE FAILED:", str(e))
+        logger.warning("JSON PARSE FAILED: %s", e)
         return {"status": 3, "data": {}}
 
     # Coerenza minima: forziamo la categoria a quella richiesta (evita drift del modello)
@@ -78,11 +218,120 @@ def generate_quiz_from_data(data):
     quiz_data["category"] = category
 
     # Validazione contro JSON Schema del tipo specifico
-    # Se non rispetta lo schema → status 4 (richiesta non valida secondo i requisiti)
-    is_valid, error = validate_quiz_data(quiz_data)
+    # Se non rispetta lo schema → status 4 (richiesta non valida secondo i requisiti);
+    # un oggetto ottenuto dalla riparazione che non è un quiz resta un errore di parsing (3, ritentabile)
+    with span("schema_validation"):
+        is_valid, error = validate_quiz_data(quiz_data)
     if not is_valid:
-        print("SCHEMA VALIDATION FAILED:", error)
-        return {"status": 4, "data": {}}
+        logger.warning("SCHEMA VALIDATION FAILED (%s): %s", repair_stage, error)
+        return {"status": _invalid_status(repair_stage), "data": {}}
 
     # Tutto ok
+    record_saved_call(repair_stage)
     return {"status": 1, "data": quiz_data}
+
+
+def generate_quiz_batch(data, deadline=None):
+    """
+    Genera più quiz sullo stesso argomento con un solo retrieval e un solo contesto.
+
+    Oltre ai campi di generate_quiz_from_data (senza "type") accetta:
+      - "types": lista dei tipi, uno per quiz (anche misti), oppure
+      - "type" + "count": N quiz dello stesso tipo
+    al massimo MAX_BATCH_SIZE quiz, ricavato dai budget di output: oltre, la risposta
+    verrebbe troncata da max_tokens e la richiesta è rifiutata (status 4).
+    Ogni quiz è validato da solo: si ritornano i successi parziali.
+
+    Ritorna:
+      - status: 1 se almeno un quiz è valido, altrimenti 2/3/4 come per il quiz singolo
+      - data: lista dei quiz validi
+      - errors: [{"index": i, "error": ...}] per i quiz scartati
+    """
+    start = time.perf_counter()
+    try:
+        result = _generate_batch(data, deadline)
+    except DeadlineExceeded as e:
+        logger.info("%s", e)
+        result = {"status": DEADLINE_STATUS, "data": [], "errors": []}
+    record_status(result["status"], time.perf_counter() - start)
+    return result
+
+
+def _batch_types(data):
+    types = data.get("types")
+    if types is None and data.get("type"):
+        try:
+            types = [data["type"]] * int(data.get("count", 1))
+        except (TypeError, ValueError):
+            return None
+    if not isinstance(types, list) or not 1 <= len(types) <= MAX_BATCH_SIZE:
+        return None
+    if any(t not in QUIZ_TYPES for t in types):
+        return None
+    return types
+
+
+def _generate_batch(data, deadline=None):
+    failed = {"status": 4, "data": [], "errors": []}
+
+    types = _batch_types(data)
+    if types is None:
+        return failed
+
+    # stessa validazione del quiz singolo, con il primo tipo come query di retrieval
+    prepared = _prepare(dict(data, type=types[0]), deadline, quiz_types=types)
+    if "status" in prepared:
+        return dict(failed, status=prepared["status"])
+
+    rag_input = dict(
+        prepared["rag_input"],
+        question=build_batch_prompt(types, data.get("category"), data.get("difficulty")),
+        prompt_prefix=None,
+    )
+    rag_response = prepared["rag_chain"].invoke(rag_input)
+    result = _build_batch_result(rag_response, data.get("category"), types)
+    _record_output(prepared, rag_response, result)
+    return result
+
+
+def _build_batch_result(rag_response, category, types):
+    log_sampled(logger, logging.DEBUG, "RAG batch result raw: %s", rag_response.get("result", ""))
+
+    if not rag_response.get("source_documents"):
+        return {"status": 2, "data": [], "errors": []}
+
+    try:
+        with span("json_extract"):
+            parsed, repair_stage = parse_llm_json(rag_response["result"])
+            items = parsed.get("quizzes")
+            if not isinstance(items, list):
+                raise ValueError("'quizzes' is not a list")
+    except Exception as e:
+        logger.warning("JSON PARSE FAILED (batch): %s", e)
+        return {"status": 3, "data": [], "errors": []}
+
+    quizzes, errors = [], []
+    for i, item in enumerate(items[:len(types)]):
+        if not isinstance(item, dict) or "type" not in item:
+            errors.append({"index": i, "error": "Not a quiz object"})
+            continue
+        # il modello può scambiare l'ordine o il tipo: ogni posizione deve avere il tipo richiesto
+        if item["type"] != types[i]:
+            errors.append({"index": i, "error": f"Expected type {types[i]}, got {item['type']}"})
+            continue
+        item["category"] = category
+        with span("schema_validation"):
+            is_valid, error = validate_quiz_data(item)
+        if not is_valid:
+            errors.append({"index": i, "error": error})
+            continue
+        quizzes.append(item)
+
+    for i in range(len(items), len(types)):
+        errors.append({"index": i, "error": "Missing from model output"})
+
+    if errors:
+        logger.info("Batch: %d/%d quiz validi", len(quizzes), len(types))
+    if quizzes:
+        record_saved_call(repair_stage)
+    return {"status": 1 if quizzes else _invalid_status(repair_stage), "data": quizzes, "errors": errors}
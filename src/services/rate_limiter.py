@@ -0,0 +1,414 @@
+# services/rate_limiter.py
+"""
+Limitatore per provider intorno ai client LLM (SAGE_RATE_LIMIT=1).
+
+Groq e Anthropic impongono limiti di richieste e di token al minuto: superarli
+significa 429 e richieste fallite. Per ogni provider:
+  - due token bucket (richieste/minuto e token stimati/minuto) dosano le chiamate;
+  - un limite di concorrenza AIMD: +1/limite a ogni successo (circa +1 per "giro"),
+    dimezzato su 429/529 del provider o su un picco di latenza, poi risale da solo.
+Se l'attesa supera il timeout della chiamata (il tempo rimasto al deadline)
+si solleva subito RateLimited invece di attendere inutilmente.
+
+Lo stato è per processo: con N worker gunicorn (serve.post_fork → configure(N)) ogni
+processo riceve 1/N dei limiti rpm/tpm, così il totale resta quello configurato.
+La ripartizione è statica (un worker scarico non cede la sua quota agli altri);
+la concorrenza AIMD resta per processo e si adatta da sola ai 429 del provider.
+"""
+
+import os
+import math
+import time
+import asyncio
+import threading
+import contextlib
+
+from services.metrics import counter, gauge
+from services.context_builder import estimate_tokens
+from services.log import get_logger
+
+logger = get_logger("rate_limiter")
+
+RATE_LIMIT_ENABLED = os.getenv("SAGE_RATE_LIMIT", "0") == "1"
+
+# Limiti di default (piano base dei provider), sovrascrivibili da env
+PROVIDER_LIMITS = {
+    "groq": {
+        "rpm": int(os.getenv("SAGE_GROQ_RPM", "30")),
+        "tpm": int(os.getenv("SAGE_GROQ_TPM", "30000")),
+    },
+    "claude": {
+        "rpm": int(os.getenv("SAGE_CLAUDE_RPM", "50")),
+        "tpm": int(os.getenv("SAGE_CLAUDE_TPM", "50000")),
+    },
+}
+# Limite di concorrenza AIMD: valore iniziale e massimo per provider
+INITIAL_CONCURRENCY = int(os.getenv("SAGE_LLM_CONCURRENCY", "4"))
+MAX_CONCURRENCY = int(os.getenv("SAGE_LLM_MAX_CONCURRENCY", "20"))
+# Attesa massima per uno slot quando la chiamata non ha un timeout (secondi)
+MAX_WAIT = float(os.getenv("SAGE_RATE_LIMIT_MAX_WAIT", "30"))
+
+BACKOFF_FACTOR = 0.5
+# Picco di latenza = oltre LATENCY_SPIKE_FACTOR volte la media mobile (dopo MIN_LATENCY_SAMPLES)
+LATENCY_SPIKE_FACTOR = 2.0
+MIN_LATENCY_SAMPLES = 10
+LATENCY_EWMA_ALPHA = 0.1
+# Al massimo una riduzione per finestra: una raffica di 429 dallo stesso picco conta una volta
+DECREASE_COOLDOWN = 2.0
+# Token di output stimati quando la chiamata non ha max_tokens
+DEFAULT_OUTPUT_TOKENS = 512
+ASYNC_POLL_SECONDS = 0.01
+THROTTLE_STATUSES = (429, 529)
+
+CONCURRENCY_LIMIT = gauge(
+    "sage_llm_concurrency_limit",
+    "Limite di concorrenza AIMD corrente per provider",
+    labelnames=("provider",),
+)
+IN_FLIGHT = gauge("sage_llm_in_flight", "Chiamate LLM in corso per provider", labelnames=("provider",))
+BUCKET_AVAILABLE = gauge(
+    "sage_llm_rate_bucket_available",
+    "Capacità residua dei token bucket: requests o tokens",
+    labelnames=("provider", "bucket"),
+)
+BUCKET_RATE = gauge(
+    "sage_llm_rate_limit_per_minute",
+    "Limite configurato al minuto: requests o tokens",
+    labelnames=("provider", "bucket"),
+)
+RATE_LIMIT_EVENTS = counter(
+    "sage_llm_rate_limit_total",
+    "Eventi del limitatore: waited, rejected (attesa oltre il timeout), throttled (429 dal provider), latency_spike",
+    labelnames=("provider", "event"),
+)
+
+
+class RateLimited(Exception):
+    def __init__(self, provider, retry_after):
+        self.provider = provider
+        self.retry_after = retry_after
+        super().__init__(f"Limite di {provider} raggiunto, slot libero tra {retry_after:.2f}s")
+
+
+class TokenBucket:
+    """Bucket che si ricarica di `per_minute` unità al minuto, fino a `capacity` (default: un minuto)."""
+
+    def __init__(self, per_minute, capacity=None, clock=time.monotonic):
+        self.rate = per_minute / 60.0
+        self.capacity = float(capacity if capacity is not None else per_minute)
+        self.tokens = self.capacity
+        self.clock = clock
+        # ultimo istante di ricarica; nel futuro se il bucket è in pausa (Retry-After)
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        if now > self._updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def available(self):
+        with self._lock:
+            self._refill(self.clock())
+            return self.tokens
+
+    def reserve(self, amount):
+        """Preleva `amount` e ritorna 0; se non bastano non preleva nulla e ritorna i secondi di attesa stimati."""
+        amount = min(amount, self.capacity)
+        with self._lock:
+            now = self.clock()
+            self._refill(now)
+            paused = max(self._updated - now, 0.0)
+            if not paused and self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return paused + max(amount - self.tokens, 0.0) / self.rate
+
+    def refund(self, amount):
+        with self._lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def pause(self, seconds):
+        """Svuota il bucket e sospende la ricarica per `seconds` (Retry-After del provider)."""
+        with self._lock:
+            self.tokens = 0.0
+            self._updated = max(self._updated, self.clock() + seconds)
+
+
+class AIMDLimit:
+    """Semaforo con limite variabile: additive increase sui successi, multiplicative decrease sui segnali di sovraccarico."""
+
+    def __init__(self, name, initial=INITIAL_CONCURRENCY, min_limit=1, max_limit=MAX_CONCURRENCY,
+                 backoff=BACKOFF_FACTOR, cooldown=DECREASE_COOLDOWN, clock=time.monotonic):
+        self.name = name
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff = backoff
+        self.cooldown = cooldown
+        self.clock = clock
+        self.limit = float(min(max(initial, min_limit), max_limit))
+        self.in_flight = 0
+        self._latency = None
+        self._samples = 0
+        self._last_decrease = None
+        self._cond = threading.Condition()
+        self._publish()
+
+    def _publish(self):
+        CONCURRENCY_LIMIT.set(int(self.limit), provider=self.name)
+        IN_FLIGHT.set(self.in_flight, provider=self.name)
+
+    def try_acquire(self):
+        with self._cond:
+            if self.in_flight >= int(self.limit):
+                return False
+            self.in_flight += 1
+            self._publish()
+            return True
+
+    def acquire(self, timeout=None):
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self.in_flight >= int(self.limit):
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            self.in_flight += 1
+            self._publish()
+            return True
+
+    async def aacquire(self, timeout=None):
+        # polling sull'event loop: un Condition bloccherebbe il loop condiviso
+        end = None if timeout is None else time.monotonic() + timeout
+        while not self.try_acquire():
+            if end is not None and time.monotonic() >= end:
+                return False
+            await asyncio.sleep(ASYNC_POLL_SECONDS)
+        return True
+
+    def release(self, latency=None, throttled=False):
+        """
+        latency: durata della chiamata riuscita (None = nessun esito, es. cancellata o errore).
+        throttled: il provider ha risposto 429/529.
+        """
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self._decrease("throttled")
+            elif latency is not None:
+                if self._is_spike(latency):
+                    self._decrease("latency_spike")
+                else:
+                    self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self._observe(latency)
+            self._publish()
+            self._cond.notify_all()
+
+    def _is_spike(self, latency):
+        return self._samples >= MIN_LATENCY_SAMPLES and latency > LATENCY_SPIKE_FACTOR * self._latency
+
+    def _observe(self, latency):
+        self._samples += 1
+        if self._latency is None:
+            self._latency = latency
+        else:
+            self._latency += LATENCY_EWMA_ALPHA * (latency - self._latency)
+
+    def _decrease(self, event):
+        RATE_LIMIT_EVENTS.inc(provider=self.name, event=event)
+        now = self.clock()
+        if self._last_decrease is not None and now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.limit = max(self.min_limit, self.limit * self.backoff)
+        logger.info("%s: %s, limite di concorrenza ridotto a %d", self.name, event, int(self.limit))
+
+
+def is_throttle_error(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status in THROTTLE_STATUSES
+
+
+def retry_after_of(error):
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        seconds = float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+    return seconds if math.isfinite(seconds) and seconds > 0 else None
+
+
+def estimate_call_tokens(messages, kwargs):
+    """Token stimati della chiamata: input (messaggi) + output massimo richiesto."""
+    if isinstance(messages, str):
+        messages = [messages]
+    text = "".join(str(getattr(m, "content", m)) for m in messages)
+    return estimate_tokens(text) + int(kwargs.get("max_tokens") or DEFAULT_OUTPUT_TOKENS)
+
+
+class ProviderLimiter:
+    def __init__(self, name, rpm=None, tpm=None, concurrency=None, clock=time.monotonic):
+        """rpm/tpm: limiti al minuto (None o 0 = nessun limite)."""
+        self.name = name
+        self.requests = TokenBucket(rpm, clock=clock) if rpm else None
+        self.tokens = TokenBucket(tpm, clock=clock) if tpm else None
+        self.concurrency = concurrency if concurrency is not None else AIMDLimit(name, clock=clock)
+        for bucket, per_minute in (("requests", rpm), ("tokens", tpm)):
+            if per_minute:
+                BUCKET_RATE.set(per_minute, provider=name, bucket=bucket)
+        self._publish()
+
+    def _publish(self):
+        for bucket, tb in (("requests", self.requests), ("tokens", self.tokens)):
+            if tb is not None:
+                BUCKET_AVAILABLE.set(int(tb.available()), provider=self.name, bucket=bucket)
+
+    def _reserve(self, tokens):
+        # entrambi i bucket o nessuno: la richiesta prelevata si restituisce se mancano i token
+        wait = self.requests.reserve(1) if self.requests is not None else 0.0
+        if not wait and self.tokens is not None:
+            wait = self.tokens.reserve(tokens)
+            if wait and self.requests is not None:
+                self.requests.refund(1)
+        self._publish()
+        return wait
+
+    def _wait_time(self, tokens, end):
+        """Secondi da attendere prima di riprovare (0 = prelevato); RateLimited se si supera `end`."""
+        wait = self._reserve(tokens)
+        if wait and time.monotonic() + wait > end:
+            RATE_LIMIT_EVENTS.inc(provider=self.name, event="rejected")
+            raise RateLimited(self.name, wait)
+        return wait
+
+    def _rejected(self, end):
+        RATE_LIMIT_EVENTS.inc(provider=self.name, event="rejected")
+        return RateLimited(self.name, max(end - time.monotonic(), 0.0))
+
+    def acquire(self, tokens, timeout=None):
+        end = time.monotonic() + (timeout if timeout is not None else MAX_WAIT)
+        wait = self._wait_time(tokens, end)
+        if wait:
+            RATE_LIMIT_EVENTS.inc(provider=self.name, event="waited")
+        while wait:
+            time.sleep(wait)
+            wait = self._wait_time(tokens, end)
+        if not self.concurrency.acquire(end - time.monotonic()):
+            raise self._rejected(end)
+
+    async def aacquire(self, tokens, timeout=None):
+        end = time.monotonic() + (timeout if timeout is not None else MAX_WAIT)
+        wait = self._wait_time(tokens, end)
+        if wait:
+            RATE_LIMIT_EVENTS.inc(provider=self.name, event="waited")
+        while wait:
+            await asyncio.sleep(wait)
+            wait = self._wait_time(tokens, end)
+        if not await self.concurrency.aacquire(end - time.monotonic()):
+            raise self._rejected(end)
+
+    def release(self, started, error=None, completed=True):
+        if error is not None and is_throttle_error(error):
+            retry_after = retry_after_of(error)
+            if retry_after is not None and self.requests is not None:
+                self.requests.pause(retry_after)
+            self.concurrency.release(throttled=True)
+        elif error is None and completed:
+            self.concurrency.release(latency=time.perf_counter() - started)
+        else:
+            self.concurrency.release()
+
+    @contextlib.contextmanager
+    def slot(self, tokens, timeout=None):
+        self.acquire(tokens, timeout)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.release(started, error=e)
+            raise
+        except BaseException:
+            # stream chiuso prima della fine (GeneratorExit) o interruzione: nessun esito
+            self.release(started, completed=False)
+            raise
+        self.release(started)
+
+    @contextlib.asynccontextmanager
+    async def aslot(self, tokens, timeout=None):
+        await self.aacquire(tokens, timeout)
+        started = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            self.release(started, error=e)
+            raise
+        except BaseException:
+            self.release(started, completed=False)
+            raise
+        self.release(started)
+
+
+class LimitedLLM:
+    """Client LLM con la stessa interfaccia (invoke/ainvoke/stream/astream), dosato dal limiter del provider."""
+
+    def __init__(self, llm, limiter):
+        self.llm = llm
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.llm, name)
+
+    def invoke(self, messages, **kwargs):
+        with self.limiter.slot(estimate_call_tokens(messages, kwargs), kwargs.get("timeout")):
+            return self.llm.invoke(messages, **kwargs)
+
+    async def ainvoke(self, messages, **kwargs):
+        async with self.limiter.aslot(estimate_call_tokens(messages, kwargs), kwargs.get("timeout")):
+            return await self.llm.ainvoke(messages, **kwargs)
+
+    def stream(self, messages, **kwargs):
+        # lo slot resta occupato finché lo stream è aperto
+        with self.limiter.slot(estimate_call_tokens(messages, kwargs), kwargs.get("timeout")):
+            yield from self.llm.stream(messages, **kwargs)
+
+    async def astream(self, messages, **kwargs):
+        async with self.limiter.aslot(estimate_call_tokens(messages, kwargs), kwargs.get("timeout")):
+            async for chunk in self.llm.astream(messages, **kwargs):
+                yield chunk
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+_processes = 1
+
+
+def configure(processes):
+    """Numero di processi che condividono i limiti dei provider (worker gunicorn)."""
+    global _processes
+    with _limiters_lock:
+        _processes = max(1, processes)
+        # limiter eventualmente creati prima del fork: si ricreano con la quota giusta
+        _limiters.clear()
+
+
+def process_limits(provider):
+    """Limiti rpm/tpm di questo processo: quelli configurati divisi tra i processi."""
+    limits = PROVIDER_LIMITS.get(provider, {})
+    return {key: value / _processes if value else value for key, value in limits.items()}
+
+
+def get_limiter(provider):
+    """Limiter di processo per il provider (condiviso da tutte le richieste)."""
+    with _limiters_lock:
+        limiter = _limiters.get(provider)
+        if limiter is None:
+            limits = process_limits(provider)
+            limiter = _limiters[provider] = ProviderLimiter(provider, limits.get("rpm"), limits.get("tpm"))
+        return limiter
+
+
+def limited(provider, llm):
+    return LimitedLLM(llm, get_limiter(provider))
@@ -1,10 +1,29 @@
 import os
 import random
+import asyncio
 import hashlib
+import logging
+import functools
+import threading
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
 from chromadb import PersistentClient
 from sentence_transformers import SentenceTransformer
 from langchain_groq import ChatGroq
 from langchain.schema import HumanMessage, SystemMessage
+from services.candidate_pools import CandidatePools, POOLS_PATH, build_where
+from services.metrics import span
+from services.json_stream import consume_stream, aconsume_stream
+from services.context_builder import build_budgeted_context, estimate_tokens
+from services.deadline import MIN_LLM_SECONDS, DEADLINE_EVENTS, DeadlineExceeded
+from services.rate_limiter import RateLimited
+from services.output_budget import response_usage
+from services.single_flight import SingleFlight, COALESCE_RETRIEVAL
+from services.embed_batcher import EMBED_BATCHING, MicroBatcher
+from services.index_versions import IndexAlias
+from services.log import get_logger, log_sampled
+
+logger = get_logger("retriever")
 
 # Evita warning dei tokenizers dopo fork
 os.environ["TOKENIZERS_PARALLELISM"] = "false"
@@ -16,10 +35,134 @@ COLLECTION_NAME = "educational_chunks"
 CHUNK_LIMIT = 6
 # Quanti candidati recuperare dal DB prima della scelta random
 CANDIDATE_LIMIT = 30
+# Thread dedicati a embedding + Chroma nel percorso async
+RETRIEVAL_WORKERS = int(os.getenv("RETRIEVAL_WORKERS", "4"))
 
 embedder = SentenceTransformer("all-MiniLM-L6-v2")
-chroma_client = PersistentClient(path=CHROMA_DIR)
-collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME)
+# Pool precalcolati (vedi candidate_pools); se mancanti o vecchi si usa la ricerca live
+candidate_pools = CandidatePools(POOLS_PATH, chroma_dir=CHROMA_DIR)
+# Versione attiva dell'indice (alias CURRENT in CHROMA_DIR, vedi index_versions)
+index_alias = IndexAlias(CHROMA_DIR)
+chroma_client = None
+collection = None
+_open_version = None
+_handle = None
+_index_lock = threading.Lock()
+
+
+class _IndexHandle:
+    """
+    Client e collection di una versione dell'indice, con le query in volo.
+    Una versione ritirata (reindex pubblicato) viene chiusa quando finisce l'ultima query.
+    """
+
+    def __init__(self, client, collection, version):
+        self.collection = collection
+        self.version = version
+        self.in_flight = 0
+        self.retired = False
+        # il System di chromadb tiene connessioni SQLite e thread del backend
+        try:
+            self.identifier, self.system = client._identifier, client._system
+        except (AttributeError, KeyError):
+            self.identifier, self.system = None, None
+
+    def retire(self):
+        # chiamato sotto _index_lock
+        self.retired = True
+        if self.in_flight == 0:
+            self.close()
+
+    def close(self):
+        # un client nuovo sulla stessa cartella riusa lo stesso System: in quel caso resta aperto
+        if self.system is None or (_handle is not None and _handle.system is self.system):
+            return
+        try:
+            from chromadb.api.client import SharedSystemClient
+            cache = SharedSystemClient._identifier_to_system
+            if cache.get(self.identifier) is self.system:
+                del cache[self.identifier]
+        except ImportError:
+            pass
+        try:
+            self.system.stop()
+        except Exception as e:
+            logger.warning("Chiusura dell'indice %s non riuscita: %s", self.version, e)
+        self.system = None
+
+
+def open_index():
+    """Apre client e collection Chroma (all'import e nei worker dopo il fork, vedi serve.py)."""
+    global chroma_client, collection, _open_version, _handle
+    version = index_alias.version()
+    chroma_client = PersistentClient(path=index_alias.path())
+    collection = chroma_client.get_or_create_collection(name=COLLECTION_NAME)
+    _open_version = version
+    _handle = _IndexHandle(chroma_client, collection, version)
+    return collection
+
+
+def reopen_index():
+    # il client aperto dal master non va usato dopo il fork (connessioni SQLite, thread del backend):
+    # si svuota la cache dei client di chromadb e si riapre (senza fermarlo: è del master)
+    try:
+        from chromadb.api.client import SharedSystemClient
+        SharedSystemClient.clear_system_cache()
+    except ImportError:
+        pass
+    return open_index()
+
+
+def _switch_index():
+    # sotto _index_lock: la versione precedente si chiude quando non ha più query in volo
+    old = _handle
+    logger.info("Nuova versione dell'indice: %s", index_alias.version())
+    open_index()
+    if old is not None:
+        old.retire()
+
+
+def _current_collection():
+    # reindex pubblicato (nuova versione nell'alias): si riaprono i handle senza riavvio;
+    # le query già in volo finiscono sulla versione precedente, che resta su disco
+    if index_alias.version() != _open_version:
+        with _index_lock:
+            if index_alias.version() != _open_version:
+                _switch_index()
+    return collection
+
+
+@contextlib.contextmanager
+def _query_collection():
+    """Collection della versione attiva, tenuta aperta per la durata della query."""
+    _current_collection()
+    with _index_lock:
+        handle = _handle
+        if handle is not None and handle.collection is collection:
+            handle.in_flight += 1
+        else:
+            # collection sostituita dall'esterno (test): nessun conteggio
+            handle = None
+        current = collection
+    try:
+        yield current
+    finally:
+        if handle is not None:
+            with _index_lock:
+                handle.in_flight -= 1
+                if handle.retired and handle.in_flight == 0:
+                    handle.close()
+
+
+open_index()
+retrieval_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="retrieval")
+# Retrieval condiviso tra richieste identiche concorrenti (SAGE_COALESCE, vedi single_flight)
+retrieval_flight = SingleFlight("retrieval")
+# Embedding delle query a micro-batch tra richieste concorrenti (SAGE_EMBED_BATCHING, vedi embed_batcher)
+query_batcher = MicroBatcher(lambda texts: embedder.encode(texts))
+# Candidati precalcolati dai batch in corso: chiave query → [candidati, batch che li usano]
+_preloaded = {}
+_preloaded_lock = threading.Lock()
 
 llm = ChatGroq(
     model="llama3-8b-8192",
@@ -29,37 +172,20 @@ llm = ChatGroq(
 def _hash_doc(text: str) -> str:
     return hashlib.md5(text.strip().encode("utf-8")).hexdigest()
 
-def query_chunks(question: str, subject: str = None, classe: str = None, anno: int = None):
-    embedding = embedder.encode(question).tolist()
-
-    # Costruzione filtro Chroma
-    filters = {}
-    if subject:
-        filters["subject"] = subject
-    if classe:
-        filters["classe"] = classe
-    if anno is not None:
-        filters["anno"] = anno
-
-    query_args = {
-        "query_embeddings": [embedding],
-        "n_results": CANDIDATE_LIMIT,
-        "include": ["documents", "metadatas"]  # ids utili se servono in futuro
-    }
-
-    if len(filters) == 1:
-        query_args["where"] = next(iter([{k: v} for k, v in filters.items()]))
-    elif len(filters) > 1:
-        query_args["where"] = {"$and": [{k: v} for k, v in filters.items()]}
-
-    print("🔎 Filtro usato:", query_args.get("where"))
+def _log_metas(title, metas):
+    if not logger.isEnabledFor(logging.DEBUG):
+        return
+    lines = [
+        f" - {i+1}. subject={meta.get('subject')}, classe={meta.get('classe')}, anno={meta.get('anno')}, title={meta.get('title')}"
+        for i, meta in enumerate(metas)
+    ]
+    log_sampled(logger, logging.DEBUG, "%s\n%s", title, "\n".join(lines))
 
-    results = collection.query(**query_args)
-
-    # Flatten
-    cand_docs = results["documents"][0] if results["documents"] else []
-    cand_metas = results["metadatas"][0] if results["metadatas"] else []
+def _dedup_and_pick(cand_docs, cand_metas):
+    with span("dedup_pick"):
+        return _dedup_and_pick_inner(cand_docs, cand_metas)
 
+def _dedup_and_pick_inner(cand_docs, cand_metas):
     # Dedup sui testi (evita tri/cerchio ripetuti)
     seen = set()
     unique_pairs = []
@@ -71,7 +197,7 @@ def query_chunks(question: str, subject: str = None, classe: str = None, anno: i
         unique_pairs.append((doc, meta))
 
     if not unique_pairs:
-        print("⚠️ Nessun risultato utile dopo dedup.")
+        logger.info("Nessun risultato utile dopo dedup.")
         return [], []
 
     # Shuffle randomico e pick dei 6 finali
@@ -81,16 +207,156 @@ def query_chunks(question: str, subject: str = None, classe: str = None, anno: i
     docs = [d for d, _ in picked]
     metas = [m for _, m in picked]
 
-    print("📎 RISULTATI TROVATI (candidati):")
-    for i, meta in enumerate(cand_metas):
-        print(f" - {i+1}. subject={meta.get('subject')}, classe={meta.get('classe')}, anno={meta.get('anno')}, title={meta.get('title')}")
-
-    print("✅ SELEZIONATI (random, dedup):")
-    for i, meta in enumerate(metas):
-        print(f" - {i+1}. subject={meta.get('subject')}, classe={meta.get('classe')}, anno={meta.get('anno')}, title={meta.get('title')}")
+    _log_metas("RISULTATI TROVATI (candidati):", cand_metas)
+    _log_metas("SELEZIONATI (random, dedup):", metas)
 
     return docs, metas
 
+def query_chunks(question: str, subject: str = None, classe: str = None, anno: int = None):
+    preloaded = _preloaded.get((question, subject, classe, anno))
+    if preloaded is not None:
+        # candidati già calcolati per un batch in corso (vedi preloaded_candidates)
+        return _dedup_and_pick(*preloaded[0])
+    if COALESCE_RETRIEVAL:
+        # richieste identiche in volo condividono i candidati; la scelta casuale resta per richiesta
+        cand_docs, cand_metas = retrieval_flight.do(
+            (question, subject, classe, anno),
+            lambda: _fetch_candidates(question, subject, classe, anno),
+        )
+    else:
+        cand_docs, cand_metas = _fetch_candidates(question, subject, classe, anno)
+    return _dedup_and_pick(cand_docs, cand_metas)
+
+def _embed_query(question):
+    if EMBED_BATCHING:
+        return query_batcher.encode(question)
+    return embedder.encode(question)
+
+def _fetch_candidates(question, subject, classe, anno):
+    """Candidati per la query: dai pool precalcolati oppure embedding + query Chroma."""
+    pooled = candidate_pools.get(question, subject, classe, anno)
+    if pooled is not None:
+        return pooled
+
+    with span("query_embedding"):
+        embedding = _embed_query(question).tolist()
+
+    query_args = {
+        "query_embeddings": [embedding],
+        "n_results": CANDIDATE_LIMIT,
+        "include": ["documents", "metadatas"]  # ids utili se servono in futuro
+    }
+
+    where = build_where(subject, classe, anno)
+    if where is not None:
+        query_args["where"] = where
+
+    logger.debug("Filtro usato: %s", query_args.get("where"))
+
+    with span("chroma_query"), _query_collection() as current:
+        results = current.query(**query_args)
+
+    # Flatten
+    cand_docs = results["documents"][0] if results["documents"] else []
+    cand_metas = results["metadatas"][0] if results["metadatas"] else []
+    return cand_docs, cand_metas
+
+def query_chunks_batch(queries):
+    """
+    Versione batch di query_chunks.
+
+    `queries` è una lista di dict con chiavi "question", "subject", "classe", "anno".
+    Ritorna una lista di (docs, metas) nello stesso ordine di `queries`.
+    """
+    return [_dedup_and_pick(*candidates) for candidates in fetch_candidates_batch(queries)]
+
+def fetch_candidates_batch(queries):
+    """
+    Candidati (prima della scelta casuale) per più query insieme.
+
+    Tutte le domande vengono codificate con una sola chiamata a embedder.encode,
+    le richieste con filtri identici sono raggruppate in un'unica collection.query
+    (Chroma accetta più query_embeddings insieme).
+    Ritorna una lista di (cand_docs, cand_metas) nello stesso ordine di `queries`.
+    """
+    if not queries:
+        return []
+
+    results_by_index = [None] * len(queries)
+
+    # Prima i pool precalcolati, solo le richieste mancanti vanno su Chroma
+    missing = []
+    for i, q in enumerate(queries):
+        pooled = candidate_pools.get(q["question"], q.get("subject"), q.get("classe"), q.get("anno"))
+        if pooled is not None:
+            results_by_index[i] = pooled
+        else:
+            missing.append(i)
+
+    if not missing:
+        return results_by_index
+
+    questions = [queries[i]["question"] for i in missing]
+    with span("query_embedding"):
+        encoded = embedder.encode(questions).tolist()
+    embeddings = dict(zip(missing, encoded))
+
+    # Raggruppa gli indici delle richieste per filtro identico
+    groups = {}
+    for i in missing:
+        q = queries[i]
+        where = build_where(q.get("subject"), q.get("classe"), q.get("anno"))
+        key = repr(where)
+        groups.setdefault(key, (where, []))[1].append(i)
+
+    for where, indexes in groups.values():
+        query_args = {
+            "query_embeddings": [embeddings[i] for i in indexes],
+            "n_results": CANDIDATE_LIMIT,
+            "include": ["documents", "metadatas"]
+        }
+        if where is not None:
+            query_args["where"] = where
+
+        logger.debug("Filtro usato (batch x%d): %s", len(indexes), where)
+
+        with span("chroma_query"), _query_collection() as current:
+            results = current.query(**query_args)
+        all_docs = results["documents"] or []
+        all_metas = results["metadatas"] or []
+
+        for pos, i in enumerate(indexes):
+            cand_docs = all_docs[pos] if pos < len(all_docs) else []
+            cand_metas = all_metas[pos] if pos < len(all_metas) else []
+            results_by_index[i] = (cand_docs, cand_metas)
+
+    return results_by_index
+
+def _candidates_key(query):
+    return (query["question"], query.get("subject"), query.get("classe"), query.get("anno"))
+
+@contextlib.contextmanager
+def preloaded_candidates(queries):
+    """
+    Calcola una volta i candidati di `queries` (query ripetute contano una volta)
+    e li fa riusare a query_chunks finché il blocco è aperto. Usato dagli endpoint batch.
+    """
+    unique = list({_candidates_key(q): q for q in queries}.items())
+    fetched = fetch_candidates_batch([q for _, q in unique])
+    with _preloaded_lock:
+        for (key, _), candidates in zip(unique, fetched):
+            entry = _preloaded.setdefault(key, [candidates, 0])
+            entry[1] += 1
+    try:
+        yield
+    finally:
+        with _preloaded_lock:
+            for key, _ in unique:
+                entry = _preloaded[key]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del _preloaded[key]
+
 def build_context(docs, metas):
     parts = []
     for i in range(len(docs)):
@@ -102,37 +368,193 @@ def build_context(docs, metas):
         parts.append(f"[Fonte: {source} | Classe: {classe} {anno} | Materia: {subject}]\n{text}")
     return "\n\n".join(parts)
 
+def build_context_for(query, docs, metas, budget=None):
+    """
+    Contesto per il prompt: completo, oppure compresso entro `budget` token
+    (vedi context_builder). Ritorna (context, stats) con i token risparmiati.
+    """
+    with span("context_build"):
+        full_context = build_context(docs, metas)
+        if not budget:
+            tokens = estimate_tokens(full_context)
+            return full_context, {"tokens_full": tokens, "tokens_used": tokens, "tokens_saved": 0}
+        context, stats = build_budgeted_context(query, docs, metas, budget, embedder.encode, full_context)
+    logger.debug("Contesto: %(tokens_used)d token (risparmiati %(tokens_saved)d)", stats)
+    return context, stats
+
+SYSTEM_PROMPT = "Sei un assistente educativo. Rispondi solo usando le fonti fornite."
+
+def build_messages(query, context, prefix=None, cache_prefix=False):
+    """
+    `prefix` (opzionale) sono le istruzioni statiche del template di tipo: vanno nel
+    messaggio di sistema, prima delle fonti variabili. Con cache_prefix il blocco viene
+    marcato per la prompt cache del provider (cache_control di Anthropic).
+    """
+    prompt = f"""Use the following sources to answer the question in a simple way, suitable for the indicated class and grade level.
+All the content should be written in Italian.
+
+Fonti:
+{context}
+
+Domanda: {query}
+Risposta (usa solo le fonti, altrimenti non rispondere):"""
+
+    system = SYSTEM_PROMPT if not prefix else f"{SYSTEM_PROMPT}\n\n{prefix}"
+    if prefix and cache_prefix:
+        system = [{"type": "text", "text": system, "cache_control": {"type": "ephemeral"}}]
+
+    return [
+        SystemMessage(content=system),
+        HumanMessage(content=prompt)
+    ]
+
+async def aquery_chunks(question: str, subject: str = None, classe: str = None, anno: int = None):
+    """query_chunks nel thread pool limitato (encode e Chroma sono bloccanti)."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        retrieval_executor,
+        functools.partial(query_chunks, question, subject=subject, classe=classe, anno=anno),
+    )
+
+def _check_deadline(deadline, stage):
+    # shed: se non resta tempo per arrivare fino alla risposta LLM non si inizia la fase
+    if deadline is not None:
+        deadline.check(stage, reserve=MIN_LLM_SECONDS)
+
+def _llm_kwargs(input_dict, deadline):
+    # max_tokens / JSON mode per tipo di quiz (vedi output_budget) + timeout dal deadline
+    kwargs = dict(input_dict.get("llm_kwargs") or {})
+    if deadline is not None:
+        # il tempo rimasto diventa il timeout della singola chiamata al provider
+        kwargs["timeout"] = deadline.remaining()
+    return kwargs
+
+async def _within(awaitable, deadline, stage):
+    """Attende `awaitable` entro il tempo rimasto; allo scadere la cancella."""
+    if deadline is None:
+        return await awaitable
+    try:
+        return await asyncio.wait_for(awaitable, deadline.remaining())
+    except asyncio.TimeoutError:
+        raise deadline.exceeded(stage) from None
+
+def _rate_limited(error):
+    # il limiter del provider non avrebbe liberato uno slot entro il deadline: richiesta scartata
+    logger.info("%s", error)
+    DEADLINE_EVENTS.inc(stage="rate_limit", outcome="shed")
+    return DeadlineExceeded("rate_limit", shed=True)
+
+def _messages_for(llm, input_dict, query, context):
+    """
+    Messaggi per l'LLM. Con un client a più provider (HedgedLLM) si passa una funzione
+    nome → messaggi: il prefisso in cache ("cache_providers") solo per chi lo supporta.
+    """
+    def build(cache_prefix):
+        # "question" (opzionale) è la richiesta per l'LLM se diversa dalla query di retrieval
+        return build_messages(
+            input_dict.get("question") or query,
+            context,
+            prefix=input_dict.get("prompt_prefix"),
+            cache_prefix=cache_prefix,
+        )
+
+    if getattr(llm, "per_provider_messages", False) is True:
+        cache_providers = set(input_dict.get("cache_providers", ()))
+        return lambda name: build(name in cache_providers)
+    return build(input_dict.get("cache_prefix", False))
+
+
 def build_rag_chain(llm):
     def invoke(input_dict):
         query = input_dict["query"]
         subject = input_dict.get("subject")
         classe = input_dict.get("classe")
         anno = input_dict.get("anno")
+        deadline = input_dict.get("deadline")
 
+        _check_deadline(deadline, "retrieval")
         docs, metas = query_chunks(query, subject=subject, classe=classe, anno=anno)
 
         if not docs:
             return {"result": "{}", "source_documents": []}
 
-        context = build_context(docs, metas)
-        prompt = f"""Use the following sources to answer the question in a simple way, suitable for the indicated class and grade level.
-All the content should be written in Italian.
+        _check_deadline(deadline, "context_build")
+        context, context_stats = build_context_for(query, docs, metas, input_dict.get("context_budget"))
+        messages = _messages_for(llm, input_dict, query, context)
 
-Fonti:
-{context}
+        _check_deadline(deadline, "llm_call")
+        try:
+            with span("llm_call"):
+                if input_dict.get("stream"):
+                    # Stream interrotto appena il primo oggetto JSON è completo
+                    result = consume_stream(llm.stream(messages, **_llm_kwargs(input_dict, deadline)))
+                    output_tokens, truncated = estimate_tokens(result), False
+                else:
+                    response = llm.invoke(messages, **_llm_kwargs(input_dict, deadline))
+                    result = response.content
+                    output_tokens, truncated = response_usage(response)
+        except RateLimited as e:
+            raise _rate_limited(e) from None
+        except Exception:
+            # timeout del provider dovuto al budget della richiesta
+            if deadline is not None and deadline.expired():
+                raise deadline.exceeded("llm_call") from None
+            raise
+        return {
+            "result": result,
+            "source_documents": docs,
+            "context_stats": context_stats,
+            "output_tokens": output_tokens,
+            "truncated": truncated,
+        }
 
-Domanda: {query}
-Risposta (usa solo le fonti, altrimenti non rispondere):"""
+    async def ainvoke(input_dict):
+        query = input_dict["query"]
+        subject = input_dict.get("subject")
+        classe = input_dict.get("classe")
+        anno = input_dict.get("anno")
+        deadline = input_dict.get("deadline")
+
+        _check_deadline(deadline, "retrieval")
+        docs, metas = await _within(
+            aquery_chunks(query, subject=subject, classe=classe, anno=anno), deadline, "retrieval"
+        )
+
+        if not docs:
+            return {"result": "{}", "source_documents": []}
 
-        messages = [
-            SystemMessage(content="Sei un assistente educativo. Rispondi solo usando le fonti fornite."),
-            HumanMessage(content=prompt)
-        ]
+        _check_deadline(deadline, "context_build")
+        context, context_stats = build_context_for(query, docs, metas, input_dict.get("context_budget"))
+        messages = _messages_for(llm, input_dict, query, context)
 
-        response = llm.invoke(messages)
+        # La chiamata LLM non occupa thread: resta in attesa sull'event loop
+        # e allo scadere del deadline viene cancellata (connessione compresa)
+        _check_deadline(deadline, "llm_call")
+        try:
+            with span("llm_call"):
+                if input_dict.get("stream"):
+                    call = aconsume_stream(llm.astream(messages, **_llm_kwargs(input_dict, deadline)))
+                    result = await _within(call, deadline, "llm_call")
+                    output_tokens, truncated = estimate_tokens(result), False
+                else:
+                    call = llm.ainvoke(messages, **_llm_kwargs(input_dict, deadline))
+                    response = await _within(call, deadline, "llm_call")
+                    result = response.content
+                    output_tokens, truncated = response_usage(response)
+        except DeadlineExceeded:
+            raise
+        except RateLimited as e:
+            raise _rate_limited(e) from None
+        except Exception:
+            if deadline is not None and deadline.expired():
+                raise deadline.exceeded("llm_call") from None
+            raise
         return {
-            "result": response.content,
-            "source_documents": docs
+            "result": result,
+            "source_documents": docs,
+            "context_stats": context_stats,
+            "output_tokens": output_tokens,
+            "truncated": truncated,
         }
 
-    return type("FakeChain", (), {"invoke": staticmethod(invoke)})()
+    return type("FakeChain", (), {"invoke": staticmethod(invoke), "ainvoke": staticmethod(ainvoke)})()
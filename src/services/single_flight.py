@@ -0,0 +1,156 @@
+# services/single_flight.py
+"""
+Coalescenza ("single flight") di richieste identiche concorrenti.
+
+Durante una lezione decine di studenti chiedono lo stesso quiz (tipo, categoria, classe,
+anno, difficoltà) nello stesso momento. Con SAGE_COALESCE:
+  - retrieval  → le richieste identiche in volo condividono embedding + query Chroma
+                 (la scelta casuale dei chunk e la chiamata LLM restano per richiesta);
+  - generation → condividono anche la generazione: un solo quiz per gruppo.
+Il fan-out per chiave è limitato (SAGE_COALESCE_FANOUT): oltre il limite parte una nuova
+chiamata, così un'aula non riceve tutta lo stesso identico quiz.
+"""
+
+import os
+import copy
+import json
+import asyncio
+import threading
+import concurrent.futures
+
+from services.metrics import counter
+from services.deadline import DEADLINE_STATUS
+from services.quiz_bank import bank_key
+
+COALESCE_MODE = os.getenv("SAGE_COALESCE", "off")
+COALESCE_RETRIEVAL = COALESCE_MODE in ("retrieval", "generation")
+COALESCE_GENERATION = COALESCE_MODE == "generation"
+# Richieste servite al massimo da una stessa generazione (leader compreso)
+COALESCE_FANOUT = int(os.getenv("SAGE_COALESCE_FANOUT", "5"))
+
+SINGLE_FLIGHT = counter(
+    "sage_single_flight_total",
+    "Richieste coalescenti: leader (esegue la chiamata) o follower (riusa quella in volo)",
+    labelnames=("scope", "role"),
+)
+
+
+class _Call:
+    __slots__ = ("future", "sharers")
+
+    def __init__(self, future):
+        self.future = future
+        self.sharers = 1
+
+
+class SingleFlight:
+    """
+    do(key, fn): se per `key` c'è già una chiamata in volo con posti liberi ne attende
+    il risultato (o l'eccezione), altrimenti esegue fn() e lo condivide.
+    max_fanout=None → nessun limite di condivisione.
+    """
+
+    def __init__(self, scope, max_fanout=None):
+        self.scope = scope
+        self.max_fanout = max_fanout
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def _join_or_lead(self, key, new_future):
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and (self.max_fanout is None or call.sharers < self.max_fanout):
+                call.sharers += 1
+                return call, False
+            # nessuna chiamata in volo, oppure piena: si parte con una nuova
+            call = self._calls[key] = _Call(new_future())
+            return call, True
+
+    def _forget(self, key, call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    def do(self, key, fn, timeout=None):
+        call, leader = self._join_or_lead(key, concurrent.futures.Future)
+        SINGLE_FLIGHT.inc(scope=self.scope, role="leader" if leader else "follower")
+        if not leader:
+            return call.future.result(timeout)
+
+        try:
+            result = fn()
+        except BaseException as e:
+            # tolto dalla tabella prima di pubblicare: chi arriva dopo non riceve un esito vecchio
+            self._forget(key, call)
+            call.future.set_exception(e)
+            raise
+        self._forget(key, call)
+        call.future.set_result(result)
+        return result
+
+
+class AsyncSingleFlight(SingleFlight):
+    """Come SingleFlight per coroutine sullo stesso event loop (app ASGI)."""
+
+    async def do(self, key, coro_fn, timeout=None):
+        loop = asyncio.get_running_loop()
+        call, leader = self._join_or_lead(key, loop.create_future)
+        SINGLE_FLIGHT.inc(scope=self.scope, role="leader" if leader else "follower")
+        if not leader:
+            # shield: un follower che rinuncia non cancella la chiamata condivisa
+            return await asyncio.wait_for(asyncio.shield(call.future), timeout)
+
+        try:
+            result = await coro_fn()
+        except BaseException as e:
+            self._forget(key, call)
+            if isinstance(e, asyncio.CancelledError):
+                # leader cancellato (es. client disconnesso): i follower non restano appesi
+                call.future.set_exception(RuntimeError("Chiamata condivisa cancellata"))
+            else:
+                call.future.set_exception(e)
+            # l'eccezione viene già rilanciata al leader: evita il warning "never retrieved"
+            call.future.exception()
+            raise
+        self._forget(key, call)
+        call.future.set_result(result)
+        return result
+
+
+def generation_key(data):
+    # valori JSON qualsiasi (anche liste/oggetti, non ancora validati): chiave testuale stabile.
+    # La chiave della banca comprende già il provider
+    return json.dumps(bank_key(data), sort_keys=True, ensure_ascii=False, default=str)
+
+
+_generation_flight = SingleFlight("generation", max_fanout=COALESCE_FANOUT)
+_async_generation_flight = AsyncSingleFlight("generation", max_fanout=COALESCE_FANOUT)
+
+
+def _timeout(deadline):
+    return deadline.remaining() if deadline is not None else None
+
+
+def coalesced_generate(data, generate, deadline=None):
+    """
+    generate(data, deadline=...) condivisa tra richieste identiche concorrenti.
+    Ogni richiesta riceve una copia del risultato; chi attende oltre il proprio deadline riceve status 5.
+    """
+    try:
+        result = _generation_flight.do(
+            generation_key(data), lambda: generate(data, deadline=deadline), timeout=_timeout(deadline)
+        )
+    except concurrent.futures.TimeoutError:
+        return {"status": DEADLINE_STATUS, "data": {}}
+    return copy.deepcopy(result)
+
+
+async def acoalesced_generate(data, agenerate, deadline=None):
+    """Versione async di coalesced_generate (agenerate_quiz_from_data)."""
+    try:
+        result = await _async_generation_flight.do(
+            generation_key(data), lambda: agenerate(data, deadline=deadline), timeout=_timeout(deadline)
+        )
+    except asyncio.TimeoutError:
+        return {"status": DEADLINE_STATUS, "data": {}}
+    return copy.deepcopy(result)
@@ -0,0 +1,83 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from jsonschema.exceptions import SchemaError
+from jsonschema.validators import validator_for
+
+logger = logging.getLogger("sage.validators")
+
+# Ogni quanto (secondi) controllare se i file degli schemi sono cambiati
+RELOAD_CHECK_SECONDS = 2.0
+
+
+class SchemaRegistry:
+    """
+    Validator JSON Schema compilati, uno per tipo di quiz (<tipo>_schema.json in schema_dir).
+
+    Gli schemi vengono letti e compilati una volta sola; se un file viene aggiunto,
+    modificato o rimosso la registry si ricarica (controllo su mtime/dimensione,
+    al massimo ogni `check_interval` secondi).
+    """
+
+    def __init__(self, schema_dir, check_interval=RELOAD_CHECK_SECONDS, clock=time.monotonic):
+        self.schema_dir = schema_dir
+        self.check_interval = check_interval
+        self.clock = clock
+        self._validators = {}
+        self._signature = None
+        self._checked_at = None
+        self._lock = threading.Lock()
+        self.reload()
+
+    def get(self, quiz_type):
+        """Validator compilato per il tipo, oppure None se non esiste lo schema."""
+        self._maybe_reload()
+        return self._validators.get(quiz_type)
+
+    def types(self):
+        self._maybe_reload()
+        return sorted(self._validators)
+
+    def reload(self):
+        with self._lock:
+            signature = self._scan()
+            validators = {}
+            for name, _, _ in signature:
+                with open(os.path.join(self.schema_dir, name), "r", encoding="utf-8") as f:
+                    schema = json.load(f)
+                # la classe segue "$schema" (draft-07 o 2020-12), check_schema una volta sola
+                cls = validator_for(schema)
+                cls.check_schema(schema)
+                validators[name[:-len("_schema.json")]] = cls(schema)
+            self._validators = validators
+            self._signature = signature
+            self._checked_at = self.clock()
+
+    def _scan(self):
+        try:
+            names = os.listdir(self.schema_dir)
+        except FileNotFoundError:
+            return ()
+        signature = []
+        for name in sorted(names):
+            if not name.endswith("_schema.json"):
+                continue
+            stat = os.stat(os.path.join(self.schema_dir, name))
+            signature.append((name, stat.st_mtime_ns, stat.st_size))
+        return tuple(signature)
+
+    def _maybe_reload(self):
+        now = self.clock()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return
+        self._checked_at = now
+        if self._scan() == self._signature:
+            return
+        try:
+            self.reload()
+        except (OSError, ValueError, SchemaError) as e:
+            # file a metà scrittura o schema non valido: si tengono i validator precedenti
+            logger.warning("Ricarica schemi fallita, uso la versione precedente: %s", e)
@@ -0,0 +1,96 @@
+from collections import Counter
+
+
+def _norm(text):
+    return text.strip().casefold() if isinstance(text, str) else text
+
+
+def _duplicates(values):
+    seen = set()
+    for value in values:
+        key = _norm(value)
+        if key in seen:
+            return value
+        seen.add(key)
+    return None
+
+
+def _strings(data, field):
+    values = data.get(field)
+    if isinstance(values, list) and all(isinstance(v, str) for v in values):
+        return values
+    return None
+
+
+def _pair_values(data, side):
+    pairs = data.get("pairs")
+    if not isinstance(pairs, list):
+        return None
+    values = [p.get(side) for p in pairs if isinstance(p, dict)]
+    return values if all(isinstance(v, str) for v in values) else None
+
+
+def check_quiz(data):
+    options = _strings(data, "options")
+    if options is None:
+        return None
+    duplicate = _duplicates(options)
+    if duplicate is not None:
+        return f"Opzione ripetuta: {duplicate!r}"
+    answer = data.get("answer")
+    if isinstance(answer, str) and _norm(answer) not in {_norm(o) for o in options}:
+        return f"La risposta {answer!r} non è tra le opzioni"
+    return None
+
+
+def check_sorting(data):
+    items = _strings(data, "items")
+    solution = _strings(data, "solution")
+    if items is None or solution is None:
+        return None
+    duplicate = _duplicates(items)
+    if duplicate is not None:
+        return f"Elemento ripetuto: {duplicate!r}"
+    if Counter(map(_norm, items)) != Counter(map(_norm, solution)):
+        return "La soluzione non è una permutazione degli elementi"
+    return None
+
+
+def check_matching(data):
+    for side in ("left", "right"):
+        values = _pair_values(data, side)
+        duplicate = _duplicates(values) if values else None
+        if duplicate is not None:
+            return f"Valore '{side}' ripetuto: {duplicate!r}"
+    return None
+
+
+def check_memory(data):
+    fronts = _pair_values(data, "front")
+    backs = _pair_values(data, "back")
+    if fronts is None or backs is None:
+        return None
+    duplicate = _duplicates(fronts)
+    if duplicate is not None:
+        return f"Carta ripetuta: {duplicate!r}"
+    for front, back in zip(fronts, backs):
+        if _norm(front) == _norm(back):
+            return f"Coppia con i due lati uguali: {front!r}"
+    return None
+
+
+# Controlli oltre lo schema: ritornano il messaggio d'errore oppure None
+SEMANTIC_CHECKS = {
+    "quiz": check_quiz,
+    "sorting": check_sorting,
+    "matching": check_matching,
+    "memory": check_memory,
+}
+
+
+def check_semantics(data):
+    question = data.get("question")
+    if isinstance(question, str) and not question.strip():
+        return "Domanda vuota"
+    check = SEMANTIC_CHECKS.get(data.get("type"))
+    return check(data) if check else None
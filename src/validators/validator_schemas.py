@@ -1,19 +1,90 @@
 import json
 import os
+import time
+import threading
 from jsonschema import validate, ValidationError
+from jsonschema.exceptions import best_match
+
+from validators.schema_registry import SchemaRegistry
+from validators.semantic_checks import check_semantics
 
 SCHEMA_DIR = os.path.join(os.path.dirname(__file__), "..", "schemas")
 
+# Una registry per cartella di schemi (SCHEMA_DIR può cambiare, es. nei test)
+_registries = {}
+_registries_lock = threading.Lock()
+
+
+def get_registry(schema_dir=None):
+    schema_dir = schema_dir or SCHEMA_DIR
+    with _registries_lock:
+        registry = _registries.get(schema_dir)
+        if registry is None:
+            registry = _registries[schema_dir] = SchemaRegistry(schema_dir)
+        return registry
+
+
+# validator compilati all'avvio (import), non alla prima richiesta
+get_registry()
+
+
 def validate_quiz_data(data):
+    quiz_type = data.get("type")
+    validator = get_registry().get(quiz_type) if isinstance(quiz_type, str) else None
+    if validator is None:
+        return False, f"Schema non trovato per tipo: {quiz_type}"
+
+    # stesso errore che solleverebbe jsonschema.validate, senza ricompilare lo schema
+    error = best_match(validator.iter_errors(data))
+    if error is not None:
+        return False, error.message
+
+    semantic_error = check_semantics(data)
+    if semantic_error is not None:
+        return False, semantic_error
+    return True, None
+
+
+def _validate_uncompiled(data):
+    # comportamento precedente (schema letto e validator ricostruito a ogni quiz), per il benchmark
     schema_path = os.path.join(SCHEMA_DIR, f"{data['type']}_schema.json")
-    if not os.path.exists(schema_path):
-        return False, f"Schema non trovato per tipo: {data['type']}"
-    
     with open(schema_path, "r", encoding="utf-8") as f:
         schema = json.load(f)
-
     try:
         validate(instance=data, schema=schema)
         return True, None
     except ValidationError as e:
         return False, e.message
+
+
+BENCHMARK_SAMPLES = {
+    "quiz": {"type": "quiz", "category": "storia", "question": "Chi fondò Roma?", "difficulty": 3,
+             "options": ["Romolo", "Remo", "Numa", "Tarquinio"], "answer": "Romolo"},
+    "matching": {"type": "matching", "category": "geografia", "question": "Abbina", "difficulty": 4,
+                 "pairs": [{"left": "Italia", "right": "Roma"}, {"left": "Francia", "right": "Parigi"}]},
+    "memory": {"type": "memory", "category": "scienze", "question": "Trova le coppie", "difficulty": 2,
+               "pairs": [{"front": "H2O", "back": "Acqua"}, {"front": "NaCl", "back": "Sale"}]},
+    "sorting": {"type": "sorting", "category": "storia", "question": "Ordina", "difficulty": 5,
+                "items": ["Impero", "Repubblica", "Monarchia"], "solution": ["Monarchia", "Repubblica", "Impero"]},
+}
+
+
+def benchmark(iterations=2000):
+    """Microsecondi per validazione, per tipo: validator compilato (+ semantica) vs schema riletto ogni volta."""
+    report = {}
+    for quiz_type, sample in BENCHMARK_SAMPLES.items():
+        row = {}
+        for label, fn in (("compiled_us", validate_quiz_data), ("uncompiled_us", _validate_uncompiled)):
+            assert fn(sample) == (True, None), quiz_type
+            start = time.perf_counter()
+            for _ in range(iterations):
+                fn(sample)
+            row[label] = (time.perf_counter() - start) / iterations * 1e6
+        report[quiz_type] = row
+    return report
+
+
+if __name__ == "__main__":
+    for quiz_type, row in benchmark().items():
+        speedup = row["uncompiled_us"] / row["compiled_us"]
+        print(f"{quiz_type:<10} compilato={row['compiled_us']:>8.1f}µs  senza registry={row['uncompiled_us']:>8.1f}µs  x{speedup:.1f}")
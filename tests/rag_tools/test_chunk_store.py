@@ -0,0 +1,124 @@
+import json
+
+import numpy as np
+
+from src.rag_tools import chunk_store
+
+
+def _records(source_id, texts, anno=3):
+    return [
+        {
+            "id": f"{source_id}_{i}",
+            "text": t,
+            "metadata": {"source_id": source_id, "title": "Titolo", "subject": "storia",
+                         "classe": "prim", "anno": anno, "created_at": "2024-01-01"},
+        }
+        for i, t in enumerate(texts)
+    ]
+
+
+def test_write_and_read_roundtrip(tmp_path):
+    path = tmp_path / "store"
+    records = _records("s1", ["primo", "città è già"]) + _records("s2", ["terzo"], anno="3")
+    chunk_store.write_store(path, records)
+
+    with chunk_store.ChunkStore(path) as store:
+        assert len(store) == 3
+        assert list(store.records()) == records
+        # i metadati ripetuti sono salvati una volta nel dizionario
+        assert store.dictionaries["title"] == ["Titolo"]
+        # anno=3 e anno="3" restano distinti (filtri Chroma diversi)
+        assert store.metadata(2)["anno"] == "3"
+        assert store.rows_of("s2").tolist() == [2]
+        assert store.rows_of("manca").tolist() == []
+        assert [len(b) for b in store.batches(2)] == [2, 1]
+        assert isinstance(store.codes, np.memmap)
+
+
+def test_update_replaces_only_given_sources(tmp_path):
+    path = tmp_path / "store"
+    chunk_store.update(path, {"s1": _records("s1", ["a", "b"]), "s2": _records("s2", ["c"])})
+    reader = chunk_store.ChunkStore(path)
+
+    chunk_store.update(path, {"s1": _records("s1", ["A"]), "s3": [], "s2": _records("s2", ["c", "d"])})
+    chunk_store.update(path, {"s2": []})
+
+    with chunk_store.ChunkStore(path) as store:
+        assert [(r["id"], r["text"]) for r in store.records()] == [("s1_0", "A")]
+    # un lettore aperto prima della riscrittura continua a vedere i vecchi file
+    assert reader.texts[1] == "b"
+    reader.close()
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["store", "store.lock", "store.versions"]
+    # restano solo la versione corrente e la precedente
+    assert sorted(p.name for p in (tmp_path / "store.versions").iterdir()) == ["2", "3"]
+
+
+def test_update_keeps_dictionaries_compact(tmp_path):
+    path = tmp_path / "store"
+    chunk_store.update(path, {"s1": _records("s1", ["a", "b"]), "s2": _records("s2", ["c"], anno=4)})
+    chunk_store.update(path, {"s2": _records("s2", ["C"], anno=5), "s3": _records("s3", ["d"])})
+    chunk_store.update(path, {"s3": []})
+
+    with chunk_store.ChunkStore(path) as store:
+        assert [(r["id"], r["text"], r["metadata"]["anno"]) for r in store.records()] == [
+            ("s1_0", "a", 3), ("s1_1", "b", 3), ("s2_0", "C", 5)
+        ]
+        # i valori delle fonti sostituite o rimosse escono dai dizionari
+        assert store.dictionaries["source_id"] == ["s1", "s2"]
+        assert store.dictionaries["anno"] == [3, 5]
+
+
+def test_path_always_points_to_a_complete_store(tmp_path, monkeypatch):
+    path = tmp_path / "store"
+    chunk_store.write_store(path, _records("s1", ["a"]))
+    seen = []
+    replace = chunk_store.os.replace
+
+    def checking_replace(src, dst):
+        # ogni passo dello swap lascia uno store leggibile
+        seen.append(chunk_store.is_store(path))
+        replace(src, dst)
+        seen.append(chunk_store.is_store(path))
+
+    monkeypatch.setattr(chunk_store.os, "replace", checking_replace)
+    chunk_store.update(path, {"s1": _records("s1", ["b"])})
+    assert seen and all(seen)
+    with chunk_store.ChunkStore(path) as store:
+        assert store.texts[0] == "b"
+
+
+def test_migrates_store_written_as_directory(tmp_path):
+    path = tmp_path / "store"
+    chunk_store.write_store(path, _records("s1", ["a"]))
+    legacy = tmp_path / "legacy"
+    chunk_store.os.replace(path.resolve(), legacy)
+    path.unlink()
+    chunk_store.os.replace(legacy, path)
+
+    chunk_store.update(path, {"s2": _records("s2", ["b"])})
+    assert path.is_symlink()
+    with chunk_store.ChunkStore(path) as store:
+        assert [r["text"] for r in store.records()] == ["a", "b"]
+
+
+def test_empty_store(tmp_path):
+    chunk_store.write_store(tmp_path / "store", [])
+    with chunk_store.ChunkStore(tmp_path / "store") as store:
+        assert len(store) == 0
+        assert list(store.batches(10)) == []
+
+
+def test_jsonl_export_import(tmp_path):
+    chunks_dir = tmp_path / "chunks"
+    chunks_dir.mkdir()
+    for source_id, texts in (("s1", ["a", "b"]), ("s2", ["c"])):
+        (chunks_dir / f"{source_id}.jsonl").write_text(
+            "\n".join(json.dumps(r) for r in _records(source_id, texts)), encoding="utf-8"
+        )
+
+    assert chunk_store.import_jsonl(chunks_dir, tmp_path / "store") == 3
+    assert chunk_store.export_jsonl(tmp_path / "store", tmp_path / "export") == 3
+    for source_id in ("s1", "s2"):
+        exported = (tmp_path / "export" / f"{source_id}.jsonl").read_text(encoding="utf-8").splitlines()
+        original = (chunks_dir / f"{source_id}.jsonl").read_text(encoding="utf-8").splitlines()
+        assert [json.loads(l) for l in exported] == [json.loads(l) for l in original]
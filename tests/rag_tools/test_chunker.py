@@ -4,7 +4,7 @@ import tempfile
 from pathlib import Path
 import pytest
 
-from src.rag_tools import chunker
+from src.rag_tools import chunker, chunk_store
 
 
 def test_split_text_into_chunks_basic():
@@ -48,19 +48,21 @@ def test_load_source_index_and_chunk_all_sources(tmp_path, monkeypatch):
     # patch paths
     monkeypatch.setattr(chunker, "SOURCE_INDEX_PATH", str(index_path))
     monkeypatch.setattr(chunker, "CLEANED_DIR", cleaned_dir)
-    monkeypatch.setattr(chunker, "CHUNK_DIR", tmp_path / "chunks")
+    monkeypatch.setattr(chunker, "CHUNK_DIR", tmp_path / "chunk_store")
 
     # run chunk_all_sources
     chunker.chunk_all_sources()
 
-    out_file = tmp_path / "chunks" / "s1.jsonl"
-    assert out_file.exists()
+    store_dir = tmp_path / "chunk_store"
+    assert chunk_store.is_store(store_dir)
 
-    # verifica contenuto JSONL
-    with open(out_file, encoding="utf-8") as f:
-        lines = [json.loads(l) for l in f]
+    # verifica contenuto dello store
+    with chunk_store.ChunkStore(store_dir) as store:
+        lines = list(store.records())
 
+    assert len(lines) == 2
     assert all("text" in r for r in lines)
     assert all("metadata" in r for r in lines)
+    assert lines[0]["id"] == "s1_0"
     assert lines[0]["metadata"]["title"] == "Titolo1"
     assert lines[0]["metadata"]["subject"] == "mate"
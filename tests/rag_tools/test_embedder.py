@@ -30,6 +30,10 @@ class DummyCollection:
     def count(self):
         return self._count
 
+    def query(self, query_embeddings, n_results, include=None):
+        ids = [i for c in self.add_calls for i in c["ids"]][:n_results]
+        return {"ids": [ids] * len(query_embeddings)}
+
 
 # ----------------- Tests -----------------
 def test_clean_metadata_defaults():
@@ -119,9 +123,12 @@ def test_embed_all_honors_batch_size(tmp_path, monkeypatch):
     assert len(dummy_collection.add_calls[0]["ids"]) == 2
 
 
-def test_embed_all_fresh_resets_dir(tmp_path, monkeypatch):
+def test_embed_all_fresh_builds_shadow_version(tmp_path, monkeypatch):
+    from services import index_versions
+
     chroma_dir = tmp_path / "chroma3"
     chroma_dir.mkdir()
+    (chroma_dir / "chroma.sqlite3").write_text("indice attivo", encoding="utf-8")
 
     chunks_dir = tmp_path / "chunks3"
     chunks_dir.mkdir()
@@ -132,8 +139,9 @@ def test_embed_all_fresh_resets_dir(tmp_path, monkeypatch):
 
     dummy_model = DummyModel()
     dummy_collection = DummyCollection()
+    opened = []
     monkeypatch.setattr(embedder, "get_model", lambda: dummy_model)
-    monkeypatch.setattr(embedder, "get_collection", lambda *a, **k: dummy_collection)
+    monkeypatch.setattr(embedder, "get_collection", lambda path, *a, **k: opened.append(path) or dummy_collection)
 
     total, count = embedder.embed_all(
         fresh=True,
@@ -142,3 +150,190 @@ def test_embed_all_fresh_resets_dir(tmp_path, monkeypatch):
     )
     assert total == 1
     assert count == 1
+
+    # costruito nella versione nuova, poi pubblicato; l'indice senza versioni nella radice
+    # resta finché i worker non sono passati alla versione nuova (periodo di grazia)
+    version = index_versions.current_version(str(chroma_dir))
+    assert opened == [index_versions.version_dir(str(chroma_dir), version)]
+    assert (chroma_dir / "versions" / version / "index_version").exists()
+    assert (chroma_dir / "chroma.sqlite3").read_text(encoding="utf-8") == "indice attivo"
+    assert (chroma_dir / index_versions.LEGACY_MARKER).exists()
+
+
+def test_embed_all_fresh_discards_invalid_version(tmp_path, monkeypatch):
+    chroma_dir = tmp_path / "chroma5"
+    chunks_dir = tmp_path / "chunks5"
+    chunks_dir.mkdir()
+    (chunks_dir / "e.jsonl").write_text(
+        json.dumps({"id": "e0", "text": "t", "metadata": {}}),
+        encoding="utf-8",
+    )
+
+    class LossyCollection(DummyCollection):
+        def count(self):
+            return 0
+
+    monkeypatch.setattr(embedder, "get_model", lambda: DummyModel())
+    monkeypatch.setattr(embedder, "get_collection", lambda *a, **k: LossyCollection())
+
+    from services.index_versions import IndexValidationError
+    with pytest.raises(IndexValidationError):
+        embedder.embed_all(fresh=True, chroma_dir=str(chroma_dir), chunks_dir=str(chunks_dir))
+
+    assert not (chroma_dir / "CURRENT").exists()
+    assert list((chroma_dir / "versions").iterdir()) == []
+
+
+def test_embed_all_writes_index_version_and_precomputes_pools(tmp_path, monkeypatch):
+    chroma_dir = tmp_path / "chroma4"
+    chunks_dir = tmp_path / "chunks4"
+    chunks_dir.mkdir()
+    (chunks_dir / "d.jsonl").write_text(
+        json.dumps({"id": "d0", "text": "t", "metadata": {"subject": "storia", "classe": "prim", "anno": 3}}),
+        encoding="utf-8",
+    )
+
+    class PoolCollection(DummyCollection):
+        def get(self, include=None):
+            return {"metadatas": [m for c in self.add_calls for m in c["metadatas"]]}
+
+        def query(self, **kwargs):
+            n = len(kwargs["query_embeddings"])
+            return {"documents": [["t"]] * n, "metadatas": [[{"title": ""}]] * n}
+
+    dummy_collection = PoolCollection()
+    monkeypatch.setattr(embedder, "get_model", lambda: DummyModel())
+    monkeypatch.setattr(embedder, "get_collection", lambda *a, **k: dummy_collection)
+
+    embedder.embed_all(chroma_dir=str(chroma_dir), chunks_dir=str(chunks_dir))
+    version = (chroma_dir / "index_version").read_text(encoding="utf-8")
+    assert version
+
+    pools_path = tmp_path / "pools.json"
+    n_pools = embedder.precompute_pools(chroma_dir=str(chroma_dir), pools_path=str(pools_path))
+    assert n_pools == 40
+
+    data = json.loads(pools_path.read_text(encoding="utf-8"))
+    assert data["index_version"] == version
+    assert data["docs"] == ["t"]
+
+
+class StoreCollection:
+    """Store in memoria con la parte di API Chroma usata dal sync."""
+
+    def __init__(self):
+        self.rows = {}
+        self.deleted = []
+        self.upserted = []
+
+    def get(self, where, include=None):
+        ids = [i for i, (_, _, m) in self.rows.items() if m["source_id"] == where["source_id"]]
+        return {"ids": ids, "metadatas": [self.rows[i][2] for i in ids]}
+
+    def delete(self, ids):
+        self.deleted.append(list(ids))
+        for i in ids:
+            del self.rows[i]
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.upserted.append(list(ids))
+        for i, e, d, m in zip(ids, embeddings, documents, metadatas):
+            self.rows[i] = (e, d, m)
+
+
+def _source_chunks(source_id, texts, created_at="2024-01-01"):
+    meta = {"source_id": source_id, "title": "T", "subject": "storia", "classe": "prim", "anno": 3}
+    return [
+        {"id": f"{source_id}_{i}", "text": t, "metadata": dict(meta, created_at=created_at)}
+        for i, t in enumerate(texts)
+    ]
+
+
+def test_sync_source_writes_only_the_delta():
+    store = StoreCollection()
+    model = DummyModel()
+
+    report = embedder.sync_source(store, model, "s1", _source_chunks("s1", ["a", "b", "c"]), batch_size=2)
+    assert report == {"added": 3, "updated": 0, "deleted": 0, "unchanged": 0}
+    assert store.upserted == [["s1_0", "s1_1"], ["s1_2"]]
+
+    # re-chunking identico (cambia solo created_at): nessuna scrittura, nessun embedding
+    model.calls.clear()
+    store.upserted.clear()
+    report = embedder.sync_source(store, model, "s1", _source_chunks("s1", ["a", "b", "c"], created_at="2025-06-01"))
+    assert report == {"added": 0, "updated": 0, "deleted": 0, "unchanged": 3}
+    assert model.calls == [] and store.upserted == []
+
+    # fonte modificata e più corta: un chunk aggiornato, l'ultimo id sparisce
+    report = embedder.sync_source(store, model, "s1", _source_chunks("s1", ["a", "B"]))
+    assert report == {"added": 0, "updated": 1, "deleted": 1, "unchanged": 1}
+    assert model.calls == [["B"]]
+    assert store.deleted == [["s1_2"]]
+    assert sorted(store.rows) == ["s1_0", "s1_1"]
+    assert store.rows["s1_1"][1] == "B"
+
+
+def test_sync_all_limits_to_sources_and_removes_deleted_ones(tmp_path, monkeypatch):
+    chunks_dir = tmp_path / "chunks6"
+    chunks_dir.mkdir()
+    for source_id, texts in (("s1", ["a", "b"]), ("s2", ["c"])):
+        (chunks_dir / f"{source_id}.jsonl").write_text(
+            "\n".join(json.dumps(c) for c in _source_chunks(source_id, texts)), encoding="utf-8"
+        )
+
+    store = StoreCollection()
+    monkeypatch.setattr(embedder, "get_model", lambda: DummyModel())
+    monkeypatch.setattr(embedder, "get_collection", lambda *a, **k: store)
+    chroma_dir = tmp_path / "chroma6"
+
+    assert embedder.sync_all(chroma_dir=str(chroma_dir), chunks_dir=str(chunks_dir)) == {
+        "added": 3, "updated": 0, "deleted": 0, "unchanged": 0
+    }
+    version = (chroma_dir / "index_version").read_text(encoding="utf-8")
+
+    # nessuna modifica: la versione dell'indice (e quindi i pool precalcolati) resta valida
+    assert embedder.sync_all(sources=["s1"], chroma_dir=str(chroma_dir), chunks_dir=str(chunks_dir))["unchanged"] == 2
+    assert (chroma_dir / "index_version").read_text(encoding="utf-8") == version
+
+    # file della fonte rimosso: i suoi chunk escono dallo store
+    (chunks_dir / "s2.jsonl").unlink()
+    report = embedder.sync_all(sources=["s2"], chroma_dir=str(chroma_dir), chunks_dir=str(chunks_dir))
+    assert report["deleted"] == 1
+    assert sorted(store.rows) == ["s1_0", "s1_1"]
+    assert (chroma_dir / "index_version").read_text(encoding="utf-8") != version
+
+
+def test_embed_all_reads_chunk_store(tmp_path, monkeypatch):
+    from rag_tools import chunk_store
+
+    store_dir = tmp_path / "store7"
+    chunk_store.write_store(store_dir, [
+        {"id": f"s_{i}", "text": f"t{i}", "metadata": {"source_id": "s", "title": "T"}} for i in range(5)
+    ])
+    dummy_collection = DummyCollection()
+    monkeypatch.setattr(embedder, "get_model", lambda: DummyModel())
+    monkeypatch.setattr(embedder, "get_collection", lambda *a, **k: dummy_collection)
+
+    total, count = embedder.embed_all(chroma_dir=str(tmp_path / "chroma7"), chunks_dir=str(store_dir), batch_size=2)
+    assert (total, count) == (5, 5)
+    assert [c["ids"] for c in dummy_collection.add_calls] == [["s_0", "s_1"], ["s_2", "s_3"], ["s_4"]]
+    assert dummy_collection.add_calls[0]["metadatas"][0]["title"] == "T"
+    assert [c["id"] for c in embedder.load_source_chunks("s", str(store_dir))][-1] == "s_4"
+
+
+def test_sync_all_with_missing_store_deletes_nothing(tmp_path, monkeypatch):
+    store = StoreCollection()
+    monkeypatch.setattr(embedder, "get_model", lambda: DummyModel())
+    monkeypatch.setattr(embedder, "get_collection", lambda *a, **k: store)
+
+    with pytest.raises(FileNotFoundError):
+        embedder.sync_all(sources=["s1"], chroma_dir=str(tmp_path / "chroma8"), chunks_dir=str(tmp_path / "manca"))
+
+
+def test_default_paths_agree_with_chunker_and_pipeline():
+    from src.rag_tools import chunker, pipeline
+
+    # stessi file da qualunque cartella si lanci lo script
+    assert Path(embedder.CHUNKS_DIR) == chunker.CHUNK_DIR == pipeline.CHUNKS_DIR
+    assert Path(embedder.CHROMA_DIR) == pipeline.CHROMA_DIR
+    assert Path(embedder.CHUNKS_DIR).is_absolute()
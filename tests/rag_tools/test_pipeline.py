@@ -0,0 +1,130 @@
+import json
+
+import pytest
+
+from src.rag_tools import pipeline
+from src.rag_tools.work_queue import WorkQueue, run_worker
+
+
+@pytest.fixture
+def data_dirs(tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    monkeypatch.setattr(pipeline, "CLEANED_DIR", tmp_path / "cleaned")
+    monkeypatch.setattr(pipeline, "CHUNKS_DIR", tmp_path / "chunk_store")
+    monkeypatch.setattr(pipeline, "SEGMENTS_DIR", tmp_path / "chunk_segments")
+    monkeypatch.setattr(pipeline, "SOURCE_INDEX", tmp_path / "fonte_index.json")
+    return tmp_path
+
+
+def test_read_topics_builds_stable_task_ids(tmp_path):
+    csv_path = tmp_path / "topics.csv"
+    csv_path.write_text(
+        "materia,classe,anno,titolo,keyword_wikipedia\n"
+        "storia,prim,3,Romani,Antica Roma\n"
+        "storia,prim,x,Rotto,Niente\n",
+        encoding="utf-8",
+    )
+    tasks = pipeline.read_topics(csv_path)
+    assert [t["id"] for t in tasks] == ["storia/prim/3/Antica Roma"]
+    assert tasks[0]["payload"]["anno"] == 3
+
+
+def test_process_topic_resumes_from_checkpoint(data_dirs, monkeypatch):
+    downloads = []
+
+    def fake_download(url, force=False):
+        downloads.append(url)
+        path = data_dirs / "raw" / "Antica_Roma.html"
+        path.write_text("<html><body><p>" + " ".join(f"w{i}" for i in range(30)) + "</p></body></html>")
+        return "Antica_Roma.html", path
+
+    real_extract = pipeline.extract_text_from_html
+    crashes = iter([True])
+
+    def flaky_extract(path):
+        if next(crashes, False):
+            raise MemoryError("crash a metà")
+        return real_extract(path)
+
+    monkeypatch.setattr(pipeline, "download_html", fake_download)
+    monkeypatch.setattr(pipeline, "extract_text_from_html", flaky_extract)
+
+    q = WorkQueue(data_dirs / "q.sqlite")
+    q.enqueue([{
+        "id": "storia/prim/3/Antica Roma",
+        "payload": {"materia": "storia", "classe": "prim", "anno": 3, "titolo": "Romani", "keyword": "Antica Roma"},
+    }])
+    stats = run_worker(q, pipeline.process_topic, "w")
+
+    # primo tentativo fallito dopo il download; il secondo riparte dal checkpoint
+    assert stats == {"done": 1, "failed": 1, "lost": 0}
+    assert len(downloads) == 1
+    assert q.results() == [{"source_id": "Antica_Roma", "chunks": 1}]
+
+    # i chunk arrivano nello store solo con il merge di fine coda
+    assert not (data_dirs / "chunk_store").exists()
+    assert pipeline.merge_segments() == ["Antica_Roma"]
+    assert list((data_dirs / "chunk_segments").glob("*.json")) == []
+
+    from rag_tools.chunk_store import ChunkStore
+    with ChunkStore(data_dirs / "chunk_store") as store:
+        assert [r["id"] for r in store.records()] == ["Antica_Roma_0"]
+    assert json.loads((data_dirs / "fonte_index.json").read_text(encoding="utf-8"))[0]["titolo"] == "Romani"
+
+
+def test_merge_segments_rewrites_the_store_once(data_dirs, monkeypatch):
+    from rag_tools import chunk_store
+
+    updates = []
+    real_update = chunk_store.update
+    monkeypatch.setattr(chunk_store, "update", lambda path, by_source: updates.append(sorted(by_source)) or real_update(path, by_source))
+
+    for source_id in ("a", "b", "c"):
+        pipeline.write_chunks({source_id: [{"id": f"{source_id}_0", "text": source_id, "metadata": {"source_id": source_id}}]})
+    assert pipeline.merge_segments() == ["a", "b", "c"]
+    assert pipeline.merge_segments() == []
+
+    assert updates == [["a", "b", "c"]]
+    with chunk_store.ChunkStore(data_dirs / "chunk_store") as store:
+        assert store.sources() == ["a", "b", "c"]
+
+
+def test_rebuild_index_uses_embedder(data_dirs, monkeypatch):
+    import sys
+    import types
+
+    calls = []
+    fake = types.SimpleNamespace(embed_all=lambda **kwargs: calls.append(kwargs) or (1, 1))
+    monkeypatch.setitem(sys.modules, "rag_tools.embedder", fake)
+
+    # senza chunk non si pubblica un indice vuoto
+    assert pipeline.rebuild_index(chroma_dir=data_dirs / "chroma") is None
+    assert calls == []
+
+    pipeline.write_chunks({"a": [{"id": "a_0", "text": "a", "metadata": {"source_id": "a"}}]})
+    pipeline.merge_segments()
+    assert pipeline.rebuild_index(chroma_dir=data_dirs / "chroma") == (1, 1)
+    assert calls == [{
+        "fresh": True, "chroma_dir": str(data_dirs / "chroma"),
+        "chunks_dir": str(data_dirs / "chunk_store"), "batch_size": pipeline.BATCH_SIZE,
+    }]
+
+
+def test_embed_pending_syncs_only_new_sources(data_dirs, monkeypatch):
+    synced = []
+    monkeypatch.setattr(pipeline, "sync_sources", lambda source_ids: synced.append(list(source_ids)))
+    q = WorkQueue(data_dirs / "q.sqlite")
+    q.enqueue([{"id": t, "payload": {}} for t in ("a", "b", "c")])
+    for source_id in ("a", "b"):
+        q.complete(q.claim("w1")["id"], "w1", {"source_id": source_id, "chunks": 1})
+
+    pipeline.embed_pending(q, ["b"])
+    assert synced == [["b", "a"]]
+
+    # rerun: solo la fonte del task completato dopo l'ultimo sync
+    q.complete(q.claim("w1")["id"], "w1", {"source_id": "c", "chunks": 1})
+    pipeline.embed_pending(q, [])
+    assert synced[-1] == ["c"]
+    pipeline.embed_pending(q, [])
+    assert synced[-1] == []
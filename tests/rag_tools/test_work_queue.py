@@ -0,0 +1,173 @@
+import os
+import threading
+
+import pytest
+
+from src.rag_tools import work_queue
+from src.rag_tools.work_queue import WorkQueue, LeaseLost, run_worker
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def _tasks(n):
+    return [{"id": f"t{i}", "payload": {"n": i}} for i in range(n)]
+
+
+def test_enqueue_is_idempotent_and_claim_leases(tmp_path):
+    clock = FakeClock()
+    q = WorkQueue(tmp_path / "q.sqlite", lease_seconds=60, clock=clock)
+    assert q.enqueue(_tasks(2)) == 2
+    assert q.enqueue(_tasks(3)) == 1
+
+    task = q.claim("w1")
+    assert task["id"] == "t0" and task["payload"] == {"n": 0}
+    assert task["attempt"] == 1 and task["checkpoint"] is None
+    assert q.claim("w2")["id"] == "t1"
+    assert q.counts() == {"pending": 1, "leased": 2, "done": 0, "failed": 0}
+
+    q.complete("t0", "w1", {"ok": True})
+    # un task finito non viene riaccodato da un nuovo run
+    assert q.enqueue(_tasks(1)) == 0
+    assert q.results() == [{"ok": True}]
+
+
+def test_unsynced_lists_tasks_done_since_last_sync(tmp_path):
+    q = WorkQueue(tmp_path / "q.sqlite")
+    q.enqueue(_tasks(3))
+    for i in range(2):
+        q.complete(q.claim("w1")["id"], "w1", i)
+    assert q.unsynced() == {"t0": 0, "t1": 1}
+
+    q.mark_synced(["t0", "t1"])
+    q.complete(q.claim("w1")["id"], "w1", 2)
+    assert q.unsynced() == {"t2": 2}
+
+    # un task riprocessato (requeue) torna da sincronizzare quando è di nuovo completato
+    q.mark_synced(["t2"])
+    q.requeue()
+    assert q.unsynced() == {}
+    q.complete(q.claim("w1")["id"], "w1", 0)
+    assert q.unsynced() == {"t0": 0}
+
+
+def test_expired_lease_is_reclaimed_from_checkpoint(tmp_path):
+    clock = FakeClock()
+    q = WorkQueue(tmp_path / "q.sqlite", lease_seconds=60, clock=clock)
+    q.enqueue(_tasks(1))
+
+    task = q.claim("w1")
+    q.checkpoint(task["id"], "w1", {"stage": "downloaded"})
+    # w1 muore: nessun heartbeat, il lease scade
+    assert q.claim("w2") is None
+    clock.now += 61
+    retry = q.claim("w2")
+    assert retry["id"] == "t0"
+    assert retry["attempt"] == 2
+    assert retry["checkpoint"] == {"stage": "downloaded"}
+
+    # il vecchio proprietario non può più scrivere
+    with pytest.raises(LeaseLost):
+        q.heartbeat("t0", "w1")
+    with pytest.raises(LeaseLost):
+        q.complete("t0", "w1")
+    q.heartbeat("t0", "w2")
+    q.complete("t0", "w2", "fatto")
+    assert q.counts()["done"] == 1
+
+
+def test_fail_retries_until_max_attempts(tmp_path):
+    clock = FakeClock()
+    q = WorkQueue(tmp_path / "q.sqlite", max_attempts=2, clock=clock)
+    q.enqueue(_tasks(1))
+
+    q.fail(q.claim("w")["id"], "w", "rete")
+    assert q.counts()["pending"] == 1
+    q.fail(q.claim("w")["id"], "w", "rete")
+    assert q.counts()["failed"] == 1
+    assert q.claim("w") is None
+
+    # lease scaduto all'ultimo tentativo: il task diventa failed invece di restare leased
+    q.enqueue([{"id": "crash", "payload": {}}])
+    for attempt in (1, 2):
+        assert q.claim("w")["attempt"] == attempt
+        clock.now += work_queue.LEASE_SECONDS + 1
+    assert q.claim("w") is None
+    assert q.counts() == {"pending": 0, "leased": 0, "done": 0, "failed": 2}
+
+    assert q.requeue() == 2
+    assert q.claim("w")["attempt"] == 1
+
+
+def test_run_worker_checkpoints_and_records_failures(tmp_path):
+    q = WorkQueue(tmp_path / "q.sqlite")
+    q.enqueue(_tasks(3))
+
+    def handler(task, save_checkpoint):
+        save_checkpoint({"step": 1})
+        if task["payload"]["n"] == 1:
+            raise RuntimeError("rotto")
+        return task["payload"]["n"] * 10
+
+    stats = run_worker(q, handler, "w", heartbeat_interval=0.01)
+    # t1 fallisce ai primi due tentativi e torna in coda fino a MAX_ATTEMPTS
+    assert stats == {"done": 2, "failed": work_queue.MAX_ATTEMPTS, "lost": 0}
+    assert sorted(q.results()) == [0, 20]
+    assert q.counts()["failed"] == 1
+
+
+def test_concurrent_workers_claim_each_task_once(tmp_path):
+    path = tmp_path / "q.sqlite"
+    WorkQueue(path).enqueue(_tasks(40))
+    seen = []
+    lock = threading.Lock()
+
+    def handler(task, save_checkpoint):
+        with lock:
+            seen.append(task["id"])
+        return task["id"]
+
+    def worker(i):
+        # una connessione per worker, come processi separati
+        q = WorkQueue(path)
+        run_worker(q, handler, f"w{i}")
+        q.close()
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert sorted(seen) == sorted(t["id"] for t in _tasks(40))
+    assert WorkQueue(path).counts()["done"] == 40
+
+
+def test_processes_share_the_queue(tmp_path):
+    path = tmp_path / "q.sqlite"
+    WorkQueue(path).enqueue(_tasks(20))
+
+    pids = []
+    for i in range(2):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                q = WorkQueue(path)
+                run_worker(q, lambda task, save: os.getpid(), f"p{i}")
+            except BaseException:
+                status = 1
+            finally:
+                os._exit(status)
+        pids.append(pid)
+    for pid in pids:
+        assert os.waitpid(pid, 0)[1] == 0
+
+    q = WorkQueue(path)
+    assert q.counts()["done"] == 20
+    assert set(q.results()) <= set(pids)
@@ -0,0 +1,143 @@
+import time
+import contextlib
+import threading
+
+import pytest
+
+from src.services import batch
+from src.services.batch import BatchError, parse_batch, run_batch
+
+
+def make_item(**overrides):
+    item = {"type": "quiz", "category": "storia", "classe": "primaria", "anno": 3, "difficulty": 2}
+    item.update(overrides)
+    return item
+
+
+@pytest.fixture
+def preloads(monkeypatch):
+    calls = []
+
+    @contextlib.contextmanager
+    def fake_preload(queries):
+        calls.append(queries)
+        yield
+
+    monkeypatch.setattr(batch, "preloaded_candidates", fake_preload)
+    return calls
+
+
+def test_parse_batch_validates_every_item_up_front():
+    valid, invalid = parse_batch([
+        make_item(),
+        make_item(type="crossword"),
+        "not an object",
+        make_item(anno=None, category=""),
+        make_item(llmProvider="claude"),
+        make_item(llmProvider="openai"),
+    ])
+
+    assert [i for i, _ in valid] == [0, 4]
+    assert valid[0][1]["llmProvider"] == "groq"
+    assert valid[1][1]["llmProvider"] == "claude"
+    assert dict(invalid) == {
+        1: "Unknown quiz type: crossword",
+        2: "Not a JSON object",
+        3: "Missing fields: category, anno",
+        5: "Unknown LLM provider: openai",
+    }
+
+
+def test_parse_batch_uses_the_single_request_validator():
+    from services.quiz_generator import validate_request
+
+    items = [make_item(), make_item(llmProvider=None), make_item(type="crossword")]
+    valid, invalid = parse_batch(items)
+    # un provider esplicitamente nullo non prende il default, come nella richiesta singola
+    assert dict(invalid)[1] == "Missing fields: llmProvider"
+    assert all(validate_request(payload) is None for _, payload in valid)
+    assert dict(invalid)[2] == validate_request(dict(items[2], llmProvider="groq"))
+
+
+@pytest.mark.parametrize("body", [None, {}, [], "x"])
+def test_parse_batch_rejects_non_array(body):
+    with pytest.raises(BatchError):
+        parse_batch(body)
+
+
+def test_parse_batch_rejects_oversized(monkeypatch):
+    monkeypatch.setattr(batch, "MAX_BATCH_ITEMS", 2)
+    with pytest.raises(BatchError):
+        parse_batch([make_item()] * 3)
+
+
+def test_run_batch_streams_in_completion_order(preloads):
+    def generate(payload, deadline=None):
+        time.sleep(payload["delay"])
+        return {"status": 1, "data": {"category": payload["category"]}}
+
+    valid, invalid = parse_batch([
+        make_item(category="lento", delay=0.3),
+        make_item(type="x"),
+        make_item(category="veloce", delay=0.0),
+    ])
+    start = time.perf_counter()
+    stream = run_batch(valid, invalid, generate, lambda: None, parallelism=2)
+
+    first = next(stream)
+    assert first == {"index": 1, "status": 4, "data": {}, "error": "Unknown quiz type: x"}
+    second = next(stream)
+    assert second["index"] == 2 and second["data"] == {"category": "veloce"}
+    assert time.perf_counter() - start < 0.2  # non aspetta l'elemento lento
+    assert next(stream)["index"] == 0
+    assert list(stream) == []
+
+
+def test_run_batch_caps_parallelism_and_groups_retrieval(preloads):
+    state = {"running": 0, "peak": 0}
+    lock = threading.Lock()
+    deadlines = []
+
+    def generate(payload, deadline=None):
+        deadlines.append(deadline)
+        with lock:
+            state["running"] += 1
+            state["peak"] = max(state["peak"], state["running"])
+        time.sleep(0.02)
+        with lock:
+            state["running"] -= 1
+        return {"status": 1, "data": {}}
+
+    items = [make_item(category="storia") for _ in range(10)] + [make_item(category="geografia") for _ in range(5)]
+    valid, invalid = parse_batch(items)
+    results = list(run_batch(valid, invalid, generate, lambda: "deadline", parallelism=3))
+
+    assert sorted(r["index"] for r in results) == list(range(15))
+    assert state["peak"] == 3
+    assert deadlines == ["deadline"] * 15  # un deadline per elemento
+    # un solo preload per batch, con una query per elemento (i duplicati li unisce il retriever)
+    assert len(preloads) == 1
+    assert len({q["subject"] for q in preloads[0]}) == 2
+
+
+def test_run_batch_item_failure_does_not_stop_stream(preloads):
+    def generate(payload, deadline=None):
+        if payload["category"] == "rotto":
+            raise RuntimeError("boom")
+        return {"status": 1, "data": {}}
+
+    valid, invalid = parse_batch([make_item(category="rotto"), make_item()])
+    results = {r["index"]: r for r in run_batch(valid, invalid, generate, lambda: None)}
+
+    assert results[0] == {"index": 0, "status": 4, "data": {}, "error": "boom"}
+    assert results[1]["status"] == 1
+
+
+def test_run_batch_survives_failed_preload(monkeypatch):
+    def broken_preload(queries):
+        raise ConnectionError("chroma down")
+
+    monkeypatch.setattr(batch, "preloaded_candidates", broken_preload)
+    valid, invalid = parse_batch([make_item()])
+    results = list(run_batch(valid, invalid, lambda p, deadline=None: {"status": 1, "data": {}}, lambda: None))
+    assert results == [{"index": 0, "status": 1, "data": {}}]
@@ -0,0 +1,118 @@
+import os
+import json
+import numpy as np
+
+from src.services import candidate_pools
+from src.services.prompt_builder import build_prompt
+
+
+class DummyModel:
+    def __init__(self):
+        self.calls = []
+
+    def encode(self, texts, convert_to_numpy=True):
+        self.calls.append(list(texts))
+        return np.array([[0.1, 0.2] for _ in texts])
+
+
+class DummyCollection:
+    def __init__(self, metadatas):
+        self._metadatas = metadatas
+        self.queries = []
+
+    def get(self, include=None):
+        return {"metadatas": self._metadatas}
+
+    def query(self, **kwargs):
+        self.queries.append(kwargs)
+        n = len(kwargs["query_embeddings"])
+        subject = kwargs["where"]["$and"][0]["subject"]
+        docs = [[f"{subject} A", f"{subject} A ", f"{subject} B"] for _ in range(n)]
+        metas = [[{"title": d.strip()} for d in row] for row in docs]
+        return {"documents": docs, "metadatas": metas}
+
+
+def make_collection():
+    return DummyCollection([
+        {"subject": "storia", "classe": "prim", "anno": 3},
+        {"subject": "storia", "classe": "prim", "anno": 3},
+        {"subject": "geografia", "classe": "sec1", "anno": 1},
+    ])
+
+
+def test_build_where_variants():
+    assert candidate_pools.build_where() is None
+    assert candidate_pools.build_where(subject="storia") == {"subject": "storia"}
+    where = candidate_pools.build_where("storia", "prim", 3)
+    assert where == {"$and": [{"subject": "storia"}, {"classe": "prim"}, {"anno": 3}]}
+
+
+def test_build_pools_one_query_per_filter_combo():
+    model = DummyModel()
+    collection = make_collection()
+
+    data = candidate_pools.build_pools(collection, model, "v1")
+
+    n_queries = len(candidate_pools.QUIZ_TYPES) * len(candidate_pools.DIFFICULTIES)
+    assert len(collection.queries) == 2
+    assert all(len(c) == n_queries for c in model.calls)
+    assert len(data["pools"]) == 2 * n_queries
+
+    # testi salvati una volta sola, dedup dentro ogni pool
+    assert sorted(data["docs"]) == ["geografia A", "geografia B", "storia A", "storia B"]
+    key = candidate_pools.pool_key(build_prompt("quiz", "storia", 5), "storia", "prim", 3)
+    assert len(data["pools"][key]) == 2
+
+
+def test_candidate_pools_lookup_and_invalidation(tmp_path):
+    chroma_dir = tmp_path / "chroma"
+    pools_path = tmp_path / "pools.json"
+
+    version = candidate_pools.write_index_version(str(chroma_dir))
+    data = candidate_pools.build_pools(make_collection(), DummyModel(), version)
+    candidate_pools.save_pools(data, str(pools_path))
+
+    pools = candidate_pools.CandidatePools(str(pools_path), chroma_dir=str(chroma_dir))
+    query = build_prompt("sorting", "geografia", 10)
+
+    docs, metas = pools.get(query, "geografia", "sec1", 1)
+    assert docs == ["geografia A", "geografia B"]
+    assert [m["title"] for m in metas] == docs
+
+    # miss: filtro con tipo diverso (anno stringa) o combinazione sconosciuta
+    assert pools.get(query, "geografia", "sec1", "1") is None
+    assert pools.get(query, "storia", "sec2", 1) is None
+
+    # re-embed: nuova versione dell'indice → fallback alla ricerca live
+    (chroma_dir / candidate_pools.INDEX_VERSION_FILE).write_text("nuova-versione", encoding="utf-8")
+    os.utime(chroma_dir / candidate_pools.INDEX_VERSION_FILE, ns=(1, 1))
+    assert pools.get(query, "geografia", "sec1", 1) is None
+
+
+def test_candidate_pools_missing_file(tmp_path):
+    pools = candidate_pools.CandidatePools(str(tmp_path / "missing.json"))
+    assert pools.get("q", "storia", "prim", 3) is None
+
+
+def test_save_pools_is_compact_json(tmp_path):
+    path = tmp_path / "sub" / "pools.json"
+    candidate_pools.save_pools({"index_version": "v", "docs": [], "metas": [], "pools": {}}, str(path))
+    assert json.loads(path.read_text(encoding="utf-8"))["index_version"] == "v"
+    assert " " not in path.read_text(encoding="utf-8")
+
+
+def test_index_version_watcher_follows_alias(tmp_path):
+    from src.services import index_versions
+
+    root = str(tmp_path)
+    candidate_pools.write_index_version(root)
+    watcher = candidate_pools.IndexVersionWatcher(root)
+    legacy = watcher.current()
+    assert legacy
+
+    version, path = index_versions.new_version(root)
+    token = candidate_pools.write_index_version(path)
+    # la versione shadow non conta finché non è pubblicata
+    assert watcher.current() == legacy
+    index_versions.publish(root, version)
+    assert watcher.current() == token
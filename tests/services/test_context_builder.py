@@ -0,0 +1,70 @@
+import numpy as np
+
+from src.services import context_builder
+from src.services.context_builder import build_budgeted_context, estimate_tokens
+
+
+VOCAB = ["roma", "cesare", "impero", "fiume", "montagna", "alpi", "senato", "console"]
+
+
+def bow_encode(texts):
+    """Encoder finto: bag-of-words sul vocabolario sopra (stesso ruolo del SentenceTransformer)."""
+    rows = []
+    for text in texts:
+        words = text.lower().replace(".", " ").split()
+        rows.append([words.count(w) for w in VOCAB] + [0.01])
+    return np.array(rows, dtype=float)
+
+
+DOCS = [
+    "Cesare fu console di Roma e guidò il senato. Le Alpi sono una grande montagna. "
+    "Cesare fu console di Roma e guidò il senato.",
+    "Il fiume Po nasce dalle Alpi e attraversa la pianura. Roma divenne un impero dopo Cesare.",
+]
+METAS = [
+    {"title": "Roma antica", "classe": "prim", "anno": 5, "subject": "storia"},
+    {"title": "Geografia", "classe": "prim", "anno": 4, "subject": "geografia"},
+]
+
+
+def test_under_budget_keeps_full_context():
+    context, stats = build_budgeted_context("roma", DOCS, METAS, 10_000, bow_encode)
+    assert "[Fonte: Roma antica | Classe: prim 5 | Materia: storia]" in context
+    assert DOCS[0] in context
+    assert stats["tokens_saved"] == 0
+
+
+def test_over_budget_packs_relevant_sentences():
+    budget = 45
+    context, stats = build_budgeted_context("cesare console roma senato impero", DOCS, METAS, budget, bow_encode)
+
+    assert estimate_tokens(context) <= budget
+    assert stats["tokens_used"] == estimate_tokens(context)
+    assert stats["tokens_saved"] == stats["tokens_full"] - stats["tokens_used"] > 0
+
+    # la frase più pertinente c'è una sola volta (doppione scartato)
+    assert context.count("Cesare fu console di Roma") == 1
+    # le frasi non pertinenti restano fuori
+    assert "fiume Po" not in context
+    assert context.startswith("[Fonte: Roma antica")
+
+
+def test_context_budget_for_env(monkeypatch):
+    monkeypatch.delenv("SAGE_CONTEXT_BUDGET", raising=False)
+    # compressione opt-in: di default il contesto resta completo
+    monkeypatch.setattr(context_builder, "CONTEXT_COMPRESSION", False)
+    assert context_builder.context_budget_for("groq") is None
+    monkeypatch.setattr(context_builder, "CONTEXT_COMPRESSION", True)
+    assert context_builder.context_budget_for("groq") == context_builder.CONTEXT_BUDGETS["groq"]
+    assert context_builder.context_budget_for("altro") == context_builder.DEFAULT_BUDGET
+
+    monkeypatch.setenv("SAGE_CONTEXT_BUDGET", "0")
+    assert context_builder.context_budget_for("groq") is None
+    monkeypatch.setenv("SAGE_CONTEXT_BUDGET", "800")
+    assert context_builder.context_budget_for("claude") == 800
+
+
+def test_split_sentences_drops_fragments():
+    assert context_builder.split_sentences("Breve. Questa invece è una frase abbastanza lunga.\nTitolo") == [
+        "Questa invece è una frase abbastanza lunga."
+    ]
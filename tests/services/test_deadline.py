@@ -0,0 +1,58 @@
+import pytest
+
+from src.services.deadline import Deadline, DeadlineExceeded, deadline_from_header
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_remaining_and_expired():
+    clock = FakeClock()
+    deadline = Deadline(2.0, clock=clock)
+    assert deadline.remaining() == 2.0
+
+    clock.now += 1.5
+    assert deadline.remaining() == pytest.approx(0.5)
+    assert not deadline.expired()
+
+    clock.now += 1.0
+    assert deadline.remaining() == 0.0
+    assert deadline.expired()
+
+
+def test_check_sheds_when_reserve_does_not_fit():
+    clock = FakeClock()
+    deadline = Deadline(2.0, clock=clock)
+    deadline.check("retrieval", reserve=1.0)
+
+    clock.now += 1.5
+    with pytest.raises(DeadlineExceeded) as exc:
+        deadline.check("llm_call", reserve=1.0)
+    assert exc.value.shed
+    assert exc.value.stage == "llm_call"
+
+
+def test_exceeded_is_not_shed():
+    error = Deadline(1.0).exceeded("llm_call")
+    assert isinstance(error, DeadlineExceeded)
+    assert not error.shed
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("5", 5.0),
+    ("2.5", 2.5),
+    ("9999", 30.0),   # limitato al default
+    (None, 30.0),
+    ("abc", 30.0),
+    ("-1", 30.0),
+    ("nan", 30.0),
+])
+def test_deadline_from_header(value, expected):
+    clock_before = Deadline(0).expires_at
+    deadline = deadline_from_header(value, default=30.0)
+    assert deadline.expires_at - clock_before == pytest.approx(expected, abs=0.5)
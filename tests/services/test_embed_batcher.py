@@ -0,0 +1,99 @@
+import time
+import threading
+
+import numpy as np
+import pytest
+
+from src.services import embed_batcher
+from src.services.embed_batcher import MicroBatcher, SyntheticEncoder
+
+
+class RecordingEncoder:
+    def __init__(self, delay=0.0):
+        self.batches = []
+        self.delay = delay
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        time.sleep(self.delay)
+        return np.array([[float(len(t)), 1.0] for t in texts])
+
+
+def encode_concurrently(batcher, texts):
+    results = {}
+    barrier = threading.Barrier(len(texts))
+
+    def call(text):
+        barrier.wait()
+        results[text] = batcher.encode(text, timeout=5)
+
+    threads = [threading.Thread(target=call, args=(t,)) for t in texts]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+def test_concurrent_requests_share_batched_encode():
+    encoder = RecordingEncoder(delay=0.01)
+    batcher = MicroBatcher(encoder, max_batch=64, max_wait=0.005)
+    texts = [f"domanda numero {i}" + "x" * i for i in range(24)]
+
+    results = encode_concurrently(batcher, texts)
+
+    assert len(encoder.batches) < len(texts) / 2
+    for text in texts:
+        assert results[text].tolist() == [float(len(text)), 1.0]  # ogni future riceve la propria riga
+
+
+def test_batch_size_cap_and_duplicate_texts():
+    encoder = RecordingEncoder(delay=0.02)
+    batcher = MicroBatcher(encoder, max_batch=4, max_wait=0.01)
+
+    encode_concurrently(batcher, [f"t{i}" for i in range(12)])
+    assert max(len(b) for b in encoder.batches) <= 4
+
+    encoder.batches.clear()
+    results = encode_concurrently(batcher, ["uguale"] * 3 + ["altro"])
+    assert all(len(b) == len(set(b)) for b in encoder.batches)  # testi uguali codificati una volta
+    assert results["uguale"].tolist() == [6.0, 1.0]
+
+
+def test_isolated_request_does_not_wait():
+    encoder = RecordingEncoder()
+    batcher = MicroBatcher(encoder, max_wait=0.5)
+
+    start = time.perf_counter()
+    batcher.encode("sola", timeout=5)
+    batcher.encode("ancora sola", timeout=5)
+    assert time.perf_counter() - start < 0.25  # l'attesa del batch scatta solo sotto carico
+
+
+def test_encode_error_reaches_every_waiter():
+    def broken(texts):
+        raise RuntimeError("modello non caricato")
+
+    batcher = MicroBatcher(broken)
+    with pytest.raises(RuntimeError, match="modello non caricato"):
+        batcher.encode("x", timeout=5)
+
+
+def test_worker_restarts_in_forked_child(monkeypatch):
+    batcher = MicroBatcher(RecordingEncoder())
+    batcher.encode("prima", timeout=5)
+    first_queue = batcher._queue
+
+    monkeypatch.setattr(embed_batcher.os, "getpid", lambda: -1)  # come in un worker dopo il fork
+    assert batcher.encode("dopo", timeout=5).tolist() == [4.0, 1.0]
+    assert batcher._queue is not first_queue
+
+
+def test_benchmark_reports_throughput_and_p99():
+    report = embed_batcher.benchmark(SyntheticEncoder(dim=32, hidden=64).encode, levels=(1, 8), requests=32)
+
+    assert set(report) == {1, 8}
+    for modes in report.values():
+        for row in modes.values():
+            assert row["throughput"] > 0
+            assert 0 < row["p50_ms"] <= row["p99_ms"]
@@ -0,0 +1,299 @@
+import asyncio
+import time
+
+from src.services import hedging
+from src.services.hedging import CircuitBreaker, HedgedLLM, LatencyTracker, NoProviderAvailable
+
+VALID = '{"question": "Q", "answer": "A"}'
+
+
+class Response:
+    def __init__(self, content):
+        self.content = content
+
+
+class StubProvider:
+    """Provider locale con latenza iniettata."""
+
+    def __init__(self, content=VALID, latency=0.0, error=None):
+        self.content = content
+        self.latency = latency
+        self.error = error
+        self.calls = 0
+        self.cancelled = False
+
+    async def ainvoke(self, messages, **kwargs):
+        self.calls += 1
+        self.kwargs = kwargs
+        self.messages = messages
+        try:
+            await asyncio.sleep(self.latency)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+        if self.error:
+            raise self.error
+        return Response(self.content)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def _hedged(primary, secondary, delay=0.05, **breaker_kwargs):
+    trackers = {name: LatencyTracker() for name in ("groq", "claude")}
+    breakers = {name: CircuitBreaker(name, **breaker_kwargs) for name in ("groq", "claude")}
+    llm = HedgedLLM([("groq", primary), ("claude", secondary)], breakers=breakers, trackers=trackers)
+    for tracker in trackers.values():
+        tracker.hedge_delay = lambda default=None: delay
+    return llm
+
+
+def test_fast_primary_wins_without_hedge():
+    primary, secondary = StubProvider(), StubProvider()
+    response = asyncio.run(_hedged(primary, secondary).ainvoke([]))
+
+    assert response.content == VALID
+    assert primary.calls == 1
+    assert secondary.calls == 0
+
+
+def test_slow_primary_is_hedged_and_cancelled():
+    primary = StubProvider(content='{"from": "groq"}', latency=1.0)
+    secondary = StubProvider(content='{"from": "claude"}', latency=0.01)
+
+    start = time.perf_counter()
+    response = asyncio.run(_hedged(primary, secondary).ainvoke([]))
+    elapsed = time.perf_counter() - start
+
+    assert response.content == '{"from": "claude"}'
+    assert elapsed < 0.5
+    assert primary.cancelled
+
+
+def test_invalid_output_fails_over_immediately():
+    primary = StubProvider(content="Mi dispiace, non posso.")
+    secondary = StubProvider(content='{"ok": 1}')
+
+    response = asyncio.run(_hedged(primary, secondary, delay=10).ainvoke([]))
+
+    assert response.content == '{"ok": 1}'
+    assert secondary.calls == 1
+
+
+def test_error_fails_over_and_last_error_is_raised():
+    primary = StubProvider(error=RuntimeError("groq giù"))
+    secondary = StubProvider(error=RuntimeError("claude giù"))
+
+    try:
+        asyncio.run(_hedged(primary, secondary, delay=10).ainvoke([]))
+    except RuntimeError as e:
+        assert "claude" in str(e)
+    else:
+        raise AssertionError("errore atteso")
+    assert primary.calls == secondary.calls == 1
+
+
+def test_all_invalid_returns_last_response():
+    primary = StubProvider(content="niente json")
+    secondary = StubProvider(content="neanche qui")
+
+    response = asyncio.run(_hedged(primary, secondary, delay=10).ainvoke([]))
+    assert response.content == "neanche qui"
+
+
+def test_breaker_opens_and_skips_provider():
+    clock = FakeClock()
+    primary = StubProvider(error=RuntimeError("giù"))
+    secondary = StubProvider()
+    llm = _hedged(primary, secondary, failure_threshold=2, reset_timeout=30, clock=clock)
+
+    for _ in range(2):
+        asyncio.run(llm.ainvoke([]))
+    assert llm.breakers["groq"].state == "open"
+
+    asyncio.run(llm.ainvoke([]))
+    assert primary.calls == 2  # escluso mentre il breaker è aperto
+
+    # dopo il reset: una richiesta di prova, che chiude il breaker se va bene
+    clock.now = 31
+    assert llm.breakers["groq"].state == "half_open"
+    primary.error = None
+    asyncio.run(llm.ainvoke([]))
+    assert primary.calls == 3
+    assert llm.breakers["groq"].state == "closed"
+
+
+def test_half_open_allows_single_probe():
+    clock = FakeClock()
+    breaker = CircuitBreaker("groq", failure_threshold=1, reset_timeout=5, clock=clock)
+    breaker.record_failure()
+    assert not breaker.allow()
+
+    clock.now = 5
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == "open"
+
+
+def test_no_provider_available():
+    llm = _hedged(StubProvider(), StubProvider(), failure_threshold=1)
+    for breaker in llm.breakers.values():
+        breaker.record_failure()
+
+    try:
+        asyncio.run(llm.ainvoke([]))
+    except NoProviderAvailable:
+        pass
+    else:
+        raise AssertionError("NoProviderAvailable attesa")
+
+
+def test_latency_tracker_uses_p95_after_enough_samples():
+    tracker = LatencyTracker()
+    assert tracker.hedge_delay(default=3.0) == 3.0
+
+    for i in range(100):
+        tracker.observe((i + 1) / 100)
+    assert tracker.hedge_delay(default=3.0) == 0.96
+
+    fast = LatencyTracker()
+    for _ in range(50):
+        fast.observe(0.01)
+    assert fast.hedge_delay() == hedging.MIN_HEDGE_DELAY
+
+
+def test_sync_invoke_runs_on_background_loop():
+    primary = StubProvider(latency=1.0)
+    secondary = StubProvider(content='{"sync": true}')
+
+    response = _hedged(primary, secondary).invoke([])
+    assert response.content == '{"sync": true}'
+
+
+def test_sync_invoke_timeout_cancels_in_flight_calls():
+    import concurrent.futures
+
+    primary, secondary = StubProvider(latency=5), StubProvider(latency=5)
+
+    try:
+        _hedged(primary, secondary).invoke([], timeout=0.2)
+    except concurrent.futures.TimeoutError:
+        pass
+    else:
+        raise AssertionError("timeout atteso")
+    time.sleep(0.1)  # la cancellazione avviene sul loop di background
+    assert primary.cancelled and secondary.cancelled
+    assert primary.kwargs == {"timeout": 0.2}
+
+
+def test_provider_kwargs_are_applied_per_provider():
+    primary = StubProvider(content="non json")
+    secondary = StubProvider()
+    llm = _hedged(primary, secondary, delay=10)
+    llm.provider_kwargs = {"groq": {"response_format": {"type": "json_object"}}, "claude": {"max_tokens": 320}}
+
+    asyncio.run(llm.ainvoke([], timeout=5))
+    assert primary.kwargs == {"response_format": {"type": "json_object"}, "timeout": 5}
+    assert secondary.kwargs == {"max_tokens": 320, "timeout": 5}
+
+
+def test_messages_are_built_per_provider():
+    primary = StubProvider(latency=1.0)
+    secondary = StubProvider()
+    llm = _hedged(primary, secondary, delay=0.01)
+
+    asyncio.run(llm.ainvoke(lambda name: [f"prompt per {name}"]))
+    assert primary.messages == ["prompt per groq"]
+    assert secondary.messages == ["prompt per claude"]
+
+
+def test_get_hedged_llm_adds_configured_fallbacks(monkeypatch):
+    monkeypatch.setenv("GROQ_API_KEY", "x")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "y")
+    built = []
+
+    def get_llm(name):
+        built.append(name)
+        return StubProvider()
+
+    llm = hedging.get_hedged_llm("claude", get_llm)
+    assert [name for name, _ in llm.providers] == ["claude", "groq"]
+    assert built == ["claude", "groq"]
+
+
+def test_refusal_with_stray_brace_is_not_a_valid_answer():
+    assert not hedging.looks_like_quiz_json("Mi dispiace, non ho fonti {")
+    assert hedging.looks_like_quiz_json('{"type": "quiz", "question": "Q?"')
+
+
+class StreamProvider:
+    def __init__(self, chunks=(VALID[:10], VALID[10:]), error=None):
+        self.chunks = list(chunks)
+        self.error = error
+        self.calls = 0
+
+    def stream(self, messages, **kwargs):
+        self.calls += 1
+        for chunk in self.chunks:
+            yield Response(chunk)
+        if self.error:
+            raise self.error
+
+    async def astream(self, messages, **kwargs):
+        self.calls += 1
+        for chunk in self.chunks:
+            yield Response(chunk)
+        if self.error:
+            raise self.error
+
+
+def test_stream_probe_closes_half_open_breaker():
+    """open → half-open → stream completo → closed (lo slot di prova non resta occupato)."""
+    clock = FakeClock()
+    primary = StreamProvider(error=RuntimeError("giù"))
+    llm = _hedged(primary, StreamProvider(), failure_threshold=2, reset_timeout=30, clock=clock)
+
+    # gli errori dello stream contano per l'apertura del breaker
+    for _ in range(2):
+        try:
+            list(llm.stream([]))
+        except RuntimeError:
+            pass
+    assert llm.breakers["groq"].state == "open"
+
+    clock.now = 31
+    assert llm.breakers["groq"].state == "half_open"
+    primary.error = None
+    assert "".join(c.content for c in llm.stream([])) == VALID
+    assert llm.breakers["groq"].state == "closed"
+    assert primary.calls == 3
+
+
+def test_astream_closed_early_records_outcome():
+    from src.services.json_stream import aconsume_stream
+
+    clock = FakeClock()
+    primary = StreamProvider(chunks=[VALID, "coda ignorata"])
+    llm = _hedged(primary, StreamProvider(), failure_threshold=1, reset_timeout=5, clock=clock)
+    llm.breakers["groq"].record_failure()
+    clock.now = 5
+
+    # oggetto completo al primo chunk: aconsume_stream chiude lo stream, il probe ha avuto successo
+    assert asyncio.run(aconsume_stream(llm.astream([]))) == VALID
+    assert llm.breakers["groq"].state == "closed"
+
+    # chiuso prima di un oggetto completo: nessun esito, ma lo slot di prova torna libero
+    llm.breakers["groq"].record_failure()
+    clock.now = 10
+    primary.chunks = ["{\"question\": ", "\"Q\"}"]
+    stream = llm.stream([])
+    next(stream)
+    stream.close()
+    assert llm.breakers["groq"].state == "half_open"
+    assert llm.breakers["groq"].allow()
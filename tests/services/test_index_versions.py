@@ -0,0 +1,119 @@
+import os
+
+import pytest
+
+from src.services import index_versions
+from src.services.index_versions import IndexAlias, IndexValidationError
+
+
+class DummyCollection:
+    def __init__(self, ids, count=None):
+        self.ids = ids
+        self._count = len(ids) if count is None else count
+
+    def count(self):
+        return self._count
+
+    def query(self, query_embeddings, n_results, include=None):
+        # l'embedding di prova è l'id stesso: ritrova il chunk se è indicizzato
+        hit = [query_embeddings[0]] if query_embeddings[0] in self.ids else self.ids[:n_results]
+        return {"ids": [hit], "distances": [[0.0 if query_embeddings[0] in self.ids else 0.5] * len(hit)]}
+
+
+def test_index_dir_without_versions_is_root(tmp_path):
+    assert index_versions.current_version(str(tmp_path)) is None
+    assert index_versions.index_dir(str(tmp_path)) == str(tmp_path)
+
+
+def test_publish_switches_alias_atomically(tmp_path):
+    root = str(tmp_path)
+    v1, p1 = index_versions.new_version(root)
+    index_versions.publish(root, v1)
+    assert index_versions.index_dir(root) == p1
+
+    v2, p2 = index_versions.new_version(root)
+    # la shadow non è visibile finché non viene pubblicata
+    assert index_versions.index_dir(root) == p1
+    index_versions.publish(root, v2)
+    assert index_versions.index_dir(root) == p2
+    # nessun file temporaneo rimasto accanto all'alias
+    assert sorted(os.listdir(root)) == ["CURRENT", "versions"]
+
+    with pytest.raises(FileNotFoundError):
+        index_versions.publish(root, "inesistente")
+    assert index_versions.current_version(root) == v2
+
+
+def test_collect_garbage_keeps_active_and_newest(tmp_path):
+    root = str(tmp_path)
+    for name in ("20240101-000000-a", "20240102-000000-b", "20240103-000000-c", "20240104-000000-d"):
+        os.makedirs(index_versions.version_dir(root, name))
+    # attiva una versione vecchia (es. rollback): non va mai cancellata
+    index_versions.publish(root, "20240101-000000-a")
+
+    removed = index_versions.collect_garbage(root, keep=2)
+    assert sorted(removed) == ["20240102-000000-b"]
+    assert sorted(os.listdir(os.path.join(root, "versions"))) == [
+        "20240101-000000-a", "20240103-000000-c", "20240104-000000-d"
+    ]
+
+
+def test_discard_never_removes_active_version(tmp_path):
+    root = str(tmp_path)
+    version, path = index_versions.new_version(root)
+    index_versions.publish(root, version)
+    index_versions.discard(root, version)
+    assert os.path.isdir(path)
+
+    shadow, shadow_path = index_versions.new_version(root)
+    index_versions.discard(root, shadow)
+    assert not os.path.exists(shadow_path)
+
+
+def test_validate_index():
+    collection = DummyCollection(["a", "b", "c"])
+    index_versions.validate_index(collection, 3, [("a", "a"), ("c", "c")])
+
+    with pytest.raises(IndexValidationError):
+        index_versions.validate_index(DummyCollection(["a", "b"], count=1), 2)
+    with pytest.raises(IndexValidationError):
+        index_versions.validate_index(collection, 3, [("z", "z")])
+
+
+def test_index_alias_detects_new_version(tmp_path):
+    root = str(tmp_path)
+    alias = IndexAlias(root)
+    assert alias.version() is None
+    assert alias.path() == root
+
+    version, path = index_versions.new_version(root)
+    index_versions.publish(root, version)
+    assert alias.version() == version
+    assert alias.path() == path
+
+
+def test_collect_garbage_removes_legacy_root_index(tmp_path):
+    root = str(tmp_path)
+    # indice creato prima delle versioni: file di Chroma direttamente nella radice
+    segment = os.path.join(root, "3f2b8c1e-5a4d-4c2e-9b7a-0d1e2f3a4b5c")
+    os.makedirs(segment)
+    for name in ("chroma.sqlite3", "index_version", "note.txt"):
+        with open(os.path.join(root, name), "w") as f:
+            f.write("x")
+
+    # senza alias la radice è l'indice attivo: non si tocca
+    assert index_versions.collect_garbage(root) == []
+    assert os.path.exists(os.path.join(root, "chroma.sqlite3"))
+
+    version, _ = index_versions.new_version(root)
+    index_versions.publish(root, version)
+    # subito dopo il publish i worker possono ancora leggerlo: solo segnato come ritirato
+    index_versions.collect_garbage(root, legacy_grace=60, clock=lambda: 1000.0)
+    assert os.path.exists(os.path.join(root, "chroma.sqlite3"))
+    assert os.path.isdir(segment)
+    index_versions.collect_garbage(root, legacy_grace=60, clock=lambda: 1030.0)
+    assert os.path.exists(os.path.join(root, "chroma.sqlite3"))
+
+    # passato il periodo di grazia: restano alias, versioni e i file che non sono dell'indice
+    index_versions.collect_garbage(root, legacy_grace=60, clock=lambda: 1061.0)
+    assert sorted(os.listdir(root)) == ["CURRENT", "note.txt", "versions"]
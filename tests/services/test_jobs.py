@@ -0,0 +1,188 @@
+import threading
+
+import pytest
+
+from src.services import jobs
+from src.services.jobs import JobQueue, JobStore, SQLiteJobStore, QueueFull, public_view
+
+
+class BlockingGenerator:
+    """Generatore che resta bloccato finché il test non lo rilascia."""
+
+    def __init__(self, fail=False):
+        self.release = threading.Event()
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, payload, deadline=None):
+        self.calls.append((payload, deadline))
+        self.release.wait(5)
+        if self.fail:
+            raise RuntimeError("LLM giù")
+        return {"status": 1, "data": {"question": payload["category"]}}
+
+
+def test_submit_run_and_poll():
+    gen = BlockingGenerator()
+    q = JobQueue(gen, workers=1, max_depth=10)
+
+    job = q.submit({"category": "storia"})
+    assert job["status"] == "queued"
+    gen.release.set()
+    q.join()
+
+    done = q.get(job["id"])
+    assert done["status"] == "done"
+    assert public_view(done)["result"] == {"status": 1, "data": {"question": "storia"}}
+    assert "payload" not in public_view(done)
+    # il deadline parte all'esecuzione
+    assert gen.calls[0][1].remaining() > 0
+
+
+def test_failed_job_records_error():
+    gen = BlockingGenerator(fail=True)
+    gen.release.set()
+    q = JobQueue(gen, workers=1)
+
+    job = q.submit({"category": "storia"})
+    q.join()
+    view = public_view(q.get(job["id"]))
+    assert view["status"] == "failed"
+    assert "LLM giù" in view["error"]
+
+
+def test_queue_full_rejects_with_retry_after():
+    gen = BlockingGenerator()
+    q = JobQueue(gen, workers=1, max_depth=2)
+
+    q.submit({"category": "a"})
+    # il primo job viene preso dal worker, poi la coda si riempie
+    for _ in range(50):
+        if gen.calls:
+            break
+        threading.Event().wait(0.01)
+    q.submit({"category": "b"})
+    q.submit({"category": "c"})
+
+    rejected = jobs.JOB_EVENTS.value(event="rejected")
+    with pytest.raises(QueueFull) as exc:
+        q.submit({"category": "d"})
+    assert exc.value.retry_after >= 1
+    assert jobs.JOB_EVENTS.value(event="rejected") == rejected + 1
+
+    gen.release.set()
+    q.join()
+
+
+def test_queue_wait_metric():
+    gen = BlockingGenerator()
+    gen.release.set()
+    before = jobs.JOB_QUEUE_WAIT.snapshot()[0]
+
+    q = JobQueue(gen, workers=2)
+    for i in range(3):
+        q.submit({"category": str(i)})
+    q.join()
+    assert jobs.JOB_QUEUE_WAIT.snapshot()[0] == before + 3
+
+
+def test_watch_yields_each_state_change():
+    gen = BlockingGenerator()
+    q = JobQueue(gen, workers=1)
+    job = q.submit({"category": "storia"})
+
+    states = []
+    watcher = threading.Thread(target=lambda: states.extend(j and j["status"] for j in q.watch(job["id"], heartbeat=0.05)))
+    watcher.start()
+    threading.Event().wait(0.2)
+    gen.release.set()
+    watcher.join(5)
+
+    changes = [s for s in states if s is not None]
+    assert changes[0] in ("queued", "running")
+    assert changes[-1] == "done"
+    assert len(changes) == len(set(changes))  # solo cambi di stato, niente duplicati
+    assert None in states  # keep-alive durante l'attesa
+
+
+def test_finished_jobs_expire_from_memory():
+    clock = [1000.0]
+    store = JobStore(ttl=10, clock=lambda: clock[0])
+    store.put({"id": "a", "status": "done", "finished_at": 1000.0})
+    clock[0] = 1011.0
+    store.put({"id": "b", "status": "queued", "finished_at": None})
+    assert store.get("a") is None
+    assert store.get("b") is not None
+
+
+def test_sqlite_store_survives_restart_and_requeues(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    gen = BlockingGenerator()
+    gen.release.set()
+
+    store = SQLiteJobStore(path)
+    q = JobQueue(gen, workers=1, store=store)
+    done_id = q.submit({"category": "storia"})["id"]
+    q.join()
+    # job rimasto "running" in un processo interrotto
+    store.put({"id": "orfano", "status": "running", "payload": {"category": "geo"},
+               "created_at": store.clock(), "started_at": store.clock(), "finished_at": None})
+    store.close()
+
+    restarted = JobQueue(gen, workers=1, store=SQLiteJobStore(path))
+    restarted.join()
+    assert restarted.get(done_id)["status"] == "done"
+    orphan = restarted.get("orfano")
+    assert orphan["status"] == "done"
+    assert orphan["result"]["data"]["question"] == "geo"
+
+
+def test_sqlite_queue_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    gen = BlockingGenerator()
+    # due code sullo stesso file, come due worker gunicorn
+    first = JobQueue(gen, workers=1, store=SQLiteJobStore(path, poll_seconds=0.01))
+    second = JobQueue(gen, workers=1, store=SQLiteJobStore(path, poll_seconds=0.01))
+
+    job = first.submit({"category": "storia"})
+    for _ in range(200):
+        if gen.calls:
+            break
+        threading.Event().wait(0.01)
+    # il job in corso è visibile dall'altro processo e non viene ripreso da lui
+    assert second.get(job["id"])["status"] == "running"
+    threading.Event().wait(0.1)
+    assert len(gen.calls) == 1
+
+    gen.release.set()
+    second.join()
+    assert second.get(job["id"])["status"] == "done"
+    assert len(gen.calls) == 1
+    first.store.close()
+    second.store.close()
+
+
+def test_sqlite_queue_reclaims_expired_leases(tmp_path):
+    path = str(tmp_path / "jobs.db")
+    clock = [1000.0]
+    store = SQLiteJobStore(path, clock=lambda: clock[0], lease_seconds=60)
+    store.put({"id": "a", "status": "queued", "payload": {}, "created_at": 1000.0, "started_at": None, "finished_at": None})
+
+    assert store.claim("morto", timeout=0)["id"] == "a"
+    # lease ancora valido: nessun altro lo prende
+    assert store.claim("vivo", timeout=0) is None
+    clock[0] += 61
+    requeued = jobs.JOB_EVENTS.value(event="requeued")
+    assert store.claim("vivo", timeout=0)["id"] == "a"
+    assert jobs.JOB_EVENTS.value(event="requeued") == requeued + 1
+    store.close()
+
+
+def test_multiple_processes_use_shared_job_db(monkeypatch):
+    monkeypatch.setattr(jobs, "JOB_DB", "")
+    monkeypatch.setattr(jobs, "_processes", 1)
+    assert jobs.job_db() == ""
+    jobs.configure(2)
+    assert jobs.job_db() == jobs.SHARED_JOB_DB
+    monkeypatch.setattr(jobs, "JOB_DB", "/tmp/altro.sqlite")
+    assert jobs.job_db() == "/tmp/altro.sqlite"
@@ -0,0 +1,52 @@
+import json
+from pathlib import Path
+
+import pytest
+
+from src.services import json_repair
+from src.services.json_repair import JsonRepairError, parse_llm_json, repair_json
+
+# Corpus di output difettosi dei modelli, con l'oggetto atteso e lo stadio che lo recupera
+CORPUS = json.loads(
+    (Path(__file__).resolve().parents[1] / "examples" / "bad_llm_outputs.json").read_text(encoding="utf-8")
+)
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[c["name"] for c in CORPUS])
+def test_corpus(case):
+    if case["expected"] is None:
+        with pytest.raises(JsonRepairError):
+            repair_json(case["output"])
+        return
+    obj, stage = repair_json(case["output"])
+    assert obj == case["expected"]
+    assert stage == case["stage"]
+
+
+def test_apostrophes_inside_double_quoted_strings_untouched():
+    text = '{"question": "Qual è l\'animale più veloce?", "answer": "ghepardo",}'
+    obj, stage = repair_json(text)
+    assert obj["question"] == "Qual è l'animale più veloce?"
+    assert stage == "quotes_commas"
+
+
+def test_parse_llm_json_metrics():
+    repairs = json_repair.JSON_REPAIRS
+    before_trunc = repairs.value(stage="truncation")
+    before_none = repairs.value(stage="none")
+
+    assert parse_llm_json('{"a": 1}') == ({"a": 1}, "strict")
+    assert parse_llm_json('{"a": [1, 2')[1] == "truncation"
+    with pytest.raises(JsonRepairError):
+        parse_llm_json("niente")
+
+    assert repairs.value(stage="truncation") == before_trunc + 1
+    assert repairs.value(stage="none") == before_none + 1
+
+
+def test_record_saved_call_only_for_repaired_outputs():
+    saved = json_repair.LLM_CALLS_SAVED
+    before = saved.value(stage="extract")
+    json_repair.record_saved_call("strict")
+    json_repair.record_saved_call("extract")
+    assert saved.value(stage="extract") == before + 1
@@ -0,0 +1,121 @@
+import json
+import asyncio
+
+import pytest
+
+from src.services import json_stream
+from src.services.json_stream import JsonObjectScanner, JsonStreamError
+
+
+class FakeChunk:
+    def __init__(self, content):
+        self.content = content
+
+
+class FakeStreamingLLM:
+    """Provider finto: emette i token uno alla volta e conta quanti ne vengono letti."""
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.emitted = 0
+        self.closed = False
+
+    def stream(self, messages=None):
+        try:
+            for tok in self.tokens:
+                self.emitted += 1
+                yield FakeChunk(tok)
+        finally:
+            self.closed = True
+
+    async def astream(self, messages=None):
+        try:
+            for tok in self.tokens:
+                self.emitted += 1
+                yield FakeChunk(tok)
+        finally:
+            self.closed = True
+
+
+QUIZ_TOKENS = ['Ecco il quiz:\n', '{"type": "quiz", ', '"question": "Chi {era} Cesare?", ',
+               '"options": ["a", "b"]', ', "answer": "a"}', '\n\nSpero ', 'sia ', 'utile!']
+
+
+def test_scanner_returns_object_when_closed():
+    scanner = JsonObjectScanner()
+    out = None
+    for tok in QUIZ_TOKENS[:5]:
+        out = scanner.feed(tok)
+    assert out is not None
+    assert json.loads(out)["question"] == "Chi {era} Cesare?"
+
+
+def test_scanner_handles_escapes_and_nested():
+    scanner = JsonObjectScanner()
+    text = '{"a": "x \\" } y", "b": [{"c": []}]} coda'
+    assert json.loads(scanner.feed(text)) == {"a": 'x " } y', "b": [{"c": []}]}
+
+
+@pytest.mark.parametrize("text", [
+    '{"a": [1, 2}',          # parentesi non bilanciate
+    "x" * 600,               # troppa prosa senza oggetto
+])
+def test_scanner_aborts_on_hopeless_output(text):
+    with pytest.raises(JsonStreamError):
+        JsonObjectScanner().feed(text)
+
+
+def test_consume_stream_stops_early():
+    llm = FakeStreamingLLM(QUIZ_TOKENS)
+    text = json_stream.consume_stream(llm.stream())
+
+    assert json.loads(text)["answer"] == "a"
+    # i token dopo la chiusura dell'oggetto non vengono letti
+    assert llm.emitted == 5
+    assert llm.closed
+
+
+def test_consume_stream_aborts_and_closes():
+    llm = FakeStreamingLLM(['{"a": ', "]", '"mai letto"', "}"])
+    before = json_stream.STREAM_OUTCOMES.value(outcome="aborted")
+
+    text = json_stream.consume_stream(llm.stream())
+
+    # il pezzo che ha causato l'abort resta nel testo
+    assert text == '{"a": ]'
+    assert llm.emitted == 2
+    assert llm.closed
+    assert json_stream.STREAM_OUTCOMES.value(outcome="aborted") == before + 1
+
+
+def test_consume_stream_exhausted_returns_partial():
+    llm = FakeStreamingLLM(['{"a": ', '"b"'])
+    assert json_stream.consume_stream(llm.stream()) == '{"a": "b"'
+
+
+def test_aconsume_stream_stops_early():
+    llm = FakeStreamingLLM(QUIZ_TOKENS)
+    text = asyncio.run(json_stream.aconsume_stream(llm.astream()))
+    assert json.loads(text)["type"] == "quiz"
+    assert llm.emitted == 5
+    assert llm.closed
+
+
+PYTHON_DICT_TOKENS = ["Ecco:\n", "{'type': 'quiz', ", "'question': 'Chi {era} Cesare?', ",
+                      "'options': ['a', 'b'], 'answer': 'a',", "}\n", "Fine."]
+
+
+def test_consume_stream_single_quotes_keeps_full_text_for_repair():
+    from services.json_repair import repair_json
+
+    llm = FakeStreamingLLM(PYTHON_DICT_TOKENS)
+    text = json_stream.consume_stream(llm.stream())
+
+    # niente stop anticipato: si legge tutto e json_repair recupera il dict
+    assert llm.emitted == len(PYTHON_DICT_TOKENS)
+    obj, stage = repair_json(text)
+    assert stage == "quotes_commas"
+    assert obj == {"type": "quiz", "question": "Chi {era} Cesare?", "options": ["a", "b"], "answer": "a"}
+
+    atext = asyncio.run(json_stream.aconsume_stream(FakeStreamingLLM(PYTHON_DICT_TOKENS).astream()))
+    assert atext == text
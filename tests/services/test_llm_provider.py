@@ -42,3 +42,165 @@ def test_get_llm_invalid_provider():
     with pytest.raises(ValueError) as excinfo:
         llm_provider.get_llm("openai")
     assert "Unknown LLM provider" in str(excinfo.value)
+
+
+# ----------------- Registry + pool HTTP -----------------
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class _StubLLMServer:
+    """Server HTTP/1.1 locale che risponde come Groq (OpenAI-like) e Anthropic."""
+
+    def __init__(self):
+        self.connections = []
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                stub.connections.append(self.client_address)
+                if self.path.endswith("/v1/messages"):
+                    out = {
+                        "id": "msg", "type": "message", "role": "assistant", "model": "stub",
+                        "content": [{"type": "text", "text": "{}"}],
+                        "stop_reason": "end_turn", "stop_sequence": None,
+                        "usage": {"input_tokens": 1, "output_tokens": 1},
+                    }
+                else:
+                    out = {
+                        "id": "cmpl", "object": "chat.completion", "created": 0, "model": "stub",
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": "{}"}, "finish_reason": "stop"}],
+                        "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+                    }
+                body = json.dumps(out).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub_server():
+    # altri moduli di test possono sostituire langchain_groq con uno stub senza HTTP
+    if not hasattr(llm_provider.ChatGroq, "__fields__"):
+        pytest.skip("langchain_groq reale non disponibile")
+    server = _StubLLMServer()
+    yield server
+    server.close()
+
+
+def test_registry_reuses_client_instance(monkeypatch):
+    monkeypatch.setattr(llm_provider, "get_llm", lambda provider, **kw: object())
+    registry = llm_provider.LLMRegistry()
+
+    assert registry.get("x") is registry.get("x")
+    assert registry.get("x") is not registry.get("y")
+
+
+def test_registry_keeps_one_client_per_event_loop(monkeypatch):
+    import asyncio
+
+    monkeypatch.setattr(llm_provider, "get_llm", lambda provider, **kw: object())
+    registry = llm_provider.LLMRegistry()
+
+    async def get():
+        return registry.get("x"), registry.get("x")
+
+    outside = registry.get("x")
+    first, again = asyncio.run(get())
+    second, _ = asyncio.run(get())
+    # il pool async di un client non passa da un event loop all'altro
+    assert first is again
+    assert len({id(outside), id(first), id(second)}) == 3
+    assert registry.get("x") is outside
+
+
+def test_registry_close_closes_async_pools_on_their_loop(monkeypatch):
+    import asyncio
+    import threading
+
+    monkeypatch.setattr(llm_provider, "get_llm", lambda provider, **kw: kw)
+    registry = llm_provider.LLMRegistry()
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    async def get():
+        return registry.get("groq")
+
+    sync_clients = registry.get("groq")
+    loop_clients = asyncio.run_coroutine_threadsafe(get(), loop).result(5)
+    registry.close()
+
+    assert sync_clients["http_client"].is_closed
+    assert sync_clients["http_async_client"].is_closed
+    assert loop_clients["http_async_client"].is_closed
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join(5)
+    loop.close()
+
+
+def test_registry_does_not_cache_failed_init():
+    registry = llm_provider.LLMRegistry()
+    with pytest.raises(ValueError):
+        registry.get("openai")
+    assert "openai" not in registry._clients
+
+
+@pytest.mark.parametrize("provider, env_var", [("groq", "GROQ_BASE_URL"), ("claude", "ANTHROPIC_BASE_URL")])
+def test_registry_keeps_connections_alive(stub_server, monkeypatch, provider, env_var):
+    monkeypatch.setenv("GROQ_API_KEY", "fake-groq")
+    monkeypatch.setenv("ANTHROPIC_API_KEY", "fake-anthropic")
+    monkeypatch.setenv(env_var, stub_server.url)
+
+    registry = llm_provider.LLMRegistry(pool_size=4, timeout=5, max_retries=0)
+    try:
+        for _ in range(5):
+            llm = registry.get(provider)
+            assert llm.invoke("ciao").content == "{}"
+    finally:
+        registry.close()
+
+    # 5 richieste, un solo client, una sola connessione TCP
+    assert len(stub_server.connections) == 5
+    assert len(set(stub_server.connections)) == 1
+
+
+def test_fresh_clients_open_new_connections(stub_server, monkeypatch):
+    monkeypatch.setenv("GROQ_API_KEY", "fake-groq")
+    monkeypatch.setenv("GROQ_BASE_URL", stub_server.url)
+
+    # confronto: un client nuovo per richiesta (comportamento precedente)
+    for _ in range(3):
+        llm_provider.get_llm("groq", max_retries=0).invoke("ciao")
+
+    assert len(set(stub_server.connections)) == 3
+
+
+def test_get_shared_llm_wraps_with_rate_limiter(monkeypatch):
+    client = object()
+    monkeypatch.setattr(llm_provider.registry, "get", lambda provider: client)
+
+    assert llm_provider.get_shared_llm("groq") is client
+
+    monkeypatch.setattr(llm_provider, "RATE_LIMIT_ENABLED", True)
+    llm = llm_provider.get_shared_llm("groq")
+    assert type(llm).__name__ == "LimitedLLM"
+    assert llm.llm is client
+    assert llm.limiter is llm_provider.get_shared_llm("groq").limiter  # un limiter per provider
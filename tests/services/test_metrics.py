@@ -0,0 +1,69 @@
+import logging
+
+import pytest
+
+from src.services import metrics
+from src.services import log
+
+
+def test_histogram_render_prometheus_format():
+    h = metrics.Histogram("t_latency_seconds", "test", labelnames=("stage",), buckets=(0.1, 1.0))
+    h.observe(0.05, stage="a")
+    h.observe(0.5, stage="a")
+    h.observe(5.0, stage="a")
+
+    text = "\n".join(h.render())
+    assert "# TYPE t_latency_seconds histogram" in text
+    assert 't_latency_seconds_bucket{stage="a",le="0.1"} 1' in text
+    assert 't_latency_seconds_bucket{stage="a",le="1"} 2' in text
+    assert 't_latency_seconds_bucket{stage="a",le="+Inf"} 3' in text
+    assert 't_latency_seconds_count{stage="a"} 3' in text
+    assert h.snapshot(stage="a")[0] == 3
+    assert h.quantile(0.5, stage="a") == 1.0
+    assert h.quantile(0.5, stage="b") is None
+
+
+def test_counter_and_wrong_labels():
+    c = metrics.Counter("t_total", "test", labelnames=("status",))
+    c.inc(status="1")
+    c.inc(2, status="1")
+    assert c.value(status="1") == 3
+    assert 't_total{status="1"} 3' in c.render()
+
+    with pytest.raises(ValueError):
+        c.inc(code="1")
+
+
+def test_span_and_record_status():
+    metrics.REGISTRY.clear()
+
+    with metrics.span("llm_call"):
+        pass
+    metrics.record_status(3, 0.2)
+
+    assert metrics.STAGE_LATENCY.snapshot(stage="llm_call")[0] == 1
+    assert metrics.QUIZ_STATUS.value(status="3") == 1
+
+    text = metrics.render_prometheus()
+    assert 'sage_stage_duration_seconds_count{stage="llm_call"} 1' in text
+    assert 'sage_quiz_status_total{status="3"} 1' in text
+
+
+def test_span_records_on_exception():
+    metrics.REGISTRY.clear()
+    with pytest.raises(RuntimeError):
+        with metrics.span("chroma_query"):
+            raise RuntimeError("boom")
+    assert metrics.STAGE_LATENCY.snapshot(stage="chroma_query")[0] == 1
+
+
+def test_log_sampled_respects_level_and_rate(caplog):
+    logger = log.get_logger("test")
+
+    with caplog.at_level(logging.INFO, logger="sage.test"):
+        log.log_sampled(logger, logging.DEBUG, "debug disattivato", rate=1.0)
+        log.log_sampled(logger, logging.INFO, "mai", rate=0.0)
+        log.log_sampled(logger, logging.INFO, "sempre", rate=1.0)
+
+    messages = [r.getMessage() for r in caplog.records]
+    assert messages == ["sempre"]
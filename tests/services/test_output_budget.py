@@ -0,0 +1,79 @@
+import types
+
+from src.services import output_budget
+from src.services.output_budget import (
+    OUTPUT_BUDGETS, BUDGET_STEP, MAX_OUTPUT_TOKENS,
+    estimate_schema_tokens, output_budget as budget_for, generation_kwargs, response_usage, record_output,
+)
+
+
+def test_budgets_derived_from_every_schema():
+    assert set(OUTPUT_BUDGETS) == {"quiz", "matching", "memory", "sorting"}
+    for budget in OUTPUT_BUDGETS.values():
+        assert budget % BUDGET_STEP == 0
+        assert 0 < budget <= MAX_OUTPUT_TOKENS
+    # le coppie pesano più di una domanda a scelta multipla
+    assert OUTPUT_BUDGETS["quiz"] < OUTPUT_BUDGETS["matching"]
+
+
+def test_estimate_respects_array_bounds():
+    strings = {"type": "array", "items": {"type": "string"}}
+    typical = estimate_schema_tokens(strings)
+    assert estimate_schema_tokens(dict(strings, maxItems=2)) < typical
+    assert estimate_schema_tokens(dict(strings, minItems=20)) > typical
+    assert estimate_schema_tokens({"type": "string"}, "question") > estimate_schema_tokens({"type": "string"}, "answer")
+
+
+def test_batch_budget_is_sum_and_capped():
+    single = budget_for(["quiz"])
+    assert budget_for(["quiz", "quiz"]) == 2 * single + output_budget.BATCH_OVERHEAD_TOKENS
+    assert budget_for(["matching"] * 20) == MAX_OUTPUT_TOKENS
+
+
+def test_max_size_batch_of_largest_type_fits():
+    largest = max(OUTPUT_BUDGETS, key=OUTPUT_BUDGETS.get)
+    batch = [largest] * output_budget.MAX_BATCH_SIZE
+    total = output_budget.BATCH_OVERHEAD_TOKENS + sum(OUTPUT_BUDGETS[t] for t in batch)
+    # nessun batch ammesso viene tagliato dal tetto di output
+    assert total <= MAX_OUTPUT_TOKENS
+    assert budget_for(batch) == total
+    assert total + OUTPUT_BUDGETS[largest] > MAX_OUTPUT_TOKENS
+
+
+def test_generation_kwargs_json_mode_only_where_supported():
+    groq = generation_kwargs("groq", ["quiz"])
+    assert groq == {"max_tokens": OUTPUT_BUDGETS["quiz"], "response_format": {"type": "json_object"}}
+    # JSON mode di Groq non è disponibile in streaming
+    assert "response_format" not in generation_kwargs("groq", ["quiz"], stream=True)
+    assert generation_kwargs("claude", ["sorting"]) == {"max_tokens": OUTPUT_BUDGETS["sorting"]}
+
+
+def test_response_usage_reads_provider_metadata():
+    groq = types.SimpleNamespace(
+        content="{}", response_metadata={"token_usage": {"completion_tokens": 42}, "finish_reason": "length"},
+    )
+    assert response_usage(groq) == (42, True)
+
+    claude = types.SimpleNamespace(
+        content="{}", usage_metadata={"output_tokens": 17}, response_metadata={"stop_reason": "end_turn"},
+    )
+    assert response_usage(claude) == (17, False)
+
+    bare = types.SimpleNamespace(content="x" * 40)
+    assert response_usage(bare) == (10, False)
+
+
+def test_record_output_metrics():
+    outputs = output_budget.LLM_OUTPUTS
+    before_ok = outputs.value(type="quiz", provider="groq", outcome="ok")
+    before_parse = outputs.value(type="quiz", provider="groq", outcome="parse_error")
+    before_trunc = outputs.value(type="quiz", provider="groq", outcome="truncated")
+
+    record_output("quiz", "groq", 1, output_tokens=120)
+    record_output("quiz", "groq", 3, output_tokens=320, truncated=True)
+    record_output("quiz", "groq", 2)  # nessuna chiamata LLM: ignorato
+
+    assert outputs.value(type="quiz", provider="groq", outcome="ok") == before_ok + 1
+    assert outputs.value(type="quiz", provider="groq", outcome="parse_error") == before_parse + 1
+    assert outputs.value(type="quiz", provider="groq", outcome="truncated") == before_trunc + 1
+    assert any(line.startswith("sage_llm_output_tokens_bucket") for line in output_budget.OUTPUT_TOKENS.render())
@@ -51,3 +51,48 @@ def test_build_prompt_difficulty_edge_cases():
 
     assert "1" in prompt_low
     assert "10" in prompt_high
+
+
+def test_build_batch_prompt_lists_types_and_schemas():
+    from src.services.prompt_builder import build_batch_prompt
+
+    prompt = build_batch_prompt(["quiz", "sorting", "quiz"], "storia", 4)
+
+    assert "Generate 3 different Italian quizzes" in prompt
+    assert "1. 'quiz', 2. 'sorting', 3. 'quiz'" in prompt
+    assert '"type": "quiz"' in prompt
+    assert '"type": "sorting"' in prompt
+    # solo gli schemi dei tipi richiesti
+    assert '"type": "matching"' not in prompt
+    assert '{"quizzes": [...]}' in prompt
+    assert "ITALIANO" in prompt
+
+
+def test_prompt_templates_only_include_their_schema():
+    from src.services.prompt_builder import PROMPT_TEMPLATES, get_prompt_template
+
+    assert set(PROMPT_TEMPLATES) == {"quiz", "matching", "memory", "sorting"}
+    template = get_prompt_template("sorting")
+    assert '"type": "sorting"' in template.prefix
+    assert '"type": "quiz"' not in template.prefix
+    assert "Difficulty 7-10" in template.prefix
+    assert get_prompt_template("essay") is None
+
+
+def test_prompt_template_prefix_is_static():
+    from src.services.prompt_builder import get_prompt_template
+
+    template = get_prompt_template("quiz")
+    # categoria e difficoltà solo nella parte variabile
+    assert "geografia" not in template.prefix
+    rendered = template.render("geografia", 7)
+    assert "geografia" in rendered and "7" in rendered
+    assert template.render("storia", 1) != rendered
+
+
+def test_template_token_report():
+    from src.services.prompt_builder import template_token_report
+
+    report = template_token_report()
+    for row in report.values():
+        assert 0 < row["variable_tokens"] < row["prefix_tokens"] < row["monolithic_tokens"]
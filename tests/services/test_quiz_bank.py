@@ -0,0 +1,199 @@
+import threading
+
+from src.services import quiz_bank
+
+
+def make_request(difficulty=5):
+    return {
+        "type": "quiz",
+        "category": "storia",
+        "classe": "prim",
+        "anno": 3,
+        "difficulty": difficulty,
+        "llmProvider": "groq",
+    }
+
+
+class FakeGenerator:
+    def __init__(self, status=1):
+        self.status = status
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, data):
+        with self._lock:
+            self.calls.append(data)
+            n = len(self.calls)
+        if self.status != 1:
+            return {"status": self.status, "data": {}}
+        return {"status": 1, "data": {"type": data["type"], "question": f"Q{n}"}}
+
+
+COMBOS = [("storia", "prim", 3)]
+
+
+def make_bank(gen, **kwargs):
+    kwargs.setdefault("index_version", Version())
+    kwargs.setdefault("providers", ("groq",))
+    kwargs.setdefault("watch_seconds", 0)
+    return quiz_bank.QuizBank(gen, combos=lambda: COMBOS, **kwargs)
+
+
+class Version:
+    def __init__(self, value="v1"):
+        self.value = value
+
+    def __call__(self):
+        return self.value
+
+
+def test_take_miss_then_refill_and_hit():
+    gen = FakeGenerator()
+    bank = make_bank(gen, target_stock=2, workers=1)
+
+    assert bank.take(make_request()) is None
+    bank.join()
+    key = quiz_bank.bank_key(make_request())
+    assert bank.stock(key) == 2
+
+    result = bank.take(make_request())
+    assert result["status"] == 1
+    assert result["data"]["question"].startswith("Q")
+
+    # dopo il take lo stock torna all'obiettivo
+    bank.join()
+    assert bank.stock(key) == 2
+    assert len(gen.calls) == 3
+    assert gen.calls[0]["llmProvider"] == "groq"
+
+
+def test_reembed_evicts_stale_entries():
+    version = Version("v1")
+    bank = make_bank(FakeGenerator(), target_stock=1, workers=1, index_version=version)
+    bank.warm([quiz_bank.bank_key(make_request())])
+    bank.join()
+
+    version.value = "v2"
+    # la voce generata su v1 non viene servita
+    assert bank.take(make_request()) is None
+    bank.join()
+    assert bank.take(make_request())["status"] == 1
+
+
+def test_evict_stale_clears_old_versions():
+    version = Version("v1")
+    bank = make_bank(FakeGenerator(), target_stock=2, workers=1, index_version=version)
+    key = quiz_bank.bank_key(make_request())
+    bank.warm([key])
+    bank.join()
+
+    version.value = "v2"
+    bank.evict_stale()
+    assert bank.stock(key) == 0
+
+
+def test_failing_generation_does_not_loop():
+    gen = FakeGenerator(status=2)
+    bank = make_bank(gen, target_stock=3, workers=1)
+
+    for _ in range(quiz_bank.MAX_FAILURES + 2):
+        assert bank.take(make_request()) is None
+        bank.join()
+
+    assert len(gen.calls) == quiz_bank.MAX_FAILURES
+
+
+def test_all_keys_covers_types_and_difficulties():
+    keys = quiz_bank.all_keys([("storia", "prim", 3), ("geografia", "sec1", 1)], providers=("groq", "claude"))
+    assert len(keys) == 2 * 4 * 10 * 2
+    assert ("sorting", "geografia", "sec1", 1, 10, "claude") in keys
+
+
+def test_bank_key_includes_provider():
+    gen = FakeGenerator()
+    bank = make_bank(gen, target_stock=1, workers=1, providers=("groq", "claude"))
+    claude = {**make_request(), "llmProvider": "claude"}
+    bank.warm([quiz_bank.bank_key(make_request())])
+    bank.join()
+
+    # lo stock generato con groq non serve le richieste per claude
+    assert bank.take(claude) is None
+    bank.join()
+    assert [c["llmProvider"] for c in gen.calls] == ["groq", "claude"]
+    assert bank.take(claude)["status"] == 1
+
+
+def test_unknown_keys_are_not_stocked():
+    gen = FakeGenerator()
+    bank = make_bank(gen, target_stock=1, workers=1)
+    unknown = [
+        {**make_request(), "category": "inventata"},
+        {**make_request(), "llmProvider": "claude"},
+        {**make_request(), "difficulty": 99},
+    ]
+    for data in unknown:
+        assert bank.take(data) is None
+    bank.join()
+
+    assert gen.calls == []
+    assert bank._stock == {} and bank._failures == {}
+
+
+def test_get_or_generate_falls_back_to_live(monkeypatch):
+    gen = FakeGenerator()
+    bank = make_bank(gen, target_stock=1, workers=1)
+    monkeypatch.setattr(quiz_bank, "_bank", bank)
+
+    result = quiz_bank.get_or_generate(make_request(), gen)
+    assert result["status"] == 1
+    bank.join()
+
+    # la seconda richiesta arriva dallo stock
+    hits = quiz_bank.BANK_REQUESTS.value(result="hit")
+    assert quiz_bank.get_or_generate(make_request(), gen)["status"] == 1
+    assert quiz_bank.BANK_REQUESTS.value(result="hit") == hits + 1
+
+
+def test_unhashable_values_are_a_miss():
+    gen = FakeGenerator()
+    bank = make_bank(gen, target_stock=1, workers=1)
+    assert bank.take({**make_request(), "category": ["storia"]}) is None
+    bank.join()
+    assert gen.calls == []
+
+
+def test_get_bank_warms_all_keys(monkeypatch):
+    gen = FakeGenerator()
+    bank_class = quiz_bank.QuizBank
+    monkeypatch.setattr(quiz_bank, "_bank", None)
+    monkeypatch.setattr(
+        quiz_bank, "QuizBank",
+        lambda generate: bank_class(
+            generate, target_stock=1, workers=2, index_version=Version(),
+            providers=("groq",), combos=lambda: COMBOS, watch_seconds=0,
+        ),
+    )
+
+    bank = quiz_bank.get_bank(gen)
+    bank.join()
+    # ogni chiave ha già lo stock prima della prima richiesta
+    keys = quiz_bank.all_keys(COMBOS, providers=("groq",))
+    assert all(bank.stock(key) == 1 for key in keys)
+    assert bank.take(make_request())["status"] == 1
+
+
+def test_new_index_version_evicts_and_rewarms():
+    version = Version("v1")
+    gen = FakeGenerator()
+    bank = make_bank(gen, target_stock=1, workers=2, index_version=version)
+    bank.warm_all()
+    bank.join()
+    assert not bank.check_index()
+    calls = len(gen.calls)
+
+    version.value = "v2"
+    assert bank.check_index()
+    bank.join()
+    keys = quiz_bank.all_keys(COMBOS, providers=("groq",))
+    assert len(gen.calls) == calls + len(keys)
+    assert all(bank.stock(key) == 1 for key in keys)
@@ -1,3 +1,4 @@
+import json
 import pytest
 from src.services import quiz_generator
 
@@ -32,7 +33,7 @@ def test_missing_fields_returns_status_4():
 def test_llm_init_failure(monkeypatch):
     data = make_base_data()
 
-    monkeypatch.setattr(quiz_generator, "get_llm", lambda provider: (_ for _ in ()).throw(Exception("fail")))
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: (_ for _ in ()).throw(Exception("fail")))
     result = quiz_generator.generate_quiz_from_data(data)
 
     assert result["status"] == 4
@@ -42,7 +43,7 @@ def test_llm_init_failure(monkeypatch):
 def test_no_sources_found(monkeypatch):
     data = make_base_data()
 
-    monkeypatch.setattr(quiz_generator, "get_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
     monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": "{}", "source_documents": []}))
     monkeypatch.setattr(quiz_generator, "build_prompt", lambda *_: "prompt")
 
@@ -54,7 +55,7 @@ def test_no_sources_found(monkeypatch):
 def test_invalid_json_response(monkeypatch):
     data = make_base_data()
 
-    monkeypatch.setattr(quiz_generator, "get_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
     monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": "niente json", "source_documents": ["doc"]}))
     monkeypatch.setattr(quiz_generator, "build_prompt", lambda *_: "prompt")
 
@@ -66,7 +67,7 @@ def test_invalid_json_response(monkeypatch):
 def test_schema_validation_failure(monkeypatch):
     data = make_base_data()
 
-    monkeypatch.setattr(quiz_generator, "get_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
     monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": '{"type": "quiz", "category": "wrong"}', "source_documents": ["doc"]}))
     monkeypatch.setattr(quiz_generator, "build_prompt", lambda *_: "prompt")
     monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda _: (False, "schema error"))
@@ -81,7 +82,7 @@ def test_successful_quiz(monkeypatch):
 
     json_response = '{"type": "quiz", "category": "whatever", "question": "Q?", "difficulty": 5, "options": ["a","b"], "answer": "a"}'
 
-    monkeypatch.setattr(quiz_generator, "get_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
     monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": json_response, "source_documents": ["doc"]}))
     monkeypatch.setattr(quiz_generator, "build_prompt", lambda *_: "prompt")
     monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda _: (True, None))
@@ -92,3 +93,236 @@ def test_successful_quiz(monkeypatch):
     assert result["data"]["type"] == "quiz"
     assert result["data"]["category"] == data["category"]  # viene forzata
     assert "question" in result["data"]
+
+
+def test_status_is_counted_in_metrics(monkeypatch):
+    data = make_base_data()
+    data["category"] = ""
+
+    quiz_metrics = quiz_generator.record_status.__globals__["QUIZ_STATUS"]
+    before = quiz_metrics.value(status="4")
+    quiz_generator.generate_quiz_from_data(data)
+    assert quiz_metrics.value(status="4") == before + 1
+
+
+class DummyAsyncRagChain:
+    def __init__(self, response):
+        self._response = response
+
+    async def ainvoke(self, _):
+        return self._response
+
+
+def test_async_successful_quiz(monkeypatch):
+    import asyncio
+
+    data = make_base_data()
+    json_response = '{"type": "quiz", "category": "x", "question": "Q?", "difficulty": 5, "options": ["a","b"], "answer": "a"}'
+
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyAsyncRagChain({"result": json_response, "source_documents": ["doc"]}))
+    monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda _: (True, None))
+
+    result = asyncio.run(quiz_generator.agenerate_quiz_from_data(data))
+    assert result["status"] == 1
+    assert result["data"]["category"] == data["category"]
+
+
+def test_async_missing_fields_returns_status_4():
+    import asyncio
+
+    data = make_base_data()
+    data["llmProvider"] = None
+    result = asyncio.run(quiz_generator.agenerate_quiz_from_data(data))
+    assert result == {"status": 4, "data": {}}
+
+
+class RecordingRagChain(DummyRagChain):
+    def __init__(self, response):
+        super().__init__(response)
+        self.inputs = []
+
+    def invoke(self, input_dict):
+        self.inputs.append(input_dict)
+        return self._response
+
+
+def make_batch_data(**extra):
+    data = make_base_data()
+    del data["type"]
+    data.update(extra)
+    return data
+
+
+def test_batch_partial_success_single_retrieval(monkeypatch):
+    items = [
+        {"type": "quiz", "question": "Q1", "difficulty": 5, "options": ["a", "b"], "answer": "a"},
+        {"type": "sorting", "question": "Q2"},
+        {"type": "quiz", "question": "Q3", "difficulty": 5, "options": ["a", "b"], "answer": "b"},
+    ]
+    chain = RecordingRagChain({"result": 'Ecco: {"quizzes": %s}' % json.dumps(items), "source_documents": ["doc"]})
+
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: chain)
+    monkeypatch.setattr(
+        quiz_generator, "validate_quiz_data",
+        lambda q: (True, None) if "options" in q else (False, "'items' is a required property"),
+    )
+
+    result = quiz_generator.generate_quiz_batch(make_batch_data(types=["quiz", "sorting", "quiz", "memory"]))
+
+    assert result["status"] == 1
+    assert [q["question"] for q in result["data"]] == ["Q1", "Q3"]
+    assert all(q["category"] == "matematica" for q in result["data"])
+    assert [e["index"] for e in result["errors"]] == [1, 3]
+
+    # un solo retrieval/contesto per tutto il batch
+    assert len(chain.inputs) == 1
+    assert "Generate 4 different Italian quizzes" in chain.inputs[0]["question"]
+    assert chain.inputs[0]["query"] != chain.inputs[0]["question"]
+
+
+def test_batch_rejects_items_with_the_wrong_type(monkeypatch):
+    items = [
+        {"type": "memory", "question": "Q1", "options": ["a"]},
+        {"type": "quiz", "question": "Q2", "options": ["a"]},
+    ]
+    chain = RecordingRagChain({"result": json.dumps({"quizzes": items}), "source_documents": ["doc"]})
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: chain)
+    monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda q: (True, None))
+
+    # ordine scambiato dal modello: quiz validi, ma non nella posizione richiesta
+    result = quiz_generator.generate_quiz_batch(make_batch_data(types=["quiz", "quiz"]))
+    assert [q["question"] for q in result["data"]] == ["Q2"]
+    assert result["errors"] == [{"index": 0, "error": "Expected type quiz, got memory"}]
+
+
+def test_batch_type_and_count(monkeypatch):
+    chain = RecordingRagChain({"result": '{"quizzes": []}', "source_documents": ["doc"]})
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: chain)
+
+    result = quiz_generator.generate_quiz_batch(make_batch_data(type="memory", count=3))
+
+    assert result["status"] == 4
+    assert len(result["errors"]) == 3
+    assert "1. 'memory', 2. 'memory', 3. 'memory'" in chain.inputs[0]["question"]
+
+
+@pytest.mark.parametrize("extra", [
+    {"types": []},
+    {"types": ["quiz"] * 21},
+    {"type": "matching", "count": quiz_generator.MAX_BATCH_SIZE + 1},
+    {"types": ["essay"]},
+    {"type": "quiz", "count": "tanti"},
+])
+def test_batch_invalid_requests(extra):
+    result = quiz_generator.generate_quiz_batch(make_batch_data(**extra))
+    assert result == {"status": 4, "data": [], "errors": []}
+
+
+def test_batch_no_sources_and_parse_error(monkeypatch):
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": "{}", "source_documents": []}))
+    assert quiz_generator.generate_quiz_batch(make_batch_data(types=["quiz"]))["status"] == 2
+
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": '{"quizzes": 3}', "source_documents": ["d"]}))
+    assert quiz_generator.generate_quiz_batch(make_batch_data(types=["quiz"]))["status"] == 3
+
+
+def test_typed_template_passed_to_chain(monkeypatch):
+    chain = RecordingRagChain({"result": "{}", "source_documents": []})
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: chain)
+
+    data = make_base_data()
+    data["type"] = "memory"
+    data["llmProvider"] = "claude"
+    quiz_generator.generate_quiz_from_data(data)
+
+    rag_input = chain.inputs[0]
+    # retrieval con il prompt monolitico, LLM con il template del solo tipo
+    assert '"type": "sorting"' in rag_input["query"]
+    assert '"type": "memory"' in rag_input["prompt_prefix"]
+    assert '"type": "sorting"' not in rag_input["prompt_prefix"]
+    assert "matematica" in rag_input["question"]
+    assert rag_input["cache_prefix"] is True
+
+
+class DeadlineRagChain:
+    """Chain che esaurisce il budget della richiesta."""
+
+    def __init__(self):
+        self.inputs = []
+
+    def invoke(self, input_dict):
+        self.inputs.append(input_dict)
+        raise quiz_generator.DeadlineExceeded("llm_call")
+
+    async def ainvoke(self, input_dict):
+        return self.invoke(input_dict)
+
+
+def test_deadline_exceeded_returns_status_5(monkeypatch):
+    import asyncio
+
+    chain = DeadlineRagChain()
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: chain)
+    deadline = object()
+
+    assert quiz_generator.generate_quiz_from_data(make_base_data(), deadline=deadline) == {"status": 5, "data": {}}
+    assert chain.inputs[0]["deadline"] is deadline
+
+    result = asyncio.run(quiz_generator.agenerate_quiz_from_data(make_base_data(), deadline=deadline))
+    assert result == {"status": 5, "data": {}}
+
+    result = quiz_generator.generate_quiz_batch(make_batch_data(types=["quiz"]), deadline=deadline)
+    assert result == {"status": 5, "data": [], "errors": []}
+
+
+def test_output_budget_and_metrics(monkeypatch):
+    json_response = '{"type": "quiz", "question": "Q?", "difficulty": 5, "options": ["a","b"], "answer": "a"}'
+    chain = RecordingRagChain({"result": json_response, "source_documents": ["doc"], "output_tokens": 60})
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: chain)
+    monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda _: (True, None))
+
+    outputs = quiz_generator.record_output.__globals__["LLM_OUTPUTS"]
+    budgets = quiz_generator.generation_kwargs.__globals__["OUTPUT_BUDGETS"]
+    before = outputs.value(type="quiz", provider="groq", outcome="ok")
+
+    assert quiz_generator.generate_quiz_from_data(make_base_data())["status"] == 1
+    llm_kwargs = chain.inputs[0]["llm_kwargs"]
+    assert llm_kwargs["max_tokens"] == budgets["quiz"]
+    assert llm_kwargs["response_format"] == {"type": "json_object"}
+    assert outputs.value(type="quiz", provider="groq", outcome="ok") == before + 1
+
+    quiz_generator.generate_quiz_batch(make_batch_data(types=["quiz", "sorting"]))
+    assert chain.inputs[1]["llm_kwargs"]["max_tokens"] > budgets["quiz"] + budgets["sorting"]
+
+
+def test_repaired_output_avoids_status_3(monkeypatch):
+    truncated = "{'type': 'quiz', 'question': 'Q?', 'difficulty': 5, 'options': ['a', 'b'], 'answer': 'a',"
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": truncated, "source_documents": ["doc"]}))
+    monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda _: (True, None))
+
+    saved = quiz_generator.record_saved_call.__globals__["LLM_CALLS_SAVED"]
+    before = saved.value(stage="truncation")
+
+    result = quiz_generator.generate_quiz_from_data(make_base_data())
+    assert result["status"] == 1
+    assert result["data"]["options"] == ["a", "b"]
+    assert saved.value(stage="truncation") == before + 1
+
+
+def test_repaired_output_failing_schema_is_parse_error(monkeypatch):
+    # la riparazione ha prodotto un oggetto, ma non è un quiz: resta ritentabile (3), non 4
+    monkeypatch.setattr(quiz_generator, "get_shared_llm", lambda provider: object())
+    monkeypatch.setattr(quiz_generator, "build_rag_chain", lambda llm: DummyRagChain({"result": "Ecco: {'nota': 'nessun quiz'", "source_documents": ["doc"]}))
+    monkeypatch.setattr(quiz_generator, "validate_quiz_data", lambda _: (False, "schema error"))
+
+    assert quiz_generator.generate_quiz_from_data(make_base_data())["status"] == 3
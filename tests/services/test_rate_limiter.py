@@ -0,0 +1,278 @@
+import types
+import asyncio
+import threading
+import time
+
+import pytest
+
+from src.services import rate_limiter
+from src.services.rate_limiter import (
+    AIMDLimit,
+    LimitedLLM,
+    ProviderLimiter,
+    RateLimited,
+    TokenBucket,
+)
+from services.metrics import render_prometheus  # stesso registry usato da rate_limiter
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class StubRateLimitError(Exception):
+    """Come groq/anthropic RateLimitError: status_code + response con gli header."""
+
+    def __init__(self, retry_after=None):
+        super().__init__("429 Too Many Requests")
+        self.status_code = 429
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = types.SimpleNamespace(status_code=429, headers=headers)
+
+
+class RateLimitingStub:
+    """Provider locale: oltre `max_concurrent` chiamate contemporanee risponde 429."""
+
+    def __init__(self, max_concurrent, latency=0.02):
+        self.max_concurrent = max_concurrent
+        self.latency = latency
+        self.in_flight = 0
+        self.peak = 0
+        self.throttled = 0
+        self.served = 0
+        self._lock = threading.Lock()
+
+    def _enter(self):
+        with self._lock:
+            if self.in_flight >= self.max_concurrent:
+                self.throttled += 1
+                raise StubRateLimitError()
+            self.in_flight += 1
+            self.peak = max(self.peak, self.in_flight)
+
+    def _exit(self):
+        with self._lock:
+            self.in_flight -= 1
+            self.served += 1
+
+    def invoke(self, messages, **kwargs):
+        self._enter()
+        try:
+            time.sleep(self.latency)
+            return types.SimpleNamespace(content='{"ok":true}')
+        finally:
+            self._exit()
+
+    async def ainvoke(self, messages, **kwargs):
+        self._enter()
+        try:
+            await asyncio.sleep(self.latency)
+            return types.SimpleNamespace(content='{"ok":true}')
+        finally:
+            self._exit()
+
+    def stream(self, messages, **kwargs):
+        self._enter()
+        try:
+            for part in ('{"ok"', ":true}", " coda"):
+                yield types.SimpleNamespace(content=part)
+        finally:
+            self._exit()
+
+
+def test_token_bucket_waits_refills_and_refunds():
+    clock = FakeClock()
+    bucket = TokenBucket(60, capacity=2, clock=clock)  # 1 al secondo
+
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == 0
+    assert bucket.reserve(1) == pytest.approx(1.0)  # niente prelevato
+
+    clock.now += 0.5
+    assert bucket.reserve(1) == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.reserve(1) == 0
+
+    bucket.refund(1)
+    assert bucket.available() == pytest.approx(1.0)
+    # richieste più grandi della capacità non restano bloccate per sempre
+    clock.now += 10
+    assert bucket.reserve(50) == 0
+
+
+def test_token_bucket_pause_follows_retry_after():
+    clock = FakeClock()
+    bucket = TokenBucket(600, clock=clock)
+
+    bucket.pause(3)
+    assert bucket.reserve(1) == pytest.approx(3 + 0.1)
+    clock.now += 3.5
+    assert bucket.reserve(1) == 0
+
+
+def test_aimd_additive_increase_and_multiplicative_decrease():
+    clock = FakeClock()
+    limit = AIMDLimit("aimd", initial=4, max_limit=6, cooldown=2.0, clock=clock)
+
+    for _ in range(4):
+        assert limit.try_acquire()
+        limit.release(latency=0.1)
+    assert limit.limit == pytest.approx(5.0, abs=0.1)  # circa +1 dopo un "giro" di successi
+
+    assert limit.try_acquire()
+    limit.release(throttled=True)
+    assert int(limit.limit) == 2
+    # la seconda 429 della stessa raffica non dimezza di nuovo
+    assert limit.try_acquire()
+    limit.release(throttled=True)
+    assert int(limit.limit) == 2
+
+    clock.now += 2.5
+    for _ in range(3):
+        assert limit.try_acquire()
+        limit.release(throttled=True)
+        clock.now += 2.5
+    assert limit.limit == 1  # mai sotto il minimo
+
+    for _ in range(200):
+        assert limit.try_acquire()
+        limit.release(latency=0.1)
+    assert limit.limit == 6  # risale fino al massimo
+
+
+def test_aimd_blocks_at_limit_and_backs_off_on_latency_spike():
+    limit = AIMDLimit("spike", initial=2, cooldown=0.0)
+    assert limit.try_acquire() and limit.try_acquire()
+    assert not limit.try_acquire()
+    assert not limit.acquire(timeout=0.05)
+    limit.release(latency=0.1)
+    limit.release(latency=0.1)
+
+    for _ in range(rate_limiter.MIN_LATENCY_SAMPLES):
+        limit.try_acquire()
+        limit.release(latency=0.1)
+    before = limit.limit
+    limit.try_acquire()
+    limit.release(latency=1.0)
+    assert limit.limit == pytest.approx(before * rate_limiter.BACKOFF_FACTOR)
+
+
+def test_provider_limiter_rejects_when_wait_exceeds_timeout():
+    limiter = ProviderLimiter("slow", rpm=60, tpm=None, concurrency=AIMDLimit("slow", initial=4))
+    llm = LimitedLLM(RateLimitingStub(max_concurrent=10), limiter)
+
+    llm.invoke("ciao", timeout=5)
+    limiter.requests.tokens = 0  # burst del minuto esaurito
+    start = time.perf_counter()
+    with pytest.raises(RateLimited) as exc:
+        llm.invoke("ciao", timeout=0.2)  # il prossimo slot è tra ~1s
+    assert time.perf_counter() - start < 0.1  # scartata subito, senza attendere
+    assert exc.value.retry_after == pytest.approx(1.0, abs=0.1)
+    assert limiter.concurrency.in_flight == 0
+
+
+def test_provider_limiter_waits_for_token_budget():
+    # 6000 token/minuto = 100/s: una chiamata da ~5 token + max_tokens 45 costa ~50 token
+    limiter = ProviderLimiter("tpm", tpm=6000, concurrency=AIMDLimit("tpm", initial=4))
+    limiter.tokens.tokens = 0
+    llm = LimitedLLM(RateLimitingStub(max_concurrent=10, latency=0), limiter)
+
+    start = time.perf_counter()
+    llm.invoke("ciao mondo", max_tokens=45, timeout=5)
+    assert 0.3 < time.perf_counter() - start < 2
+
+
+def test_limited_llm_adapts_to_rate_limiting_stub():
+    """Load test: 40 chiamate concorrenti contro un provider che accetta 3 chiamate alla volta."""
+
+    def run(llm, calls=40):
+        errors = []
+
+        def call():
+            try:
+                llm.invoke("domanda", timeout=10)
+            except StubRateLimitError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=call) for _ in range(calls)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return len(errors)
+
+    unlimited = RateLimitingStub(max_concurrent=3)
+    unlimited_errors = run(unlimited)
+
+    stub = RateLimitingStub(max_concurrent=3)
+    concurrency = AIMDLimit("stub", initial=8, cooldown=0.0)
+    limited_errors = run(LimitedLLM(stub, ProviderLimiter("stub", concurrency=concurrency)))
+
+    assert unlimited_errors >= 30
+    assert limited_errors <= unlimited_errors // 3
+    assert stub.served >= 40 - limited_errors
+    assert concurrency.in_flight == 0
+    assert concurrency.limit <= 4  # ha imparato il limite del provider
+    assert rate_limiter.RATE_LIMIT_EVENTS.value(provider="stub", event="throttled") == limited_errors
+
+
+def test_limited_llm_retry_after_pauses_requests():
+    clock = FakeClock()
+    limiter = ProviderLimiter("retry", rpm=600, clock=clock)
+
+    class AlwaysThrottled:
+        def invoke(self, messages, **kwargs):
+            raise StubRateLimitError(retry_after=20)
+
+    with pytest.raises(StubRateLimitError):
+        LimitedLLM(AlwaysThrottled(), limiter).invoke("x", timeout=5)
+    with pytest.raises(RateLimited) as exc:
+        LimitedLLM(AlwaysThrottled(), limiter).invoke("x", timeout=5)
+    assert exc.value.retry_after > 19
+
+
+def test_limited_llm_async_and_stream_release_slots():
+    stub = RateLimitingStub(max_concurrent=10)
+    concurrency = AIMDLimit("slots", initial=2)
+    llm = LimitedLLM(stub, ProviderLimiter("slots", concurrency=concurrency))
+
+    async def burst():
+        return await asyncio.gather(*(llm.ainvoke("x", timeout=5) for _ in range(6)))
+
+    assert len(asyncio.run(burst())) == 6
+    assert stub.peak <= 2
+
+    stream = llm.stream("x")
+    assert next(stream).content == '{"ok"'
+    assert concurrency.in_flight == 1
+    stream.close()  # consumer che smette appena il JSON è completo
+    assert concurrency.in_flight == 0
+
+
+def test_limiter_exposes_current_limits_as_metrics():
+    ProviderLimiter("metrics", rpm=30, tpm=6000, concurrency=AIMDLimit("metrics", initial=3))
+    text = render_prometheus()
+    assert 'sage_llm_concurrency_limit{provider="metrics"} 3' in text
+    assert 'sage_llm_rate_limit_per_minute{provider="metrics",bucket="tokens"} 6000' in text
+    assert 'sage_llm_rate_bucket_available{provider="metrics",bucket="requests"} 30' in text
+
+
+def test_limited_llm_delegates_attributes():
+    llm = LimitedLLM(types.SimpleNamespace(model_name="stub-model"), ProviderLimiter("attrs"))
+    assert llm.model_name == "stub-model"
+
+
+def test_limits_are_split_between_worker_processes(monkeypatch):
+    monkeypatch.setattr(rate_limiter, "PROVIDER_LIMITS", {"groq": {"rpm": 30, "tpm": 30000}})
+    monkeypatch.setattr(rate_limiter, "_limiters", {})
+    monkeypatch.setattr(rate_limiter, "_processes", 1)
+
+    rate_limiter.configure(3)
+    assert rate_limiter.process_limits("groq") == {"rpm": 10, "tpm": 10000}
+    limiter = rate_limiter.get_limiter("groq")
+    assert limiter.requests.capacity == 10
+    assert limiter.tokens.capacity == 10000
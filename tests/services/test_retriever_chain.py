@@ -1,6 +1,8 @@
 # tests/services/test_retriever_chain_random.py
 import sys
+import time
 import types
+import asyncio
 import pytest
 import numpy as np
 
@@ -64,11 +66,18 @@ sys.modules.setdefault("langchain_groq", _fake_groq)
 from src.services import retriever_chain
 
 
+class _NoPools:
+    def get(self, *args, **kwargs):
+        return None
+
+
 # ---------- fixture per isolare lo stato tra i test ----------
 @pytest.fixture(autouse=True)
 def _isolate_collection(monkeypatch):
     """Assicura che ogni test parta con una collection dummy 'pulita'."""
     monkeypatch.setattr(retriever_chain, "collection", _dummy_collection)
+    # nessun pool precalcolato: ricerca sempre live
+    monkeypatch.setattr(retriever_chain, "candidate_pools", _NoPools())
     _dummy_collection.result = {"documents": [[]], "metadatas": [[]]}
     _dummy_collection.last_query = None
     yield
@@ -196,3 +205,486 @@ def test_build_rag_chain_with_docs(monkeypatch):
     messages = dummy.invoked_with
     assert any("Fonti:" in m.content for m in messages)
     assert any("quanto fa 2+2?" in m.content for m in messages)
+
+
+def test_query_chunks_batch_groups_by_filter(monkeypatch):
+    monkeypatch.setattr(retriever_chain.random, "shuffle", lambda seq: None)
+
+    # Embedder batch: una riga per domanda, registra le chiamate
+    class BatchEmbedder:
+        def __init__(self):
+            self.calls = []
+
+        def encode(self, texts):
+            self.calls.append(list(texts))
+            return np.array([[float(i), 0.0] for i in range(len(texts))])
+
+    batch_embedder = BatchEmbedder()
+    monkeypatch.setattr(retriever_chain, "embedder", batch_embedder)
+
+    class MultiQueryCollection:
+        def __init__(self):
+            self.queries = []
+
+        def query(self, **kwargs):
+            self.queries.append(kwargs)
+            n = len(kwargs["query_embeddings"])
+            subject = kwargs["where"]["$and"][0]["subject"]
+            docs = [[f"{subject}-{j}", f"{subject}-{j}", "X"] for j in range(n)]
+            metas = [[{"title": d} for d in row] for row in docs]
+            return {"documents": docs, "metadatas": metas}
+
+    multi = MultiQueryCollection()
+    monkeypatch.setattr(retriever_chain, "collection", multi)
+
+    queries = [
+        {"question": "q1", "subject": "storia", "classe": "prim", "anno": 3},
+        {"question": "q2", "subject": "geografia", "classe": "prim", "anno": 3},
+        {"question": "q3", "subject": "storia", "classe": "prim", "anno": 3},
+    ]
+    out = retriever_chain.query_chunks_batch(queries)
+
+    # una sola encode per tutte le domande, una query per gruppo di filtri
+    assert batch_embedder.calls == [["q1", "q2", "q3"]]
+    assert len(multi.queries) == 2
+    assert [len(q["query_embeddings"]) for q in multi.queries] == [2, 1]
+
+    # risultati nello stesso ordine delle richieste, con dedup
+    assert out[0][0] == ["storia-0", "X"]
+    assert out[1][0] == ["geografia-0", "X"]
+    assert out[2][0] == ["storia-1", "X"]
+
+
+def test_query_chunks_batch_empty():
+    assert retriever_chain.query_chunks_batch([]) == []
+
+
+def test_preloaded_candidates_shared_by_query_chunks(monkeypatch):
+    monkeypatch.setattr(retriever_chain.random, "shuffle", lambda seq: None)
+    fetched = []
+
+    def fake_fetch(queries):
+        fetched.append([q["question"] for q in queries])
+        return [([f"{q['question']}-doc"], [{"title": q["question"]}]) for q in queries]
+
+    monkeypatch.setattr(retriever_chain, "fetch_candidates_batch", fake_fetch)
+    monkeypatch.setattr(retriever_chain, "_fetch_candidates", lambda *a: pytest.fail("retrieval non condiviso"))
+
+    queries = [
+        {"question": "q1", "subject": "storia", "classe": "prim", "anno": 3},
+        {"question": "q1", "subject": "storia", "classe": "prim", "anno": 3},
+        {"question": "q2", "subject": "storia", "classe": "prim", "anno": 3},
+    ]
+    with retriever_chain.preloaded_candidates(queries):
+        assert retriever_chain.query_chunks("q1", "storia", "prim", 3)[0] == ["q1-doc"]
+        assert retriever_chain.query_chunks("q2", "storia", "prim", 3)[0] == ["q2-doc"]
+
+    assert fetched == [["q1", "q2"]]  # query ripetute calcolate una volta
+    assert retriever_chain._preloaded == {}
+
+
+def test_query_chunks_uses_micro_batcher_when_enabled(monkeypatch):
+    calls = []
+
+    class ListEmbedder:
+        def encode(self, texts):
+            calls.append(texts)
+            return np.array([[0.5, 0.5] for _ in texts])
+
+    monkeypatch.setattr(retriever_chain, "embedder", ListEmbedder())
+    monkeypatch.setattr(retriever_chain, "EMBED_BATCHING", True)
+    monkeypatch.setattr(retriever_chain, "candidate_pools", types.SimpleNamespace(get=lambda *a: None))
+    retriever_chain.query_chunks("domanda", subject="storia")
+
+    assert calls == [["domanda"]]  # encode in batch (lista), non sulla singola stringa
+    assert retriever_chain.collection.last_query["query_embeddings"] == [[0.5, 0.5]]
+
+
+def test_query_chunks_served_from_pools(monkeypatch):
+    monkeypatch.setattr(retriever_chain.random, "shuffle", lambda seq: None)
+
+    class Pools:
+        def get(self, query, subject=None, classe=None, anno=None):
+            if subject == "storia":
+                return ["P1", "P2"], [{"title": "p1"}, {"title": "p2"}]
+            return None
+
+    class FailingEmbedder:
+        def encode(self, text):
+            raise AssertionError("encode non deve essere chiamato su un hit")
+
+    monkeypatch.setattr(retriever_chain, "candidate_pools", Pools())
+    monkeypatch.setattr(retriever_chain, "embedder", FailingEmbedder())
+
+    docs, metas = retriever_chain.query_chunks("q", subject="storia", classe="prim", anno=3)
+    assert docs == ["P1", "P2"]
+    assert _dummy_collection.last_query is None
+
+    # batch: tutti hit → nessuna encode, nessuna query
+    out = retriever_chain.query_chunks_batch([{"question": "q", "subject": "storia"}])
+    assert out[0][0] == ["P1", "P2"]
+
+
+def test_query_chunks_falls_back_on_pool_miss(monkeypatch):
+    class Pools:
+        def get(self, *args, **kwargs):
+            return None
+
+    monkeypatch.setattr(retriever_chain, "candidate_pools", Pools())
+    _dummy_collection.result = {"documents": [["L"]], "metadatas": [[{"title": "l"}]]}
+
+    docs, _ = retriever_chain.query_chunks("q", subject="geografia")
+    assert docs == ["L"]
+    assert _dummy_collection.last_query["where"] == {"subject": "geografia"}
+
+
+def test_build_rag_chain_ainvoke_hundreds_in_flight(monkeypatch):
+    """
+    Load test con LLM stub: 300 richieste concorrenti restano tutte in volo
+    sulla chiamata LLM, mentre il retrieval bloccante usa al massimo RETRIEVAL_WORKERS thread.
+    """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+
+    n_requests = 300
+    workers = 4
+    executor = ThreadPoolExecutor(max_workers=workers)
+    monkeypatch.setattr(retriever_chain, "retrieval_executor", executor)
+
+    lock = threading.Lock()
+    retrieval = {"active": 0, "max": 0}
+
+    def fake_query_chunks(question, subject=None, classe=None, anno=None):
+        with lock:
+            retrieval["active"] += 1
+            retrieval["max"] = max(retrieval["max"], retrieval["active"])
+        time.sleep(0.001)
+        with lock:
+            retrieval["active"] -= 1
+        return ["DOC"], [{"title": "t"}]
+
+    monkeypatch.setattr(retriever_chain, "query_chunks", fake_query_chunks)
+
+    class StubAsyncLLM:
+        def __init__(self):
+            self.in_flight = 0
+            self.max_in_flight = 0
+
+        async def ainvoke(self, messages):
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            await asyncio.sleep(0.3)
+            self.in_flight -= 1
+
+            class _Resp:
+                content = '{"ok":true}'
+            return _Resp
+
+    llm = StubAsyncLLM()
+    chain = retriever_chain.build_rag_chain(llm)
+
+    async def run_all():
+        tasks = [chain.ainvoke({"query": f"q{i}", "subject": "storia"}) for i in range(n_requests)]
+        return await asyncio.gather(*tasks)
+
+    try:
+        results = asyncio.run(run_all())
+    finally:
+        executor.shutdown()
+
+    assert len(results) == n_requests
+    assert all(r["result"] == '{"ok":true}' for r in results)
+    assert llm.max_in_flight >= 250
+    assert retrieval["max"] <= workers
+
+
+def test_build_rag_chain_streaming_stops_after_json(monkeypatch):
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "t"}]))
+
+    class StreamingLLM:
+        def __init__(self):
+            self.emitted = 0
+
+        def invoke(self, messages):
+            raise AssertionError("in modalità stream non si usa invoke")
+
+        def stream(self, messages):
+            for tok in ['{"ok":', ' true}', " e poi tanto altro testo", " ancora"]:
+                self.emitted += 1
+                yield type("C", (), {"content": tok})()
+
+    llm = StreamingLLM()
+    chain = retriever_chain.build_rag_chain(llm)
+    res = chain.invoke({"query": "q", "stream": True})
+
+    assert res["result"] == '{"ok": true}'
+    assert llm.emitted == 2
+
+
+def test_build_rag_chain_context_budget(monkeypatch):
+    long_doc = " ".join(f"Frase numero {i} sulla storia di Roma antica." for i in range(200))
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: ([long_doc], [{"title": "T"}]))
+    monkeypatch.setattr(
+        retriever_chain,
+        "embedder",
+        type("E", (), {"encode": lambda self, texts: np.ones((len(texts), 3)) + np.arange(len(texts))[:, None] * np.array([0, 0.001, 0])})(),
+    )
+
+    dummy = DummyLLM('{"ok":true}')
+    chain = retriever_chain.build_rag_chain(dummy)
+
+    full = chain.invoke({"query": "roma"})
+    budgeted = chain.invoke({"query": "roma", "context_budget": 200})
+
+    assert full["context_stats"]["tokens_saved"] == 0
+    stats = budgeted["context_stats"]
+    assert stats["tokens_used"] <= 200
+    assert stats["tokens_saved"] > 0
+    assert stats["tokens_full"] == full["context_stats"]["tokens_full"]
+
+
+def test_build_rag_chain_prompt_prefix_and_cache(monkeypatch):
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "T"}]))
+    dummy = DummyLLM('{"ok":true}')
+    chain = retriever_chain.build_rag_chain(dummy)
+
+    chain.invoke({"query": "retrieval", "question": "variabile", "prompt_prefix": "STATICO"})
+    system, human = dummy.invoked_with
+    assert system.content.endswith("STATICO")
+    assert "Domanda: variabile" in human.content
+    assert "STATICO" not in human.content
+
+    chain.invoke({"query": "retrieval", "question": "variabile", "prompt_prefix": "STATICO", "cache_prefix": True})
+    system, _ = dummy.invoked_with
+    assert system.content[0]["cache_control"] == {"type": "ephemeral"}
+    assert system.content[0]["text"].endswith("STATICO")
+
+
+class PerProviderLLM(DummyLLM):
+    """Come HedgedLLM: riceve una funzione nome → messaggi."""
+
+    per_provider_messages = True
+
+    def invoke(self, messages, **kwargs):
+        self.invoked_with = {name: messages(name) for name in ("groq", "claude")}
+        return super().invoke(self.invoked_with)
+
+
+def test_build_rag_chain_cache_prefix_only_for_cache_providers(monkeypatch):
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "T"}]))
+    llm = PerProviderLLM('{"ok":true}')
+    chain = retriever_chain.build_rag_chain(llm)
+
+    chain.invoke({
+        "query": "retrieval", "prompt_prefix": "STATICO", "cache_prefix": True, "cache_providers": ["claude"],
+    })
+    groq_system, _ = llm.invoked_with["groq"]
+    claude_system, _ = llm.invoked_with["claude"]
+    assert isinstance(groq_system.content, str) and groq_system.content.endswith("STATICO")
+    assert claude_system.content[0]["cache_control"] == {"type": "ephemeral"}
+
+
+# il modulo sotto test importa "services.*" (src/ è nel sys.path): stesse classi
+from services.deadline import Deadline, DeadlineExceeded
+
+
+def test_build_rag_chain_sheds_before_retrieval(monkeypatch):
+    calls = []
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: calls.append(a) or (["DOC"], [{}]))
+    chain = retriever_chain.build_rag_chain(DummyLLM('{"ok":true}'))
+
+    with pytest.raises(DeadlineExceeded) as exc:
+        chain.invoke({"query": "q", "deadline": Deadline(0.5)})  # meno di MIN_LLM_SECONDS
+    assert exc.value.shed and exc.value.stage == "retrieval"
+    assert calls == []
+
+
+def test_build_rag_chain_passes_remaining_time_as_provider_timeout(monkeypatch):
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "T"}]))
+    seen = {}
+
+    class TimeoutLLM:
+        def invoke(self, messages, **kwargs):
+            seen.update(kwargs)
+            return types.SimpleNamespace(content='{"ok":true}')
+
+    result = retriever_chain.build_rag_chain(TimeoutLLM()).invoke({"query": "q", "deadline": Deadline(10)})
+    assert result["result"] == '{"ok":true}'
+    assert 9 < seen["timeout"] <= 10
+
+
+def test_build_rag_chain_provider_timeout_becomes_deadline(monkeypatch):
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "T"}]))
+    deadline = Deadline(5)
+
+    class HangingLLM:
+        def invoke(self, messages, timeout=None):
+            deadline.expires_at = deadline.clock()  # il provider ha consumato tutto il budget
+            raise TimeoutError("read timeout")
+
+    with pytest.raises(DeadlineExceeded) as exc:
+        retriever_chain.build_rag_chain(HangingLLM()).invoke({"query": "q", "deadline": deadline})
+    assert not exc.value.shed and exc.value.stage == "llm_call"
+
+
+def test_build_rag_chain_ainvoke_cancels_llm_at_deadline(monkeypatch):
+    async def fake_aquery(*a, **kw):
+        return ["DOC"], [{"title": "T"}]
+
+    monkeypatch.setattr(retriever_chain, "aquery_chunks", fake_aquery)
+    monkeypatch.setattr(retriever_chain, "MIN_LLM_SECONDS", 0.0)
+    state = {"cancelled": False}
+
+    class SlowLLM:
+        async def ainvoke(self, messages, **kwargs):
+            try:
+                await asyncio.sleep(5)
+            except asyncio.CancelledError:
+                state["cancelled"] = True
+                raise
+
+    chain = retriever_chain.build_rag_chain(SlowLLM())
+    start = time.perf_counter()
+    with pytest.raises(DeadlineExceeded):
+        asyncio.run(chain.ainvoke({"query": "q", "deadline": Deadline(0.1)}))
+    assert time.perf_counter() - start < 1
+    assert state["cancelled"]
+
+
+def test_build_rag_chain_forwards_llm_kwargs_and_reports_usage(monkeypatch):
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "T"}]))
+    seen = {}
+
+    class BudgetLLM:
+        def invoke(self, messages, **kwargs):
+            seen.update(kwargs)
+            return types.SimpleNamespace(
+                content='{"ok":true}',
+                response_metadata={"token_usage": {"completion_tokens": 7}, "finish_reason": "stop"},
+            )
+
+    result = retriever_chain.build_rag_chain(BudgetLLM()).invoke(
+        {"query": "q", "llm_kwargs": {"max_tokens": 320, "response_format": {"type": "json_object"}}}
+    )
+    assert seen == {"max_tokens": 320, "response_format": {"type": "json_object"}}
+    assert result["output_tokens"] == 7
+    assert result["truncated"] is False
+
+
+def test_build_rag_chain_rate_limited_call_is_shed(monkeypatch):
+    from services.rate_limiter import RateLimited
+
+    monkeypatch.setattr(retriever_chain, "query_chunks", lambda *a, **kw: (["DOC"], [{"title": "T"}]))
+
+    class ThrottledLLM:
+        def invoke(self, messages, **kwargs):
+            raise RateLimited("groq", 12.0)
+
+    with pytest.raises(DeadlineExceeded) as exc:
+        retriever_chain.build_rag_chain(ThrottledLLM()).invoke({"query": "q", "deadline": Deadline(5)})
+    assert exc.value.shed and exc.value.stage == "rate_limit"
+
+
+def test_query_chunks_coalesces_concurrent_retrieval(monkeypatch):
+    """Load test: richieste identiche a raffica → una sola encode + query Chroma."""
+    import threading
+    from services.single_flight import SingleFlight
+
+    calls = {"encode": 0, "query": 0}
+
+    class SlowEmbedder(_DummyEmbedder):
+        def encode(self, text):
+            calls["encode"] += 1
+            time.sleep(0.1)
+            return super().encode(text)
+
+    class CountingCollection(_DummyCollection):
+        def query(self, **kwargs):
+            calls["query"] += 1
+            return {"documents": [[f"d{i}" for i in range(10)]], "metadatas": [[{"i": i} for i in range(10)]]}
+
+    monkeypatch.setattr(retriever_chain, "embedder", SlowEmbedder())
+    monkeypatch.setattr(retriever_chain, "collection", CountingCollection())
+    monkeypatch.setattr(retriever_chain, "COALESCE_RETRIEVAL", True)
+    monkeypatch.setattr(retriever_chain, "retrieval_flight", SingleFlight("retrieval"))
+
+    barrier = threading.Barrier(25)
+    results = []
+
+    def run():
+        barrier.wait()
+        results.append(retriever_chain.query_chunks("stessa domanda", subject="storia", classe="prim", anno=3))
+
+    threads = [threading.Thread(target=run) for _ in range(25)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert calls == {"encode": 1, "query": 1}
+    assert len(results) == 25
+    # ogni richiesta fa la propria scelta dei chunk
+    assert all(len(docs) == retriever_chain.CHUNK_LIMIT for docs, _ in results)
+
+
+def test_query_chunks_reopens_index_on_new_version(tmp_path, monkeypatch):
+    """Reindex pubblicato: alla query successiva si apre la nuova versione, senza riavvio."""
+    from services.index_versions import IndexAlias, new_version, publish
+
+    opened = []
+    new_collection = _DummyCollection()
+    new_collection.result = {"documents": [["nuovo"]], "metadatas": [[{"title": "n"}]]}
+
+    monkeypatch.setattr(retriever_chain, "index_alias", IndexAlias(str(tmp_path)))
+    monkeypatch.setattr(retriever_chain, "_open_version", None)
+    monkeypatch.setattr(
+        retriever_chain, "PersistentClient", lambda path: opened.append(path) or _DummyClient(new_collection)
+    )
+
+    # alias invariato: nessuna riapertura
+    retriever_chain.query_chunks("domanda", subject="storia")
+    assert opened == []
+
+    version, path = new_version(str(tmp_path))
+    publish(str(tmp_path), version)
+
+    docs, _ = retriever_chain.query_chunks("domanda", subject="storia")
+    assert opened == [path]
+    assert docs == ["nuovo"]
+    assert retriever_chain.collection is new_collection
+
+
+def test_retired_index_is_stopped_after_in_flight_queries(tmp_path, monkeypatch):
+    """Reindex pubblicato: il client della versione precedente si ferma dopo l'ultima query in volo."""
+    from services.index_versions import IndexAlias, new_version, publish
+
+    class _System:
+        stopped = False
+
+        def stop(self):
+            self.stopped = True
+
+    def client(path):
+        c = _DummyClient(_DummyCollection())
+        c._identifier, c._system = path, _System()
+        return c
+
+    for name in ("index_alias", "chroma_client", "collection", "_open_version", "_handle"):
+        monkeypatch.setattr(retriever_chain, name, getattr(retriever_chain, name))
+    monkeypatch.setattr(retriever_chain, "index_alias", IndexAlias(str(tmp_path)))
+    monkeypatch.setattr(retriever_chain, "PersistentClient", client)
+    retriever_chain.open_index()
+    old = retriever_chain._handle
+
+    with retriever_chain._query_collection() as current:
+        assert current is old.collection
+        version, _ = new_version(str(tmp_path))
+        publish(str(tmp_path), version)
+        # la query successiva apre la nuova versione; quella in volo tiene aperta la vecchia
+        with retriever_chain._query_collection() as newer:
+            assert newer is not current
+        system = old.system
+        assert old.retired and not system.stopped
+
+    assert system.stopped
+    assert not retriever_chain._handle.retired and not retriever_chain._handle.system.stopped
@@ -0,0 +1,185 @@
+import time
+import asyncio
+import threading
+import concurrent.futures
+
+import pytest
+
+from src.services import single_flight
+from src.services.single_flight import SingleFlight, AsyncSingleFlight
+
+
+def burst(n, fn):
+    """n thread che partono insieme (traffico a raffica) e chiamano fn(i)."""
+    barrier = threading.Barrier(n)
+    results = [None] * n
+
+    def run(i):
+        barrier.wait()
+        results[i] = fn(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+class SlowBackend:
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        with self._lock:
+            self.calls += 1
+            n = self.calls
+        time.sleep(self.delay)
+        return {"status": 1, "data": {"question": f"Q{n}"}}
+
+
+def test_identical_concurrent_calls_share_one_execution():
+    backend = SlowBackend()
+    flight = SingleFlight("test")
+
+    results = burst(30, lambda i: flight.do("k", backend))
+    assert backend.calls == 1
+    assert all(r is results[0] for r in results)
+
+
+def test_fanout_limit_starts_new_calls():
+    backend = SlowBackend()
+    flight = SingleFlight("test", max_fanout=5)
+
+    results = burst(30, lambda i: flight.do("k", backend))
+    assert backend.calls == 6
+    questions = [r["data"]["question"] for r in results]
+    assert max(questions.count(q) for q in set(questions)) <= 5
+
+
+def test_different_keys_are_not_coalesced():
+    backend = SlowBackend(delay=0.05)
+    flight = SingleFlight("test")
+    burst(6, lambda i: flight.do(i % 3, backend))
+    assert backend.calls == 3
+
+
+def test_sequential_calls_are_not_coalesced():
+    backend = SlowBackend(delay=0)
+    flight = SingleFlight("test")
+    flight.do("k", backend)
+    flight.do("k", backend)
+    assert backend.calls == 2
+
+
+def test_errors_are_shared_and_not_cached():
+    flight = SingleFlight("test")
+    calls = []
+
+    def failing():
+        calls.append(1)
+        time.sleep(0.1)
+        raise RuntimeError("giù")
+
+    def call(i):
+        try:
+            flight.do("k", failing)
+        except RuntimeError as e:
+            return str(e)
+
+    assert burst(5, call) == ["giù"] * 5
+    assert len(calls) == 1
+    assert flight.do("k", lambda: "ok") == "ok"
+
+
+def test_follower_timeout():
+    flight = SingleFlight("test")
+    started = threading.Event()
+
+    def slow():
+        started.set()
+        time.sleep(0.5)
+        return "tardi"
+
+    leader = threading.Thread(target=flight.do, args=("k", slow))
+    leader.start()
+    started.wait()
+    with pytest.raises(concurrent.futures.TimeoutError):
+        flight.do("k", slow, timeout=0.05)
+    leader.join()
+
+
+def test_async_single_flight_with_fanout():
+    calls = []
+
+    async def backend():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"n": len(calls)}
+
+    async def main():
+        flight = AsyncSingleFlight("test", max_fanout=4)
+        return await asyncio.gather(*(flight.do("k", backend) for _ in range(20)))
+
+    results = asyncio.run(main())
+    assert len(calls) == 5
+    assert len(results) == 20
+
+
+def test_async_follower_timeout_does_not_cancel_leader():
+    async def main():
+        flight = AsyncSingleFlight("test")
+
+        async def backend():
+            await asyncio.sleep(0.1)
+            return "ok"
+
+        leader = asyncio.ensure_future(flight.do("k", backend))
+        await asyncio.sleep(0)
+        with pytest.raises(asyncio.TimeoutError):
+            await flight.do("k", backend, timeout=0.01)
+        return await leader
+
+    assert asyncio.run(main()) == "ok"
+
+
+def test_coalesced_generate_load(monkeypatch):
+    """Load test: 40 studenti chiedono lo stesso quiz insieme → 40/FANOUT generazioni, copie indipendenti."""
+    monkeypatch.setattr(single_flight, "_generation_flight", SingleFlight("generation", max_fanout=8))
+    backend = SlowBackend()
+    data = {"type": "quiz", "category": "storia", "classe": "prim", "anno": 3, "difficulty": 5, "llmProvider": "groq"}
+
+    results = burst(40, lambda i: single_flight.coalesced_generate(dict(data), backend))
+    assert backend.calls == 5
+    results[0]["data"]["question"] = "modificata"
+    assert sum(r["data"]["question"] == "modificata" for r in results) == 1
+
+
+def test_coalesced_generate_deadline(monkeypatch):
+    monkeypatch.setattr(single_flight, "_generation_flight", SingleFlight("generation"))
+    from services.deadline import Deadline
+
+    backend = SlowBackend(delay=0.5)
+    data = {"type": "quiz", "llmProvider": "groq"}
+
+    def call(i):
+        # il primo è leader senza deadline, gli altri aspettano al massimo 50ms
+        if i == 0:
+            return single_flight.coalesced_generate(data, backend)
+        time.sleep(0.05)
+        return single_flight.coalesced_generate(data, backend, Deadline(0.05))
+
+    results = burst(3, call)
+    assert results[0]["status"] == 1
+    assert [r["status"] for r in results[1:]] == [5, 5]
+    assert backend.calls == 1
+
+
+def test_generation_key_accepts_any_json_values():
+    data = {"type": ["quiz"], "category": {"b": 1, "a": 2}, "classe": "prim", "anno": 3, "difficulty": 5, "llmProvider": "groq"}
+    key = single_flight.generation_key(data)
+    assert key == single_flight.generation_key(dict(data, category={"a": 2, "b": 1}))
+    assert key != single_flight.generation_key(dict(data, llmProvider="claude"))
+    hash(key)
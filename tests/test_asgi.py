@@ -0,0 +1,76 @@
+import json
+import asyncio
+
+from src import asgi
+
+
+def call_app(method, path, body=b"", headers=()):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": method, "path": path, "headers": list(headers)}
+    asyncio.run(asgi.app(scope, receive, send))
+    status = sent[0]["status"]
+    payload = b"".join(m.get("body", b"") for m in sent[1:])
+    return status, payload
+
+
+def test_generate_quiz_uses_async_generator(monkeypatch):
+    seen = {}
+
+    async def fake_agenerate(data, deadline=None):
+        seen.update(data)
+        return {"status": 1, "data": {"type": "quiz"}}
+
+    monkeypatch.setattr(asgi, "agenerate_quiz_from_data", fake_agenerate)
+
+    status, payload = call_app("POST", "/generate_quiz", json.dumps({"type": "quiz"}).encode())
+    assert status == 200
+    assert json.loads(payload) == {"status": 1, "data": {"type": "quiz"}}
+    assert seen["llmProvider"] == "groq"
+
+
+def test_generate_quiz_invalid_body():
+    status, payload = call_app("POST", "/generate_quiz", b"non json")
+    assert status == 400
+    assert json.loads(payload)["status"] == 4
+
+
+def test_metrics_and_not_found():
+    status, payload = call_app("GET", "/metrics")
+    assert status == 200
+    assert b"sage_stage_duration_seconds" in payload
+
+    status, _ = call_app("GET", "/nope")
+    assert status == 404
+
+
+def test_generate_quiz_deadline_header_and_504(monkeypatch):
+    seen = {}
+
+    async def fake_agenerate(data, deadline=None):
+        seen["remaining"] = deadline.remaining()
+        return {"status": 5, "data": {}}
+
+    monkeypatch.setattr(asgi, "agenerate_quiz_from_data", fake_agenerate)
+
+    status, payload = call_app(
+        "POST", "/generate_quiz", json.dumps({"type": "quiz"}).encode(),
+        headers=[(b"x-request-timeout", b"1.5")],
+    )
+    assert status == 504
+    assert json.loads(payload)["status"] == 5
+    assert 0 < seen["remaining"] <= 1.5
+
+
+def test_health_routes():
+    status, payload = call_app("GET", "/healthz")
+    assert status == 200 and json.loads(payload)["status"] == "ok"
+
+    status, payload = call_app("GET", "/readyz")
+    assert status == 200 and json.loads(payload)["status"] == "ready"
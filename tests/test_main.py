@@ -0,0 +1,129 @@
+from src import main
+
+
+def test_metrics_endpoint_prometheus_text():
+    client = main.app.test_client()
+    resp = client.get("/metrics")
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    assert "# TYPE sage_stage_duration_seconds histogram" in resp.get_data(as_text=True)
+
+
+def test_generate_quiz_set_endpoint(monkeypatch):
+    seen = {}
+
+    def fake_batch(data, deadline=None):
+        seen.update(data)
+        return {"status": 1, "data": [{"type": "quiz"}], "errors": []}
+
+    monkeypatch.setattr(main, "generate_quiz_batch", fake_batch)
+    client = main.app.test_client()
+
+    resp = client.post("/generate_quiz_set", json={"types": ["quiz"], "category": "storia"})
+    assert resp.status_code == 200
+    assert resp.get_json()["data"] == [{"type": "quiz"}]
+    assert seen["llmProvider"] == "groq"
+
+    resp = client.post("/generate_quiz_set", data="x", content_type="text/plain")
+    assert resp.status_code == 400
+
+
+def test_generate_quiz_deadline_header_and_504(monkeypatch):
+    seen = {}
+
+    def fake_generate(data, deadline=None):
+        seen["remaining"] = deadline.remaining()
+        return {"status": 5, "data": {}}
+
+    monkeypatch.setattr(main, "generate_quiz_from_data", fake_generate)
+    monkeypatch.setattr(main, "QUIZ_BANK_ENABLED", False)
+    client = main.app.test_client()
+
+    resp = client.post("/generate_quiz", json={"type": "quiz"}, headers={"X-Request-Timeout": "2"})
+    assert resp.status_code == 504
+    assert resp.get_json() == {"status": 5, "data": {}}
+    assert 0 < seen["remaining"] <= 2
+
+
+def test_job_api_submit_poll_and_events(monkeypatch):
+    from src.services.jobs import JobQueue
+
+    def fake_generate(data, deadline=None):
+        return {"status": 1, "data": {"type": data["type"]}}
+
+    queue = JobQueue(fake_generate, workers=1)
+    monkeypatch.setattr(main, "get_job_queue", lambda generate: queue)
+    client = main.app.test_client()
+
+    resp = client.post("/jobs", json={"type": "quiz"})
+    assert resp.status_code == 202
+    job_id = resp.get_json()["id"]
+    assert resp.headers["Location"] == f"/jobs/{job_id}"
+    queue.join()
+
+    resp = client.get(f"/jobs/{job_id}")
+    assert resp.get_json()["status"] == "done"
+    assert resp.get_json()["result"] == {"status": 1, "data": {"type": "quiz"}}
+
+    resp = client.get(f"/jobs/{job_id}/events")
+    assert resp.mimetype == "text/event-stream"
+    body = resp.get_data(as_text=True)
+    assert body.startswith("event: done\ndata: ")
+
+    assert client.get("/jobs/nope").status_code == 404
+    assert client.post("/jobs", data="x", content_type="text/plain").status_code == 400
+
+
+def test_job_api_queue_full_429(monkeypatch):
+    class FullQueue:
+        def submit(self, data):
+            raise main.QueueFull(7)
+
+    monkeypatch.setattr(main, "get_job_queue", lambda generate: FullQueue())
+    resp = main.app.test_client().post("/jobs", json={"type": "quiz"})
+    assert resp.status_code == 429
+    assert resp.headers["Retry-After"] == "7"
+
+
+def test_generate_quiz_batch_streams_ndjson(monkeypatch):
+    import json
+    import contextlib
+
+    def fake_generate(data, deadline=None):
+        assert 0 < deadline.remaining() <= 3
+        return {"status": 1, "data": {"category": data["category"]}}
+
+    monkeypatch.setattr(main, "_generate", fake_generate)
+    monkeypatch.setitem(main.run_batch.__globals__, "preloaded_candidates", lambda queries: contextlib.nullcontext())
+    client = main.app.test_client()
+
+    items = [
+        {"type": "quiz", "category": "storia", "classe": "primaria", "anno": 3, "difficulty": 2},
+        {"type": "quiz"},
+    ]
+    resp = client.post("/generate_quiz/batch", json=items, headers={"X-Request-Timeout": "3"})
+    assert resp.status_code == 200
+    assert resp.mimetype == "application/x-ndjson"
+    lines = [json.loads(line) for line in resp.get_data(as_text=True).splitlines()]
+    assert {line["index"]: line["status"] for line in lines} == {0: 1, 1: 4}
+
+    resp = client.post("/generate_quiz/batch", json={"type": "quiz"})
+    assert resp.status_code == 400
+
+
+def test_health_and_readiness(monkeypatch):
+    import services.retriever_chain as rc
+
+    client = main.app.test_client()
+    assert client.get("/healthz").get_json()["status"] == "ok"
+
+    resp = client.get("/readyz")
+    assert resp.status_code == 200
+    assert resp.get_json()["checks"] == {"embedder": True, "index": True, "schemas": True}
+
+    monkeypatch.setattr(rc, "collection", None)  # es. indice non riaperto dopo il fork
+    resp = client.get("/readyz")
+    assert resp.status_code == 503
+    assert resp.get_json()["checks"]["index"] is False
+
+    assert "sage_process_memory_bytes" in client.get("/metrics").get_data(as_text=True)
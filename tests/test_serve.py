@@ -0,0 +1,60 @@
+import gc
+import sys
+
+import numpy as np
+import pytest
+
+from src import serve
+from src.services.health import memory_usage
+
+pytestmark = pytest.mark.skipif(not memory_usage(), reason="serve richiede /proc/self/smaps_rollup (Linux)")
+
+
+def test_preload_freezes_loaded_objects(monkeypatch):
+    monkeypatch.setattr(serve, "_preloaded", False)
+    gc.unfreeze()
+    try:
+        serve.preload()
+        assert gc.get_freeze_count() > 0
+        assert gc.isenabled()
+        assert "services.retriever_chain" in sys.modules
+    finally:
+        gc.unfreeze()
+
+
+def test_create_app_exposes_health_routes(monkeypatch):
+    monkeypatch.setattr(serve, "preload", lambda: None)
+    app = serve.create_app("wsgi")
+    client = app.test_client()
+    assert client.get("/healthz").get_json()["status"] == "ok"
+    assert client.get("/readyz").status_code == 200
+
+
+def test_forked_workers_share_preloaded_memory(monkeypatch):
+    """Misura reale: 64 MB caricati nel master restano condivisi (non privati) nei worker."""
+    size = 64 * 2**20
+    shared = np.ones(size, dtype=np.uint8)  # pagine residenti nel master, come i pesi del modello
+    monkeypatch.setattr(serve, "post_fork", lambda workers: None)
+
+    report = serve.measure_workers(3, warmup=lambda: int(shared.sum()))
+
+    assert len(report["workers"]) == 3
+    for usage in report["workers"]:
+        assert usage["rss"] > size  # l'RSS conta anche le pagine condivise...
+        assert usage["uss"] < size / 4  # ...ma il costo proprio del worker è piccolo
+        assert usage["pss"] < usage["rss"]
+
+
+def test_gunicorn_post_fork_uses_effective_worker_count(monkeypatch):
+    import runpy
+    import types
+    from pathlib import Path
+
+    calls = []
+    monkeypatch.setitem(sys.modules, "serve", types.SimpleNamespace(post_fork=calls.append))
+    conf = runpy.run_path(str(Path(serve.__file__).with_name("gunicorn.conf.py")))
+
+    # -w 6 da riga di comando: vale quello, non il default del file di configurazione
+    server = types.SimpleNamespace(cfg=types.SimpleNamespace(workers=6))
+    conf["post_fork"](server, worker=None)
+    assert calls == [6]
@@ -0,0 +1,74 @@
+import json
+import os
+
+from src.validators import validator_schemas
+from src.validators.schema_registry import SchemaRegistry
+
+
+def write_schema(directory, quiz_type, required):
+    schema = {
+        "type": "object",
+        "properties": {"type": {"const": quiz_type}},
+        "required": required,
+    }
+    path = directory / f"{quiz_type}_schema.json"
+    path.write_text(json.dumps(schema), encoding="utf-8")
+    return path
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_compiles_one_validator_per_type(tmp_path):
+    write_schema(tmp_path, "quiz", ["type"])
+    write_schema(tmp_path, "sorting", ["type", "items"])
+    (tmp_path / "notes.json").write_text("{}", encoding="utf-8")
+
+    registry = SchemaRegistry(str(tmp_path))
+    assert registry.types() == ["quiz", "sorting"]
+    assert registry.get("quiz") is registry.get("quiz")  # compilato una volta
+    assert registry.get("memory") is None
+    assert not registry.get("sorting").is_valid({"type": "sorting"})
+
+
+def test_reloads_when_files_change(tmp_path):
+    clock = FakeClock()
+    path = write_schema(tmp_path, "quiz", ["type"])
+    registry = SchemaRegistry(str(tmp_path), check_interval=1.0, clock=clock)
+    assert registry.get("quiz").is_valid({"type": "quiz"})
+
+    write_schema(tmp_path, "quiz", ["type", "answer"])
+    os.utime(path, ns=(1, 1))  # mtime diverso anche su filesystem a bassa risoluzione
+    # entro l'intervallo non si ricontrolla il disco
+    assert registry.get("quiz").is_valid({"type": "quiz"})
+
+    clock.now = 2.0
+    assert not registry.get("quiz").is_valid({"type": "quiz"})
+
+    write_schema(tmp_path, "memory", ["type"])
+    clock.now = 4.0
+    assert registry.get("memory") is not None
+
+
+def test_broken_schema_keeps_previous_validators(tmp_path):
+    clock = FakeClock()
+    path = write_schema(tmp_path, "quiz", ["type"])
+    registry = SchemaRegistry(str(tmp_path), check_interval=0, clock=clock)
+
+    path.write_text("{ non json", encoding="utf-8")
+    assert registry.get("quiz").is_valid({"type": "quiz"})
+
+
+def test_real_schemas_and_micro_benchmark():
+    registry = validator_schemas.get_registry()
+    assert registry.types() == ["matching", "memory", "quiz", "sorting"]
+
+    report = validator_schemas.benchmark(iterations=20)
+    assert set(report) == set(registry.types())
+    for row in report.values():
+        assert row["compiled_us"] > 0 and row["uncompiled_us"] > 0
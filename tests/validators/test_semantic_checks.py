@@ -0,0 +1,62 @@
+import pytest
+
+from src.validators import validator_schemas
+from src.validators.semantic_checks import check_semantics
+
+
+def quiz(**extra):
+    data = {"type": "quiz", "category": "storia", "question": "Chi fondò Roma?", "difficulty": 3,
+            "options": ["Romolo", "Remo"], "answer": "Romolo"}
+    data.update(extra)
+    return data
+
+
+def sorting(**extra):
+    data = {"type": "sorting", "category": "storia", "question": "Ordina", "difficulty": 3,
+            "items": ["b", "c", "a"], "solution": ["a", "b", "c"]}
+    data.update(extra)
+    return data
+
+
+@pytest.mark.parametrize("data", [
+    quiz(),
+    quiz(answer=" romolo "),  # confronto senza spazi e maiuscole
+    sorting(),
+    {"type": "matching", "question": "Abbina", "pairs": [{"left": "a", "right": "1"}, {"left": "b", "right": "2"}]},
+    {"type": "memory", "question": "Coppie", "pairs": [{"front": "H2O", "back": "Acqua"}, {"front": "NaCl", "back": "Sale"}]},
+])
+def test_valid_semantics(data):
+    assert check_semantics(data) is None
+
+
+@pytest.mark.parametrize("data, message", [
+    (quiz(answer="Numa"), "non è tra le opzioni"),
+    (quiz(options=["Romolo", "romolo "]), "Opzione ripetuta"),
+    (quiz(question="  "), "Domanda vuota"),
+    (sorting(solution=["a", "b"]), "permutazione"),
+    (sorting(solution=["a", "b", "d"]), "permutazione"),
+    (sorting(items=["a", "a", "b"], solution=["a", "a", "b"]), "Elemento ripetuto"),
+    ({"type": "matching", "pairs": [{"left": "a", "right": "1"}, {"left": "b", "right": "1"}]}, "'right' ripetuto"),
+    ({"type": "memory", "pairs": [{"front": "x", "back": "X"}, {"front": "y", "back": "z"}]}, "lati uguali"),
+    ({"type": "memory", "pairs": [{"front": "x", "back": "1"}, {"front": "x", "back": "2"}]}, "Carta ripetuta"),
+])
+def test_invalid_semantics(data, message):
+    assert message in check_semantics(data)
+
+
+def test_validate_quiz_data_runs_semantic_checks_after_schema():
+    assert validator_schemas.validate_quiz_data(quiz()) == (True, None)
+
+    valid, error = validator_schemas.validate_quiz_data(quiz(answer="Numa"))
+    assert valid is False and "opzioni" in error
+
+    # errori di schema hanno la precedenza
+    data = quiz()
+    del data["options"]
+    valid, error = validator_schemas.validate_quiz_data(data)
+    assert valid is False and "options" in error
+
+
+def test_validate_quiz_data_unknown_or_missing_type():
+    assert validator_schemas.validate_quiz_data({"type": "puzzle"})[0] is False
+    assert validator_schemas.validate_quiz_data({})[0] is False